@@ -0,0 +1,128 @@
+"""
+Бенчмарк скачивания альбома из 10 фото: последовательный bot.download против MediaFetcher
+(с холодным и тёплым кешем файлов).
+
+Telegram эмулируется фейковым ботом с задержкой get_file и отдачей файла чанками,
+поэтому скрипт запускается без токена и сети:
+
+    python -m benchmarks.album_download
+"""
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.file_cache import TelegramFileCache  # noqa: E402
+from utils.media_fetcher import MediaFetcher  # noqa: E402
+
+ALBUM_SIZE = 10
+PHOTO_SIZE = 1_500_000            # ~1.5 МБ — типичное фото с телефона после сжатия Telegram
+CHUNK_SIZE = 65536
+GET_FILE_LATENCY = 0.08           # round-trip до Bot API
+BANDWIDTH = 20_000_000            # байт/с на одну загрузку
+RUNS = 5
+
+
+class _Photo:
+    def __init__(self, idx: int):
+        self.file_id = f"file_{idx}"
+        self.file_unique_id = f"unique_{idx}"
+        self.file_size = PHOTO_SIZE
+
+
+class _File:
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+        self.file_unique_id = file_id.replace("file_", "unique_")
+        self.file_path = f"photos/{file_id}.jpg"
+        self.file_size = PHOTO_SIZE
+
+
+class FakeBot:
+    """Повторяет контракт aiogram Bot.get_file / download_file / download"""
+
+    id = 1
+
+    def __init__(self):
+        self._payload = os.urandom(PHOTO_SIZE)
+        self.network_requests = 0
+
+    async def get_file(self, file_id: str) -> _File:
+        self.network_requests += 1
+        await asyncio.sleep(GET_FILE_LATENCY)
+        return _File(file_id)
+
+    async def download_file(self, file_path, destination=None, timeout=30, chunk_size=CHUNK_SIZE, seek=True):
+        self.network_requests += 1
+        for start in range(0, PHOTO_SIZE, chunk_size):
+            chunk = self._payload[start:start + chunk_size]
+            await asyncio.sleep(len(chunk) / BANDWIDTH)
+            destination.write(chunk)
+            destination.flush()
+        if seek:
+            destination.seek(0)
+        return destination
+
+    async def download(self, file, destination=None, timeout=30, chunk_size=CHUNK_SIZE, seek=True):
+        file_id = file if isinstance(file, str) else file.file_id
+        f = await self.get_file(file_id)
+        return await self.download_file(f.file_path, destination=destination, timeout=timeout,
+                                        chunk_size=chunk_size, seek=seek)
+
+
+async def sequential(bot: FakeBot, photos: list[_Photo]) -> list[bytes]:
+    result = []
+    for photo in photos:
+        buf = io.BytesIO()
+        await bot.download(photo, destination=buf)
+        result.append(buf.getvalue())
+    return result
+
+
+async def parallel(bot: FakeBot, photos: list[_Photo]) -> list[bytes]:
+    # свежий кеш на каждый прогон — меряем именно сеть, а не попадания
+    return await MediaFetcher(cache=TelegramFileCache(disk_dir=None)).fetch_many(bot, photos)
+
+
+_warm_fetcher: MediaFetcher | None = None
+
+
+async def parallel_cached(bot: FakeBot, photos: list[_Photo]) -> list[bytes]:
+    """Повторная работа с тем же альбомом (правка уже присланных фото)"""
+    global _warm_fetcher
+    if _warm_fetcher is None:
+        _warm_fetcher = MediaFetcher(cache=TelegramFileCache(disk_dir=None))
+        await _warm_fetcher.fetch_many(bot, photos)
+    return await _warm_fetcher.fetch_many(bot, [p.file_id for p in photos])
+
+
+async def measure(fn, bot: FakeBot, photos: list[_Photo]) -> list[float]:
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        data = await fn(bot, photos)
+        timings.append(time.perf_counter() - started)
+        assert len(data) == len(photos) and all(len(d) == PHOTO_SIZE for d in data)
+    return timings
+
+
+async def main():
+    bot = FakeBot()
+    photos = [_Photo(i) for i in range(ALBUM_SIZE)]
+    print(f"Альбом: {ALBUM_SIZE} фото по {PHOTO_SIZE / 1e6:.1f} МБ, прогонов: {RUNS}")
+    for name, fn in (("sequential bot.download", sequential), ("MediaFetcher.fetch_many", parallel),
+                     ("repeat, warm file cache", parallel_cached)):
+        if fn is parallel_cached:
+            await parallel_cached(bot, photos)
+        bot.network_requests = 0
+        timings = await measure(fn, bot, photos)
+        print(f"{name:<26} median {statistics.median(timings) * 1000:8.1f} ms   "
+              f"min {min(timings) * 1000:8.1f} ms   requests/run {bot.network_requests / RUNS:.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+"""
+Бенчмарк памяти на альбом из 10 фото: пиковый RSS от скачивания до готового контента для модели
+(data URL каждой картинки, как в build_user_content_for_chat).
+
+    bytesio       — как было: bytes из MediaFetcher → io.BytesIO → getbuffer() (копия разделяемого
+                    буфера) → bytes(memoryview) для пула процессов (ещё копия)
+    media_buffer  — MediaBuffer: те же bytes из кеша файлов идут в пул как есть, data URL запоминается
+                    в буфере целиком (одна строка base64, а не две)
+
+Каждый вариант прогоняется в отдельном процессе (ru_maxrss — пик за всю жизнь процесса), считается
+прирост пика над состоянием после подготовки. Telegram эмулируется фейковым ботом — токен и сеть не нужны:
+
+    python -m benchmarks.album_memory
+"""
+import asyncio
+import gc
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from utils.file_cache import TelegramFileCache  # noqa: E402
+from utils.image_processing import ImageProcessor, encode_data_url  # noqa: E402
+from utils.media_fetcher import MediaFetcher  # noqa: E402
+
+ALBUM_SIZE = 10
+PHOTO_SIZE = (1920, 1440)         # влезает в лимит OpenAI — картинка уходит без перекодирования
+CHUNK_SIZE = 65536
+RUNS = 5
+
+
+def make_photo() -> bytes:
+    # шум сжимается плохо — размер близок к реальному фото (~2 МБ)
+    noise = Image.effect_noise(PHOTO_SIZE, 64).convert("RGB")
+    buf = io.BytesIO()
+    noise.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class _Photo:
+    def __init__(self, idx: int, size: int):
+        self.file_id = f"file_{idx}"
+        self.file_unique_id = f"unique_{idx}"
+        self.file_size = size
+
+
+class _File:
+    def __init__(self, file_id: str, size: int):
+        self.file_id = file_id
+        self.file_unique_id = file_id.replace("file_", "unique_")
+        self.file_path = f"photos/{file_id}.jpg"
+        self.file_size = size
+
+
+class FakeBot:
+    """Повторяет контракт aiogram Bot.get_file / download_file без задержек сети"""
+
+    id = 1
+
+    def __init__(self, payload: bytes):
+        self._payload = payload
+
+    async def get_file(self, file_id: str) -> _File:
+        return _File(file_id, len(self._payload))
+
+    async def download_file(self, file_path, destination=None, timeout=30, chunk_size=CHUNK_SIZE, seek=True):
+        view = memoryview(self._payload)
+        for start in range(0, len(view), chunk_size):
+            destination.write(view[start:start + chunk_size])
+            await asyncio.sleep(0)
+        if seek:
+            destination.seek(0)
+        return destination
+
+
+async def bytesio(fetcher: MediaFetcher, processor: ImageProcessor, bot: FakeBot, photos: list[_Photo]) -> list[str]:
+    buffers = [io.BytesIO(raw) for raw in await fetcher.fetch_many(bot, photos)]
+    return await asyncio.gather(*(processor.to_data_url(b.getbuffer(), "openai") for b in buffers))
+
+
+async def media_buffer(fetcher: MediaFetcher, processor: ImageProcessor, bot: FakeBot,
+                       photos: list[_Photo]) -> list[str]:
+    buffers = await fetcher.fetch_many_media(bot, photos)
+    return await asyncio.gather(*(processor.to_data_url(b, "openai") for b in buffers))
+
+
+VARIANTS = {"bytesio": bytesio, "media_buffer": media_buffer}
+
+
+async def run_variant(name: str, photo_path: str) -> dict:
+    with open(photo_path, "rb") as f:
+        payload = f.read()
+    bot = FakeBot(payload)
+    processor = ImageProcessor(workers=2)
+    await processor._run(encode_data_url, b"", "image/jpeg")         # пул поднимается до замера
+    fetcher = MediaFetcher(cache=TelegramFileCache(disk_dir=None))
+    photos = [_Photo(i, len(payload)) for i in range(ALBUM_SIZE)]
+    gc.collect()
+    baseline = peak_rss_mb()
+    content = await VARIANTS[name](fetcher, processor, bot, photos)
+    peak = peak_rss_mb()
+    assert len(content) == ALBUM_SIZE and all(url.startswith("data:image/jpeg;base64,") for url in content)
+    processor.shutdown()
+    return {"peak_mb": peak - baseline}
+
+
+def main():
+    photo = make_photo()
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        f.write(photo)
+    try:
+        print(f"Альбом: {ALBUM_SIZE} фото по {len(photo) / 1e6:.1f} МБ, прогонов: {RUNS}")
+        for name in VARIANTS:
+            peaks = []
+            for _ in range(RUNS):
+                out = subprocess.run([sys.executable, "-m", "benchmarks.album_memory", name, f.name],
+                                     capture_output=True, text=True, check=True,
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+                peaks.append(json.loads(out.stdout.strip().splitlines()[-1])["peak_mb"])
+            print(f"{name:<14} peak RSS +{statistics.median(peaks):6.1f} МБ на альбом   "
+                  f"(min {min(peaks):6.1f}, max {max(peaks):6.1f})")
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print(json.dumps(asyncio.run(run_variant(sys.argv[1], sys.argv[2]))))
+    else:
+        main()
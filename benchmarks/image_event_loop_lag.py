@@ -0,0 +1,93 @@
+"""
+Бенчмарк задержки event loop при одновременной обработке фото с телефона:
+нормализация прямо в loop (как было) против ImageProcessor с пулом процессов.
+
+Пока идёт обработка, тикер каждые 10 мс замеряет, насколько позже он просыпается —
+это та задержка, которую в этот момент получают все остальные пользователи бота.
+
+    python -m benchmarks.image_event_loop_lag
+"""
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from utils.image_processing import (  # noqa: E402
+    ImageProcessor, PROVIDER_MAX_SIDE, normalize_image_to_data_url, prepare_runway_ref_data_uri,
+)
+
+PHOTOS = 8                        # одновременных загрузок
+PHOTO_SIZE = (4032, 3024)         # 12 Мп — типичная камера смартфона
+TICK = 0.01
+
+
+def make_photo(seed: int) -> bytes:
+    # шум сжимается плохо — размер и время декодирования близки к реальному фото
+    noise = Image.effect_noise(PHOTO_SIZE, 64 + seed).convert("RGB")
+    buf = io.BytesIO()
+    noise.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+async def ticker(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def inline(photos: list[bytes]) -> None:
+    async def one(data: bytes) -> None:
+        await asyncio.sleep(0)
+        normalize_image_to_data_url(data, PROVIDER_MAX_SIDE["openai"])
+        prepare_runway_ref_data_uri(data)
+    await asyncio.gather(*(one(p) for p in photos))
+
+
+async def pooled(processor: ImageProcessor, photos: list[bytes]) -> None:
+    views = [memoryview(p) for p in photos]
+    await asyncio.gather(processor.to_data_urls(views, "openai"), processor.runway_ref_data_uris(views))
+
+
+async def measure(coro_factory) -> tuple[float, list[float]]:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    tick_task = asyncio.create_task(ticker(lags, stop))
+    await asyncio.sleep(TICK * 3)
+    started = time.perf_counter()
+    await coro_factory()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick_task
+    return elapsed, lags
+
+
+def report(name: str, elapsed: float, lags: list[float]) -> None:
+    lags_ms = sorted(l * 1000 for l in lags) or [0.0]
+    p99 = lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))]
+    print(f"{name:<22} total {elapsed * 1000:8.1f} ms   lag median {statistics.median(lags_ms):7.1f} ms   "
+          f"p99 {p99:7.1f} ms   max {lags_ms[-1]:7.1f} ms")
+
+
+async def main():
+    photos = [make_photo(i) for i in range(PHOTOS)]
+    print(f"{PHOTOS} фото {PHOTO_SIZE[0]}x{PHOTO_SIZE[1]}, ~{len(photos[0]) / 1e6:.1f} МБ каждое; "
+          f"CPU: {os.cpu_count()}")
+
+    report("inline (event loop)", *await measure(lambda: inline(photos)))
+
+    processor = ImageProcessor()
+    # прогрев: запуск процессов не должен попадать в замер
+    await processor.to_data_url(photos[0], "openai")
+    report("ImageProcessor pool", *await measure(lambda: pooled(processor, photos)))
+    processor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""
+Бенчмарк LLMRouter на локальных заглушках OpenAI-совместимого API (aiohttp, без внешней сети).
+
+Заглушка «flaky» быстрая, но с хвостом медленных ответов и окном полного отказа (503),
+«steady» — медленнее, зато ровная. Сравниваем:
+  * single — только flaky, как сейчас с одним neuroapi (SDK сам повторяет запрос);
+  * router — flaky + steady через LLMRouter (выбор по p95, failover, хеджирование, автоматы защиты).
+
+    python -m benchmarks.llm_router_failover
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.llm_stand_in import StandInServer  # noqa: E402
+from utils.llm_router import LLMBackendConfig, LLMRouter  # noqa: E402
+
+REQUESTS = 400
+CONCURRENCY = 20
+OUTAGE = (3.0, 7.0)               # секунды от старта прогона, когда flaky отвечает 503
+
+
+async def run(label: str, router: LLMRouter, servers: list[StandInServer]) -> None:
+    for server in servers:
+        server.reset()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await router.chat.completions.create(model="gpt-5-mini",
+                                                     messages=[{"role": "user", "content": f"вопрос {i}"}])
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(REQUESTS)))
+    total = time.perf_counter() - started
+    latencies.sort()
+    p50 = statistics.median(latencies) if latencies else 0
+    p95 = latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0
+    p99 = latencies[int(0.99 * (len(latencies) - 1))] if latencies else 0
+    hits = ", ".join(f"{s.name}={s.hits}" for s in servers)
+    print(f"{label:<7} {total:6.1f} s   p50 {p50 * 1000:6.0f} ms   p95 {p95 * 1000:6.0f} ms   "
+          f"p99 {p99 * 1000:6.0f} ms   ошибок {errors:3d}/{REQUESTS}   запросов к серверам: {hits}")
+    print(f"        {router.snapshot()}")
+
+
+async def main():
+    random.seed(1)
+    flaky = StandInServer("flaky", latency=0.15, tail_share=0.04, tail_latency=4.0, outage=OUTAGE)
+    steady = StandInServer("steady", latency=0.35)
+    await flaky.start()
+    await steady.start()
+    print(f"{REQUESTS} запросов, параллельно {CONCURRENCY}; flaky отказывает с {OUTAGE[0]:.0f} по {OUTAGE[1]:.0f} с")
+    try:
+        single = LLMRouter([LLMBackendConfig("flaky", flaky.url, "bench")])
+        await run("single", single, [flaky])
+        router = LLMRouter([LLMBackendConfig("flaky", flaky.url, "bench"),
+                            LLMBackendConfig("steady", steady.url, "bench")])
+        await run("router", router, [flaky, steady])
+    finally:
+        await flaky.stop()
+        await steady.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""
+Микробенчмарк сборки запроса к Chat Completions на каждый send_message:
+как было (tools конвертируются заново, system_prompt склеивается с блоком времени,
+день недели через pytz, для ключа схлопывания сериализуются и tools)
+против PromptAssembler (статичный префикс и tools собраны один раз, отпечаток tools готов).
+
+Кроме времени показывает, сколько символов в начале запроса совпадает у двух запросов подряд —
+именно этот префикс может взять из кеша провайдер.
+
+system_prompt и tools берутся из settings.py без его импорта (через ast), так что бенчмарку
+не нужны зависимости бота.
+
+    python -m benchmarks.prompt_build
+"""
+import ast
+import hashlib
+import json
+import os
+import sys
+import time
+import timeit
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.prompt_assembly import MSK, PromptAssembler, _tools_for_chat_completions  # noqa: E402
+
+ROUNDS = 20_000
+HISTORY = [
+    {"role": "user" if i % 2 == 0 else "assistant", "content": f"сообщение {i} " + "текст " * 40}
+    for i in range(20)
+]
+ABOUT_USER = "Меня зовут Анна, я дизайнер, пишу на русском, люблю короткие ответы."
+
+
+def load_settings_literals() -> tuple[str, list[dict]]:
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "settings.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    found = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) in ("system_prompt", "tools"):
+            found[node.targets[0].id] = ast.literal_eval(node.value)
+    return found["system_prompt"], found["tools"]
+
+
+def completion_key(messages, tools) -> str:
+    payload = json.dumps(["gpt-5-mini", messages, tools, {"parallel_tool_calls": True}],
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8", "surrogatepass"), digest_size=20).hexdigest()
+
+
+def legacy_weekday() -> str:
+    import pytz
+    moscow_now = datetime.utcnow().replace(tzinfo=pytz.UTC).astimezone(pytz.timezone("Europe/Moscow"))
+    return ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"][moscow_now.weekday()]
+
+
+def legacy_build(system_prompt: str, tools: list[dict]):
+    system_text = (
+        "ВАЖНАЯ ИНФОРМАЦИЯ О ВРЕМЕНИ:\n"
+        f"Текущие дата и время в Москве: {datetime.now(timezone.utc).astimezone(MSK):%Y-%m-%d %H:%M:%S}\n"
+        f"Сегодня {legacy_weekday()}\n"
+        "ВСЕ уведомления и напоминания должны устанавливаться в московском времени!\n"
+        "Примеры относительных дат:\n"
+        "- 'завтра' = следующий день после сегодняшнего\n"
+        "- 'послезавтра' = через два дня\n"
+        "- 'на следующей неделе в понедельник' = ближайший понедельник после текущей недели\n"
+        "- 'через 30 минут' = добавить 30 минут к текущему времени\n\n"
+    )
+    system_text += f"Информация о пользователе:\n{ABOUT_USER}\n\n"
+    messages = [{"role": "system", "content": system_prompt + "\n\n" + system_text}] + HISTORY
+    tools_payload = _tools_for_chat_completions(tools)
+    return messages, tools_payload, completion_key(messages, tools_payload)
+
+
+def assembled_build(assembler: PromptAssembler):
+    messages = assembler.build_messages(HISTORY, ABOUT_USER)
+    return messages, assembler.tools_payload, completion_key(messages, assembler.tools_digest)
+
+
+def shared_prefix(first: list[dict], second: list[dict]) -> int:
+    a = json.dumps(first, ensure_ascii=False)
+    b = json.dumps(second, ensure_ascii=False)
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def main():
+    system_prompt, tools = load_settings_literals()
+    assembler = PromptAssembler(system_prompt, tools)
+    assembler.tools_payload  # компиляция — один раз при старте
+
+    for label, fn in (("было", lambda: legacy_build(system_prompt, tools)),
+                      ("стало", lambda: assembled_build(assembler))):
+        per_call = min(timeit.repeat(fn, number=ROUNDS, repeat=3)) / ROUNDS
+        first = fn()[0]
+        time.sleep(1.1)    # время в промпте сменится, как у двух реальных запросов подряд
+        second = fn()[0]
+        total = len(json.dumps(second, ensure_ascii=False))
+        prefix = shared_prefix(first, second)
+        print(f"{label:<6} {per_call * 1e6:7.1f} мкс на сборку   "
+              f"общий префикс двух запросов {prefix:6d} из {total} символов ({prefix / total:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,11 @@ from datetime import datetime as dt
 
 from settings import (
     storage_bot, main_bot_token, set_current_bot, set_current_assistant, 
-    initialize_logger, set_current_loop, logger
+    initialize_logger, set_current_loop, logger, on_shutdown
 )
 from utils.schedulers import send_notif, safe_send_notif, job_error_listener, scheduler, monitor_scheduler, \
-    scheduler_paused_listener, scheduler_shutdown_listener, safe_extend_users_sub
+    scheduler_paused_listener, scheduler_shutdown_listener, safe_extend_users_sub, log_runtime_stats, \
+    safe_prune_caches
 
 main_bot = Bot(token=main_bot_token,
                default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -28,8 +29,9 @@ main_bot = Bot(token=main_bot_token,
 
 async def main():
     set_current_bot(main_bot)
-    from utils.completions_gpt_tools import GPTCompletions
-    set_current_assistant(assistant=GPTCompletions())
+    # бэкенд выбирается на пользователя: ASSISTANT_BACKEND / ASSISTANT_BACKEND_SPLIT / ASSISTANT_BACKEND_USERS
+    from utils.assistant_backends import assistant_router
+    set_current_assistant(assistant=assistant_router)
     set_current_loop(asyncio.get_running_loop())
     
     # Инициализируем logger с настройками для основного бота
@@ -44,6 +46,7 @@ async def main():
     from utils.message_throttling import CombinedMiddleware
     dp.message.middleware.register(CombinedMiddleware())
     dp.include_routers(try_on_router, payment_router, standard_router)
+    dp.shutdown.register(on_shutdown)
 
     scheduler = AsyncIOScheduler()
     # заменяем send_notif на safe_send_notif
@@ -70,6 +73,24 @@ async def main():
     )
 
 
+    # Сводка по кешам - раз в час
+    scheduler.add_job(
+        func=log_runtime_stats,
+        trigger="interval",
+        hours=1,
+        max_instances=1,
+        coalesce=True,
+    )
+
+    # Чистка устаревших записей кешей - раз в сутки
+    scheduler.add_job(
+        func=safe_prune_caches,
+        trigger="interval",
+        hours=24,
+        max_instances=1,
+        coalesce=True,
+    )
+
     # Листенер ошибок в задачах
     scheduler.add_listener(job_error_listener, EVENT_JOB_ERROR)
     scheduler.add_listener(scheduler_shutdown_listener, EVENT_SCHEDULER_SHUTDOWN)
@@ -121,7 +142,11 @@ async def main():
         # 4. Даем секунду «на отлёт» всем оставшимся корутинам, если нужно
         await asyncio.sleep(1)
 
-        # 5. Закрываем хранилище и сессию
+        # 5. Досылаем дайджест алертов и очередь исходящих сообщений, закрываем хранилище и сессию
+        from utils.admin_alerts import admin_alerts
+        await admin_alerts.flush()
+        from utils.telegram_sender import close_senders
+        await close_senders()
         await storage_bot.close()
         await main_bot.session.close()
 
@@ -6,13 +6,30 @@ from typing import Union, Any
 from .configuration import DatabaseConfig
 from .base import BaseModel
 import sqlalchemy.ext.asyncio  # type: ignore
-from sqlalchemy import MetaData  # type: ignore
+from sqlalchemy import MetaData, text  # type: ignore
 from sqlalchemy.engine import URL  # type: ignore
 from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine, \
     create_async_engine as _create_async_engine  # type: ignore
 from sqlalchemy.orm import sessionmaker  # type: ignore
 
 
+# create_all не добавляет индексы к уже существующим таблицам — докатываем их сами.
+# Перед уникальным индексом чистим дубли, которые могли накопиться до его появления.
+_POST_CREATE_DDL = (
+    """
+    DO $$
+    BEGIN
+        IF to_regclass('ux_promo_activations_promo_user') IS NULL THEN
+            DELETE FROM promo_activations a
+            USING promo_activations b
+            WHERE a.promo_id = b.promo_id AND a.activate_user_id = b.activate_user_id AND a.id > b.id;
+            CREATE UNIQUE INDEX ux_promo_activations_promo_user ON promo_activations (promo_id, activate_user_id);
+        END IF;
+    END $$;
+    """,
+)
+
+
 class DatabaseEngine:
 
     def __create_async_engine(self, url: Union[URL, str]) -> AsyncEngine:
@@ -22,6 +39,8 @@ class DatabaseEngine:
     async def __proceed_schemas(self, engine: AsyncEngine, metadata: MetaData) -> None:
         async with engine.begin() as conn:
             await conn.run_sync(metadata.create_all)
+            for ddl in _POST_CREATE_DDL:
+                await conn.execute(text(ddl))
 
     def __get_session_maker(self, engine: AsyncEngine) -> sessionmaker:
         return sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
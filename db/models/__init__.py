@@ -11,6 +11,10 @@ from .type_subscriptions import TypeSubscriptions
 from .users import Users
 from .referral_system import ReferralSystem
 from .promo_activations import PromoActivations
+from .vector_store_files import VectorStoreFiles
+from .openai_files import OpenAIFiles
+from .voice_transcriptions import VoiceTranscriptions
+from .telegram_media import TelegramMedia
 
 
 __all__ = ['Users',
@@ -25,5 +29,9 @@ __all__ = ['Users',
            'Events',
            'TypeSubscriptions',
            'GenerationsPackets',
-           'DialogsMessages'
+           'DialogsMessages',
+           'VectorStoreFiles',
+           'OpenAIFiles',
+           'VoiceTranscriptions',
+           'TelegramMedia'
            ]
\ No newline at end of file
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, String, DateTime, Index
+
+from db.base import BaseModel, CleanModel
+
+
+class OpenAIFiles(BaseModel, CleanModel):
+    """Уже загруженные в OpenAI Files API файлы: хеш содержимого → file_id"""
+    __tablename__ = 'openai_files'
+
+    content_hash = Column(String, nullable=False)
+    purpose = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=True)        # срок жизни файла на стороне OpenAI, если задан
+    verified_at = Column(DateTime, nullable=False)      # когда последний раз убеждались, что файл ещё существует
+
+    __table_args__ = (
+        Index('ux_openai_files_hash_purpose', 'content_hash', 'purpose', unique=True),
+    )
+
+    def __str__(self) -> str:
+        return f"<{self.__tablename__}:{self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
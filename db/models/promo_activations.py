@@ -1,4 +1,4 @@
-from sqlalchemy import Column, BigInteger, ForeignKey, String, Boolean
+from sqlalchemy import Column, BigInteger, ForeignKey, String, Boolean, Index
 from sqlalchemy.orm import relationship, Mapped
 
 from db.base import BaseModel, CleanModel
@@ -12,6 +12,11 @@ class PromoActivations(BaseModel, CleanModel):
     promo_id = Column(BigInteger, ForeignKey('referral_system.id'), primary_key=True, unique=False)
     activate_user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False, unique=False)
 
+    # один пользователь — одна активация промокода; на этот индекс опирается ON CONFLICT в activate_promo
+    __table_args__ = (
+        Index('ux_promo_activations_promo_user', 'promo_id', 'activate_user_id', unique=True),
+    )
+
     @property
     def stats(self) -> str:
         """
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, BigInteger, String, Index
+
+from db.base import BaseModel, CleanModel
+
+
+class TelegramMedia(BaseModel, CleanModel):
+    """Реестр уже загруженных в Telegram файлов: ключ медиа (хеш содержимого, URL, статичная картинка) → file_id"""
+    __tablename__ = 'telegram_media'
+
+    bot_id = Column(BigInteger, nullable=False)         # file_id действителен только для бота, который его получил
+    media_key = Column(String, nullable=False)          # "sha256:…", "url:…", "static:…", "tts:…"
+    kind = Column(String, nullable=False)               # photo / document / video / voice
+    file_id = Column(String, nullable=False)
+    file_unique_id = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('ux_telegram_media_bot_key', 'bot_id', 'media_key', unique=True),
+    )
+
+    def __str__(self) -> str:
+        return f"<{self.__tablename__}:{self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,26 @@
+from sqlalchemy import Column, BigInteger, ForeignKey, String, Index
+
+from db.base import BaseModel, CleanModel
+
+
+class VectorStoreFiles(BaseModel, CleanModel):
+    """Манифест vector store: какие файлы (и с каким содержимым) уже лежат в хранилище пользователя"""
+    __tablename__ = 'vector_store_files'
+
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False)
+    scope = Column(String, nullable=False)              # thread_id для Assistants, "responses" для Responses API
+    vector_store_id = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    content_hash = Column(String, nullable=True)        # None — файл достался от хранилища, созданного до манифеста
+    file_name = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('ix_vector_store_files_user_scope', 'user_id', 'scope'),
+        Index('ux_vector_store_files_store_file', 'vector_store_id', 'file_id', unique=True),
+    )
+
+    def __str__(self) -> str:
+        return f"<{self.__tablename__}:{self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
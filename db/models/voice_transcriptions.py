@@ -0,0 +1,25 @@
+from sqlalchemy import Column, String, Integer, Text, DateTime, Index
+
+from db.base import BaseModel, CleanModel
+
+
+class VoiceTranscriptions(BaseModel, CleanModel):
+    """Расшифровки голосовых: file_unique_id Telegram + язык → текст (пересланное голосовое не распознаём заново)"""
+    __tablename__ = 'voice_transcriptions'
+
+    file_unique_id = Column(String, nullable=False)
+    language = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+    duration = Column(Integer, nullable=True)           # длительность голосового, сек
+    last_used_at = Column(DateTime, nullable=False)     # по нему чистим давно не нужные расшифровки
+
+    __table_args__ = (
+        Index('ux_voice_transcriptions_file_language', 'file_unique_id', 'language', unique=True),
+        Index('ix_voice_transcriptions_last_used_at', 'last_used_at'),
+    )
+
+    def __str__(self) -> str:
+        return f"<{self.__tablename__}:{self.id}>"
+
+    def __repr__(self):
+        return self.__str__()
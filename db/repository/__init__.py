@@ -10,6 +10,10 @@ from .type_subscriptions_repository import TypeSubscriptionsRepository
 from .users_repo import UserRepository
 from .refferal_repo import ReferralSystemRepository
 from .promo_activations_repo import PromoActivationsRepository
+from .vector_store_files_repo import VectorStoreFilesRepository
+from .openai_files_repo import OpenAIFilesRepository
+from .voice_transcriptions_repo import VoiceTranscriptionsRepository
+from .telegram_media_repo import TelegramMediaRepository
 
 users_repository = UserRepository()
 admin_repository = AdminRepository()
@@ -23,6 +27,10 @@ operation_repository = OperationRepository()
 type_subscriptions_repository = TypeSubscriptionsRepository()
 generations_packets_repository = GenerationsPacketsRepository()
 dialogs_messages_repository = DialogsMessagesRepository()
+vector_store_files_repository = VectorStoreFilesRepository()
+openai_files_repository = OpenAIFilesRepository()
+voice_transcriptions_repository = VoiceTranscriptionsRepository()
+telegram_media_repository = TelegramMediaRepository()
 
 __all__ = ['users_repository',
            'admin_repository',
@@ -36,4 +44,8 @@ __all__ = ['users_repository',
            'type_subscriptions_repository',
            'generations_packets_repository',
            'dialogs_messages_repository',
+           'vector_store_files_repository',
+           'openai_files_repository',
+           'voice_transcriptions_repository',
+           'telegram_media_repository',
           ]
\ No newline at end of file
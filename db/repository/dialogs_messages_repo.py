@@ -28,6 +28,18 @@ class DialogsMessagesRepository:
                     return False
                 return True
 
+    async def add_messages(self, user_id: int, messages: Sequence[Any]):
+        """
+        Добавление нескольких сообщений одной транзакцией (один INSERT на всю пачку).
+        """
+        if not messages:
+            return True
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                session.add_all([DialogsMessages(user_id=user_id, message=message) for message in messages])
+                return True
+
     async def get_messages_by_user_id(self, user_id: int) -> Sequence[DialogsMessages]:
         """
         Получение всех сообщений для пользователя по его ID.
@@ -35,7 +47,7 @@ class DialogsMessagesRepository:
         async with self.session_maker() as session:
             session: AsyncSession
             async with session.begin():
-                sql = select(DialogsMessages).where(or_(DialogsMessages.user_id == user_id)).order_by(asc(DialogsMessages.creation_date))
+                sql = select(DialogsMessages).where(or_(DialogsMessages.user_id == user_id)).order_by(asc(DialogsMessages.creation_date), asc(DialogsMessages.id))
                 query = await session.execute(sql)
                 return query.scalars().all()
 
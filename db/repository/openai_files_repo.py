@@ -0,0 +1,57 @@
+import datetime
+
+from sqlalchemy import select, update, delete, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.engine import DatabaseEngine
+from db.models import OpenAIFiles
+
+
+class OpenAIFilesRepository:
+    def __init__(self):
+        self.session_maker = DatabaseEngine().create_session()
+
+    async def get_file(self, content_hash: str, purpose: str) -> OpenAIFiles | None:
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                sql = select(OpenAIFiles).where(and_(OpenAIFiles.content_hash == content_hash,
+                                                     OpenAIFiles.purpose == purpose))
+                query = await session.execute(sql)
+                return query.scalars().one_or_none()
+
+    async def upsert_file(self, content_hash: str, purpose: str, file_id: str,
+                          expires_at: datetime.datetime | None):
+        """
+        Запоминает загруженный файл; при гонке двух процессов побеждает последний.
+        """
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                now = datetime.datetime.now()
+                sql = insert(OpenAIFiles).values(
+                    content_hash=content_hash, purpose=purpose, file_id=file_id,
+                    expires_at=expires_at, verified_at=now,
+                ).on_conflict_do_update(
+                    index_elements=[OpenAIFiles.content_hash, OpenAIFiles.purpose],
+                    set_={"file_id": file_id, "expires_at": expires_at, "verified_at": now},
+                )
+                await session.execute(sql)
+                return True
+
+    async def mark_verified(self, file_id: str):
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                sql = update(OpenAIFiles).where(OpenAIFiles.file_id == file_id).values(
+                    verified_at=datetime.datetime.now())
+                await session.execute(sql)
+                return True
+
+    async def delete_file(self, file_id: str):
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                await session.execute(delete(OpenAIFiles).where(OpenAIFiles.file_id == file_id))
+                return True
@@ -1,12 +1,70 @@
+from dataclasses import dataclass
+from enum import Enum
 from typing import Sequence, Optional
 
-from sqlalchemy import select, or_, update
+from sqlalchemy import select, or_, update, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from db.engine import DatabaseEngine
 from db.models import PromoActivations
 
 
+class PromoActivationStatus(str, Enum):
+    ACTIVATED = "activated"
+    NOT_FOUND = "not_found"
+    INACTIVE = "inactive"
+    ALREADY_ACTIVATED = "already_activated"
+    EXHAUSTED = "exhausted"
+
+
+@dataclass(slots=True)
+class PromoActivationResult:
+    status: PromoActivationStatus
+    promo_id: int | None = None
+    promo_code: str | None = None
+    days_sub: int | None = None
+    max_generations: int | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status is PromoActivationStatus.ACTIVATED
+
+
+# Вся активация — один запрос:
+#   promo   — блокирует строку промокода (FOR UPDATE), конкурентные активации одного кода идут по очереди;
+#   ins     — вставляет активацию, если промокод активен и лимит не выбран; повтор отсекает уникальный индекс;
+#   counter — увеличивает счётчик, только если активация действительно вставилась.
+_ACTIVATE_PROMO_SQL = text("""
+WITH promo AS (
+    SELECT id, promo_code, days_sub, max_generations, max_activations,
+           COALESCE(activations, 0) AS activations, active
+    FROM referral_system
+    WHERE promo_code = :promo_code
+    FOR UPDATE
+),
+ins AS (
+    INSERT INTO promo_activations (promo_id, activate_user_id, creation_date)
+    SELECT p.id, :user_id, now()
+    FROM promo p
+    WHERE p.active AND (p.max_activations IS NULL OR p.activations < p.max_activations)
+    ON CONFLICT (promo_id, activate_user_id) DO NOTHING
+    RETURNING promo_id
+),
+counter AS (
+    UPDATE referral_system r
+    SET activations = COALESCE(r.activations, 0) + 1
+    FROM ins
+    WHERE r.id = ins.promo_id
+    RETURNING r.id
+)
+SELECT p.id, p.promo_code, p.days_sub, p.max_generations, p.max_activations, p.activations, p.active,
+       EXISTS (SELECT 1 FROM counter) AS activated,
+       EXISTS (SELECT 1 FROM promo_activations a
+               WHERE a.promo_id = p.id AND a.activate_user_id = :user_id) AS already_activated
+FROM promo p
+""")
+
+
 class PromoActivationsRepository:
     def __init__(self):
         self.session_maker = DatabaseEngine().create_session()
@@ -25,6 +83,35 @@ class PromoActivationsRepository:
                     return False
                 return True
 
+    async def activate_promo(self, promo_code: str, user_id: int) -> PromoActivationResult:
+        """
+        Атомарная активация промокода пользователем: проверка активности, лимита активаций,
+        повторной активации и увеличение счётчика — в одной транзакции одним запросом.
+        """
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                query = await session.execute(_ACTIVATE_PROMO_SQL, {"promo_code": promo_code, "user_id": user_id})
+                row = query.mappings().one_or_none()
+        if row is None:
+            return PromoActivationResult(status=PromoActivationStatus.NOT_FOUND)
+        if row["activated"]:
+            status = PromoActivationStatus.ACTIVATED
+        elif row["already_activated"]:
+            status = PromoActivationStatus.ALREADY_ACTIVATED
+        elif not row["active"]:
+            status = PromoActivationStatus.INACTIVE
+        elif row["max_activations"] is not None and row["activations"] >= row["max_activations"]:
+            status = PromoActivationStatus.EXHAUSTED
+        else:
+            # вставку отсекло ON CONFLICT: параллельный запрос этого же пользователя успел раньше
+            status = PromoActivationStatus.ALREADY_ACTIVATED
+        return PromoActivationResult(status=status,
+                                     promo_id=row["id"],
+                                     promo_code=row["promo_code"],
+                                     days_sub=row["days_sub"],
+                                     max_generations=row["max_generations"])
+
     # async def get_promo_info_by_user_id(self, user_id: int) -> Optional[PromoActivations]:
     #     async with self.session_maker() as session:
     #         session: AsyncSession
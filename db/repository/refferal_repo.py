@@ -1,11 +1,15 @@
 from typing import Sequence, Optional
 
 from sqlalchemy import select, or_, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from db.engine import DatabaseEngine
 from db.models import ReferralSystem
 
+# asyncpg ограничивает запрос 32767 параметрами: 8 колонок × 2000 строк с запасом
+BULK_CHUNK_SIZE = 2000
+
 
 class ReferralSystemRepository:
     def __init__(self):
@@ -45,6 +49,49 @@ class ReferralSystemRepository:
                     return False
                 return True
 
+    async def add_promos_bulk(self,
+                              promo_codes: Sequence[str],
+                              days_sub: int = 30,
+                              max_activations: int | None = None,
+                              max_generations: int = 0,
+                              with_voice: bool = False,
+                              with_files: bool = False,
+                              web_search: bool = False,
+                              active: bool = True) -> list[str]:
+        """
+        Пакетное создание промокодов одним INSERT ... ON CONFLICT DO NOTHING на чанк.
+        Возвращает коды, которые реально вставились; уже существующие молча пропускаются.
+        """
+        inserted: list[str] = []
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                for start in range(0, len(promo_codes), BULK_CHUNK_SIZE):
+                    rows = [dict(promo_code=code,
+                                 days_sub=days_sub,
+                                 max_activations=max_activations,
+                                 max_generations=max_generations,
+                                 with_voice=with_voice,
+                                 with_files=with_files,
+                                 web_search=web_search,
+                                 active=active)
+                            for code in promo_codes[start:start + BULK_CHUNK_SIZE]]
+                    sql = insert(ReferralSystem).values(rows).on_conflict_do_nothing(
+                        index_elements=[ReferralSystem.promo_code]
+                    ).returning(ReferralSystem.promo_code)
+                    query = await session.execute(sql)
+                    inserted.extend(query.scalars().all())
+        return inserted
+
+    async def select_existing_promo_codes(self, promo_codes: Sequence[str]) -> set:
+        """Какие из переданных кодов уже есть в базе (без выгрузки всей таблицы)"""
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                sql = select(ReferralSystem.promo_code).where(ReferralSystem.promo_code.in_(promo_codes))
+                query = await session.execute(sql)
+                return set(query.scalars().all())
+
     async def select_all_promo(self) -> Sequence[ReferralSystem]:
         async with self.session_maker() as session:
             session: AsyncSession
@@ -0,0 +1,42 @@
+from sqlalchemy import select, delete, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.engine import DatabaseEngine
+from db.models import TelegramMedia
+
+
+class TelegramMediaRepository:
+    def __init__(self):
+        self.session_maker = DatabaseEngine().create_session()
+
+    async def get_media(self, bot_id: int, media_key: str) -> TelegramMedia | None:
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                sql = select(TelegramMedia).where(and_(TelegramMedia.bot_id == bot_id,
+                                                       TelegramMedia.media_key == media_key))
+                query = await session.execute(sql)
+                return query.scalars().one_or_none()
+
+    async def upsert_media(self, bot_id: int, media_key: str, kind: str, file_id: str,
+                           file_unique_id: str | None):
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                sql = insert(TelegramMedia).values(
+                    bot_id=bot_id, media_key=media_key, kind=kind, file_id=file_id, file_unique_id=file_unique_id,
+                ).on_conflict_do_update(
+                    index_elements=[TelegramMedia.bot_id, TelegramMedia.media_key],
+                    set_={"kind": kind, "file_id": file_id, "file_unique_id": file_unique_id},
+                )
+                await session.execute(sql)
+                return True
+
+    async def delete_media(self, bot_id: int, media_key: str):
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                await session.execute(delete(TelegramMedia).where(and_(TelegramMedia.bot_id == bot_id,
+                                                                       TelegramMedia.media_key == media_key)))
+                return True
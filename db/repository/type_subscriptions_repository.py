@@ -1,11 +1,14 @@
 from typing import Sequence
 
 from sqlalchemy import select, or_, update, delete, and_, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from db.engine import DatabaseEngine
 from db.models import TypeSubscriptions
 
+BULK_CHUNK_SIZE = 2000
+
 
 class TypeSubscriptionsRepository:
     def __init__(self):
@@ -27,6 +30,31 @@ class TypeSubscriptionsRepository:
                     return False
                 return True
 
+    async def add_type_subscriptions_bulk(self,
+                                          plan_names: Sequence[str],
+                                          with_voice: bool | None = False, max_generations: int | None = None,
+                                          with_files: bool | None = None, price: int | None = None,
+                                          web_search: bool | None = False, from_promo: bool | None = False) -> int:
+        """
+        Пакетная вставка тарифов с одинаковыми параметрами и разными plan_name.
+        Существующие plan_name пропускаются, возвращается число вставленных строк.
+        """
+        inserted = 0
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                for start in range(0, len(plan_names), BULK_CHUNK_SIZE):
+                    rows = [dict(with_voice=with_voice, plan_name=plan_name,
+                                 with_files=with_files, max_generations=max_generations,
+                                 price=price, web_search=web_search, from_promo=from_promo)
+                            for plan_name in plan_names[start:start + BULK_CHUNK_SIZE]]
+                    sql = insert(TypeSubscriptions).values(rows).on_conflict_do_nothing(
+                        index_elements=[TypeSubscriptions.plan_name]
+                    ).returning(TypeSubscriptions.id)
+                    query = await session.execute(sql)
+                    inserted += len(query.scalars().all())
+        return inserted
+
     async def get_type_subscription_by_id(self, type_id: int) -> TypeSubscriptions:
         async with self.session_maker() as session:
             session: AsyncSession
@@ -0,0 +1,52 @@
+from typing import Sequence
+
+from sqlalchemy import select, delete, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.engine import DatabaseEngine
+from db.models import VectorStoreFiles
+
+
+class VectorStoreFilesRepository:
+    def __init__(self):
+        self.session_maker = DatabaseEngine().create_session()
+
+    async def get_files(self, user_id: int, scope: str) -> Sequence[VectorStoreFiles]:
+        """
+        Все записи манифеста пользователя в рамках scope (thread или backend).
+        """
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                sql = select(VectorStoreFiles).where(and_(VectorStoreFiles.user_id == user_id,
+                                                          VectorStoreFiles.scope == scope))
+                query = await session.execute(sql)
+                return query.scalars().all()
+
+    async def apply_diff(self, user_id: int, scope: str, vector_store_id: str,
+                         removed_file_ids: Sequence[str], added: Sequence[dict]):
+        """
+        Одной транзакцией убирает удалённые из хранилища файлы и добавляет новые
+        (added — словари с file_id, content_hash, file_name).
+        """
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                if removed_file_ids:
+                    await session.execute(delete(VectorStoreFiles).where(and_(
+                        VectorStoreFiles.vector_store_id == vector_store_id,
+                        VectorStoreFiles.file_id.in_(list(removed_file_ids)),
+                    )))
+                session.add_all([VectorStoreFiles(user_id=user_id, scope=scope, vector_store_id=vector_store_id,
+                                                  **item) for item in added])
+                return True
+
+    async def delete_store(self, vector_store_id: str):
+        """
+        Удаление манифеста хранилища (например, vector store истёк на стороне OpenAI).
+        """
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                await session.execute(delete(VectorStoreFiles).where(VectorStoreFiles.vector_store_id == vector_store_id))
+                return True
@@ -0,0 +1,51 @@
+import datetime
+
+from sqlalchemy import select, update, delete, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.engine import DatabaseEngine
+from db.models import VoiceTranscriptions
+
+
+class VoiceTranscriptionsRepository:
+    def __init__(self):
+        self.session_maker = DatabaseEngine().create_session()
+
+    async def get_transcription(self, file_unique_id: str, language: str) -> VoiceTranscriptions | None:
+        """Расшифровка голосового; заодно отмечает, что она снова пригодилась"""
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                condition = and_(VoiceTranscriptions.file_unique_id == file_unique_id,
+                                 VoiceTranscriptions.language == language)
+                query = await session.execute(select(VoiceTranscriptions).where(condition))
+                row = query.scalars().one_or_none()
+                if row is not None:
+                    await session.execute(update(VoiceTranscriptions).where(condition).values(
+                        last_used_at=datetime.datetime.now()))
+                return row
+
+    async def save_transcription(self, file_unique_id: str, language: str, text: str, duration: int | None):
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                now = datetime.datetime.now()
+                sql = insert(VoiceTranscriptions).values(
+                    file_unique_id=file_unique_id, language=language, text=text,
+                    duration=duration, last_used_at=now,
+                ).on_conflict_do_update(
+                    index_elements=[VoiceTranscriptions.file_unique_id, VoiceTranscriptions.language],
+                    set_={"text": text, "duration": duration, "last_used_at": now},
+                )
+                await session.execute(sql)
+                return True
+
+    async def delete_unused_before(self, last_used_before: datetime.datetime) -> int:
+        """:return: сколько расшифровок удалено"""
+        async with self.session_maker() as session:
+            session: AsyncSession
+            async with session.begin():
+                result = await session.execute(delete(VoiceTranscriptions).where(
+                    VoiceTranscriptions.last_used_at < last_used_before))
+                return result.rowcount
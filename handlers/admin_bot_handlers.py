@@ -11,13 +11,16 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from data.keyboards import admin_keyboard, add_delete_admin, cancel_keyboard, back_to_bots_keyboard, \
     db_tables_keyboard, type_users_mailing_keyboard, statistics_keyboard, confirm_send_mailing
 from db.repository import admin_repository, users_repository, ai_requests_repository, subscriptions_repository, \
-    referral_system_repository, events_repository, type_subscriptions_repository
+    events_repository, type_subscriptions_repository
 from settings import InputMessage, business_connection_id, get_current_bot, read_promo_codes, EXCEL_EXTENSIONS
 from test_bot import test_bot
-from utils.generate_promo import generate_single_promo_code
+from utils.generate_promo import create_promo_codes, import_promo_codes
+from utils.admin_alerts import admin_alerts
 from utils.get_table_db_to_excel import export_table_to_memory
 from utils.is_main_admin import is_main_admin
 from utils.list_admins_keyboard import Admins_kb
+from utils.media_registry import media_registry, content_key
+from utils.telegram_sender import get_sender, SendPriority
 
 admin_router = Router()
 
@@ -48,28 +51,14 @@ async def get_promo_table(message: types.Message, state: FSMContext, bot: Bot):
         await bot.download(file=message.document, destination=file_buffer)
         promo_list = read_promo_codes(file_buffer.getvalue())
         await message.answer("Таблица успешно загружена")
-        for promo_code in promo_list:
-            try:
-                max_generations_photos = 5
-                max_days = 7
-                max_activations = 1
-                result = await referral_system_repository.get_promo_by_promo_code(promo_code=str(promo_code))
-                if result:
-                    continue
-                await referral_system_repository.add_promo(promo_code=str(promo_code),
-                                                           days_sub=max_days,
-                                                           max_activations=max_activations,
-                                                           max_generations=max_generations_photos)
-                await type_subscriptions_repository.add_type_subscription(with_files=True,
-                                                                          web_search=True,
-                                                                          with_voice=True,
-                                                                          plan_name=f"promo_{promo_code}",
-                                                                          price=0,
-                                                                          max_generations=max_generations_photos,
-                                                                          from_promo=True)
-            except:
-                from settings import logger
-                logger.log('ERROR_HANDLER', f"Error in promo_code {promo_code}\n\n" + traceback.format_exc())
+        max_generations_photos = 5
+        max_days = 7
+        max_activations = 1
+        created = await import_promo_codes(promo_list,
+                                           days_sub=max_days,
+                                           max_activations=max_activations,
+                                           max_generations=max_generations_photos)
+        await message.answer(f"Добавлено новых промокодов: {len(created)} из {len(promo_list)}")
         await message.answer("Процесс добавления промокодов завершен!")
     except:
         from settings import logger
@@ -78,6 +67,32 @@ async def get_promo_table(message: types.Message, state: FSMContext, bot: Bot):
 
 
 
+@admin_router.message(F.text.startswith("/promo_bulk"), any_state)
+@is_main_admin
+async def generate_promo_bulk(message: types.Message, state: FSMContext, bot: Bot):
+    """/promo_bulk <кол-во> <дней> <активаций> <генераций> — выпуск пачки промокодов файлом"""
+    await state.clear()
+    args = message.text.split()[1:]
+    if len(args) != 4 or not all(arg.isdigit() for arg in args):
+        await message.answer("Формат: <code>/promo_bulk количество дней активаций генераций</code>\n\n"
+                             "Например: <code>/promo_bulk 1000 7 1 5</code>")
+        return
+    count, max_days, max_activations, max_generations_photos = map(int, args)
+    try:
+        promo_codes = await create_promo_codes(count,
+                                               days_sub=max_days,
+                                               max_activations=max_activations,
+                                               max_generations=max_generations_photos)
+    except Exception:
+        from settings import logger
+        logger.log("ERROR_HANDLER", "Error in promo bulk generation\n\n" + traceback.format_exc())
+        await message.answer("Не удалось выпустить промокоды, попробуй еще раз")
+        return
+    await message.answer_document(document=BufferedInputFile(file="\n".join(promo_codes).encode(),
+                                                             filename=f"promo_codes_{len(promo_codes)}.txt"),
+                                  caption=f"Выпущено промокодов: {len(promo_codes)}")
+
+
 @admin_router.callback_query(F.data.startswith("db_tables|"), any_state)
 @is_main_admin
 async def choice_table_db(call: types.CallbackQuery, state: FSMContext, bot: Bot):
@@ -224,9 +239,8 @@ async def enter_message_photo_mailing(message: types.Message, state: FSMContext,
     state_data = await state.get_data()
     type_users = state_data.get("type_users")
     message_id = state_data.get("message_id")
+    # превью шлёт тот же бот, которому прислали фото, — достаточно его file_id, без скачивания и загрузки
     photo = message.photo[-1].file_id
-    photo_bytes_io = io.BytesIO()
-    await bot.download(message.photo[-1], destination=photo_bytes_io)
     print(type_users)
     user = await users_repository.get_user_by_user_id(user_id=message.from_user.id)
     if type_users == "all":
@@ -236,8 +250,7 @@ async def enter_message_photo_mailing(message: types.Message, state: FSMContext,
             if "with usernames" in caption:
                 caption = f"Дорогой {'@' + user.username if user.username else 'друг'}!|||\n\n" + '\n'.join(split_text[1:])
             mailing_message = await message.answer_photo(caption=caption,
-                                      photo=BufferedInputFile(file=photo_bytes_io.getvalue(),
-                                                              filename="mailing_photo.jpg"),
+                                      photo=photo,
                                                         reply_markup = confirm_send_mailing().as_markup())
             # await message.answer("Подтвердить рассылку сообщения выше?", ))
         except Exception as e:
@@ -270,26 +283,34 @@ async def confirm_mailing_message(call: types.CallbackQuery, state: FSMContext,
     if is_confirm:
         await message.answer(text="Начали рассылку по пользователями с твоим отправленным фото")
         await call.message.delete()
-        sending_messages = 0
         send_messages = {}
-        for user in users:
+        sender = get_sender(main_bot)
+        photo_bytes = photo_bytes_io.getvalue() if photo_bytes_io else None
+        # основной бот загружает фото один раз, остальным получателям оно уходит по file_id
+        photo_key = content_key(photo_bytes) if photo_bytes else None
+
+        async def send_to_user(user) -> None:
             caption = message.caption or message.text
-            # if user.user_id == 774127719:
-            #         print("send")
             try:
                 if with_usernames:
                     caption = f"Дорогой {'@' + user.username if user.username else 'друг'}!\n" + '\n'.join(split_text[1:])
-                if photo_bytes_io:
-                    send_message = await main_bot.send_photo(chat_id=user.user_id, caption=caption,
-                                              photo=BufferedInputFile(file=photo_bytes_io.getvalue(),
-                                                                      filename="mailing_photo.jpg"))
+                if photo_bytes:
+                    send_message = await media_registry.send(
+                        main_bot, photo_key, "photo",
+                        lambda photo: sender.send_photo(chat_id=user.user_id, caption=caption, photo=photo,
+                                                        priority=SendPriority.BROADCAST),
+                        lambda: BufferedInputFile(file=photo_bytes, filename="mailing_photo.jpg"),
+                    )
                 else:
-                    send_message = await main_bot.send_message(chat_id=user.user_id, text=caption)
+                    send_message = await sender.send_message(chat_id=user.user_id, text=caption,
+                                                             priority=SendPriority.BROADCAST)
                 send_messages[user.user_id] = send_message.message_id
-                sending_messages += 1
-            except Exception as e:
+            except Exception:
                 print(traceback.format_exc())
-                continue
+
+        # Темп рассылки задаёт очередь отправки: ответы пользователям идут вне очереди
+        await asyncio.gather(*(send_to_user(user) for user in users))
+        sending_messages = len(send_messages)
         await message.answer(text=f"Рассылка завершена. {sending_messages} из {len(users)} человек получили рассылку")
         print(send_messages)
     else:
@@ -359,6 +380,7 @@ async def actions_admin(call: types.CallbackQuery, state: FSMContext, bot: Bot):
 async def choice_delete_admin(call: types.CallbackQuery, state: FSMContext, bot: Bot):
     admin_id = call.data.split("|")[1]
     await admin_repository.delete_admin_by_admin_id(int(admin_id))
+    admin_alerts.invalidate_admins()
     await call.message.answer(text=f"Отлично, вы удалили админа с telegram id {admin_id},"
                                    f" выберите свои дальнейшие действия!", reply_markup=admin_keyboard)
     await call.message.delete()
@@ -370,6 +392,7 @@ async def add_mew_admin(message: types.Message, state: FSMContext, bot: Bot):
     try:
         message_admin = await bot.send_message(chat_id=message.text, text="Вас добавили в данного бота, как админа!")
         await admin_repository.add_admin(admin_id=int(message.text), username=message_admin.chat.username)
+        admin_alerts.invalidate_admins()
         await message.answer(text="Отлично, вы успешно добавили нового админа!", reply_markup=admin_keyboard)
         await message.delete()
         await state.clear()
@@ -440,18 +463,10 @@ async def route_enter_max_generations_photos(message: types.Message, state: FSMC
     max_generations_photos = message.text
     if max_generations_photos.isdigit():
         max_generations_photos = int(max_generations_photos)
-        promo_code = await generate_single_promo_code()
-        await referral_system_repository.add_promo(promo_code=promo_code,
-                                                   days_sub=max_days,
-                                                   max_activations=max_activations,
-                                                   max_generations=max_generations_photos)
-        await type_subscriptions_repository.add_type_subscription(with_files=True,
-                                                                  web_search=True,
-                                                                  with_voice=True,
-                                                                  plan_name=f"promo_{promo_code}",
-                                                                  price=0,
-                                                                  max_generations=max_generations_photos,
-                                                                  from_promo=True)
+        promo_code, = await create_promo_codes(1,
+                                               days_sub=max_days,
+                                               max_activations=max_activations,
+                                               max_generations=max_generations_photos)
         await message.answer(f"Отлично, ты выпустил промокод!\n\nПромокод: <code>{promo_code}</code>")
         return
     else:
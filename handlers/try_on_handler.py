@@ -1,5 +1,3 @@
-import io
-import io
 import traceback
 
 from aiogram import Router, F, Bot
@@ -14,9 +12,13 @@ from db.repository import users_repository, subscriptions_repository, type_subsc
     generations_packets_repository
 from settings import InputMessage, sub_text
 from utils.is_subscriber import is_channel_subscriber, is_subscriber
+from utils.media_fetcher import media_fetcher
+from utils.media_registry import media_registry, content_key
 from utils.new_fitroom_api import FitroomClient, CreditsFitroomAPIError
+from utils.resilience import ProviderUnavailableError, deadline_scope
 
 try_on_router = Router()
+TRY_ON_DEADLINE_SEC = 150
 
 
 @try_on_router.message(F.text == "/try_on")
@@ -119,33 +121,32 @@ async def standard_message_photo_handler(message: Message, state: FSMContext, bo
     await bot.delete_message(message_id=delete_message_id,
                              chat_id=user_id)
     people_photo_id = state_data.get("people_photo_id")
-    photo_bytes_io = io.BytesIO()
-    people_photo_io = io.BytesIO()
     photo_id = message.photo[-1].file_id
     await users_repository.update_last_photo_id_by_user_id(photo_id=people_photo_id + ", " + photo_id, user_id=user_id)
-    await bot.download(message.photo[-1], destination=photo_bytes_io)
-    await bot.download(people_photo_id, destination=people_photo_io)
-    people_photo_io.seek(0)
-    photo_bytes_io.seek(0)
-    model_bytes = people_photo_io.read()
-    cloth_bytes = photo_bytes_io.read()
+    model_bytes, cloth_bytes = await media_fetcher.fetch_many(bot, [people_photo_id, message.photo[-1]])
 
     await bot.send_chat_action(chat_id=message.chat.id, action="upload_photo")
     client = FitroomClient()
 
     try:
-        ai_photo = await client.try_on(
-            validate=False,
-            model_bytes=model_bytes,
-            cloth_bytes=cloth_bytes,
-            chat_id=user_id,
-            send_bot=bot,
-            cloth_type=mode_generation,  # или "lower", "full", "combo"
-            timeout=150
-        )
+        # дедлайн хендлера действует и на повторы запросов внутри клиента
+        with deadline_scope(TRY_ON_DEADLINE_SEC):
+            ai_photo = await client.try_on(
+                validate=False,
+                model_bytes=model_bytes,
+                cloth_bytes=cloth_bytes,
+                chat_id=user_id,
+                send_bot=bot,
+                cloth_type=mode_generation,  # или "lower", "full", "combo"
+                timeout=TRY_ON_DEADLINE_SEC
+            )
         user_sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user_id)
         await subscriptions_repository.update_generations(subscription_id=user_sub.id, new_generations=-1)
-        photo_answer = await message.answer_photo(BufferedInputFile(file=ai_photo, filename="image.png"))
+        photo_answer = await media_registry.send(
+            bot, content_key(ai_photo), "photo",
+            lambda photo: message.answer_photo(photo),
+            lambda: BufferedInputFile(file=ai_photo, filename="image.png"),
+        )
         await state.set_state(InputMessage.input_photo_people)
         generations = user_sub.photo_generations
         # await ai_requests_repository.add_request(user_id=user_id,
@@ -201,6 +202,11 @@ async def standard_message_photo_handler(message: Message, state: FSMContext, bo
                    f"{user_id} | @{message.from_user.username} 🚫 Ошибка в обработке сообщения: {traceback.format_exc()}")
         await message.answer(text=error_text)
         await state.clear()
+    except ProviderUnavailableError as e:
+        from settings import logger
+        logger.log("ERROR_HANDLER", f"{user_id} | @{message.from_user.username} 🚫 Примерка недоступна: {e}")
+        await message.answer(text=e.user_message)
+        await state.clear()
     except:
         from settings import logger
         # print(traceback.format_exc())
@@ -6,7 +6,7 @@ from datetime import datetime, timedelta
 from aiogram import Router, F, Bot, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import any_state
-from aiogram.types import Message, CallbackQuery, BufferedInputFile, InputMediaPhoto, URLInputFile
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, InputMediaPhoto
 from aiogram.utils.chat_action import ChatActionSender
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram_media_group import media_group_handler
@@ -15,14 +15,20 @@ from data.keyboards import profiles_keyboard, cancel_keyboard, settings_keyboard
     confirm_clear_context, buy_sub_keyboard, subscriptions_keyboard, delete_payment_keyboard, unlink_card_keyboard, \
     confirm_delete_notification_keyboard, delete_notification_keyboard
 from db.repository import users_repository, ai_requests_repository, subscriptions_repository, \
-    type_subscriptions_repository, notifications_repository, referral_system_repository, promo_activations_repository, \
-    dialogs_messages_repository
+    type_subscriptions_repository, notifications_repository, promo_activations_repository
+from db.repository.promo_activations_repo import PromoActivationStatus
 from settings import InputMessage, photos_pages, OPENAI_ALLOWED_DOC_EXTS, get_current_assistant, sub_text, \
-    gemini_images_client, SUPPORTED_TEXT_FILE_TYPES
-from utils.completions_gpt_tools import NoSubscription, NoGenerations
+    gemini_images_client, SUPPORTED_DOCUMENT_FILE_TYPES
+from utils.assistant_backends import NoSubscription, NoGenerations
+from utils.audio_pipeline import audio_pipeline
+from utils.media_registry import media_registry, content_key, url_key
 from utils.is_subscriber import is_subscriber, is_channel_subscriber
+from utils.media_buffer import MediaBuffer, as_media
+from utils.media_fetcher import media_fetcher, FileBuffer
 from utils.paginator import MechanicsPaginator
 from utils.parse_gpt_text import split_telegram_html, sanitize_with_links
+from utils.telegram_sender import get_sender
+from utils.video_relay import video_relay, UploadProgress, VideoTooLarge, VIDEO_UPLOAD_TIMEOUT
 
 standard_router = Router()
 
@@ -45,57 +51,64 @@ async def process_ai_response(ai_response, message: Message, user_id: int, bot:
     video_urls = ai_response.get("video_urls", [])
     audio_file = ai_response.get("audio_file")
     reply_markup: InlineKeyboardBuilder | None = ai_response.get("reply_markup", None)
+    sender = get_sender(bot)
+    chat_id = message.chat.id
     
     # Обработка файлов (документы, изображения от ассистента)
     if video_urls:
         for video_url in video_urls:
+            progress = UploadProgress(bot, chat_id)
             try:
-                video_file = URLInputFile(
-                    url=video_url,
-                    filename="sora_video.mp4"
-                )
-
-                await message.answer_document(
-                    document=video_file,
-                    caption="✅ Видео готово!"
+                await media_registry.send(
+                    bot, url_key(video_url), "document",
+                    lambda document: video_relay.send(document, lambda: sender.send(
+                        chat_id, message.answer_document, document=document, caption="✅ Видео готово!",
+                        request_timeout=VIDEO_UPLOAD_TIMEOUT)),
+                    lambda: video_relay.input_file(video_url, filename="sora_video.mp4", on_progress=progress),
                 )
 
+            except VideoTooLarge:
+                await sender.send(chat_id, message.answer,
+                                  text=f"✅ Видео готово! Оно больше 50 МБ, скачать можно по ссылке:\n{video_url}")
             except Exception as e:
                 from settings import logger
                 logger.log("ERROR_HANDLER", traceback.format_exc())
+            finally:
+                await progress.finish()
         return
 
     if files:
         for file_data in files:
             try:
-                await message.reply_document(
-                    document=BufferedInputFile(
-                        file=file_data.get("bytes"),
-                        filename=file_data.get("filename")
-                    ),
-                    reply_markup=reply_markup.as_markup() if reply_markup else None,
+                await media_registry.send(
+                    bot, content_key(file_data.get("bytes")), "document",
+                    lambda document: sender.send(chat_id, message.reply_document, document=document,
+                                                 reply_markup=reply_markup.as_markup() if reply_markup else None),
+                    lambda: BufferedInputFile(file=file_data.get("bytes"), filename=file_data.get("filename")),
                 )
                 text = text or "🤖Сгенерированный файл"
             except Exception:
                 print(traceback.format_exc())
-                await message.answer("Возникла ошибка при отправке файла, попробуй еще раз",
-                                     reply_markup=reply_markup.as_markup() if reply_markup else None,)
+                await sender.send(chat_id, message.answer, "Возникла ошибка при отправке файла, попробуй еще раз",
+                                  reply_markup=reply_markup.as_markup() if reply_markup else None,)
                 return
     
     # Обработка изображений
     if image_files:
         photos_ids = []
-        for raw in image_files:
-            buffer = io.BytesIO(raw)
-            buffer.seek(0)
-
-            photo = BufferedInputFile(file=buffer.getvalue(), filename="image.png")
-            reply_message = await message.reply_photo(
-                text=text,
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True,
-                photo=photo,
-                reply_markup=reply_markup.as_markup() if reply_markup else None,
+        for image in map(as_media, image_files):
+            # то же изображение (повтор из кеша инструмента) второй раз не загружается
+            reply_message = await media_registry.send(
+                bot, content_key(image), "photo",
+                lambda photo: sender.send(
+                    chat_id, message.reply_photo,
+                    text=text,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True,
+                    photo=photo,
+                    reply_markup=reply_markup.as_markup() if reply_markup else None,
+                ),
+                lambda: BufferedInputFile(file=image.tobytes(), filename="image.png"),
             )
             photos_ids.append(reply_message.photo[-1].file_id)
         await users_repository.update_last_photo_id_by_user_id(
@@ -108,13 +121,29 @@ async def process_ai_response(ai_response, message: Message, user_id: int, bot:
             text = sanitize_with_links(text)
             split_messages = split_telegram_html(text)
             for chunk in split_messages:
-                await message.reply(
+                await sender.send(
+                    chat_id, message.reply,
                     chunk,
                     disable_web_page_preview=True,
                     parse_mode=ParseMode.HTML,
                     reply_markup=reply_markup.as_markup() if reply_markup else None,
                 )
 
+    # Озвучка уходит после текста: TTS качается потоком прямо в загрузку и не задерживает ответ,
+    # а уже звучавшая фраза отправляется по file_id
+    if audio_file is not None:
+        try:
+            voice = audio_pipeline.voice_input(audio_file)
+            cache_key = getattr(voice, "cache_key", None)
+            await media_registry.send(
+                bot, f"tts:{cache_key}" if cache_key else None, "voice",
+                lambda v: sender.send(chat_id, message.reply_voice, voice=v),
+                lambda: voice,
+            )
+        except Exception:
+            from settings import logger
+            logger.log("ERROR_HANDLER", traceback.format_exc())
+
     # Сохранение запроса в БД
     await ai_requests_repository.add_request(
         user_id=user_id,
@@ -150,20 +179,19 @@ async def route_enter_promocode(message: Message, state: FSMContext, bot: Bot):
             await bot.delete_message(chat_id=user_id, message_id=delete_message_id)
         except:
             pass
-    promo = await referral_system_repository.get_promo_by_promo_code(promo_code=promo_code)
-    if promo is None:
+    promo = await promo_activations_repository.activate_promo(promo_code=promo_code, user_id=user_id)
+    if promo.status is PromoActivationStatus.NOT_FOUND:
         await message.answer("Такого промокода не существует",
                              reply_markup=cancel_keyboard.as_markup())
         return
     await state.clear()
-    # delete_message = await message.answer("Секундочку, загружаем информацию о промокоде)")
-    user = await users_repository.get_user_by_user_id(user_id=user_id)
-    promo_activations = await promo_activations_repository.get_user_ids_activations_by_promo_id(promo_id=promo.id)
-    if user_id in promo_activations:
+    if promo.status is PromoActivationStatus.ALREADY_ACTIVATED:
         await message.answer("К сожалению, мы вынуждены отказать. Ты уже активировал данные бонусы ранее")
         return
-    await referral_system_repository.update_activations_by_promo_id(promo_id=promo.id)
-    await promo_activations_repository.add_activation(promo_id=promo.id, activate_user_id=user_id)
+    if not promo.ok:
+        await message.answer("К сожалению, данный промокод больше не действует")
+        return
+    user = await users_repository.get_user_by_user_id(user_id=user_id)
     activate_user_sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user_id)
     user_sub_type = await type_subscriptions_repository.get_type_subscription_by_id(type_id=activate_user_sub.type_subscription_id)
     if activate_user_sub is None or (user_sub_type and user_sub_type.plan_name == "Free"):
@@ -185,7 +213,7 @@ async def route_enter_promocode(message: Message, state: FSMContext, bot: Bot):
         text = f"✅ К текущему плану тебе добавили <b>{timedelta(days=promo.days_sub).days} дней</b>! Подписка действует до {end_date.strftime('%d.%m.%y, %H:%M')} (GMT+3)"
     await message.answer(text=text)
     from settings import logger
-    logger.log("PROMO_ACTIVATED", f"✅ USER {user_id} | {user.username} ACTIVATE PROMO: {promo.id} | {promo.promo_code}")
+    logger.log("PROMO_ACTIVATED", f"✅ USER {user_id} | {user.username} ACTIVATE PROMO: {promo.promo_id} | {promo.promo_code}")
 
 
 
@@ -298,13 +326,15 @@ async def get_page_paginator(call: CallbackQuery, state: FSMContext):
     paginator = MechanicsPaginator(page_now)
     if call_data[1] == "page_prev_keys":
         keyboard = paginator.generate_prev_page()
-        await call.message.edit_media(media=InputMediaPhoto(media=photos_pages.get(paginator.page_now)),
-                                      reply_markup=keyboard)
-
     elif call_data[1] == "page_next_keys":
         keyboard = paginator.generate_next_page()
-        await call.message.edit_media(media=InputMediaPhoto(media=photos_pages.get(paginator.page_now)),
-                                      reply_markup=keyboard)
+    else:
+        return
+    await media_registry.send_static(
+        call.bot, photos_pages.get(paginator.page_now), "photo",
+        lambda photo: get_sender(call.bot).send(call.message.chat.id, call.message.edit_media,
+                                                media=InputMediaPhoto(media=photo), reply_markup=keyboard),
+    )
 
 
 @standard_router.message(F.text == "/instructions", any_state)
@@ -314,8 +344,10 @@ async def send_user_message(message: Message, state: FSMContext, bot: Bot, user_
     paginator = MechanicsPaginator(page_now=1)
     keyboard = paginator.generate_now_page()
     try:
-        await message.answer_photo(photo=photos_pages.get(paginator.page_now),
-                                   reply_markup=keyboard)
+        await media_registry.send_static(
+            bot, photos_pages.get(paginator.page_now), "photo",
+            lambda photo: message.answer_photo(photo=photo, reply_markup=keyboard),
+        )
     except:
         await message.answer("Привет! Ты можешь задавать мне разные вопросы и я могу помогать тебе решать разные задачи!")
 
@@ -352,8 +384,8 @@ async def send_user_message(message: Message, state: FSMContext, bot: Bot):
 @is_channel_subscriber
 async def send_user_message(call: CallbackQuery, state: FSMContext, bot: Bot):
     user_id = call.from_user.id
-    await dialogs_messages_repository.delete_messages_by_user_id(user_id=user_id)
-    # await users_repository.update_thread_id_by_user_id(user_id=user_id, thread_id=None)
+    # историю чистит тот бэкенд, на котором сейчас пользователь (таблица диалогов, thread или цепочка ответов)
+    await get_current_assistant().clear_history(user_id)
     await call.message.delete()
     await call.message.answer("Контекст твоего диалога очищен✨")
 
@@ -478,16 +510,11 @@ async def handle_photo_album(messages: list[types.Message], state: FSMContext, b
     # Общий caption Telegram присылает только в первом элементе альбома 
     text = "\n".join([message.caption for message in messages if message.caption is not None])
     # print(text)
-    # Скачиваем все фото → BytesIO
-    image_buffers: list[io.BytesIO] = []
-    photo_ids: list[str] = []
+    # Скачиваем все фото → MediaBuffer (байты из кеша файлов, без копий по пути к модели)
     messages.sort(key=lambda x: x.message_id)
-    for msg in messages:
-        buf = io.BytesIO()
-        await bot.download(msg.photo[-1], destination=buf)
-        image_buffers.append(buf)
-        photo_ids.append(msg.photo[-1].file_id)
-        # print(msg.photo[-1].file_id)
+    photos = [msg.photo[-1] for msg in messages]
+    image_buffers: list[MediaBuffer] = await media_fetcher.fetch_many_media(bot, photos)
+    photo_ids = [photo.file_id for photo in photos]
     await users_repository.update_last_photo_id_by_user_id(photo_id=", ".join(photo_ids), user_id=user_id)
     # Отправляем весь список в GPT
     async with ChatActionSender.typing(bot=bot, chat_id=first.chat.id):
@@ -530,12 +557,11 @@ async def standard_message_photo_handler(message: Message, state: FSMContext, bo
     user = await users_repository.get_user_by_user_id(user_id=user_id)
     async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id):
         text = message.caption
-        photo_bytes_io = io.BytesIO()
         photo_id = message.photo[-1].file_id
         await users_repository.update_last_photo_id_by_user_id(photo_id=photo_id, user_id=user_id)
-        await bot.download(message.photo[-1], destination=photo_bytes_io)
+        photo = await media_fetcher.fetch_media(bot, message.photo[-1])
         # photo_answer = await gemini_images_client.generate_gemini_image(prompt=text,
-        #                                            reference_images=photo_bytes_io.read())
+        #                                            reference_images=photo)
         # photo = BufferedInputFile(file=photo_answer, filename="image.png")
         # await message.answer_photo(photo=photo)
         try:
@@ -543,7 +569,7 @@ async def standard_message_photo_handler(message: Message, state: FSMContext, bo
                                                          thread_id=user.standard_ai_threat_id,
                                                          text=text,
                                                          user_data=user,
-                                                         image_bytes=[photo_bytes_io])
+                                                         image_bytes=[photo])
         except NoSubscription:
             return
         except NoGenerations:
@@ -569,14 +595,11 @@ async def standard_message_voice_handler(message: Message, state: FSMContext, bo
     user_id = message.from_user.id
     user = await users_repository.get_user_by_user_id(user_id=user_id)
     async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id):
-        audio_bytes_io = io.BytesIO()
-        await bot.download(message.voice.file_id, destination=audio_bytes_io)
-        # Telegram сообщает mime_type для voice
-        mime = getattr(message.voice, "mime_type", None)  # Telegram даёт audio/ogg и т.п.
-
         try:
-            transcribed_audio_text = await get_current_assistant().transcribe_audio(
-                audio_bytes=audio_bytes_io,
+            # голосовое идёт из Telegram в Whisper потоком, длинное — параллельными кусками
+            transcribed_audio_text = await audio_pipeline.transcribe_voice(
+                bot=bot,
+                voice=message.voice,
                 language="ru"
             )
         except:
@@ -625,6 +648,11 @@ async def handle_document_album(messages: list[types.Message],  state: FSMContex
 
 
     if any(message.document.file_name.split('.')[-1].lower() in ['jpg', 'jpeg', 'png', "DNG", "gif", "dng"] for message in messages):
+        raw_documents = await media_fetcher.fetch_many(bot, [msg.document for msg in messages])
+        for msg, raw in zip(messages, raw_documents):
+            file_name = msg.document.file_name
+            doc_buffers.append((FileBuffer(raw, msg.document.file_unique_id), file_name, file_name.split('.')[-1].lower()))
+            file_ids.append(msg.document.file_id)
         try:
             ai_answer = await get_current_assistant().send_message(
                 user_id=user_id,
@@ -639,19 +667,18 @@ async def handle_document_album(messages: list[types.Message],  state: FSMContex
         except NoGenerations:
             return
     else:
+        # Сначала проверяем форматы, чтобы не качать альбом, который всё равно не обработаем
         for msg in messages:
-            buf = io.BytesIO()
-            await bot.download(msg.document, destination=buf)
-            file_name = msg.document.file_name
-            # print(file_name)
-            ext = file_name.split('.')[-1].lower()
-            if ext not in SUPPORTED_TEXT_FILE_TYPES:
+            if msg.document.file_name.split('.')[-1].lower() not in SUPPORTED_DOCUMENT_FILE_TYPES:
                 await first.reply(
                     f"⚠️ Формат файла «{msg.document.file_name}» не поддерживается. "
-                    f"Пришлите один из форматов: {', '.join(sorted(SUPPORTED_TEXT_FILE_TYPES))}"
+                    f"Пришлите один из форматов: {', '.join(sorted(SUPPORTED_DOCUMENT_FILE_TYPES))}"
                 )
                 return
-            doc_buffers.append((buf, file_name, ext))
+        raw_documents = await media_fetcher.fetch_many(bot, [msg.document for msg in messages])
+        for msg, raw in zip(messages, raw_documents):
+            file_name = msg.document.file_name
+            doc_buffers.append((FileBuffer(raw, msg.document.file_unique_id), file_name, file_name.split('.')[-1].lower()))
             file_ids.append(msg.document.file_id)
         try:
             ai_answer = await get_current_assistant().send_message(
@@ -690,10 +717,9 @@ async def standard_message_document_handler(message: Message, state: FSMContext,
         # delete_message = await message.reply("Формулирую ответ, это займет не более 5 секунд")
         text = message.caption
         # print(text)
-        buf = io.BytesIO()
         file_id = message.document.file_id
         # print(file_id)
-        await bot.download(message.document.file_id, destination=buf)
+        buf = await media_fetcher.fetch_buffer(bot, message.document)
 
 
         file_name = message.document.file_name
@@ -716,10 +742,10 @@ async def standard_message_document_handler(message: Message, state: FSMContext,
                 except NoGenerations:
                     return
             else:
-                if ext not in SUPPORTED_TEXT_FILE_TYPES:
+                if ext not in SUPPORTED_DOCUMENT_FILE_TYPES:
                     await message.reply(
                         f"⚠️ Формат файла «{message.document.file_name}» не поддерживается. "
-                        f"Пришлите один из форматов: {', '.join(sorted(SUPPORTED_TEXT_FILE_TYPES))}"
+                        f"Пришлите один из форматов: {', '.join(sorted(SUPPORTED_DOCUMENT_FILE_TYPES))}"
                     )
                     return
                 try:
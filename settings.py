@@ -2,7 +2,6 @@ import io
 import locale
 import re
 import asyncio
-import traceback
 import types
 from os import getenv
 import pandas as pd
@@ -17,7 +16,7 @@ from aiogram.types import Message
 from dotenv import load_dotenv, find_dotenv
 from loguru import logger
 
-from db.repository import subscriptions_repository, admin_repository
+from db.repository import subscriptions_repository
 
 from utils.google_banano_generate import GeminiImageService
 from utils.new_fitroom_api import FitroomClient
@@ -63,38 +62,14 @@ def set_current_loop(loop: asyncio.AbstractEventLoop):
     global _loop
     _loop = loop
 
-async def telegram_admin_sink(message):
-    """
-    Фоновые оповещения админам — полностью асинхронно.
-    """
-    try:
-        from bot_admin import admin_bot
-        record = message.record
-        time = record["time"].strftime("%d-%b-%Y %H:%M:%S")
-        level = record["level"].name
-        
-        # Определяем тип бота по текущему боту
-        bot_type = "TEST BOT" if get_current_bot() and hasattr(get_current_bot(), 'token') and get_current_bot().token == test_bot_token else ""
-        bot_prefix = f"️<b>{bot_type}</b>\n\n" if bot_type else ""
-        
-        text = f"{bot_prefix}<b>{time}</b>\n<b>Level:</b> {level}\n{record['message']}"
-        admins = await admin_repository.select_all_admins()
-        for admin in admins:
-            try:
-                print(admin.admin_id)
-                await admin_bot.send_message(chat_id=admin.admin_id, text=text)
-            except:
-                print(traceback.format_exc())
-                continue
-    except Exception:
-        logger.exception("Ошибка внутри telegram_admin_sink")
-
 def loguru_sink_wrapper(message):
     """
-    Синхронный синк для Loguru: из любого треда шлёт корутину в наш loop.
+    Синхронный синк для Loguru: из любого треда передаёт запись агрегатору алертов в наш loop.
+    Одинаковые ошибки склеиваются в дайджест, см. utils/admin_alerts.py
     """
     if _loop:
-        asyncio.run_coroutine_threadsafe(telegram_admin_sink(message), _loop)
+        from utils.admin_alerts import admin_alerts
+        admin_alerts.submit_threadsafe(message.record, _loop)
     else:
         logger.error("Event loop is not initialized, cannot notify admins")
 
@@ -139,6 +114,7 @@ def initialize_logger():
     logger.level("PROMO_ACTIVATED", no=60, color="<green>")
     logger.level("YooKassaError", no=65, color="<red>")
     logger.level("Sora2Error", no=65, color="<red>")
+    logger.level("STATS", no=25, color="<cyan>")
 
     # Синк для ERROR_HANDLER, GPT_ERROR
     for lvl in ("START_BOT", "STOPPED", "ERROR_HANDLER", "SCHEDULER_ERROR", "SCHEDULER_INFO", "PROMO_ACTIVATED",
@@ -159,11 +135,20 @@ first_photo = "AgACAgIAAxkBAAIHFWgvsyvJI83DztTg7ht8MBDAYOTdAAL68jEbtZ6BSUvhKdFmg
 second_photo = "AgACAgIAAxkBAAIHE2gvsyuw1J5Qq_0PHECiBqUJL9yNAAL48jEbtZ6BSXG82fh961ZiAQADAgADeQADNgQ"
 third_photo = "AgACAgIAAxkBAAIHFmgvsyvIF_6lUKrRzxHGEs9FFBiBAAL78jEbtZ6BSStjtX_DKxi6AQADAgADeQADNgQ"
 fourth_photo = "AgACAgIAAxkBAAIHFGgvsyv25F-DuLX-Qo6BTltn6cLtAAL58jEbtZ6BSf09-Dq-8ZxbAQADAgADeQADNgQ"
+# Страница инструкции (/start, /instructions) → имя статичной картинки в реестре медиа (utils/media_registry.py).
+# file_id выше загружены основным ботом; другому боту (тестовому) картинка один раз загрузится
+# из STATIC_MEDIA_DIR/<имя>.jpg и дальше тоже пойдёт по своему file_id
 photos_pages = {
-    1: first_photo,
-    2: second_photo,
-    3: third_photo,
-    4: fourth_photo,
+    1: "mechanics_page_1",
+    2: "mechanics_page_2",
+    3: "mechanics_page_3",
+    4: "mechanics_page_4",
+}
+static_photos = {
+    "mechanics_page_1": first_photo,
+    "mechanics_page_2": second_photo,
+    "mechanics_page_3": third_photo,
+    "mechanics_page_4": fourth_photo,
 }
 
 OPENAI_ALLOWED_DOC_EXTS: set[str] = {
@@ -245,10 +230,14 @@ async def is_valid_email(email):
 
 from utils.combined_gpt_tools import GPT  # noqa: E402
 from utils.completions_gpt_tools import GPTCompletions
+from utils.assistant_backends import AssistantBackend
+from utils.media_registry import media_registry
+
+media_registry.register_static(static_photos)
 
 gpt_assistant = None
 
-def set_current_assistant(assistant: GPT | GPTCompletions):
+def set_current_assistant(assistant: AssistantBackend | GPT | GPTCompletions):
     global gpt_assistant
     gpt_assistant = assistant
 
@@ -563,6 +552,11 @@ SUPPORTED_TEXT_FILE_TYPES = (
     "access", "error", "debug", "trace"
 )
 
+# Документы, текст из которых достаётся парсерами в utils/document_extraction.py
+EXTRACTABLE_DOCUMENT_TYPES = ("pdf", "docx", "xlsx", "xlsm")
+
+SUPPORTED_DOCUMENT_FILE_TYPES = SUPPORTED_TEXT_FILE_TYPES + EXTRACTABLE_DOCUMENT_TYPES
+
 
 
 sora_client = KieSora2Client()
@@ -578,6 +572,16 @@ async def on_shutdown(dispatcher):
     # Закрываем сессию
     await sora_client.close()
     logger.info("Sora клиент остановлен")
+    from utils.audio_pipeline import audio_pipeline
+    await audio_pipeline.close()
+    from utils.video_relay import video_relay
+    await video_relay.close()
+    from utils.image_processing import image_processor
+    image_processor.shutdown()
+    from utils.document_extraction import document_extractor
+    document_extractor.shutdown()
+    from utils.semantic_retrieval import semantic_retrieval
+    semantic_retrieval.shutdown()
 
 
 async def send_initial(bot: Bot, chat_id: int) -> Message:
@@ -593,10 +597,11 @@ def _split_ids(s: str) -> list[str]:
     return [x.strip() for x in (s or "").split(",") if x.strip()]
 
 async def build_telegram_image_urls_from_ids(bot: Bot, ids: list[str]) -> list[str]:
+    from utils.file_cache import file_cache
     urls: list[str] = []
     for file_id in ids:
         try:
-            f = await bot.get_file(file_id)  # -> aiogram.types.File
+            f = await file_cache.get_file(bot, file_id)  # кешированные метаданные aiogram.types.File
             if not f or not f.file_path:
                 continue
             # Формируем публичный URL к файлу на серверах Telegram:
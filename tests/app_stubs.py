@@ -0,0 +1,37 @@
+import os
+import sys
+import types
+from unittest import mock
+
+# app_stubs.py — заглушки модулей приложения для юнит-тестов:
+# settings при импорте поднимает ботов и читает .env, а db.models / db.repository тянут БД и все модели
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _placeholder_module(name: str, factory) -> types.ModuleType:
+    module = types.ModuleType(name)
+    cache: dict[str, object] = {}
+
+    def __getattr__(attr: str):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        if attr not in cache:
+            cache[attr] = factory(attr)
+        return cache[attr]
+
+    module.__getattr__ = __getattr__
+    return module
+
+
+def install() -> None:
+    """Ставит заглушки в sys.modules; вызывать до импорта тестируемых модулей utils"""
+    if "settings" not in sys.modules:
+        sys.modules["settings"] = _placeholder_module("settings", lambda attr: mock.MagicMock(name=attr))
+    for name in ("db.models", "db.repository", "data.keyboards"):
+        if name in sys.modules:
+            continue
+        module = _placeholder_module(name, lambda attr: type(attr, (), {}))
+        # подмодули (db.models.notifications и т.п.) грузятся настоящие
+        module.__path__ = [os.path.join(_ROOT, *name.split("."))]
+        sys.modules[name] = module
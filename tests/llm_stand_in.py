@@ -0,0 +1,61 @@
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+# llm_stand_in.py — локальная заглушка OpenAI-совместимого /v1/chat/completions (aiohttp, без внешней сети)
+#
+# Ей пользуются тесты LLMRouter и бенчмарк benchmarks/llm_router_failover.py.
+
+
+class StandInServer:
+    """Минимальный /v1/chat/completions с настраиваемой задержкой и отказами"""
+
+    def __init__(self, name: str, latency: float, tail_share: float = 0.0, tail_latency: float = 0.0,
+                 outage: tuple[float, float] | None = None, reject_requests: bool = False):
+        self.name = name
+        self.latency = latency
+        self.tail_share = tail_share
+        self.tail_latency = tail_latency
+        self.outage = outage
+        self.reject_requests = reject_requests        # отвечать 400, как на невалидный запрос
+        self.started_at = time.monotonic()
+        self.hits = 0
+        self.runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.hits += 1
+        body = await request.json()
+        elapsed = time.monotonic() - self.started_at
+        if self.outage and self.outage[0] <= elapsed < self.outage[1]:
+            await asyncio.sleep(0.05)
+            return web.json_response({"error": {"message": "overloaded"}}, status=503)
+        if self.reject_requests:
+            return web.json_response({"error": {"message": "invalid request"}}, status=400)
+        delay = self.tail_latency if random.random() < self.tail_share else self.latency
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+        return web.json_response({
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"ответ от {self.name}"}}],
+        })
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/v1"
+
+    def reset(self) -> None:
+        self.started_at = time.monotonic()
+        self.hits = 0
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
@@ -0,0 +1,85 @@
+import asyncio
+import sys
+import types
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendMessage
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils.admin_alerts import MAX_MESSAGE_LEN, AdminAlertAggregator, _AlertGroup, alert_fingerprint  # noqa: E402
+
+AT = datetime(2026, 1, 1, 12, 0, 0)
+
+
+class AdminAlertsTest(unittest.IsolatedAsyncioTestCase):
+    def _aggregator(self, window: float) -> AdminAlertAggregator:
+        aggregator = AdminAlertAggregator(window=window)
+        aggregator._send_digest = mock.AsyncMock()
+        return aggregator
+
+    def test_fingerprint_ignores_ids_and_addresses(self):
+        self.assertEqual(alert_fingerprint("ERROR", "123 | Ошибка в 0x7f12ab"),
+                         alert_fingerprint("ERROR", "456 | Ошибка в 0x7f99cd"))
+        self.assertNotEqual(alert_fingerprint("ERROR", "1 | Ошибка"), alert_fingerprint("WARNING", "1 | Ошибка"))
+
+    async def test_repeats_within_window_become_one_digest(self):
+        aggregator = self._aggregator(window=0.05)
+
+        for user_id in (1, 2, 3):
+            aggregator._put(("GPT_ERROR", f"{user_id} | Ошибка в ответе gpt", AT))
+        aggregator._put(("SCHEDULER_ERROR", "Job failed", AT))
+        await asyncio.sleep(0.1)
+
+        aggregator._send_digest.assert_awaited_once()
+        groups = aggregator._send_digest.await_args.args[0]
+        self.assertEqual([(g.level, g.count) for g in groups], [("GPT_ERROR", 3), ("SCHEDULER_ERROR", 1)])
+        await aggregator.flush()
+
+    async def test_flush_sends_without_waiting_for_window(self):
+        aggregator = self._aggregator(window=60)
+        aggregator._put(("ERROR", "бот остановлен", AT))
+        await asyncio.sleep(0)
+
+        await aggregator.flush()
+
+        aggregator._send_digest.assert_awaited_once()
+        self.assertEqual(aggregator._pending, {})
+
+    def test_long_digest_is_split_under_telegram_limit(self):
+        aggregator = AdminAlertAggregator()
+        groups = [_AlertGroup("ERROR", f"{i} " + "x" * 2000, AT) for i in range(6)]
+
+        messages = aggregator._pack_messages(groups)
+
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(len(m) <= MAX_MESSAGE_LEN for m in messages))
+        self.assertEqual(sum(m.count("<b>Level:</b>") for m in messages), 6)
+
+    async def test_broken_markup_falls_back_to_plain_text(self):
+        aggregator = AdminAlertAggregator()
+        aggregator._admin_ids, aggregator._admins_loaded_at = [7], float("inf")
+        sent: list[dict] = []
+
+        async def send_message(**kwargs):
+            if kwargs.get("parse_mode", "HTML") is not None:
+                raise TelegramBadRequest(method=SendMessage(chat_id=7, text=""), message="can't parse entities")
+            sent.append(kwargs)
+
+        sender = types.SimpleNamespace(send_message=send_message)
+        with mock.patch.dict(sys.modules, {"bot_admin": types.SimpleNamespace(admin_bot=object())}), \
+                mock.patch("utils.telegram_sender.get_sender", return_value=sender):
+            await aggregator._send_digest([_AlertGroup("ERROR", 'File "<module>", line 1', AT)])
+
+        self.assertEqual(len(sent), 1)
+        self.assertNotIn("<b>", sent[0]["text"])
+        self.assertIn("<module>", sent[0]["text"])
+
+
+if __name__ == "__main__":
+    unittest.main()
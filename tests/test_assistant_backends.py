@@ -0,0 +1,168 @@
+import asyncio
+import unittest
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import assistant_backends  # noqa: E402
+from utils.assistant_backends import AssistantRouter, ToolExecutor, get_thread_lock  # noqa: E402
+
+
+class _FakeBackend:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: list[int] = []
+
+    async def send_message(self, user_id: int, thread_id: str | None = None, **kwargs) -> dict:
+        self.calls.append(user_id)
+        return {"text": f"ответ от {self.name}"}
+
+
+def _factories(*names: str) -> dict:
+    return {name: (lambda name=name: _FakeBackend(name)) for name in names}
+
+
+class ToolExecutorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_results_keep_call_order(self):
+        executor = ToolExecutor(concurrency=3)
+
+        async def tool(value: int, delay: float) -> int:
+            await asyncio.sleep(delay)
+            return value
+
+        results = await executor.run(1, [
+            ("slow", lambda: tool(1, 0.05)),
+            ("fast", lambda: tool(2, 0.0)),
+            ("medium", lambda: tool(3, 0.02)),
+        ])
+
+        self.assertEqual(results, [1, 2, 3])
+
+    async def test_per_user_concurrency_cap(self):
+        executor = ToolExecutor(concurrency=2)
+        active = {1: 0, 2: 0}
+        peak = {1: 0, 2: 0}
+
+        async def tool(user_id: int) -> None:
+            active[user_id] += 1
+            peak[user_id] = max(peak[user_id], active[user_id])
+            await asyncio.sleep(0.02)
+            active[user_id] -= 1
+
+        await asyncio.gather(
+            executor.run(1, [("generate_image", lambda: tool(1)) for _ in range(5)]),
+            executor.run(1, [("search_web", lambda: tool(1)) for _ in range(3)]),
+            executor.run(2, [("search_web", lambda: tool(2)) for _ in range(2)]),
+        )
+
+        self.assertEqual(peak[1], 2)          # оба хода пользователя делят один лимит
+        self.assertEqual(peak[2], 2)          # а чужой лимит от него не зависит
+        self.assertEqual(executor._semaphores, {})
+
+    async def test_failing_tool_does_not_break_others(self):
+        executor = ToolExecutor()
+
+        async def ok() -> str:
+            await asyncio.sleep(0.01)
+            return "ok"
+
+        async def broken() -> str:
+            raise ValueError("инструмент упал")
+
+        results = await executor.run(1, [("search_web", ok), ("generate_image", broken), ("add_notification", ok)])
+
+        self.assertEqual(results[0], "ok")
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], "ok")
+        self.assertEqual(executor.snapshot()["generate_image"]["errors"], 1)
+        self.assertEqual(executor.snapshot()["search_web"]["errors"], 0)
+
+
+class AssistantRouterTest(unittest.IsolatedAsyncioTestCase):
+    def test_split_is_sticky_and_follows_shares(self):
+        factories = _factories("completions", "responses")
+        router = AssistantRouter(default="completions", split="completions:70,responses:30",
+                                 users="", salt="test", factories=factories)
+        same_salt = AssistantRouter(default="completions", split="completions:70,responses:30",
+                                    users="", salt="test", factories=factories)
+
+        names = [router.backend_name(user_id) for user_id in range(2000)]
+
+        self.assertEqual(names, [router.backend_name(user_id) for user_id in range(2000)])
+        self.assertEqual(names, [same_salt.backend_name(user_id) for user_id in range(2000)])
+        self.assertAlmostEqual(names.count("responses") / len(names), 0.3, delta=0.05)
+
+    def test_new_salt_reshuffles_users(self):
+        factories = _factories("completions", "responses")
+        first = AssistantRouter(default="completions", split="completions:50,responses:50",
+                                users="", salt="ab-1", factories=factories)
+        second = AssistantRouter(default="completions", split="completions:50,responses:50",
+                                 users="", salt="ab-2", factories=factories)
+
+        moved = sum(first.backend_name(u) != second.backend_name(u) for u in range(1000))
+
+        self.assertGreater(moved, 300)
+
+    def test_override_beats_split(self):
+        router = AssistantRouter(default="completions", split="completions:100",
+                                 users='{"42": "assistants"}', salt="test",
+                                 factories=_factories("completions", "assistants"))
+
+        self.assertEqual(router.backend_name(42), "assistants")
+        self.assertEqual(router.backend_name(43), "completions")
+
+    def test_unknown_backend_rejected(self):
+        with self.assertRaises(ValueError):
+            AssistantRouter(default="completions", split="", users='{"1": "legacy"}', salt="test",
+                            factories=_factories("completions"))
+
+    async def test_send_message_goes_to_user_backend(self):
+        router = AssistantRouter(default="completions", split="", users='{"7": "responses"}', salt="test",
+                                 factories=_factories("completions", "responses"))
+
+        answer = await router.send_message(7, text="привет")
+        await router.send_message(8, text="привет")
+
+        self.assertEqual(answer, {"text": "ответ от responses"})
+        self.assertEqual(router.backend("responses").calls, [7])
+        self.assertEqual(router.backend("completions").calls, [8])
+        self.assertEqual(router.snapshot()["responses"]["requests"], 1)
+
+
+class ThreadLocksTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._saved = dict(assistant_backends._thread_locks)
+        assistant_backends._thread_locks.clear()
+
+    async def asyncTearDown(self):
+        assistant_backends._thread_locks.clear()
+        assistant_backends._thread_locks.update(self._saved)
+
+    async def test_idle_locks_are_evicted(self):
+        limit = assistant_backends.THREAD_LOCKS_SOFT_LIMIT
+        busy = await get_thread_lock("busy")
+        async with busy:
+            for key in range(limit):
+                await get_thread_lock(str(key))
+            self.assertIs(await get_thread_lock("busy"), busy)
+
+        self.assertLessEqual(len(assistant_backends._thread_locks), 2)
+        self.assertIn("busy", assistant_backends._thread_locks)
+
+    async def test_lock_handed_to_waiter_is_kept(self):
+        lock = await get_thread_lock("dialog")
+        await lock.acquire()
+        waiter = asyncio.create_task(lock.acquire())
+        await asyncio.sleep(0)
+        lock.release()              # замок свободен, но разбуженный ожидающий ещё не успел его взять
+
+        assistant_backends._drop_idle_thread_locks()
+
+        self.assertIs(await get_thread_lock("dialog"), lock)
+        await waiter
+        lock.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import struct
+import unittest
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils.audio_pipeline import OPUS_RATE, OggOpusSplitter  # noqa: E402
+
+
+def _page(granule: int, body: bytes, seq: int = 0) -> bytes:
+    """Страница OGG с телом короче 255 байт (один сегмент); CRC декодеру в тесте не нужен"""
+    return b"OggS" + struct.pack("<BBqIIIB", 0, 0, granule, 1, seq, 0, 1) + bytes([len(body)]) + body
+
+
+HEADERS = [_page(0, b"OpusHead\x01\x01"), _page(0, b"OpusTags")]
+
+
+def _audio(seconds: range) -> list[bytes]:
+    return [_page(second * OPUS_RATE, f"audio-{second}".encode(), seq=second) for second in seconds]
+
+
+def _feed(splitter: OggOpusSplitter, stream: bytes, step: int) -> list[bytes]:
+    chunks: list[bytes] = []
+    for pos in range(0, len(stream), step):
+        chunks += splitter.feed(stream[pos:pos + step])
+    tail = splitter.finish()
+    return chunks + ([tail] if tail else [])
+
+
+class OggOpusSplitterTest(unittest.TestCase):
+    def test_chunks_are_standalone_and_lose_no_pages(self):
+        pages = _audio(range(1, 66))
+        stream = b"".join(HEADERS + pages)
+
+        for step in (7, 4096):                      # страницы, разорванные между порциями, и целые порции
+            with self.subTest(step=step):
+                chunks = _feed(OggOpusSplitter(chunk_sec=30, total_sec=65), stream, step)
+
+                self.assertEqual(len(chunks), 3)
+                self.assertTrue(all(chunk.startswith(b"".join(HEADERS)) for chunk in chunks))
+                audio = b"".join(chunk[len(b"".join(HEADERS)):] for chunk in chunks)
+                self.assertEqual(audio, b"".join(pages))
+
+    def test_short_tail_joins_last_chunk(self):
+        stream = b"".join(HEADERS + _audio(range(1, 64)))
+
+        chunks = _feed(OggOpusSplitter(chunk_sec=30, total_sec=63), stream, 4096)
+
+        self.assertEqual(len(chunks), 2)            # хвост в 3 секунды не отделяется
+        self.assertIn(b"audio-63", chunks[-1])
+
+    def test_page_without_granule_is_not_a_boundary(self):
+        pages = _audio(range(1, 30)) + [_page(-1, b"continued")] + _audio(range(30, 70))
+        chunks = _feed(OggOpusSplitter(chunk_sec=30, total_sec=69), b"".join(HEADERS + pages), 4096)
+
+        self.assertIn(b"continued", chunks[0])
+        self.assertTrue(chunks[0].endswith(_audio(range(30, 31))[0]))
+
+    def test_garbage_between_pages_is_skipped(self):
+        pages = _audio(range(1, 11))
+        stream = b"".join(HEADERS + pages[:5]) + b"\x00junk" + b"".join(pages[5:])
+
+        chunks = _feed(OggOpusSplitter(chunk_sec=30, total_sec=10), stream, 3)
+
+        self.assertEqual(chunks, [b"".join(HEADERS + pages)])
+
+    def test_non_ogg_stream_is_rejected(self):
+        splitter = OggOpusSplitter(chunk_sec=30, total_sec=90)
+
+        self.assertEqual(splitter.feed(b"ID3\x04" + b"\x00" * 100), [])
+        self.assertFalse(splitter.valid)
+        self.assertIsNone(splitter.finish())
+
+    def test_ogg_without_opus_head_is_rejected(self):
+        splitter = OggOpusSplitter(chunk_sec=30, total_sec=90)
+
+        splitter.feed(_page(0, b"\x01vorbis"))
+
+        self.assertFalse(splitter.valid)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import io
+import types
+import unittest
+from unittest import mock
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import completions_gpt_tools  # noqa: E402
+from utils.completions_gpt_tools import GPTCompletions  # noqa: E402
+
+
+class _FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.02)
+        message = types.SimpleNamespace(content=f"ответ {self.calls}", tool_calls=None)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class SendMessageCoalescingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.completions = _FakeCompletions()
+        self.history = mock.AsyncMock()
+        self.history.load.return_value = []
+        users = mock.AsyncMock()
+        users.get_user_by_user_id.return_value = types.SimpleNamespace(user_id=1, context=None)
+        patcher = mock.patch.object(completions_gpt_tools, "users_repository", users)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.gpt = GPTCompletions()
+        self.gpt.client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=self.completions))
+        self.gpt.history = self.history
+
+    def _saved_inputs(self) -> list[dict]:
+        return [c.kwargs["payload"] for c in self.history.append.await_args_list
+                if c.kwargs["payload"]["type"] == "human"]
+
+    async def test_duplicate_turn_reaches_api_once(self):
+        first, second = await asyncio.gather(
+            self.gpt.send_message(1, text="нарисуй кота"),
+            self.gpt.send_message(1, text="нарисуй кота"),
+        )
+
+        self.assertEqual(self.completions.calls, 1)
+        self.assertEqual(first["text"], "ответ 1")
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(len(self._saved_inputs()), 1)
+
+    async def test_same_photo_in_new_buffer_is_a_duplicate(self):
+        photo = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+        key = completions_gpt_tools._turn_key
+        common = dict(text="что на фото?", document_bytes=None, audio_bytes=None, with_audio_transcription=False)
+
+        self.assertEqual(key(1, image_bytes=[io.BytesIO(photo)], **common),
+                         key(1, image_bytes=[io.BytesIO(photo)], **common))
+        self.assertNotEqual(key(1, image_bytes=[io.BytesIO(photo)], **common),
+                            key(2, image_bytes=[io.BytesIO(photo)], **common))
+
+    async def test_different_turns_run_one_after_another(self):
+        first, second = await asyncio.gather(
+            self.gpt.send_message(1, text="привет"),
+            self.gpt.send_message(1, text="как дела?"),
+        )
+
+        self.assertEqual(self.completions.calls, 2)
+        self.assertEqual({first["text"], second["text"]}, {"ответ 1", "ответ 2"})
+        self.assertEqual(len(self._saved_inputs()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
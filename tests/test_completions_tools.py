@@ -0,0 +1,74 @@
+import json
+import types
+import unittest
+from unittest import mock
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import completions_gpt_tools  # noqa: E402
+from utils.assistant_backends import NoSubscription, TurnQuota  # noqa: E402
+
+
+def _call(tool_id: str, name: str, **arguments) -> dict:
+    return {"id": tool_id, "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments, ensure_ascii=False)}}
+
+
+class RefusedToolCallsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.access = mock.AsyncMock(side_effect=NoSubscription("нет подписки"))
+        self.history = mock.AsyncMock()
+        self.executed: list[str] = []
+
+        async def dispatch(tc, image_client, **kwargs):
+            self.executed.append(tc["function"]["name"])
+            return "найдено"
+
+        users = mock.AsyncMock()
+        users.get_user_by_user_id.return_value = types.SimpleNamespace(user_id=1)
+        for name, value in {
+            "require_tool_access": self.access,
+            "dispatch_tool_call": dispatch,
+            "send_tool_indicator": mock.AsyncMock(return_value=None),
+            "dialogs_messages_repository": self.history,
+            "users_repository": users,
+            "AsyncOpenAIImageClient": mock.MagicMock,
+        }.items():
+            patcher = mock.patch.object(completions_gpt_tools, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def _run(self, tool_calls: list[dict]):
+        messages = [{"role": "user", "content": "вопрос"},
+                    {"role": "assistant", "content": None, "tool_calls": tool_calls}]
+        return await completions_gpt_tools.run_tools_and_followup_chat(
+            client=None, messages=messages, tool_calls=tool_calls, user_id=1, max_photo_generations=0,
+            quota=TurnQuota(user_id=1, subscription=None, plan=None),
+        )
+
+    async def test_free_calls_still_run_next_to_refused_one(self):
+        _, web_answer, _, outputs, _ = await self._run([
+            _call("c1", "generate_image", prompt="кот"),
+            _call("c2", "search_web", query="погода"),
+            _call("c3", "generate_image", prompt="собака"),
+        ])
+
+        self.assertEqual(self.executed, ["search_web"])
+        self.assertEqual(web_answer, "найдено")
+        self.assertEqual([m["tool_call_id"] for m in outputs], ["c1", "c3", "c2"])
+        self.assertEqual(json.loads(outputs[0]["content"])["reason"], "no_subscription")
+        self.access.assert_awaited_once()           # сообщение о подписке уходит пользователю один раз
+
+    async def test_only_refused_calls_raise(self):
+        with self.assertRaises(NoSubscription):
+            await self._run([_call("c1", "generate_image", prompt="кот")])
+
+        saved = self.history.add_messages.await_args.kwargs["messages"]
+        self.assertEqual([m["tool_call_id"] for m in saved], ["c1"])
+        self.assertEqual(self.executed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
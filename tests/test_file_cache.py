@@ -0,0 +1,63 @@
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from utils.file_cache import TelegramFileCache
+
+
+class TelegramFileCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    async def test_memory_evicts_least_recently_used(self):
+        cache = TelegramFileCache(memory_max_bytes=250, disk_dir=None)
+        await cache.put("a", b"a" * 100)
+        await cache.put("b", b"b" * 100)
+        await cache.get("a")                      # «a» свежее «b»
+        await cache.put("c", b"c" * 100)
+
+        self.assertIsNotNone(await cache.get("a"))
+        self.assertIsNone(await cache.get("b"))
+        self.assertIsNotNone(await cache.get("c"))
+        self.assertEqual(cache.snapshot()["memory_bytes"], 200)
+
+    async def test_disk_level_survives_memory_eviction_and_restart(self):
+        cache = TelegramFileCache(memory_max_bytes=100, disk_dir=self.tmp.name, disk_max_bytes=1000)
+        await cache.put("a", b"a" * 100)
+        await cache.put("b", b"b" * 100)
+
+        self.assertEqual(await cache.get("a"), b"a" * 100)
+        self.assertEqual(cache.stats["disk_hits"], 1)
+
+        restarted = TelegramFileCache(memory_max_bytes=100, disk_dir=self.tmp.name, disk_max_bytes=1000)
+        self.assertEqual(await restarted.get("b"), b"b" * 100)
+
+    async def test_disk_evicts_over_limit_and_removes_files(self):
+        cache = TelegramFileCache(memory_max_bytes=1000, disk_dir=self.tmp.name, disk_max_bytes=250)
+        for key in ("a", "b", "c"):
+            await cache.put(key, key.encode() * 100)
+
+        self.assertEqual(cache.snapshot()["disk_bytes"], 200)
+        self.assertFalse(os.path.exists(cache._disk_path("a")))
+        self.assertFalse(os.path.exists(cache._disk_path("a") + ".key"))
+        self.assertTrue(os.path.exists(cache._disk_path("c")))
+
+    async def test_file_id_resolves_to_unique_id(self):
+        cache = TelegramFileCache(disk_dir=None)
+        bot = types.SimpleNamespace(id=1, get_file=mock.AsyncMock(return_value=types.SimpleNamespace(
+            file_unique_id="uniq", file_path="photos/1.jpg", file_size=3)))
+        await cache.put("uniq", b"jpg")
+
+        first = await cache.get_file(bot, "file-id-1")
+        await cache.get_file(bot, "file-id-1")
+
+        self.assertEqual(first.file_path, "photos/1.jpg")
+        self.assertEqual(bot.get_file.await_count, 1)
+        self.assertEqual(await cache.get("file-id-1"), b"jpg")
+
+
+if __name__ == "__main__":
+    unittest.main()
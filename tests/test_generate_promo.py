@@ -0,0 +1,80 @@
+import collections
+import unittest
+from unittest import mock
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import generate_promo  # noqa: E402
+from utils.generate_promo import ALPHABET, create_promo_codes, generate_promo_codes  # noqa: E402
+
+
+class GeneratePromoCodesTest(unittest.TestCase):
+    def test_codes_are_distinct_and_well_formed(self):
+        codes = generate_promo_codes(500, code_length=8)
+
+        self.assertEqual(len(codes), 500)
+        self.assertTrue(all(len(code) == 8 and set(code) <= set(ALPHABET) for code in codes))
+
+    def test_every_byte_maps_without_bias(self):
+        # ровно по разу каждый байт: на каждый символ алфавита должно прийтись одинаково, хвост 252..255 отброшен
+        with mock.patch.object(generate_promo.secrets, "token_bytes", return_value=bytes(range(256))):
+            codes = generate_promo_codes(36, code_length=7)
+
+        counts = collections.Counter("".join(codes))
+        self.assertEqual(set(counts), set(ALPHABET))
+        self.assertEqual(set(counts.values()), {7})
+
+    def test_short_batch_is_topped_up(self):
+        # первый вызов даёт одни отбрасываемые байты — генератор должен добрать коды следующим
+        rejected = bytes([255]) * 40
+        with mock.patch.object(generate_promo.secrets, "token_bytes",
+                               side_effect=[rejected, bytes(range(256))]) as token_bytes:
+            codes = generate_promo_codes(2, code_length=10)
+
+        self.assertEqual(len(codes), 2)
+        self.assertEqual(token_bytes.call_count, 2)
+
+
+class CreatePromoCodesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.existing = {"TAKEN00001"}
+        self.inserted: list[list[str]] = []
+
+        async def add_promos_bulk(codes, **kwargs):
+            self.inserted.append(list(codes))
+            fresh = [code for code in codes if code not in self.existing]
+            self.existing.update(fresh)
+            return fresh
+
+        referrals = mock.AsyncMock()
+        referrals.add_promos_bulk.side_effect = add_promos_bulk
+        self.plans = mock.AsyncMock()
+        for name, value in {"referral_system_repository": referrals, "type_subscriptions_repository": self.plans}.items():
+            patcher = mock.patch.object(generate_promo, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_collisions_are_regenerated(self):
+        batches = iter([{"TAKEN00001", "FRESH00001", "FRESH00002"}, {"FRESH00003"}])
+        with mock.patch.object(generate_promo, "generate_promo_codes", side_effect=lambda n, length: next(batches)):
+            created = await create_promo_codes(3, days_sub=7, max_activations=None, max_generations=5)
+
+        self.assertEqual(sorted(created), ["FRESH00001", "FRESH00002", "FRESH00003"])
+        self.assertEqual(len(self.inserted), 2)
+        self.assertEqual(len(self.inserted[1]), 1)            # во втором раунде — только взамен коллизии
+        plan_names = self.plans.add_type_subscriptions_bulk.await_args.args[0]
+        self.assertEqual(sorted(plan_names), [f"promo_{code}" for code in sorted(created)])
+
+    async def test_gives_up_after_max_rounds(self):
+        with mock.patch.object(generate_promo, "generate_promo_codes", return_value={"TAKEN00001"}):
+            with self.assertRaises(RuntimeError):
+                await create_promo_codes(1, days_sub=7, max_activations=None, max_generations=5)
+
+        self.assertEqual(len(self.inserted), generate_promo.MAX_GENERATION_ROUNDS)
+        self.plans.add_type_subscriptions_bulk.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
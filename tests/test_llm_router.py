@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import time
+import unittest
+
+from openai import BadRequestError
+
+from tests.llm_stand_in import StandInServer
+from utils.llm_router import LLMBackend, LLMBackendConfig, LLMRouter
+from utils.resilience import BreakerState, CircuitBreaker
+
+
+def _half_open_breaker(name: str) -> CircuitBreaker:
+    breaker = CircuitBreaker(name, reset_timeout=0.05)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    return breaker
+
+
+class LLMRouterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.servers: list[StandInServer] = []
+        self.routers: list[LLMRouter] = []
+
+    async def asyncTearDown(self):
+        for router in self.routers:
+            for backend in router.backends:
+                if backend._client is not None:
+                    await backend._client.close()
+        for server in self.servers:
+            await server.stop()
+
+    async def _server(self, name: str, latency: float, **kwargs) -> StandInServer:
+        server = StandInServer(name, latency=latency, **kwargs)
+        await server.start()
+        self.servers.append(server)
+        return server
+
+    def _router(self, *servers: StandInServer) -> LLMRouter:
+        router = LLMRouter([LLMBackendConfig(s.name, s.url, "test") for s in servers])
+        self.routers.append(router)
+        return router
+
+    async def _ask(self, router: LLMRouter):
+        return await router.chat.completions.create(model="gpt-5-mini",
+                                                    messages=[{"role": "user", "content": "вопрос"}])
+
+    async def _wait_half_open(self, breaker: CircuitBreaker) -> None:
+        await asyncio.sleep(0.06)
+        self.assertIs(breaker.state, BreakerState.HALF_OPEN)
+
+    async def test_cancelled_probe_releases_slot(self):
+        slow = await self._server("slow", latency=2.0)
+        router = self._router(slow)
+        backend = router.backends[0]
+        backend.breaker = _half_open_breaker("llm:slow")
+        await self._wait_half_open(backend.breaker)
+
+        call = asyncio.create_task(self._ask(router))
+        await asyncio.sleep(0.2)
+        call.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await call
+        await asyncio.sleep(0.1)      # отменённые задачи бэкендов успевают завершиться
+
+        self.assertIs(backend.breaker.state, BreakerState.HALF_OPEN)
+        self.assertTrue(backend.breaker.allow())
+
+    async def test_probe_cancelled_before_start_releases_slot(self):
+        slow = await self._server("slow", latency=2.0)
+        backend = self._router(slow).backends[0]
+        backend.breaker = _half_open_breaker("llm:slow")
+        await self._wait_half_open(backend.breaker)
+
+        task = backend.start({"model": "gpt-5-mini", "messages": []})
+        self.assertIsNotNone(task)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+        self.assertTrue(backend.breaker.allow())
+
+    async def test_bad_request_does_not_close_half_open_breaker(self):
+        strict = await self._server("strict", latency=0.01, reject_requests=True)
+        router = self._router(strict)
+        backend = router.backends[0]
+        backend.breaker = _half_open_breaker("llm:strict")
+        await self._wait_half_open(backend.breaker)
+
+        with self.assertRaises(BadRequestError):
+            await self._ask(router)
+
+        self.assertIs(backend.breaker.state, BreakerState.HALF_OPEN)
+        self.assertTrue(backend.breaker.allow())
+        self.assertEqual(router.stats["failovers"], 0)
+
+    async def test_reset_client_waits_for_requests_in_flight(self):
+        # первый запрос успевает до «аварии» и отвечает через 0.3 с, второй получает 503 и размыкает цепь
+        flaky = await self._server("flaky", latency=0.3, outage=(0.1, 1e9))
+        backend = LLMBackend(LLMBackendConfig(flaky.name, flaky.url, "test"))    # без повторов внутри SDK
+        backend.breaker = CircuitBreaker("llm:flaky", failure_threshold=1)
+        request = {"model": "gpt-5-mini", "messages": [{"role": "user", "content": "вопрос"}]}
+        old = backend.client
+        flaky.reset()
+
+        slow = asyncio.create_task(backend.create(request))
+        await asyncio.sleep(0.15)
+        with self.assertRaises(Exception):
+            await backend.create(request)
+        await asyncio.sleep(0.05)
+
+        self.assertIsNot(backend.client, old)
+        self.assertFalse(old.is_closed())
+        self.assertEqual((await slow).choices[0].message.content, "ответ от flaky")
+        await asyncio.sleep(0.01)       # закрытие старого клиента идёт отдельной задачей
+        self.assertTrue(old.is_closed())
+        await backend.client.close()
+
+    async def test_hedge_loser_releases_probe(self):
+        slow = await self._server("slow", latency=2.0)
+        fast = await self._server("fast", latency=0.01)
+        router = self._router(slow, fast)
+        prober, _ = router.backends
+        prober.breaker = _half_open_breaker("llm:slow")
+        prober.hedge_after = lambda: 0.05
+        await self._wait_half_open(prober.breaker)
+
+        result = await self._ask(router)
+        await asyncio.sleep(0.1)      # отменённые задачи бэкендов успевают завершиться
+
+        self.assertEqual(result.choices[0].message.content, "ответ от fast")
+        self.assertEqual(router.stats["hedged"], 1)
+        self.assertTrue(prober.breaker.allow())
+
+    async def test_hedge_timing_follows_failover_backend(self):
+        down = await self._server("down", latency=0.01, outage=(0.0, 1e9))
+        slow = await self._server("slow", latency=2.0)
+        fast = await self._server("fast", latency=0.01)
+        router = self._router(down, slow, fast)
+        router.backends[0].hedge_after = lambda: 10.0
+        router.backends[1].hedge_after = lambda: 0.05
+
+        started = time.perf_counter()
+        result = await self._ask(router)
+
+        self.assertEqual(result.choices[0].message.content, "ответ от fast")
+        self.assertEqual(router.stats["failovers"], 1)
+        self.assertLess(time.perf_counter() - started, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import base64
+import hashlib
+import io
+import unittest
+
+from utils.media_buffer import MediaBuffer, as_media, sniff_mime
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+
+
+class FileBuffer(io.BytesIO):
+    """Как буфер из media_fetcher: BytesIO с file_unique_id"""
+    file_unique_id = "uniq"
+
+
+class MediaBufferTest(unittest.TestCase):
+    def test_bytes_source_is_never_copied(self):
+        buffer = MediaBuffer(JPEG)
+
+        self.assertIs(buffer.tobytes(), JPEG)
+        self.assertIs(buffer.getvalue(), JPEG)
+        self.assertTrue(buffer.view.readonly)
+        self.assertIs(buffer.view.obj, JPEG)
+
+    def test_view_over_bytearray_is_readonly(self):
+        data = bytearray(PNG)
+        buffer = MediaBuffer(data)
+
+        with self.assertRaises(TypeError):
+            buffer.view[0] = 0
+        self.assertEqual(len(buffer), len(PNG))
+        self.assertEqual(len(MediaBuffer(memoryview(data))), len(PNG))
+
+    def test_derived_values_are_computed_once(self):
+        buffer = MediaBuffer(PNG)
+
+        data_url = buffer.data_url()
+        self.assertIs(buffer.data_url(), data_url)
+        self.assertEqual(data_url, "data:image/png;base64," + base64.b64encode(PNG).decode())
+        self.assertEqual(buffer.sha256(), hashlib.sha256(PNG).hexdigest())
+        self.assertNotEqual(buffer.data_url("image/jpeg"), data_url)      # другой MIME — другой data URL
+
+    def test_precomputed_data_url_is_reused(self):
+        buffer = MediaBuffer(JPEG)
+        buffer.remember_data_url("data:image/jpeg;base64,precomputed")
+
+        self.assertTrue(buffer.has_data_url)
+        self.assertEqual(buffer.data_url(), "data:image/jpeg;base64,precomputed")
+
+    def test_sniff_mime(self):
+        cases = {JPEG: "image/jpeg", PNG: "image/png", b"RIFF\x00\x00\x00\x00WEBPVP8 ": "image/webp",
+                 b"OggS\x00\x02": "audio/ogg", b"%PDF-1.7": "application/pdf", b"plain text": None}
+        for data, mime in cases.items():
+            with self.subTest(mime=mime):
+                self.assertEqual(sniff_mime(data), mime)
+
+    def test_as_media_keeps_identity_and_file_unique_id(self):
+        buffer = MediaBuffer(JPEG)
+        self.assertIs(as_media(buffer), buffer)
+
+        from_file = as_media(FileBuffer(JPEG))
+        self.assertEqual(from_file.file_unique_id, "uniq")
+        self.assertEqual(from_file.tobytes(), JPEG)
+        self.assertIs(as_media(JPEG).tobytes(), JPEG)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendPhoto
+from aiogram.types import BufferedInputFile, FSInputFile
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import media_registry as registry_module  # noqa: E402
+from utils.media_registry import MediaRegistry, content_key, static_key  # noqa: E402
+
+BOT = types.SimpleNamespace(id=1)
+
+
+def _bad_request(message: str) -> TelegramBadRequest:
+    return TelegramBadRequest(method=SendPhoto(chat_id=1, photo="x"), message=message)
+
+
+class MediaRegistryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.rows: dict[tuple[int, str], str] = {}
+        repository = mock.AsyncMock()
+        repository.get_media.side_effect = lambda bot_id, media_key: (
+            types.SimpleNamespace(file_id=self.rows[bot_id, media_key]) if (bot_id, media_key) in self.rows else None)
+        repository.upsert_media.side_effect = lambda bot_id, media_key, file_id, **kwargs: self.rows.__setitem__(
+            (bot_id, media_key), file_id)
+        repository.delete_media.side_effect = lambda bot_id, media_key: self.rows.pop((bot_id, media_key), None)
+        patcher = mock.patch.object(registry_module, "telegram_media_repository", repository)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.static_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.static_dir.cleanup)
+        self.registry = MediaRegistry(static_dir=self.static_dir.name)
+        self.sent: list = []
+        self.stale_ids: set[str] = set()
+
+    async def _telegram(self, media):
+        """Отправка фото: загрузка получает новый file_id, протухший file_id Telegram отвергает"""
+        self.sent.append(media)
+        await asyncio.sleep(0.01)
+        if isinstance(media, str):
+            if media in self.stale_ids:
+                raise _bad_request("Bad Request: wrong file identifier/HTTP URL specified")
+            file_id = media
+        else:
+            file_id = f"file_{len(self.sent)}"
+        return types.SimpleNamespace(photo=[types.SimpleNamespace(file_id=file_id, file_unique_id="u")])
+
+    async def _send(self, key: str | None):
+        return await self.registry.send(BOT, key, "photo", self._telegram,
+                                        lambda: BufferedInputFile(b"jpg", filename="photo.jpg"))
+
+    async def test_second_send_goes_by_file_id(self):
+        key = content_key(b"jpg")
+        await self._send(key)
+        await self._send(key)
+
+        self.assertIsInstance(self.sent[0], BufferedInputFile)
+        self.assertEqual(self.sent[1], "file_1")
+        self.assertEqual(self.rows[BOT.id, key], "file_1")
+
+    async def test_file_id_is_shared_after_restart(self):
+        key = content_key(b"jpg")
+        self.rows[BOT.id, key] = "file_saved"
+
+        await self._send(key)
+
+        self.assertEqual(self.sent, ["file_saved"])
+
+    async def test_stale_file_id_falls_back_to_upload(self):
+        key = content_key(b"jpg")
+        self.rows[BOT.id, key] = "file_gone"
+        self.stale_ids.add("file_gone")
+
+        result = await self._send(key)
+
+        self.assertEqual(self.sent[0], "file_gone")
+        self.assertIsInstance(self.sent[1], BufferedInputFile)
+        self.assertEqual(result.photo[-1].file_id, "file_2")
+        self.assertEqual(self.rows[BOT.id, key], "file_2")
+        self.assertEqual(self.registry.stats["stale"], 1)
+
+    async def test_other_bad_request_is_not_retried(self):
+        key = content_key(b"jpg")
+        self.rows[BOT.id, key] = "file_ok"
+
+        async def send(media):
+            self.sent.append(media)
+            raise _bad_request("Bad Request: chat not found")
+
+        with self.assertRaises(TelegramBadRequest):
+            await self.registry.send(BOT, key, "photo", send, lambda: BufferedInputFile(b"jpg", filename="p.jpg"))
+
+        self.assertEqual(self.sent, ["file_ok"])
+        self.assertEqual(self.rows[BOT.id, key], "file_ok")
+
+    async def test_foreign_static_file_id_is_replaced_by_local_file(self):
+        with open(os.path.join(self.static_dir.name, "instruction.jpg"), "wb") as f:
+            f.write(b"jpg")
+        self.registry.register_static({"instruction": "file_main_bot"})
+        self.stale_ids.add("file_main_bot")
+
+        await self.registry.send_static(BOT, "instruction", "photo", self._telegram)
+        await self.registry.send_static(BOT, "instruction", "photo", self._telegram)
+
+        self.assertEqual(self.sent[0], "file_main_bot")
+        self.assertIsInstance(self.sent[1], FSInputFile)
+        self.assertEqual(self.sent[2], "file_2")
+        self.assertEqual(await self.registry.lookup(2, static_key("instruction")), "file_main_bot")
+
+    async def test_concurrent_sends_upload_once(self):
+        key = content_key(b"jpg")
+
+        await asyncio.gather(*(self._send(key) for _ in range(5)))
+
+        uploads = [media for media in self.sent if not isinstance(media, str)]
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(self.registry.stats["coalesced"], 4)
+
+    async def test_waiters_upload_themselves_if_first_upload_fails(self):
+        key = content_key(b"jpg")
+        attempts = []
+
+        async def flaky(media):
+            attempts.append(media)
+            await asyncio.sleep(0.01)
+            if len(attempts) == 1:
+                raise ConnectionError("upload failed")
+            return await self._telegram(media)
+
+        results = await asyncio.gather(
+            *(self.registry.send(BOT, key, "photo", flaky, lambda: BufferedInputFile(b"jpg", filename="p.jpg"))
+              for _ in range(2)), return_exceptions=True)
+
+        self.assertIsInstance(results[0], ConnectionError)
+        self.assertEqual(results[1].photo[-1].file_id, "file_1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import io
+import sys
+import time
+import types
+import unittest
+from unittest import mock
+
+import httpx
+from openai import NotFoundError
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import openai_file_cache as cache_module  # noqa: E402
+from utils.openai_file_cache import EXPIRY_MARGIN_SEC, OpenAIFileCache  # noqa: E402
+
+
+def _not_found() -> NotFoundError:
+    request = httpx.Request("GET", "https://api.openai.com/v1/files/file_old")
+    return NotFoundError("not found", response=httpx.Response(404, request=request), body=None)
+
+
+class OpenAIFileCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.repository = mock.AsyncMock()
+        self.repository.get_file.return_value = None
+        patcher = mock.patch.object(cache_module, "openai_files_repository", self.repository)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.uploaded = 0
+
+        async def create(file, purpose):
+            self.uploaded += 1
+            await asyncio.sleep(0.01)
+            return types.SimpleNamespace(id=f"file_{self.uploaded}", expires_at=None)
+
+        self.client = mock.MagicMock()
+        self.client.files.create = mock.AsyncMock(side_effect=create)
+        self.cache = OpenAIFileCache()
+
+    def _row(self, *, verified_ago: float, expires_in: float | None = None) -> types.SimpleNamespace:
+        now = time.time()
+        return types.SimpleNamespace(
+            file_id="file_old",
+            verified_at=datetime.datetime.fromtimestamp(now - verified_ago),
+            expires_at=datetime.datetime.fromtimestamp(now + expires_in) if expires_in is not None else None,
+        )
+
+    async def test_same_content_is_uploaded_once(self):
+        first = await self.cache.upload(self.client, b"pdf", filename="a.pdf", purpose="assistants")
+        second = await self.cache.upload(self.client, io.BytesIO(b"pdf"), filename="b.pdf", purpose="assistants")
+        other_purpose = await self.cache.upload(self.client, b"pdf", filename="a.pdf", purpose="vision")
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other_purpose)
+        self.assertEqual(self.uploaded, 2)
+        self.assertEqual(self.cache.stats["bytes_saved"], 3)
+
+    async def test_concurrent_uploads_share_one_request(self):
+        ids = await asyncio.gather(*(self.cache.upload(self.client, b"album", filename="p.jpg", purpose="vision")
+                                     for _ in range(5)))
+
+        self.assertEqual(set(ids), {"file_1"})
+        self.assertEqual(self.uploaded, 1)
+
+    async def test_fresh_row_from_db_is_reused_without_api_calls(self):
+        self.repository.get_file.return_value = self._row(verified_ago=60)
+
+        file_id = await self.cache.upload(self.client, b"doc", filename="d.pdf", purpose="assistants")
+
+        self.assertEqual(file_id, "file_old")
+        self.assertEqual(self.uploaded, 0)
+
+    async def test_expiring_file_is_uploaded_again(self):
+        self.repository.get_file.return_value = self._row(verified_ago=60, expires_in=EXPIRY_MARGIN_SEC / 2)
+
+        file_id = await self.cache.upload(self.client, b"doc", filename="d.pdf", purpose="assistants")
+
+        self.assertEqual(file_id, "file_1")
+        self.repository.delete_file.assert_awaited_once_with(file_id="file_old")
+        self.assertEqual(self.cache.stats["expired"], 1)
+
+    async def test_stale_row_is_verified_and_deleted_file_replaced(self):
+        self.repository.get_file.return_value = self._row(verified_ago=self.cache.verify_after + 1)
+        retrieve = mock.AsyncMock(side_effect=_not_found())
+
+        with mock.patch.dict(sys.modules, {"utils.combined_gpt_tools": types.SimpleNamespace(
+                retrieve_with_retry=retrieve)}):
+            file_id = await self.cache.upload(self.client, b"doc", filename="d.pdf", purpose="assistants")
+
+        retrieve.assert_awaited_once()
+        self.assertEqual(file_id, "file_1")
+        self.repository.delete_file.assert_awaited_once_with(file_id="file_old")
+
+
+if __name__ == "__main__":
+    unittest.main()
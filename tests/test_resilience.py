@@ -0,0 +1,187 @@
+import asyncio
+import unittest
+
+from utils.resilience import (
+    BreakerState, CircuitBreaker, Outcome, ProviderGuard, ProviderUnavailableError, RetryBudget, deadline_scope,
+)
+
+
+class ProviderError(Exception):
+    def __init__(self, outcome: Outcome):
+        self.outcome = outcome
+        super().__init__(outcome.value)
+
+
+def _classify(error: BaseException) -> Outcome:
+    return error.outcome if isinstance(error, ProviderError) else Outcome.RETRY
+
+
+def _expire(breaker: CircuitBreaker) -> None:
+    """Перематывает время так, будто таймаут разомкнутой цепи уже прошёл"""
+    breaker._opened_at -= breaker._reset_timeout
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker("test", failure_threshold=3)
+
+        self.assertEqual([breaker.record_failure() for _ in range(3)], [False, False, True])
+        self.assertIs(breaker.state, BreakerState.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats, {"opened": 1, "rejected": 1})
+
+    def test_opens_on_failure_rate_in_window(self):
+        breaker = CircuitBreaker("test", failure_threshold=100, window=10, min_calls=10, failure_rate=0.5)
+        for _ in range(4):
+            breaker.record_success()
+            self.assertFalse(breaker.record_failure())
+        breaker.record_success()
+
+        self.assertTrue(breaker.record_failure())      # десятый исход: половина — ошибки
+        self.assertIs(breaker.state, BreakerState.OPEN)
+
+    def test_half_open_lets_limited_probes_and_success_closes(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10, half_open_calls=1)
+        breaker.record_failure()
+        _expire(breaker)
+
+        self.assertIs(breaker.state, BreakerState.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())             # пробный слот занят
+
+        breaker.record_success()
+        self.assertIs(breaker.state, BreakerState.CLOSED)
+        self.assertEqual(breaker._reset_timeout, 10)
+
+    def test_half_open_failure_reopens_with_doubled_timeout(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10, max_reset_timeout=25)
+        breaker.record_failure()
+        for expected_timeout in (20, 25):
+            _expire(breaker)
+            self.assertTrue(breaker.allow())
+            self.assertTrue(breaker.record_failure())
+            self.assertIs(breaker.state, BreakerState.OPEN)
+            self.assertEqual(breaker._reset_timeout, expected_timeout)
+
+    def test_request_error_in_half_open_frees_probe_without_closing(self):
+        breaker = CircuitBreaker("test", failure_threshold=1)
+        breaker.record_failure()
+        _expire(breaker)
+        self.assertTrue(breaker.allow())
+
+        breaker.record_request_error()
+
+        self.assertIs(breaker.state, BreakerState.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+
+    def test_request_error_in_closed_breaks_failure_streak(self):
+        breaker = CircuitBreaker("test", failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_request_error()
+
+        self.assertFalse(breaker.record_failure())
+        self.assertIs(breaker.state, BreakerState.CLOSED)
+
+
+class ProviderGuardTest(unittest.IsolatedAsyncioTestCase):
+    def _guard(self, **breaker_kwargs) -> ProviderGuard:
+        budget = breaker_kwargs.pop("budget", None)
+        return ProviderGuard("test", base_delay=0, rate_limit_delay=0,
+                             breaker=CircuitBreaker("test", **breaker_kwargs), budget=budget)
+
+    @staticmethod
+    def _provider(*results):
+        """Провайдер, который по очереди отдаёт результаты, а исключения — бросает"""
+        pending = list(results)
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            result = pending.pop(0)
+            if isinstance(result, BaseException):
+                raise result
+            return result
+
+        return fn, calls
+
+    async def test_retries_transient_errors_then_succeeds(self):
+        guard = self._guard()
+        fn, calls = self._provider(ProviderError(Outcome.RETRY), ProviderError(Outcome.RATE_LIMITED), "ok")
+
+        self.assertEqual(await guard.call(fn, _classify, max_attempts=3), "ok")
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((guard.stats["retries"], guard.stats["failures"], guard.stats["successes"]), (2, 2, 1))
+
+    async def test_fatal_error_is_not_retried_and_not_a_failure(self):
+        guard = self._guard(failure_threshold=1)
+        fn, calls = self._provider(ProviderError(Outcome.FATAL))
+
+        with self.assertRaises(ProviderError):
+            await guard.call(fn, _classify)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(guard.stats["failures"], 0)
+        self.assertIs(guard.breaker.state, BreakerState.CLOSED)
+
+    async def test_fatal_error_in_half_open_keeps_probe_state(self):
+        guard = self._guard(failure_threshold=1)
+        guard.breaker.record_failure()
+        _expire(guard.breaker)
+        fn, _ = self._provider(ProviderError(Outcome.FATAL), "ok")
+
+        with self.assertRaises(ProviderError):
+            await guard.call(fn, _classify)
+        self.assertIs(guard.breaker.state, BreakerState.HALF_OPEN)
+
+        self.assertEqual(await guard.call(fn, _classify), "ok")
+        self.assertIs(guard.breaker.state, BreakerState.CLOSED)
+
+    async def test_exhausted_budget_fails_without_retry(self):
+        guard = self._guard(budget=RetryBudget(ratio=0.2, min_tokens=0))
+        fn, calls = self._provider(ProviderError(Outcome.RETRY), "ok")
+
+        with self.assertRaises(ProviderUnavailableError) as caught:
+            await guard.call(fn, _classify, max_attempts=3)
+
+        self.assertEqual(caught.exception.reason, "retry_budget")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(guard.stats["budget_exhausted"], 1)
+
+    async def test_open_breaker_fails_fast(self):
+        guard = self._guard(failure_threshold=1, reset_timeout=60)
+        fn, calls = self._provider(ProviderError(Outcome.RETRY), "ok")
+
+        with self.assertRaises(ProviderUnavailableError) as first:
+            await guard.call(fn, _classify)
+        with self.assertRaises(ProviderUnavailableError) as second:
+            await guard.call(fn, _classify)
+
+        self.assertEqual((first.exception.reason, second.exception.reason), ("circuit_open", "circuit_open"))
+        self.assertGreater(second.exception.retry_after, 0)
+        self.assertEqual(len(calls), 1)                # второй вызов до провайдера не дошёл
+        self.assertEqual(guard.stats["fast_failed"], 2)
+
+    async def test_slow_provider_hits_handler_deadline(self):
+        guard = self._guard(failure_threshold=1)
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        with deadline_scope(0.05):
+            with self.assertRaises(ProviderUnavailableError) as caught:
+                await guard.call(slow, _classify)
+
+        self.assertEqual(caught.exception.reason, "deadline")
+        self.assertIs(guard.breaker.state, BreakerState.OPEN)
+
+    async def test_nested_deadline_cannot_extend_outer(self):
+        with deadline_scope(0.05):
+            with deadline_scope(10):
+                guard = self._guard()
+                with self.assertRaises(ProviderUnavailableError):
+                    await guard.call(lambda: asyncio.sleep(1), _classify)
+
+
+if __name__ == "__main__":
+    unittest.main()
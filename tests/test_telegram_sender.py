@@ -0,0 +1,107 @@
+import asyncio
+import contextlib
+import unittest
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils.telegram_sender import SendPriority, TelegramSender, TokenBucket  # noqa: E402
+
+
+class TelegramSenderTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.delivered: list[str] = []
+
+    async def asyncTearDown(self):
+        await self.sender.close()
+
+    def _sender(self, workers_count: int) -> TelegramSender:
+        self.sender = TelegramSender(bot=None, workers_count=workers_count)
+        return self.sender
+
+    async def _deliver(self, text: str, delay: float = 0.0) -> str:
+        await asyncio.sleep(delay)
+        self.delivered.append(text)
+        return text
+
+    async def test_interactive_goes_first(self):
+        sender = self._sender(workers_count=1)
+
+        await asyncio.gather(
+            sender.send(1, self._deliver, "рассылка", priority=SendPriority.BROADCAST),
+            sender.send(2, self._deliver, "напоминание", priority=SendPriority.REMINDER),
+            sender.send(3, self._deliver, "ответ", priority=SendPriority.INTERACTIVE),
+        )
+
+        self.assertEqual(self.delivered, ["ответ", "напоминание", "рассылка"])
+
+    async def test_retry_after_keeps_chat_order(self):
+        sender = self._sender(workers_count=2)
+        attempts = 0
+
+        async def flaky(text: str) -> str:
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                raise TelegramRetryAfter(method=SendMessage(chat_id=1, text=text),
+                                         message="Too Many Requests", retry_after=1)
+            return await self._deliver(text)
+
+        first = asyncio.create_task(sender.send(1, flaky, "часть 1"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(sender.send(1, self._deliver, "часть 2"))
+        await asyncio.gather(first, second)
+
+        self.assertEqual(self.delivered, ["часть 1", "часть 2"])
+        self.assertEqual(sender.stats()["retry_after"], 1)
+        self.assertEqual(sender.stats()["held_back"], 1)
+
+    async def test_other_chats_are_not_held(self):
+        sender = self._sender(workers_count=2)
+        sender._chat_buckets[1] = TokenBucket(rate=2, capacity=1)
+
+        await sender.send(1, self._deliver, "первое в чат 1")
+        slow = asyncio.create_task(sender.send(1, self._deliver, "второе в чат 1"))
+        await asyncio.sleep(0.05)
+        await sender.send(2, self._deliver, "чат 2")
+        await slow
+
+        self.assertEqual(self.delivered, ["первое в чат 1", "чат 2", "второе в чат 1"])
+        self.assertEqual(sender.stats()["deferred"], 1)
+
+    async def test_cancelled_send_is_not_executed(self):
+        sender = self._sender(workers_count=1)
+
+        busy = asyncio.create_task(sender.send(1, self._deliver, "долгое", 0.05))
+        await asyncio.sleep(0.01)
+        gave_up = asyncio.create_task(sender.send(2, self._deliver, "отменённое"))
+        await asyncio.sleep(0.01)
+        gave_up.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await gave_up
+        await busy
+        await sender.send(3, self._deliver, "следующее")
+
+        self.assertEqual(self.delivered, ["долгое", "следующее"])
+
+    async def test_close_cancels_deferred_jobs(self):
+        sender = self._sender(workers_count=1)
+        sender._chat_buckets[1] = TokenBucket(rate=0.01, capacity=1)
+        await sender.send(1, self._deliver, "ушло")
+        waiting = asyncio.create_task(sender.send(1, self._deliver, "не успеет"))
+        await asyncio.sleep(0.05)
+
+        sender._drain = lambda: asyncio.sleep(0)
+        await sender.close()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(self.delivered, ["ушло"])
+
+
+if __name__ == "__main__":
+    unittest.main()
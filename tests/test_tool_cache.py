@@ -0,0 +1,63 @@
+import asyncio
+import contextlib
+import unittest
+
+from utils.tool_cache import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        calls = 0
+
+        async def work() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "готово"
+
+        results = await asyncio.gather(*(flight.run("key", work) for _ in range(5)))
+
+        self.assertEqual(results, ["готово"] * 5)
+        self.assertEqual(calls, 1)
+        self.assertEqual(flight.snapshot()["coalesced"], 4)
+
+    async def test_error_reaches_every_waiter(self):
+        flight = SingleFlight()
+
+        async def work() -> str:
+            await asyncio.sleep(0.01)
+            raise ValueError("провайдер упал")
+
+        results = await asyncio.gather(*(flight.run("key", work) for _ in range(3)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    async def test_cancelled_leader_hands_work_to_waiter(self):
+        flight = SingleFlight()
+        calls = 0
+
+        async def work() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return f"попытка {calls}"
+
+        leader = asyncio.create_task(flight.run("key", work))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(flight.run("key", work)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await leader
+
+        results = await asyncio.gather(*waiters)
+
+        self.assertEqual(results, ["попытка 2"] * 3)
+        self.assertEqual(calls, 2)
+        self.assertEqual(flight.snapshot()["takeovers"], 1)
+        self.assertFalse(flight.in_flight("key"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import types
+import unittest
+from unittest import mock
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import transcription_cache as cache_module  # noqa: E402
+from utils.transcription_cache import TranscriptionCache  # noqa: E402
+
+
+class TranscriptionCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.repository = mock.AsyncMock()
+        self.repository.get_transcription.return_value = None
+        patcher = mock.patch.object(cache_module, "voice_transcriptions_repository", self.repository)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = TranscriptionCache(memory_max_chars=100)
+        self.whisper_calls = 0
+
+    def _whisper(self, text: str = "привет"):
+        async def transcribe():
+            self.whisper_calls += 1
+            await asyncio.sleep(0.01)
+            return text
+        return transcribe
+
+    async def test_forwarded_voice_is_answered_from_memory(self):
+        first = await self.cache.get_or_transcribe("uniq", "ru", self._whisper(), duration=12)
+        second = await self.cache.get_or_transcribe("uniq", "ru", self._whisper("другое"), duration=12)
+
+        self.assertEqual((first, second), ("привет", "привет"))
+        self.assertEqual(self.whisper_calls, 1)
+        self.assertEqual(self.cache.stats["seconds_saved"], 12)
+        self.repository.save_transcription.assert_awaited_once_with("uniq", "ru", text="привет", duration=12)
+
+    async def test_language_is_part_of_the_key(self):
+        await self.cache.get_or_transcribe("uniq", "ru", self._whisper())
+        await self.cache.get_or_transcribe("uniq", "en", self._whisper("hello"))
+
+        self.assertEqual(self.whisper_calls, 2)
+
+    async def test_db_row_is_used_after_restart(self):
+        self.repository.get_transcription.return_value = types.SimpleNamespace(text="из базы")
+
+        text = await self.cache.get_or_transcribe("uniq", "ru", self._whisper(), duration=5)
+
+        self.assertEqual(text, "из базы")
+        self.assertEqual(self.whisper_calls, 0)
+        self.assertEqual(self.cache.stats["db_hits"], 1)
+
+    async def test_concurrent_requests_share_one_transcription(self):
+        texts = await asyncio.gather(*(self.cache.get_or_transcribe("uniq", "ru", self._whisper())
+                                       for _ in range(5)))
+
+        self.assertEqual(set(texts), {"привет"})
+        self.assertEqual(self.whisper_calls, 1)
+
+    async def test_empty_text_is_not_cached(self):
+        await self.cache.get_or_transcribe("uniq", "ru", self._whisper("  "))
+        await self.cache.get_or_transcribe("uniq", "ru", self._whisper())
+
+        self.assertEqual(self.whisper_calls, 2)
+        self.repository.save_transcription.assert_awaited_once()
+
+    async def test_database_outage_does_not_break_transcription(self):
+        self.repository.get_transcription.side_effect = ConnectionError("db down")
+        self.repository.save_transcription.side_effect = ConnectionError("db down")
+
+        self.assertEqual(await self.cache.get_or_transcribe("uniq", "ru", self._whisper()), "привет")
+
+    async def test_memory_is_bounded_by_characters(self):
+        for i in range(5):
+            await self.cache.get_or_transcribe(f"voice-{i}", "ru", self._whisper("x" * 40))
+
+        snapshot = self.cache.snapshot()
+        self.assertLessEqual(snapshot["memory_chars"], 100)
+        self.assertEqual(snapshot["memory_items"], 2)
+        self.assertNotIn(("voice-0", "ru"), self.cache._memory)
+
+
+if __name__ == "__main__":
+    unittest.main()
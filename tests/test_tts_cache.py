@@ -0,0 +1,85 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import audio_pipeline as pipeline_module  # noqa: E402
+from utils.audio_pipeline import AudioPipeline  # noqa: E402
+from utils.tts_cache import MAX_CACHED_TEXT_CHARS, TTSCache, speech_key  # noqa: E402
+
+VOICE = {"model": "gpt-4o-mini-tts", "voice": "shimmer", "instructions": "Speak dramatic", "response_format": "opus"}
+
+
+class SpeechKeyTest(unittest.TestCase):
+    def test_key_depends_on_every_synthesis_parameter(self):
+        base = speech_key("Привет", **VOICE)
+
+        self.assertEqual(base, speech_key("  Привет\n", **VOICE))
+        for name, value in {"model": "tts-1", "voice": "alloy", "instructions": "Whisper",
+                            "response_format": "mp3"}.items():
+            with self.subTest(parameter=name):
+                self.assertNotEqual(base, speech_key("Привет", **{**VOICE, name: value}))
+
+
+class TTSCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def test_audio_survives_restart_on_disk(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            await TTSCache(disk_dir=disk_dir).put_audio("key", b"ogg")
+
+            restarted = TTSCache(disk_dir=disk_dir)
+            self.assertEqual(await restarted.get_audio("key"), b"ogg")
+            self.assertEqual(restarted.stats["audio_hits"], 1)
+
+
+class CachedSpeechTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.cache = TTSCache(disk_dir=None)
+        patcher = mock.patch.object(pipeline_module, "tts_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pipeline = AudioPipeline()
+        self.synthesized = 0
+
+    def _tts(self, chunks: list[bytes], fail_after: int | None = None):
+        async def stream_speech(text, **kwargs):
+            self.synthesized += 1
+            for i, chunk in enumerate(chunks):
+                if fail_after is not None and i == fail_after:
+                    raise ConnectionError("TTS оборвал поток")
+                yield chunk
+        self.pipeline.stream_speech = stream_speech
+
+    async def _read(self, text: str) -> bytes:
+        return b"".join([chunk async for chunk in self.pipeline.read_speech(self.pipeline.speech_file(text))])
+
+    async def test_repeated_phrase_is_synthesized_once(self):
+        self._tts([b"og", b"g"])
+
+        self.assertEqual(await self._read("Ошибка, попробуйте позже"), b"ogg")
+        self.assertEqual(await self._read("Ошибка, попробуйте позже"), b"ogg")
+
+        self.assertEqual(self.synthesized, 1)
+        self.assertEqual(self.cache.stats["audio_hits"], 1)
+
+    async def test_truncated_stream_is_not_cached(self):
+        self._tts([b"og", b"g"], fail_after=1)
+        with self.assertRaises(ConnectionError):
+            await self._read("Привет")
+
+        self._tts([b"og", b"g"])
+        await self._read("Привет")
+
+        self.assertEqual(self.synthesized, 2)
+        self.assertEqual(self.cache.stats["stored"], 1)
+
+    async def test_long_answer_is_not_cached(self):
+        speech = self.pipeline.speech_file("а" * (MAX_CACHED_TEXT_CHARS + 1))
+
+        self.assertIsNone(speech.cache_key)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import io
+import types
+import unittest
+from unittest import mock
+
+import httpx
+from openai import NotFoundError
+
+from tests import app_stubs
+
+app_stubs.install()
+
+from utils import vector_store_manifest as manifest_module  # noqa: E402
+from utils.vector_store_manifest import DocumentFile, VectorStoreManifest, content_hash  # noqa: E402
+
+STORE = "vs_1"
+
+
+def _not_found() -> NotFoundError:
+    request = httpx.Request("GET", "https://api.openai.com/v1/vector_stores/vs_1")
+    return NotFoundError("not found", response=httpx.Response(404, request=request), body=None)
+
+
+def _doc(file_id: str) -> DocumentFile:
+    return DocumentFile(content_hash=f"hash-{file_id}", file_id=file_id, file_name=f"{file_id}.pdf")
+
+
+class VectorStoreManifestTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.rows: list[types.SimpleNamespace] = []
+        self.repository = mock.AsyncMock()
+        self.repository.get_files.side_effect = lambda **kwargs: list(self.rows)
+        self.file_cache = mock.AsyncMock()
+        for name, value in {"vector_store_files_repository": self.repository,
+                            "openai_file_cache": self.file_cache}.items():
+            patcher = mock.patch.object(manifest_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = mock.MagicMock()
+        self.client.vector_stores.files.delete = mock.AsyncMock()
+        self.client.vector_stores.file_batches.create = mock.AsyncMock(
+            return_value=types.SimpleNamespace(id="batch_1", status="completed", file_counts=None))
+        self.manifest = VectorStoreManifest()
+
+    def _store(self, *file_ids: str) -> None:
+        self.rows = [types.SimpleNamespace(file_id=file_id, content_hash=f"hash-{file_id}", vector_store_id=STORE)
+                     for file_id in file_ids]
+
+    async def _sync(self, *documents: DocumentFile) -> None:
+        await self.manifest.sync(self.client, user_id=1, scope="chat", vector_store_id=STORE,
+                                 documents=list(documents))
+
+    async def test_known_content_is_not_uploaded_again(self):
+        known, fresh = io.BytesIO(b"known"), io.BytesIO(b"fresh")
+        self.rows = [types.SimpleNamespace(file_id="file_known", content_hash=content_hash(known),
+                                           vector_store_id=STORE)]
+        self.file_cache.upload.return_value = "file_fresh"
+
+        documents = await self.manifest.upload_documents(
+            self.client, user_id=1, scope="chat", document_bytes=[(known, "a.pdf", "pdf"), (fresh, "b.pdf", "pdf")])
+
+        self.assertEqual([(d.file_id, d.reused) for d in documents], [("file_known", True), ("file_fresh", False)])
+        self.file_cache.upload.assert_awaited_once()
+        self.assertEqual(self.manifest.stats["uploads"], 1)
+
+    async def test_unchanged_store_makes_no_api_calls(self):
+        self._store("file_a", "file_b")
+
+        await self._sync(_doc("file_a"), _doc("file_b"))
+
+        self.client.vector_stores.files.delete.assert_not_awaited()
+        self.client.vector_stores.file_batches.create.assert_not_awaited()
+        self.repository.apply_diff.assert_not_awaited()
+        self.assertEqual(self.manifest.stats["unchanged_syncs"], 1)
+
+    async def test_diff_is_applied_in_one_batch(self):
+        self._store("file_a", "file_old")
+
+        await self._sync(_doc("file_a"), _doc("file_b"), _doc("file_c"))
+
+        self.client.vector_stores.files.delete.assert_awaited_once_with(vector_store_id=STORE, file_id="file_old")
+        self.client.vector_stores.file_batches.create.assert_awaited_once_with(
+            vector_store_id=STORE, file_ids=["file_b", "file_c"])
+        diff = self.repository.apply_diff.await_args.kwargs
+        self.assertEqual(diff["removed_file_ids"], ["file_old"])
+        self.assertEqual([row["file_id"] for row in diff["added"]], ["file_b", "file_c"])
+
+    async def test_failed_batch_is_not_written_to_manifest(self):
+        self._store("file_a")
+        self.client.vector_stores.file_batches.create.return_value = types.SimpleNamespace(
+            id="batch_1", status="failed", file_counts=None)
+
+        await self._sync(_doc("file_a"), _doc("file_b"))
+
+        self.assertEqual(self.repository.apply_diff.await_args.kwargs["added"], [])
+        self.assertEqual(self.manifest.stats["added"], 0)
+
+    async def test_expired_store_clears_manifest(self):
+        self._store("file_a")
+        self.client.vector_stores.file_batches.create.side_effect = _not_found()
+
+        with self.assertRaises(NotFoundError):
+            await self._sync(_doc("file_b"))
+
+        self.repository.delete_store.assert_awaited_once_with(vector_store_id=STORE)
+        self.repository.apply_diff.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from utils.video_relay import MAX_UPLOAD_BYTES, RELAY_CHUNK_SIZE, VideoRelay, VideoTooLarge
+
+VIDEO = bytes(range(256)) * 4096                  # 1 МиБ — несколько чанков
+
+
+class VideoRelayTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def video(request):
+            return web.Response(body=VIDEO, content_type="video/mp4")
+
+        async def huge(request):
+            # размер отдаём только в HEAD — тело такого видео релей читать не должен
+            return web.Response(headers={"Content-Length": str(MAX_UPLOAD_BYTES + 1)})
+
+        app = web.Application()
+        app.router.add_get("/video.mp4", video)
+        app.router.add_get("/no-head.mp4", video, allow_head=False)
+        app.router.add_route("HEAD", "/huge.mp4", huge)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.addAsyncCleanup(self.server.close)
+
+        self.relay = VideoRelay(concurrency=2)
+        self.addAsyncCleanup(self.relay.close)
+
+    async def _upload(self, document) -> bytes:
+        """То, что делает aiogram при отправке: дочитывает файл до конца"""
+        chunks = [chunk async for chunk in document.read(bot=None)]
+        self.assertTrue(all(len(chunk) <= RELAY_CHUNK_SIZE for chunk in chunks))
+        return b"".join(chunks)
+
+    async def test_video_is_streamed_with_progress(self):
+        progress: list[tuple[int, int | None]] = []
+        document = self.relay.input_file(str(self.server.make_url("/video.mp4")),
+                                         on_progress=lambda sent, total: progress.append((sent, total)))
+
+        uploaded = await self.relay.send(document, lambda: self._upload(document))
+
+        self.assertEqual(uploaded, VIDEO)
+        self.assertEqual(progress[-1], (len(VIDEO), len(VIDEO)))
+        self.assertEqual(self.relay.snapshot()["relayed"], 1)
+
+    async def test_too_large_video_is_not_downloaded(self):
+        document = self.relay.input_file(str(self.server.make_url("/huge.mp4")))
+        called = []
+
+        with self.assertRaises(VideoTooLarge) as caught:
+            await self.relay.send(document, lambda: called.append(1))
+
+        self.assertEqual(caught.exception.size, MAX_UPLOAD_BYTES + 1)
+        self.assertEqual(caught.exception.url, document.url)
+        self.assertEqual(called, [])
+        self.assertEqual(self.relay.stats["too_large"], 1)
+        self.assertEqual(self.relay.stats["bytes"], 0)
+
+    async def test_unknown_size_is_relayed(self):
+        document = self.relay.input_file(str(self.server.make_url("/no-head.mp4")))
+
+        self.assertEqual(await self.relay.send(document, lambda: self._upload(document)), VIDEO)
+        self.assertIsNone(document.size)
+
+    async def test_concurrent_relays_are_limited(self):
+        async def relay_one():
+            document = self.relay.input_file(str(self.server.make_url("/video.mp4")))
+
+            async def upload():
+                await asyncio.sleep(0.02)
+                return await self._upload(document)
+
+            return await self.relay.send(document, upload)
+
+        await asyncio.gather(*(relay_one() for _ in range(5)))
+
+        self.assertEqual(self.relay.stats["max_active"], 2)
+        self.assertEqual(self.relay.active, 0)
+
+    async def test_file_id_is_sent_without_relay(self):
+        async def call():
+            return "sent"
+
+        self.assertEqual(await self.relay.send("file_id", call), "sent")
+        self.assertEqual(self.relay.stats["relayed"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import re
+import time
+import traceback
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest
+
+# admin_alerts.py — склейка одинаковых алертов из loguru в дайджесты для админов
+
+ALERT_WINDOW_SEC = 15             # сколько копим записи перед отправкой дайджеста
+ALERT_QUEUE_MAXSIZE = 1000        # больше в очередь не берём — лишнее отбрасываем и считаем
+ADMINS_CACHE_TTL_SEC = 300
+MAX_BLOCK_LEN = 1500              # обрезка текста одной группы в дайджесте
+MAX_MESSAGE_LEN = 4000            # запас до лимита Telegram в 4096 символов
+
+_NUMBERS_RE = re.compile(r"\d+")
+_HEX_RE = re.compile(r"0x[0-9a-fA-F]+")
+_MARKUP_RE = re.compile(r"</?b>")
+
+
+def alert_fingerprint(level: str, text: str) -> str:
+    """
+    Отпечаток записи: уровень + текст без чисел и адресов,
+    чтобы «123 | Ошибка ...» и «456 | Ошибка ...» попадали в одну группу.
+    """
+    normalized = _NUMBERS_RE.sub("N", _HEX_RE.sub("0x", text))
+    return hashlib.sha1(f"{level}|{normalized}".encode("utf-8", "ignore")).hexdigest()
+
+
+class _AlertGroup:
+    __slots__ = ("level", "text", "count", "first_at", "last_at")
+
+    def __init__(self, level: str, text: str, at: datetime):
+        self.level = level
+        self.text = text
+        self.count = 1
+        self.first_at = at
+        self.last_at = at
+
+
+class AdminAlertAggregator:
+    """
+    Принимает записи loguru из любого треда, группирует одинаковые за окно
+    и рассылает админам один дайджест с количеством повторов.
+    Очередь ограничена, поэтому логирование никогда не копит работу в event loop.
+    При остановке бота flush() досылает накопленное, не дожидаясь конца окна.
+    """
+
+    def __init__(self, window: float = ALERT_WINDOW_SEC, maxsize: int = ALERT_QUEUE_MAXSIZE):
+        self.window = window
+        self.maxsize = maxsize
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._pending: dict[str, _AlertGroup] = {}
+        self._admin_ids: list[int] = []
+        self._admins_loaded_at = 0.0
+        self.dropped = 0
+        self.received = 0
+        self.digests_sent = 0
+
+    # ---------- приём записей ----------
+    def submit_threadsafe(self, record: dict, loop: asyncio.AbstractEventLoop) -> None:
+        """Вызывается из синка loguru (свой тред): переносит запись в loop без ожидания"""
+        item = (record["level"].name, record["message"], record["time"])
+        try:
+            loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            # loop уже закрыт — при остановке бота алерт некуда доставить
+            pass
+
+    def _put(self, item: tuple) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait(item)
+            self.received += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def invalidate_admins(self) -> None:
+        """Сбрасывает кеш списка админов (после добавления/удаления)"""
+        self._admins_loaded_at = 0.0
+
+    # ---------- рассылка ----------
+    async def _run(self) -> None:
+        while True:
+            level, text, at = await self._queue.get()
+            self._add(self._pending, level, text, at)
+            deadline = time.monotonic() + self.window
+            while (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    level, text, at = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._add(self._pending, level, text, at)
+            await self._send_pending()
+
+    async def _send_pending(self) -> None:
+        if not self._pending:
+            return
+        try:
+            await self._send_digest(list(self._pending.values()))
+        except Exception:
+            # не через logger: ошибка рассылки алертов сама стала бы алертом
+            print(traceback.format_exc())
+        # прервали на отправке — группы остаются, flush дошлёт их (повтор лучше потери)
+        self._pending = {}
+
+    async def flush(self) -> None:
+        """Останавливает окно накопления и сразу рассылает всё, что пришло; вызывать до close_senders"""
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._add(self._pending, *self._queue.get_nowait())
+        await self._send_pending()
+
+    @staticmethod
+    def _add(groups: dict[str, _AlertGroup], level: str, text: str, at: datetime) -> None:
+        key = alert_fingerprint(level, text)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = _AlertGroup(level, text, at)
+        else:
+            group.count += 1
+            group.last_at = at
+
+    async def _get_admin_ids(self) -> list[int]:
+        if time.monotonic() - self._admins_loaded_at > ADMINS_CACHE_TTL_SEC or not self._admin_ids:
+            from db.repository import admin_repository
+            admins = await admin_repository.select_all_admins()
+            self._admin_ids = [admin.admin_id for admin in admins]
+            self._admins_loaded_at = time.monotonic()
+        return self._admin_ids
+
+    def _format_group(self, group: _AlertGroup) -> str:
+        text = group.text
+        if len(text) > MAX_BLOCK_LEN:
+            text = text[:MAX_BLOCK_LEN] + "…"
+        header = f"<b>{group.first_at.strftime('%d-%b-%Y %H:%M:%S')}</b>\n<b>Level:</b> {group.level}"
+        if group.count > 1:
+            header += f"\n🔁 <b>×{group.count}</b> (до {group.last_at.strftime('%H:%M:%S')})"
+        return f"{header}\n{text}"
+
+    def _pack_messages(self, groups: list[_AlertGroup]) -> list[str]:
+        from settings import get_current_bot, test_bot_token
+        current_bot = get_current_bot()
+        bot_type = "TEST BOT" if current_bot and getattr(current_bot, "token", None) == test_bot_token else ""
+        bot_prefix = f"️<b>{bot_type}</b>\n\n" if bot_type else ""
+        if self.dropped:
+            bot_prefix += f"⚠️ Пропущено алертов из-за переполнения очереди: {self.dropped}\n\n"
+            self.dropped = 0
+
+        messages: list[str] = []
+        current = bot_prefix
+        for group in groups:
+            block = self._format_group(group)
+            if current and len(current) + len(block) + 2 > MAX_MESSAGE_LEN:
+                messages.append(current)
+                current = ""
+            current += ("\n\n" if current and current != bot_prefix else "") + block
+        if current:
+            messages.append(current)
+        return messages
+
+    async def _send_digest(self, groups: list[_AlertGroup]) -> None:
+        from bot_admin import admin_bot
+        from utils.telegram_sender import get_sender, SendPriority
+        admin_ids = await self._get_admin_ids()
+        sender = get_sender(admin_bot)
+        for text in self._pack_messages(groups):
+            for admin_id in admin_ids:
+                try:
+                    await sender.send_message(chat_id=admin_id, text=text, priority=SendPriority.REMINDER)
+                except TelegramBadRequest:
+                    # трейсбеки содержат «<module>» и ломают HTML-разметку — шлём простым текстом без своих тегов
+                    try:
+                        await sender.send_message(chat_id=admin_id, text=_MARKUP_RE.sub("", text), parse_mode=None,
+                                                  priority=SendPriority.REMINDER)
+                    except Exception:
+                        print(traceback.format_exc())
+                except Exception:
+                    print(traceback.format_exc())
+        self.digests_sent += 1
+
+
+admin_alerts = AdminAlertAggregator()
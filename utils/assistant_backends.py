@@ -0,0 +1,412 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Protocol, Sequence, runtime_checkable
+
+from dotenv import find_dotenv, load_dotenv
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AuthenticationError,
+    PermissionDeniedError,
+    RateLimitError,
+)
+
+from data.keyboards import subscriptions_keyboard, more_generations_keyboard
+from db.models import Subscriptions, TypeSubscriptions, DialogsMessages
+from db.repository import (
+    subscriptions_repository,
+    type_subscriptions_repository,
+    generations_packets_repository,
+    dialogs_messages_repository,
+)
+from utils.media_buffer import MediaBuffer
+
+# assistant_backends.py — общий каркас бэкендов ассистента
+#
+# GPTCompletions (Chat Completions), GPT (Assistants) и GPTResponses (Responses) реализуют один протокол
+# AssistantBackend и берут отсюда общее: тарифные исключения, замки диалогов, разбор и параллельное
+# исполнение вызовов инструментов, проверку подписки/генераций и хранилище истории.
+# assistant_router выбирает бэкенд для каждого пользователя (явно или по проценту трафика)
+# и считает задержку ответа по каждому бэкенду для A/B-сравнения.
+#
+# Модули бэкендов импортируют этот модуль, поэтому сами бэкенды создаются лениво по имени.
+
+load_dotenv(find_dotenv())
+ASSISTANT_BACKEND = os.getenv("ASSISTANT_BACKEND", "completions")          # бэкенд по умолчанию
+# доли трафика по бэкендам, например "completions:90,responses:10"; пользователь закреплён за бэкендом
+ASSISTANT_BACKEND_SPLIT = os.getenv("ASSISTANT_BACKEND_SPLIT", "")
+# явные назначения, например {"123456789": "assistants"} — важнее долей
+ASSISTANT_BACKEND_USERS = os.getenv("ASSISTANT_BACKEND_USERS", "")
+ASSISTANT_BACKEND_SALT = os.getenv("ASSISTANT_BACKEND_SALT", "ab-1")      # новая соль — новое разбиение
+TOOL_CONCURRENCY_PER_USER = 3     # сколько инструментов одного хода исполняются одновременно
+THREAD_LOCKS_SOFT_LIMIT = 10_000  # сверх этого числа замков свободные выбрасываются
+VIDEO_TOOLS = ("generate_text_to_video", "generate_image_to_video")
+LATENCY_WINDOW = 500
+
+
+class NoSubscription(Exception):
+    """Ошибка отсутствия подписки для функции"""
+    pass
+
+
+class NoGenerations(Exception):
+    """Ошибка: у пользователя закончились генерации"""
+    pass
+
+
+# ---------- замки диалогов ----------
+
+_thread_locks: Dict[str, asyncio.Lock] = {}
+
+
+async def get_thread_lock(dialog_key: str) -> asyncio.Lock:
+    """
+    Один замок на диалог (thread_id или user_id) для всех бэкендов.
+    Бэкенды берут замок сразу после получения (async with), без await между ними,
+    поэтому свободный замок можно выбросить — следующий вызов создаст новый.
+    """
+    lock = _thread_locks.get(dialog_key)
+    if lock is None:
+        if len(_thread_locks) >= THREAD_LOCKS_SOFT_LIMIT:
+            _drop_idle_thread_locks()
+        lock = _thread_locks[dialog_key] = asyncio.Lock()
+    return lock
+
+
+def _drop_idle_thread_locks() -> None:
+    for key, lock in list(_thread_locks.items()):
+        # release() снимает locked() раньше, чем разбуженный ожидающий успеет взять замок:
+        # пока он в _waiters, замок занят, иначе следующий вызов получит второй замок на тот же диалог
+        if not lock.locked() and not lock._waiters:
+            del _thread_locks[key]
+
+
+async def retry_call(
+    fn: Callable[..., Awaitable[Any]],
+    *args,
+    attempts: int = 6,
+    backoff: float = 1.5,
+    **kwargs,
+):
+    """Повторяет вызов *fn* с экспоненциальной задержкой при сетевых ошибках."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except (APITimeoutError, APIConnectionError, APIStatusError, RateLimitError):
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(backoff ** attempt)
+        except (AuthenticationError, PermissionDeniedError):
+            raise  # ошибки неустранимы
+
+
+# ---------- инструменты ----------
+
+def parse_tool_call(tool_call: Any) -> tuple[str, dict, str | None]:
+    """
+    Имя, аргументы и id вызова инструмента в любом из форматов:
+    объект Chat Completions/Assistants (tool_call.function), элемент Responses (name/arguments/call_id) или dict.
+    """
+    if hasattr(tool_call, "function"):
+        name = tool_call.function.name
+        args_raw = tool_call.function.arguments
+        call_id = getattr(tool_call, "id", None)
+    elif isinstance(tool_call, dict):
+        name = tool_call.get("function", {}).get("name") or tool_call.get("name")
+        args_raw = tool_call.get("function", {}).get("arguments") or tool_call.get("arguments")
+        call_id = tool_call.get("id") or tool_call.get("call_id")
+    else:
+        name = getattr(tool_call, "name", None)
+        args_raw = getattr(tool_call, "arguments", None)
+        call_id = getattr(tool_call, "call_id", None) or getattr(tool_call, "id", None)
+
+    if isinstance(args_raw, dict):
+        return name, args_raw, call_id
+    try:
+        args = json.loads(args_raw or "{}")
+    except json.JSONDecodeError:
+        # модель иногда склеивает два объекта подряд — берём первый
+        args = json.loads((args_raw or "").split('}', 1)[0] + '}')
+    return name, args if isinstance(args, dict) else {}, call_id
+
+
+class ToolExecutor:
+    """
+    Исполняет вызовы инструментов одного хода параллельно, но не больше concurrency на пользователя.
+    Исключение инструмента возвращается вместо результата, а не роняет остальные.
+    """
+
+    def __init__(self, concurrency: int = TOOL_CONCURRENCY_PER_USER):
+        self.concurrency = concurrency
+        # семафор живёт, пока у пользователя есть ход с инструментами, — словарь не растёт с числом пользователей
+        self._semaphores: Dict[int, asyncio.Semaphore] = {}
+        self._active_runs: Dict[int, int] = defaultdict(int)
+        self.stats: Dict[str, Dict[str, float]] = defaultdict(lambda: {"calls": 0, "errors": 0, "total_sec": 0.0})
+
+    async def run(self, user_id: int,
+                  calls: Sequence[tuple[str, Callable[[], Awaitable[Any]]]]) -> List[Any]:
+        """calls — пары (имя инструмента, фабрика корутины); результаты в том же порядке"""
+        semaphore = self._semaphores.get(user_id)
+        if semaphore is None:
+            semaphore = self._semaphores[user_id] = asyncio.Semaphore(self.concurrency)
+
+        async def one(name: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+            async with semaphore:
+                started = time.monotonic()
+                stats = self.stats[name]
+                stats["calls"] += 1
+                try:
+                    return await factory()
+                except Exception:
+                    stats["errors"] += 1
+                    raise
+                finally:
+                    stats["total_sec"] += time.monotonic() - started
+
+        self._active_runs[user_id] += 1
+        try:
+            return await asyncio.gather(*(one(name, factory) for name, factory in calls), return_exceptions=True)
+        finally:
+            self._active_runs[user_id] -= 1
+            if not self._active_runs[user_id]:
+                del self._active_runs[user_id]
+                del self._semaphores[user_id]
+
+    def snapshot(self) -> dict:
+        return {name: {"calls": int(s["calls"]), "errors": int(s["errors"]),
+                       "avg_sec": round(s["total_sec"] / s["calls"], 2) if s["calls"] else 0.0}
+                for name, s in self.stats.items()}
+
+
+tool_executor = ToolExecutor()
+
+
+async def send_tool_indicator(bot, chat_id: int, fname: str):
+    """Сообщение «начал работу» на время инструмента; бэкенд удаляет его, когда инструменты отработали"""
+    from utils.telegram_sender import get_sender
+    sender = get_sender(bot)
+    if fname == "search_web":
+        return await sender.send_message(chat_id, "🔍Начал поиск в интернете, анализирую страницы...")
+    if fname == "add_notification":
+        return await sender.send_message(chat_id, "🖌Начал настраивать напоминание...")
+    if fname in VIDEO_TOOLS:
+        from settings import send_initial
+        return await sender.send(chat_id, send_initial, bot, chat_id)
+    return await sender.send_message(chat_id, "🎨Начал работу над изображением, немного магии…")
+
+
+# ---------- подписка и генерации ----------
+
+@dataclass(slots=True)
+class TurnQuota:
+    """Подписка пользователя на один ход ассистента: загружается один раз, проверяется на каждый платный инструмент"""
+    user_id: int
+    subscription: Subscriptions | None
+    plan: TypeSubscriptions | None
+
+    @property
+    def is_paid(self) -> bool:
+        return self.subscription is not None and not (self.plan is not None and self.plan.plan_name == "Free")
+
+    @property
+    def generations_left(self) -> int:
+        return self.subscription.photo_generations if self.subscription else 0
+
+
+async def load_quota(user_id: int) -> TurnQuota:
+    subscription = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user_id)
+    plan = await type_subscriptions_repository.get_type_subscription_by_id(
+        type_id=subscription.type_subscription_id
+    ) if subscription else None
+    return TurnQuota(user_id=user_id, subscription=subscription, plan=plan)
+
+
+async def require_tool_access(quota: TurnQuota, *, metered: bool = True) -> None:
+    """
+    Платный инструмент: без подписки — NoSubscription, без генераций (для metered) — NoGenerations.
+    Перед исключением пользователю уходит сообщение с кнопками покупки.
+    """
+    from settings import get_current_bot
+    from utils.telegram_sender import get_sender
+    sender = get_sender(get_current_bot())
+    if not quota.is_paid:
+        from settings import sub_text
+        sub_types = await type_subscriptions_repository.select_all_type_subscriptions()
+        await sender.send_message(
+            quota.user_id,
+            "🚨 Эта функция доступна только по подписке\n\n" + sub_text,
+            reply_markup=subscriptions_keyboard(sub_types).as_markup(),
+        )
+        raise NoSubscription(f"User {quota.user_id} dont has active subscription")
+    if metered and quota.generations_left <= 0:
+        from settings import buy_generations_text
+        generations_packets = await generations_packets_repository.select_all_generations_packets()
+        await sender.send_message(
+            quota.user_id,
+            buy_generations_text,
+            reply_markup=more_generations_keyboard(generations_packets).as_markup(),
+        )
+        raise NoGenerations(f"User {quota.user_id} dont has generations")
+
+
+async def consume_generations(quota: TurnQuota, count: int) -> None:
+    if quota.subscription is not None and count > 0:
+        await subscriptions_repository.use_generation(subscription_id=quota.subscription.id, count=count)
+
+
+# ---------- история ----------
+
+class DialogHistory:
+    """История диалога в таблице dialogs_messages (Chat Completions хранит её у себя, а не у провайдера)"""
+
+    def __init__(self):
+        self.repo = dialogs_messages_repository
+
+    async def append(self, user_id: int, payload: dict):
+        await self.repo.add_message(user_id=user_id, message=payload)
+
+    async def extend(self, user_id: int, payloads: Sequence[dict]):
+        await self.repo.add_messages(user_id=user_id, messages=payloads)
+
+    async def load(self, user_id: int) -> Sequence[DialogsMessages]:
+        return await self.repo.get_messages_by_user_id(user_id=user_id)
+
+    async def clear(self, user_id: int):
+        await self.repo.delete_messages_by_user_id(user_id=user_id)
+
+
+# ---------- протокол и выбор бэкенда ----------
+
+@runtime_checkable
+class AssistantBackend(Protocol):
+    async def send_message(self, user_id: int, thread_id: str | None = None, *,
+                           with_audio_transcription: bool = False, text: str | None = None,
+                           image_bytes: Sequence[MediaBuffer | io.BytesIO] | None = None,
+                           document_bytes: Sequence[tuple[io.BytesIO, str, str]] | None = None,
+                           document_type: str | None = None, audio_bytes: io.BytesIO | None = None,
+                           user_data: Any = None) -> dict: ...
+
+    async def transcribe_audio(self, audio_bytes: io.BytesIO, language: str = "ru") -> str: ...
+
+    async def clear_history(self, user_id: int) -> None: ...
+
+
+def _completions_backend() -> AssistantBackend:
+    from utils.completions_gpt_tools import GPTCompletions
+    return GPTCompletions()
+
+
+def _assistants_backend() -> AssistantBackend:
+    from utils.combined_gpt_tools import GPT
+    return GPT()
+
+
+def _responses_backend() -> AssistantBackend:
+    from utils.responses_gpt_tools import GPTResponses
+    return GPTResponses()
+
+
+BACKEND_FACTORIES: Dict[str, Callable[[], AssistantBackend]] = {
+    "completions": _completions_backend,
+    "assistants": _assistants_backend,
+    "responses": _responses_backend,
+}
+
+
+def _parse_split(raw: str) -> list[tuple[str, int]]:
+    split = []
+    for part in filter(None, (p.strip() for p in raw.split(","))):
+        name, _, share = part.partition(":")
+        split.append((name.strip(), int(share or 0)))
+    return split
+
+
+class AssistantRouter:
+    """
+    Сам реализует AssistantBackend: каждый вызов уходит бэкенду пользователя.
+    Пользователь закреплён за бэкендом (история у бэкендов своя), поэтому доли считаются
+    по стабильному хешу user_id, а не случайно на каждый запрос.
+    """
+
+    def __init__(self, default: str = ASSISTANT_BACKEND, split: str = ASSISTANT_BACKEND_SPLIT,
+                 users: str = ASSISTANT_BACKEND_USERS, salt: str = ASSISTANT_BACKEND_SALT,
+                 factories: Dict[str, Callable[[], AssistantBackend]] | None = None):
+        self.factories = factories or BACKEND_FACTORIES
+        self.default = default
+        self.split = _parse_split(split)
+        self.users = {int(k): v for k, v in json.loads(users).items()} if users else {}
+        self.salt = salt
+        unknown = {self.default, *(name for name, _ in self.split), *self.users.values()} - self.factories.keys()
+        if unknown:
+            raise ValueError(f"Unknown assistant backends: {', '.join(sorted(unknown))}")
+        self._backends: Dict[str, AssistantBackend] = {}
+        self._latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._errors: Dict[str, int] = defaultdict(int)
+
+    def use(self, name: str, backend: AssistantBackend) -> None:
+        """Подставляет готовый экземпляр бэкенда (например, созданный в bot.py)"""
+        self._backends[name] = backend
+
+    def backend_name(self, user_id: int) -> str:
+        if user_id in self.users:
+            return self.users[user_id]
+        total = sum(share for _, share in self.split)
+        if total <= 0:
+            return self.default
+        digest = hashlib.blake2b(f"{self.salt}:{user_id}".encode(), digest_size=8).digest()
+        bucket = int.from_bytes(digest, "big") % total
+        for name, share in self.split:
+            if bucket < share:
+                return name
+            bucket -= share
+        return self.default
+
+    def backend(self, name: str | None = None) -> AssistantBackend:
+        name = name or self.default
+        backend = self._backends.get(name)
+        if backend is None:
+            backend = self._backends[name] = self.factories[name]()
+        return backend
+
+    def for_user(self, user_id: int) -> AssistantBackend:
+        return self.backend(self.backend_name(user_id))
+
+    async def send_message(self, user_id: int, thread_id: str | None = None, **kwargs) -> dict:
+        name = self.backend_name(user_id)
+        started = time.monotonic()
+        try:
+            return await self.backend(name).send_message(user_id=user_id, thread_id=thread_id, **kwargs)
+        except (NoSubscription, NoGenerations):
+            raise
+        except Exception:
+            self._errors[name] += 1
+            raise
+        finally:
+            self._latencies[name].append(time.monotonic() - started)
+
+    async def transcribe_audio(self, audio_bytes: io.BytesIO, language: str = "ru") -> str:
+        return await self.backend().transcribe_audio(audio_bytes=audio_bytes, language=language)
+
+    async def clear_history(self, user_id: int) -> None:
+        await self.for_user(user_id).clear_history(user_id)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for name, latencies in self._latencies.items():
+            ordered = sorted(latencies)
+            result[name] = {
+                "requests": len(ordered), "errors": self._errors[name],
+                "p50_sec": round(ordered[len(ordered) // 2], 2) if ordered else None,
+                "p95_sec": round(ordered[int(0.95 * (len(ordered) - 1))], 2) if ordered else None,
+            }
+        return result
+
+
+assistant_router = AssistantRouter()
@@ -0,0 +1,318 @@
+import asyncio
+import io
+import math
+import os
+import struct
+import traceback
+from typing import Any, AsyncGenerator, AsyncIterable
+
+import aiohttp
+from aiogram.types import BufferedInputFile, InputFile
+from dotenv import find_dotenv, load_dotenv
+
+from utils.file_cache import file_cache
+from utils.media_fetcher import media_fetcher
+from utils.transcription_cache import transcription_cache
+from utils.tts_cache import speech_key, tts_cache
+
+# audio_pipeline.py — потоковая обработка голоса: распознавание (Whisper) и озвучка ответов (TTS)
+#
+# Голосовое не собирается целиком в памяти: байты из Telegram сразу уходят телом запроса
+# в /audio/transcriptions. Длинное голосовое режется по страницам OGG на куски примерно по CHUNK_SEC,
+# и каждый кусок распознаётся, как только докачан, параллельно с остальными.
+# Ответ TTS тоже не буферизуется: SpeechInputFile отдаёт его в загрузку Telegram по мере получения.
+
+load_dotenv(find_dotenv())
+OPENAI_API_KEY: str | None = os.getenv("GPT_TOKEN") or os.getenv("OPENAI_API_KEY")
+TTS_API_KEY: str | None = os.getenv("NEURO_GPT_TOKEN") or OPENAI_API_KEY
+TRANSCRIPTIONS_URL = "https://api.openai.com/v1/audio/transcriptions"
+SPEECH_URL = "https://api.openai.com/v1/audio/speech"
+TTS_MODEL = "gpt-4o-mini-tts"
+
+STREAM_CHUNK_SIZE = 64 * 1024
+LONG_VOICE_SEC = 60               # голосовые длиннее режем на куски
+CHUNK_SEC = 30
+MIN_TAIL_SEC = 5                  # совсем короткий хвост Whisper распознаёт плохо — дописываем его к последнему куску
+TRANSCRIBE_CONCURRENCY = 8        # одновременных запросов к Whisper на процесс
+TRANSCRIBE_TIMEOUT = 60
+TTS_TIMEOUT = 60
+OPUS_RATE = 48_000                # granule position в OGG/Opus всегда в отсчётах 48 кГц
+
+
+class OggOpusSplitter:
+    """
+    Режет поток OGG/Opus на самостоятельные файлы: каждый кусок — заголовочные страницы (OpusHead, OpusTags)
+    и следующие за ними целые страницы с аудио. Страницы не перепаковываются: декодер Whisper
+    спокойно принимает ненулевой начальный granule и пропуски в номерах страниц.
+    """
+
+    def __init__(self, chunk_sec: float, total_sec: float):
+        self.chunk_granules = int(chunk_sec * OPUS_RATE)
+        self.total_granules = int(total_sec * OPUS_RATE)
+        self.valid = True                  # False — поток не OGG/Opus, резать его нельзя
+        self._buf = bytearray()
+        self._headers: list[bytes] = []
+        self._pages: list[bytes] = []
+        self._chunk_start = 0
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Принимает очередную порцию потока и возвращает куски, которые уже можно распознавать"""
+        self._buf += data
+        ready: list[bytes] = []
+        for granule, page, body_offset in self._take_pages():
+            if len(self._headers) < 2:
+                if not self._headers and not page.startswith(b"OpusHead", body_offset):
+                    self.valid = False
+                    return []
+                self._headers.append(page)
+                continue
+            self._pages.append(page)
+            # granule == -1: на странице не заканчивается ни один пакет, границей она быть не может
+            if granule < 0 or granule - self._chunk_start < self.chunk_granules:
+                continue
+            if self.total_granules - granule < MIN_TAIL_SEC * OPUS_RATE:
+                continue
+            ready.append(self._flush())
+            self._chunk_start = granule
+        return ready
+
+    def finish(self) -> bytes | None:
+        """Последний кусок, когда поток закончился"""
+        return self._flush() if self.valid and self._pages else None
+
+    def _flush(self) -> bytes:
+        chunk = b"".join(self._headers + self._pages)
+        self._pages = []
+        return chunk
+
+    def _take_pages(self):
+        buf = self._buf
+        pos = 0
+        while True:
+            if len(buf) - pos < 27:
+                break
+            if buf[pos:pos + 4] != b"OggS":
+                if not self._headers:
+                    self.valid = False
+                    break
+                # потеряли синхронизацию — ищем следующую страницу
+                nxt = buf.find(b"OggS", pos + 1)
+                if nxt < 0:
+                    pos = max(pos, len(buf) - 3)
+                    break
+                pos = nxt
+                continue
+            segments = buf[pos + 26]
+            body_offset = 27 + segments
+            if len(buf) - pos < body_offset:
+                break
+            size = body_offset + sum(buf[pos + 27:pos + body_offset])
+            if len(buf) - pos < size:
+                break
+            granule = struct.unpack_from("<q", buf, pos + 6)[0]
+            yield granule, bytes(buf[pos:pos + size]), body_offset
+            pos += size
+        del buf[:pos]
+
+
+class SpeechInputFile(InputFile):
+    """
+    Озвучка текста, которая качается из TTS прямо в загрузку Telegram, без буфера на весь файл.
+    Короткие фразы получают cache_key — их озвучка (tts_cache) и file_id (media_registry) переиспользуются.
+    """
+
+    def __init__(self, text: str, *, voice: str = "shimmer", instructions: str = "Speak dramatic",
+                 response_format: str = "opus", model: str = TTS_MODEL, filename: str | None = None,
+                 pipeline: "AudioPipeline | None" = None):
+        super().__init__(filename=filename or f"answer.{'ogg' if response_format == 'opus' else response_format}",
+                         chunk_size=STREAM_CHUNK_SIZE)
+        self.text = text
+        self.voice = voice
+        self.instructions = instructions
+        self.response_format = response_format
+        self.model = model
+        self.cache_key = speech_key(text, model=model, voice=voice, instructions=instructions,
+                                    response_format=response_format) if tts_cache.cacheable(text) else None
+        self._pipeline = pipeline
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        # aiogram вызывает read на каждую попытку отправки — повтор получит свежий поток
+        pipeline = self._pipeline or audio_pipeline
+        async for chunk in pipeline.read_speech(self):
+            yield chunk
+
+
+class AudioPipeline:
+    """Распознавание голосовых Telegram и озвучка ответов через один общий HTTP-пул"""
+
+    def __init__(self, concurrency: int = TRANSCRIBE_CONCURRENCY):
+        self.concurrency = concurrency
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self.stats = {"streamed": 0, "chunked": 0, "chunks": 0, "fallbacks": 0, "tts_streams": 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # один пул соединений — без TLS-рукопожатия на каждое голосовое
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    # --------------------- распознавание ---------------------
+
+    async def transcribe_voice(self, bot, voice: Any, language: str = "ru") -> str:
+        """
+        Расшифровка голосового (Voice/Audio из aiogram). Пересланное голосовое (тот же file_unique_id)
+        отвечается из кеша. Иначе файл читается из Telegram потоком и сразу уходит в Whisper;
+        длинное голосовое распознаётся параллельными кусками. Если потоковый путь сорвался —
+        одна попытка по-старому: скачать целиком и отправить одним запросом.
+        """
+        return await transcription_cache.get_or_transcribe(
+            getattr(voice, "file_unique_id", None), language,
+            lambda: self._transcribe_voice(bot, voice, language),
+            duration=getattr(voice, "duration", None),
+        )
+
+    async def _transcribe_voice(self, bot, voice: Any, language: str) -> str:
+        from settings import logger
+        mime = getattr(voice, "mime_type", None) or "audio/ogg"
+        duration = getattr(voice, "duration", None) or 0
+        # локальный Bot API отдаёт путь на диске — потоковое чтение по URL ему не подходит
+        if not getattr(bot.session.api, "is_local", False):
+            try:
+                meta = await file_cache.get_file(bot, voice.file_id)
+                stream = bot.session.stream_content(url=bot.session.api.file_url(bot.token, meta.file_path),
+                                                    timeout=TRANSCRIBE_TIMEOUT, chunk_size=STREAM_CHUNK_SIZE)
+                if duration > LONG_VOICE_SEC and mime == "audio/ogg":
+                    return await self._transcribe_chunked(stream, duration, language)
+                self.stats["streamed"] += 1
+                return await self._post_transcription(stream, language, filename=_voice_filename(mime), mime=mime)
+            except Exception:
+                logger.log("GPT_ERROR", f"Потоковое распознавание не удалось, пробуем целиком: {traceback.format_exc()}")
+            self.stats["fallbacks"] += 1
+        data = await media_fetcher.fetch(bot, voice)
+        return await self._post_transcription(data, language, filename=_voice_filename(mime), mime=mime)
+
+    async def transcribe(self, audio: bytes | io.BytesIO, language: str = "ru", *,
+                         filename: str = "audio.mp3", mime: str | None = None) -> str:
+        """Расшифровка уже скачанного аудио; FileBuffer из media_fetcher кешируется по file_unique_id"""
+        file_unique_id = getattr(audio, "file_unique_id", None)
+        if isinstance(audio, io.BytesIO):
+            audio = audio.getvalue()
+        return await transcription_cache.get_or_transcribe(
+            file_unique_id, language,
+            lambda: self._post_transcription(audio, language, filename=filename, mime=mime),
+        )
+
+    async def _transcribe_chunked(self, stream: AsyncIterable[bytes], duration: float, language: str) -> str:
+        parts = math.ceil(duration / CHUNK_SEC)
+        splitter = OggOpusSplitter(chunk_sec=duration / parts, total_sec=duration)
+        tasks: list[asyncio.Task] = []
+
+        def start(piece: bytes) -> None:
+            tasks.append(asyncio.create_task(
+                self._post_transcription(piece, language, filename="voice.ogg", mime="audio/ogg")
+            ))
+
+        try:
+            async for data in stream:
+                for piece in splitter.feed(data):
+                    start(piece)
+                if not splitter.valid:
+                    raise ValueError("Голосовое не в формате OGG/Opus")
+            tail = splitter.finish()
+            if tail:
+                start(tail)
+            texts = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        self.stats["chunked"] += 1
+        self.stats["chunks"] += len(tasks)
+        return " ".join(text.strip() for text in texts if text and text.strip())
+
+    async def _post_transcription(self, body: bytes | AsyncIterable[bytes], language: str, *,
+                                  filename: str, mime: str | None) -> str:
+        form = aiohttp.FormData()
+        form.add_field("model", "whisper-1")
+        form.add_field("language", language)
+        # асинхронный итератор aiohttp отправляет chunked — тело не собирается в памяти
+        form.add_field("file", body, filename=filename, content_type=mime or "application/octet-stream")
+        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+        async with self._get_semaphore():
+            async with self._get_session().post(TRANSCRIPTIONS_URL, headers=headers, data=form,
+                                                timeout=aiohttp.ClientTimeout(total=TRANSCRIBE_TIMEOUT)) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    return result.get("text", "")
+                raise RuntimeError(f"Transcription error {response.status}: {await response.text()}")
+
+    # --------------------- озвучка ---------------------
+
+    def speech_file(self, text: str, **kwargs) -> SpeechInputFile:
+        """Файл для отправки в Telegram; TTS запрашивается только в момент загрузки"""
+        return SpeechInputFile(text, pipeline=self, **kwargs)
+
+    @staticmethod
+    def voice_input(audio: Any) -> InputFile:
+        """Что передать в send_voice: файл озвучки как есть, готовый буфер — обёрнутым"""
+        if isinstance(audio, InputFile):
+            return audio
+        return BufferedInputFile(file=audio.getvalue(), filename="answer.mp3")
+
+    async def read_speech(self, speech: SpeechInputFile) -> AsyncGenerator[bytes, None]:
+        """Байты озвучки: из кеша, если фраза уже звучала, иначе потоком из TTS (короткая фраза попутно копится в кеш)"""
+        if speech.cache_key:
+            data = await tts_cache.get_audio(speech.cache_key)
+            if data is not None:
+                for pos in range(0, len(data), STREAM_CHUNK_SIZE):
+                    yield data[pos:pos + STREAM_CHUNK_SIZE]
+                return
+        received = bytearray() if speech.cache_key else None
+        async for chunk in self.stream_speech(speech.text, voice=speech.voice, instructions=speech.instructions,
+                                              response_format=speech.response_format, model=speech.model):
+            if received is not None:
+                received += chunk
+            yield chunk
+        # сюда доходим, только если поток дочитан до конца — обрезанная озвучка в кеш не попадёт
+        if received:
+            await tts_cache.put_audio(speech.cache_key, bytes(received))
+
+    async def stream_speech(self, text: str, *, voice: str = "shimmer", instructions: str = "Speak dramatic",
+                            response_format: str = "opus", model: str = TTS_MODEL) -> AsyncGenerator[bytes, None]:
+        headers = {"Authorization": f"Bearer {TTS_API_KEY}", "Content-Type": "application/json"}
+        payload = {
+            "model": model,
+            "input": text,
+            "voice": voice,
+            "instructions": instructions,
+            "response_format": response_format,
+        }
+        async with self._get_session().post(SPEECH_URL, headers=headers, json=payload,
+                                            timeout=aiohttp.ClientTimeout(total=TTS_TIMEOUT)) as response:
+            if response.status != 200:
+                raise RuntimeError(f"TTS error {response.status}: {await response.text()}")
+            self.stats["tts_streams"] += 1
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                yield chunk
+
+    def snapshot(self) -> dict:
+        return dict(self.stats)
+
+
+def _voice_filename(mime: str) -> str:
+    # Whisper определяет формат по расширению
+    return {"audio/ogg": "voice.ogg", "audio/mpeg": "voice.mp3", "audio/mp4": "voice.m4a",
+            "audio/x-wav": "voice.wav", "audio/wav": "voice.wav"}.get(mime, "voice.ogg")
+
+
+audio_pipeline = AudioPipeline()
@@ -7,22 +7,16 @@ import json
 import os
 import pprint
 import traceback
-from collections import defaultdict
-from typing import Any, Awaitable, Callable, Optional, Sequence
-from typing import Dict
+from typing import Any, Optional, Sequence
 
-import aiohttp
 from dotenv import find_dotenv, load_dotenv
 from openai import (
     APIConnectionError,
-    APIStatusError,
     APITimeoutError,
     AsyncOpenAI,
-    AuthenticationError,
-    PermissionDeniedError,
-    RateLimitError, BadRequestError, )
+    BadRequestError, NotFoundError, )
 
-from data.keyboards import subscriptions_keyboard, more_generations_keyboard, delete_notification_keyboard
+from data.keyboards import delete_notification_keyboard
 from settings import get_current_datetime_string, print_log, get_current_bot
 from utils import web_search_agent
 from utils.create_notification import (
@@ -36,24 +30,31 @@ from utils.create_notification import (
     NotificationTextTooLongError
 )
 from utils.gpt_images import AsyncOpenAIImageClient
+from utils.media_fetcher import media_fetcher
+from utils.media_buffer import MediaBuffer, as_media
+from utils.audio_pipeline import audio_pipeline, SpeechInputFile
 from utils.new_fitroom_api import FitroomClient
 from utils.parse_gpt_text import sanitize_with_links
 from utils.runway_api import generate_image_bytes, RunwayTaskFailed, format_runway_fail_for_user
+from utils.assistant_backends import (
+    NoSubscription,
+    NoGenerations,
+    TurnQuota,
+    consume_generations,
+    get_thread_lock,
+    load_quota,
+    parse_tool_call,
+    require_tool_access,
+    send_tool_indicator,
+    tool_executor,
+)
+from utils.resilience import ProviderUnavailableError
+from utils.run_tracker import run_tracker, backoff_delays, TERMINAL_STATUSES
+from utils.openai_file_cache import openai_file_cache
+from utils.vector_store_manifest import DocumentFile, vector_store_manifest
 
 # combined_gpt_tools.py
 
-_thread_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
-
-
-class NoSubscription(Exception):
-    """Ошибка отсутствия подписки для функции"""
-    pass
-
-class NoGenerations(Exception):
-    """Ошибка отсутствия подписки для функции"""
-    pass
-
-
 import asyncio
 from openai import InternalServerError
 
@@ -81,17 +82,17 @@ async def retrieve_with_retry(client, file_id: str, max_attempts: int = 4, base_
 
 
 
-async def get_thread_lock(thread_id: str) -> asyncio.Lock:
-    # defaultdict вернёт существующий или создаст новый Lock
-    return _thread_locks[thread_id]
-
-
 load_dotenv(find_dotenv())
 OPENAI_API_KEY: str | None = os.getenv("GPT_TOKEN") or os.getenv("OPENAI_API_KEY")
 assistant_id = os.getenv("ASSISTANT_ID")
 reasoning_assistant_id = os.getenv("REASONING_ASSISTANT_ID")
 DEFAULT_IMAGE_MODEL = "gpt-image-1"
+RUN_WAIT_TIMEOUT_SEC = 90           # столько ждём чужой активный run перед его отменой
+RUN_POLL_MAX_DELAY_SEC = 4.0
+RUN_STREAM_READ_TIMEOUT_SEC = 60.0  # между событиями стрима run'а модель может долго думать
 DEFAULT_IMAGE_SIZE = "1024x1024"
+# бесплатные инструменты: без проверки подписки и без списания генераций
+_FREE_TOOLS = ("search_web", "add_notification")
 
 # --- вспомогательная фильтрация ---
 def _strip_response_format(kwargs: dict) -> dict:
@@ -109,36 +110,13 @@ def _b64(b: bytes) -> str:
     return base64.b64encode(b).decode()
 
 
-async def _retry(
-    fn: Callable[..., Awaitable[Any]],
-    *args,
-    attempts: int = 6,
-    backoff: float = 1.5,
-    **kwargs,
-):
-    """Повторяет вызов *fn* с экспоненциальной задержкой при сетевых ошибках."""
-    for attempt in range(1, attempts + 1):
-        try:
-            return await fn(*args, **kwargs)
-        except (APITimeoutError, APIConnectionError, APIStatusError, RateLimitError):
-            if attempt == attempts:
-                raise
-            await asyncio.sleep(backoff ** attempt)
-        except (AuthenticationError, PermissionDeniedError):
-            raise  # ошибки неустранимы
-
-
-
-
-
 def _image_content(b: bytes, detail: str = "auto") -> dict:
     """Формирует словарь‑контент для изображения."""
     return {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{_b64(b)}"}, "detail": detail}
 
 
 from db.models import Users
-from db.repository import users_repository, subscriptions_repository, type_subscriptions_repository, \
-    generations_packets_repository, notifications_repository
+from db.repository import users_repository, notifications_repository, vector_store_files_repository
 
 api_key = OPENAI_API_KEY
 
@@ -162,7 +140,7 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
         for attempt in range(max_retry):
             try:
                 if model:
-                    return await self.client.beta.threads.runs.create_and_poll(
+                    return await self._stream_run(
                         thread_id=thread_id,
                         assistant_id=assistant_id,
                         instructions=instructions,
@@ -170,7 +148,7 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                         timeout=timeout,
                     )
                 else:
-                    return await self.client.beta.threads.runs.create_and_poll(
+                    return await self._stream_run(
                         thread_id=thread_id,
                         assistant_id=assistant_id,
                         instructions=instructions,
@@ -179,11 +157,39 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
             except BadRequestError as e:
                 # если уже есть активный run — дождаться его завершения и повторить
                 if "already has an active run" in str(e) and attempt < max_retry - 1:
-                    await self._wait_for_active_run(thread_id)
+                    # локальное состояние разошлось с сервером — сверяемся с API
+                    await self._wait_for_active_run(thread_id, refresh=True)
                     continue
                 # во всех остальных случаях пробросить ошибку дальше
                 raise
 
+    async def _stream_run(self, *, thread_id: str, timeout: float, **params):
+        """
+        Создаёт run стримом и дочитывает события до паузы (requires_action) или завершения.
+        Статусы приходят событиями, опрашивать runs.retrieve не нужно. Если стрим оборвался
+        после создания run'а, возвращаем последний известный run — send_message дождётся его опросом.
+        """
+        from settings import logger
+        last_run = None
+        try:
+            async with self.client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                timeout=max(timeout, RUN_STREAM_READ_TIMEOUT_SEC),
+                **params,
+            ) as stream:
+                async for event in stream:
+                    run = run_tracker.on_event(event)
+                    if run is not None:
+                        last_run = run
+        except (APIConnectionError, APITimeoutError):
+            if last_run is None:
+                raise
+            logger.log("GPT_ERROR", f"Run stream interrupted, falling back to polling: "
+                                    f"thread={thread_id}, run={last_run.id}")
+        if last_run is None:
+            raise RuntimeError(f"Run stream for thread {thread_id} ended without run events")
+        return last_run
+
     async def _ensure_assistant(self, user_type_model: str | None = "universal"):
         """Ленивая загрузка объекта ассистента."""
         # if user_type_model == "universal":
@@ -210,56 +216,46 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
         await users_repository.update_thread_id_by_user_id(user_id=user_id, thread_id=thread.id)
         return thread
 
-    async def _sync_vector_store(self, thread_id: str, file_ids: list[str]) -> str:
+    async def _sync_vector_store(self, thread_id: str, user_id: int, documents: list[DocumentFile]) -> str:
         """
         Привязывает к thread единственный vector‑store,
-        содержащий точно указанный набор file_ids.
+        содержащий точно указанный набор документов.
+        Текущее содержимое берётся из манифеста, разница уходит в API одним батчем.
         """
-        thread = await self.client.beta.threads.retrieve(thread_id)
-
-        # 1. получаем текущий vs, если он уже есть
-        vs_ids = []
-        if thread.tool_resources and thread.tool_resources.file_search:
-            vs_ids = thread.tool_resources.file_search.vector_store_ids or []
+        vs_id = next((row.vector_store_id
+                      for row in await vector_store_files_repository.get_files(user_id=user_id, scope=thread_id)),
+                     None)
 
-        vs_id = vs_ids[0] if vs_ids else None
+        # 1. хранилища нет в манифесте — смотрим, не привязано ли оно к thread раньше
+        if vs_id is None:
+            thread = await self.client.beta.threads.retrieve(thread_id)
+            if thread.tool_resources and thread.tool_resources.file_search:
+                vs_ids = thread.tool_resources.file_search.vector_store_ids or []
+                vs_id = vs_ids[0] if vs_ids else None
 
         # 2. создаём VS при отсутствии
         if vs_id is None:
-            vs = await self.client.vector_stores.create(
-                name=f"vs-{thread_id}",
-                file_ids=file_ids,
-            )
-            vs_id = vs.id
-
-            await self.client.beta.threads.update(
-                thread_id=thread_id,
-                tool_resources={"file_search": {"vector_store_ids": [vs_id]}},
-            )
-        else:
-            # 3. синхронизация существующего хранилища
-            current_ids = {
-                f.id
-                for f in (await self.client.vector_stores.files.list(vs_id)).data
-            }
-
-            # удалить лишние
-            for fid in current_ids - set(file_ids):
-                await self.client.vector_stores.files.delete(vector_store_id=vs_id, file_id=fid)
-
-            # добавить недостающие
-            for fid in set(file_ids) - current_ids:
-                await self.client.vector_stores.files.create(
-                    vector_store_id=vs_id,
-                    file_id=fid,
-                )
-
-        # 4. ждём завершения индексации
-        while (await self.client.vector_stores.retrieve(vs_id)).status != "completed":
-            await asyncio.sleep(0.3)
+            vs_id = await self._create_thread_vector_store(thread_id)
 
+        # 3. инкрементальная синхронизация и ожидание индексации
+        try:
+            await vector_store_manifest.sync(self.client, user_id=user_id, scope=thread_id,
+                                             vector_store_id=vs_id, documents=documents)
+        except NotFoundError:
+            # хранилище удалили на стороне OpenAI — заводим новое
+            vs_id = await self._create_thread_vector_store(thread_id)
+            await vector_store_manifest.sync(self.client, user_id=user_id, scope=thread_id,
+                                             vector_store_id=vs_id, documents=documents)
         return vs_id
 
+    async def _create_thread_vector_store(self, thread_id: str) -> str:
+        vs = await self.client.vector_stores.create(name=f"vs-{thread_id}")
+        await self.client.beta.threads.update(
+            thread_id=thread_id,
+            tool_resources={"file_search": {"vector_store_ids": [vs.id]}},
+        )
+        return vs.id
+
     async def send_message(
         self,
         user_id: int,
@@ -267,7 +263,7 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
         *,
         with_audio_transcription: bool = False,
         text: str | None = None,
-        image_bytes: Sequence[io.BytesIO] | None = None,
+        image_bytes: Sequence[MediaBuffer | io.BytesIO] | None = None,
         document_bytes: Sequence[tuple[io.BytesIO, str, str]] | None = None,
         document_type: str | None = None,
         audio_bytes: io.BytesIO | None = None,
@@ -280,7 +276,6 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
             "audio_file": None,
             "reply_markup": None
         }
-        main_bot = get_current_bot()
         from settings import logger
         from settings import get_weekday_russian
         """Отправляет пользовательский запрос с опциональными вложениями."""
@@ -305,15 +300,17 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                 final_content["text"] = "Не получен контент для обработки"
                 return final_content
             # print(text)
-            content, attachments, file_ids = await self._build_content(
+            content, attachments, documents = await self._build_content(
                 text,
+                user_id=user_id,
+                thread_id=thread_id,
                 image_bytes=image_bytes,
                 document_bytes=document_bytes,
                 audio_bytes=audio_bytes,
             )
             # print(content)
-            if file_ids:
-                await self._sync_vector_store(thread_id, file_ids)
+            if documents:
+                await self._sync_vector_store(thread_id, user_id, documents)
             # print(attachments)
             run_id = None
             try:
@@ -364,6 +361,7 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                     backoff = min(max_backoff, backoff * (1.6 + random.random() * 0.3))
                     # опрос актуального статуса
                     run = await self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+                    run_tracker.observe(run)
 
                 # 2) Терминальные неуспешные статусы: отдаём пользователю понятное объяснение
                 if run.status in ("failed", "incomplete", "cancelled", "expired"):
@@ -386,80 +384,24 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                 # print("Сегодня - ", get_current_datetime_string())
                 # ---------------- NEW: обработка image‑tools ----------------
                 if run.status == "requires_action":
-                    from settings import sub_text
-
-
-                    user_sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user.user_id)
-                    if user_sub:
-                        type_sub = await type_subscriptions_repository.get_type_subscription_by_id(type_id=user_sub.type_subscription_id)
-                    else:
-                        type_sub = None
-                    sub_types = await type_subscriptions_repository.select_all_type_subscriptions()
-                    if user_sub is None or (type_sub is not None and type_sub.plan_name == "Free"):
-                        tools_names = [tc.function.name for tc in run.required_action.submit_tool_outputs.tool_calls]
-                        if "edit_image_only_with_peoples" not in tools_names and "generate_image" not in tools_names:
-                            await main_bot.send_message(chat_id=user.user_id,
-                                                        text="🚨К сожалению, данная функция, которую ты"
-                                                    " пытаешься использовать, доступна только по подписке\n\n" + sub_text,
-                                                        reply_markup=subscriptions_keyboard(sub_types).as_markup())
-                            raise NoSubscription(f"User {user.user_id} dont has active subscription")
-                    delete_message = None
-
-                    print(*[tc.function.name for tc in run.required_action.submit_tool_outputs.tool_calls])
-                    send_buy_generations_text = False
-                    for tc in run.required_action.submit_tool_outputs.tool_calls:
-
-                        if tc.function.name == "search_web":
-                            delete_message = await main_bot.send_message(text="🔍Начал поиск в интернете, анализирую страницы...",
-                                                                         chat_id=user.user_id)
-                        elif tc.function.name == "add_notification":
-                            delete_message = await main_bot.send_message(
-                                text="🖌Начал настраивать напоминание, это не займет много времени...",
-                                chat_id=user.user_id)
-                        else:
-                            if user_sub.photo_generations <= 0:
-                                generations_packets = await generations_packets_repository.select_all_generations_packets()
-                                from settings import buy_generations_text
-                                if type_sub.plan_name == "Free":
-                                    await main_bot.send_message(chat_id=user.user_id,
-                                                                text="🚨К сожалению, данная функция, которую ты"
-                                                                     " пытаешься использовать, доступна только по подписке\n\n" + sub_text,
-                                                                reply_markup=subscriptions_keyboard(
-                                                                    sub_types).as_markup())
-                                    raise NoSubscription(f"User {user.user_id} dont has active subscription")
-                                if not send_buy_generations_text:
-                                    await main_bot.send_message(chat_id=user_id, text=buy_generations_text,
-                                                                reply_markup=more_generations_keyboard(generations_packets).as_markup())
-                                    send_buy_generations_text = True
-                                # await process_assistant_run(message_response.tool_calls, user_id=user.user_id)
-                                raise NoGenerations(f"User {user.user_id} dont has generations")
-                            if tc.function.name != "fitting_clothes":
-                                delete_message = await main_bot.send_message(chat_id=user.user_id,
-                                                                             text="🎨Начал работу над изображением, немного магии…")
-                        break
+                    # подписка и генерации — по общим правилам бэкендов: загружаем один раз на ход
+                    quota = await load_quota(user.user_id)
                     try:
                         result = await process_assistant_run(self.client, run, thread_id, user_id=user.user_id,
-                                                             max_photo_generations=user_sub.photo_generations)
-                        # result = await process_assistant_run(self.client, run, thread_id, user_id=user.user_id)
+                                                             quota=quota)
                         result_images = result.get("final_images")
                         web_answer: str = result.get("web_answer")
                         notification: str = result.get("notif_answer")
                         text_answer: str = result.get("text_answer")
                         # print(f"\n\n\n\n\n\n\n{text_answer}\n\n\n\n\n\n\n")
                         if len(result_images) == 0 and web_answer is None and notification is None and text_answer is None:
-                            try:
-                                await delete_message.delete()
-                            finally:
-                                from settings import logger
-                                final_content["text"] = ("В связи с большим наплывом пользователей"
-                                                         " наши сервера испытывают экстремальные нагрузки."
-                                                         " Скоро генерация изображений станет снова доступна,"
-                                                         " а пока можете воспользоваться другим функционалом."
-                                                         " Я умею немало 🤗")
-                                return final_content
+                            final_content["text"] = ("В связи с большим наплывом пользователей"
+                                                     " наши сервера испытывают экстремальные нагрузки."
+                                                     " Скоро генерация изображений станет снова доступна,"
+                                                     " а пока можете воспользоваться другим функционалом."
+                                                     " Я умею немало 🤗")
+                            return final_content
                         messages = await self.client.beta.threads.messages.list(thread_id=thread_id)
-                        if delete_message:
-                            await delete_message.delete()
                         first_msg = messages.data[0]
                         if web_answer:
                             final_content["text"] = sanitize_with_links(web_answer)
@@ -475,7 +417,7 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                             return final_content
                         elif len(result_images) != 0:
 
-                            await subscriptions_repository.use_generation(subscription_id=user_sub.id, count=len(result_images))
+                            await consume_generations(quota, len(result_images))
 
                             final_content["text"] = sanitize_with_links(first_msg.content[0]
                                                                         .text
@@ -484,10 +426,10 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                                                                         else "Сгенерировал изображение")
                             final_content["image_files"] = result_images
                             return final_content
+                    except (NoSubscription, NoGenerations):
+                        raise
                     except Exception:
                         print(traceback.format_exc())
-                        if delete_message:
-                            await delete_message.delete()
                         from settings import logger
                         logger.log(
                             "GPT_ERROR",
@@ -561,42 +503,14 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
 
     # -------- вспомогательные методы --------
     @staticmethod
-    async def generate_audio_by_text(text: str) -> io.BytesIO:
-        """TTS‑синтез ответа в mp3 через /audio/speech."""
-        url = "https://api.openai.com/v1/audio/speech"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": "gpt-4o-mini-tts",
-            "input": text,
-            "voice": "shimmer",
-            "instructions": "Speak dramatic",
-            "response_format": "mp3",
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload, timeout=30) as response:
-                if response.status == 200:
-                    return io.BytesIO(await response.read())
-                raise RuntimeError(f"TTS error {response.status}: {await response.text()}")
+    async def generate_audio_by_text(text: str) -> SpeechInputFile:
+        """TTS-озвучка ответа: файл, который при отправке в Telegram потоком читается из /audio/speech"""
+        return audio_pipeline.speech_file(text)
 
     @staticmethod
     async def transcribe_audio(audio_bytes: io.BytesIO, language: str = "ru") -> str:
         """Возвращает текстовую расшифровку аудио через Whisper."""
-        url = "https://api.openai.com/v1/audio/transcriptions"
-        headers = {"Authorization": f"Bearer {api_key}"}
-
-        audio_bytes.name = "audio.mp3"
-        data = {"file": audio_bytes, "model": "whisper-1", "language": language}
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=data, timeout=60) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result.get("text", "")
-                raise RuntimeError(f"Transcription error {response.status}: {await response.text()}")
+        return await audio_pipeline.transcribe(audio_bytes, language)
 
     @staticmethod
     def _build_about_user(user: Users | None) -> str:
@@ -627,13 +541,15 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
             self,
             text: str,
             *,
-            image_bytes: Sequence[io.BytesIO] | None,
+            image_bytes: Sequence[MediaBuffer | io.BytesIO] | None,
             document_bytes: Sequence[tuple[io.BytesIO, str, str]] | None,
             audio_bytes: io.BytesIO | None,
-    ) -> tuple[list[dict], list[dict], list[str]]:
+            user_id: int,
+            thread_id: str,
+    ) -> tuple[list[dict], list[dict], list[DocumentFile]]:
         content: list[dict] = []
         attachments: list[dict] = []
-        doc_file_ids: list[str] = []
+        documents: list[DocumentFile] = []
 
         # 1. транскрипт аудио (не трогаем...)
         # 2. текст
@@ -641,19 +557,13 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
         # 3. изображения
         if image_bytes:
             for idx, img_io in enumerate(image_bytes):
-                img_io.seek(0)
-                img_file = await self.client.files.create(
-                    file=(f"image_{idx}.png", img_io, "image/png"),
-                    purpose="vision",
-                )
-                while True:
-                    if img_file.status in ("uploaded", "processed", "error"):
-                        break
-                    await asyncio.sleep(0.3)
-                while True:
+                # то же изображение (повторная отправка, пересылка) второй раз не загружаем
+                img_file_id = await openai_file_cache.upload(self.client, as_media(img_io), filename=f"image_{idx}.png",
+                                                             mime="image/png", purpose="vision")
+                for delay in backoff_delays(initial=0.2, maximum=2.0):
                     try:
                         # print("попытка")
-                        file_info = await retrieve_with_retry(self.client, file_id=img_file.id)
+                        file_info = await retrieve_with_retry(self.client, file_id=img_file_id)
                     except RuntimeError:
                         from settings import logger
                         logger.log(
@@ -667,14 +577,14 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
                     # print(file_info.status)
                     if getattr(file_info, "status", None) in ("uploaded", "processing_complete", "ready", "processed"):
                         break
-                    await asyncio.sleep(0.2)
+                    await asyncio.sleep(delay)
                 # (Опционально) Можно добавить ещё небольшую задержку
                 await asyncio.sleep(1)  # даём Vision-движку немного «вздохнуть»
 
                 image_names.append(f"image_{idx}.png")
                 content.append({
                     "type": "image_file",
-                    "image_file": {"file_id": img_file.id},
+                    "image_file": {"file_id": img_file_id},
                 })
                 # print(image_names)
 
@@ -683,103 +593,101 @@ class GPT:  # noqa: N801 – сохраняем оригинальное имя
         # 4. документы
         if document_bytes:
             text += "\n\nВот названия файлов, которые я прикрепил:\n"
-            for idx, (doc_io, file_name, mime_ext) in enumerate(document_bytes):
-                doc_io.seek(0)
-                doc_file = await self.client.files.create(
-                    file=(f"{file_name}", doc_io, f"application/{mime_ext}"),
-                    purpose="assistants",
-                )
-                text += f"{file_name} "
-                doc_file_ids.append(doc_file.id)
+            # уже лежащие в хранилище thread'а документы (по хешу содержимого) повторно не загружаем
+            documents = await vector_store_manifest.upload_documents(
+                self.client, user_id=user_id, scope=thread_id, document_bytes=document_bytes,
+            )
+            for doc in documents:
+                text += f"{doc.file_name} "
                 attachments.append({
-                    "file_id": doc_file.id,
+                    "file_id": doc.file_id,
                     "tools": [{"type": "file_search"}],
                 })
         #
         content.append({"type": "text", "text": f"Сегодня - {get_current_datetime_string()}\n\n по Москве.\n\n" + text})
         content = content[-10:] if len(content) > 10 else content
-        return content, attachments, doc_file_ids
+        return content, attachments, documents
 
-    async def _wait_for_active_run(
-        self,
-        thread_id: str,
-        poll_interval: float = 0.5,
-    ) -> None:
+    async def _wait_for_active_run(self, thread_id: str, *, refresh: bool = False) -> None:
         """
         Блокирует выполнение, пока в thread есть активный run.
         Обеспечивает последовательную обработку запросов (очередь).
+        Состояние берётся из run_tracker; runs.list — только для незнакомого thread'а или по refresh,
+        активные run'ы дожидаемся событиями и редкими runs.retrieve с растущей паузой.
         """
-        ACTIVE = {"queued", "in_progress", "requires_action", "cancelling", "active"}
-        retries = 180
-        while retries > 0:
-            runs = await self.client.beta.threads.runs.list(
-                thread_id=thread_id,
-                limit=100,
-                order="desc",  # последний первым
-            )
-            if any(r.status in ACTIVE for r in runs.data):
-                await asyncio.sleep(poll_interval)
-                retries -= 1
-                continue
-            break
-        else:
-            await self._cancel_active_runs(thread_id=thread_id)
-
-    async def _cancel_active_runs(self, thread_id: str):
-        ACTIVE = {"queued", "in_progress", "requires_action", "cancelling", "active"}
+        if refresh or not run_tracker.is_known(thread_id):
+            await self._refresh_runs(thread_id)
+        elif run_tracker.is_idle(thread_id):
+            run_tracker.stats["local_hits"] += 1
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RUN_WAIT_TIMEOUT_SEC
+        for delay in backoff_delays(initial=0.5, maximum=RUN_POLL_MAX_DELAY_SEC):
+            if run_tracker.is_idle(thread_id):
+                return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            if await run_tracker.wait_idle(thread_id, timeout=min(delay, remaining)):
+                return
+            for run_id in run_tracker.active_run_ids(thread_id):
+                run_tracker.stats["polls"] += 1
+                run_tracker.observe(await self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id))
+        await self._cancel_active_runs(thread_id=thread_id)
+
+    async def _refresh_runs(self, thread_id: str) -> None:
+        """Одна сверка с API: активный run в thread может быть только один, поэтому хватает последних"""
         runs = await self.client.beta.threads.runs.list(
             thread_id=thread_id,
-            limit=100,
+            limit=5,
             order="desc",  # последний первым
         )
-        for run in runs.data:
-            if any(r.status in ACTIVE for r in runs.data):
-                await self._safe_cancel_run(run_id=run.id, thread_id=thread_id)
+        run_tracker.seed(thread_id, runs.data)
+
+    async def _cancel_active_runs(self, thread_id: str):
+        if not run_tracker.is_known(thread_id):
+            await self._refresh_runs(thread_id)
+        for run_id in run_tracker.active_run_ids(thread_id):
+            await self._safe_cancel_run(run_id=run_id, thread_id=thread_id)
 
     async def _safe_cancel_run(self, thread_id: str, run_id: str | None = None):
         if run_id is None:
             return
+        if not run_tracker.may_be_active(thread_id, run_id):
+            # run уже завершился (видели это в событиях) — отменять нечего
+            run_tracker.stats["skipped_cancels"] += 1
+            return
         for i in range(3):
             try:
-                await self.client.beta.threads.runs.cancel(run_id=run_id, timeout=10, thread_id=thread_id)
+                run = await self.client.beta.threads.runs.cancel(run_id=run_id, timeout=10, thread_id=thread_id)
+                run_tracker.observe(run)
+                break
+            except BadRequestError:
+                # run уже в терминальном статусе — сверимся с API при следующем ожидании
+                run_tracker.forget(thread_id)
                 break
             except:
                 await asyncio.sleep(1)
 
+    async def clear_history(self, user_id: int) -> None:
+        """История живёт в thread у OpenAI — отвязываем его, следующий запрос создаст новый"""
+        await users_repository.update_thread_id_by_user_id(user_id=user_id, thread_id=None)
+
     async def _reset_client(self):
         """Переинициализирует клиента OpenAI и сбрасывает кеш ассистента."""
         self.client = AsyncOpenAI(api_key=api_key)
 
 
-async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_generations: int | None = None) -> Any:
+async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_generations: int | None = None,
+                             user: Users | None = None) -> Any:
     """
     Принимает как Pydantic‑объект RequiredActionFunctionToolCall,
     так и старый словарь (для обратной совместимости).
     """
-    # --- 1. Извлекаем имя и аргументы ---
-    if hasattr(tool_call, "function"):                         # новый формат
-        name = tool_call.function.name
-        args_raw = tool_call.function.arguments
-    else:                                                      # старый формат (dict)
-        name = tool_call.get("name") or tool_call.get("function", {}).get("name")
-        args_raw = tool_call.get("arguments") or tool_call.get("function", {}).get("arguments")
-
-    # --- 2. Приводим arguments к dict ---
-    import json
+    # --- 1. Извлекаем имя и аргументы (dict, если JSON склеен — первый объект) ---
     from settings import logger
-    if isinstance(args_raw, dict):
-        args = args_raw
-    else:
-        try:
-            args = json.loads(args_raw)
-        except json.JSONDecodeError:
-            # print("\n\n")
-            # print(args_raw)
-            # print("\n\n")
-            # например, обрезать до первого `}` и допarse
-            first_obj = args_raw.split('}', 1)[0] + '}'
-            args = json.loads(first_obj)
-    user = await users_repository.get_user_by_user_id(user_id=user_id)
+    name, args, _ = parse_tool_call(tool_call)
+    user = user or await users_repository.get_user_by_user_id(user_id=user_id)
     photo_bytes = []
     print("\n\n" + name + "\n\n")
     pprint.pprint(args)
@@ -827,16 +735,8 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
         # возвращаем результат модели как plain text
         return result
     if user.last_image_id is not None:
-        for photo_id in user.last_image_id.split(", "):
-            main_bot = get_current_bot()
-            # print(photo_id)
-            photo_bytes_io = io.BytesIO()
-            try:
-                await main_bot.download(photo_id, destination=photo_bytes_io)
-                photo_bytes_io.seek(0)
-                photo_bytes.append(photo_bytes_io.read())
-            except:
-                pass
+        photo_bytes = await media_fetcher.fetch_many(get_current_bot(), user.last_image_id.split(", "),
+                                                     skip_errors=True)
     # --- 3. Диспатчинг ---
     if name == "generate_image":
         # print("generate_image")
@@ -907,6 +807,9 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
             )
             return [result_bytes]
 
+        except ProviderUnavailableError as e:
+            logger.log("GPT_ERROR", f"{user_id} | fitroom недоступен: {e}")
+            return e.user_message
         except Exception:
             logger.log("GPT_ERROR",
                        f"Не смогли сгенерировать изображение или обработать запрос😔n\n {traceback.format_exc()}")
@@ -941,6 +844,9 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
                 return []
             logger.log("GPT_ERROR", f"RunwayTaskFailed: {user_msg}")
             return user_msg
+        except ProviderUnavailableError as e:
+            logger.log("GPT_ERROR", f"{user_id} | runway недоступен: {e}")
+            return e.user_message
         except RuntimeError as e:
             logger.log("GPT_ERROR", traceback.format_exc())
             # print(f"Runway task failed for prompt «{prompt}»: {e}")
@@ -956,17 +862,31 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
     return None
 
 
+def _call_key(tc) -> tuple[str, str]:
+    """(имя, аргументы без учёта порядка ключей) — одинаковые вызовы в одном run исполняем один раз"""
+    try:
+        args = json.dumps(json.loads(tc.function.arguments or "{}"), ensure_ascii=False, sort_keys=True)
+    except ValueError:
+        args = tc.function.arguments or ""
+    return tc.function.name, args
+
+
 async def process_assistant_run(
     client: AsyncOpenAI,
     run,
     thread_id: str,
     user_id: int,
-    max_photo_generations: int | None = 999,
+    quota: TurnQuota | None = None,
     image_client: Optional[AsyncOpenAIImageClient] = None,
 ):
-    """Выполняет все tool‑calls ассистента и передаёт результаты."""
+    """
+    Выполняет все tool‑calls ассистента и передаёт результаты.
+    Проверки подписки, индикаторы и параллельное исполнение — общие с остальными бэкендами
+    (require_tool_access, send_tool_indicator, tool_executor); списывает генерации вызывающий код.
+    """
+    empty = {"final_images": [], "web_answer": None, "notif_answer": None, "text_answer": None}
     if run.status != "requires_action" or run.required_action.type != "submit_tool_outputs":
-        return {"final_images": [], "web_answer": None, "notif_answer": None, "text_answer": None}
+        return empty
     image_client = image_client or AsyncOpenAIImageClient()
     outputs = []
     final_images = []
@@ -976,6 +896,7 @@ async def process_assistant_run(
     images_counter = 0
     # 1) освежить run прямо перед извлечением tool_calls — мог измениться
     run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    run_tracker.observe(run)
 
     # 2) аккуратно извлечь массив tool_calls
     submit = getattr(getattr(run, "required_action", None), "submit_tool_outputs", None)
@@ -983,75 +904,127 @@ async def process_assistant_run(
 
     # 3) если пусто — корректно выйти (ничего сабмитить не нужно)
     if not tool_calls:
-        return {"final_images": [], "web_answer": None, "notif_answer": None, "text_answer": None}
-    functions_start = []
-
+        return empty
+    quota = quota or await load_quota(user_id)
+
+    # 4) Проверки подписки/лимитов — до запуска инструментов, в порядке вызовов.
+    # Генерации резервируем заранее. Вызовы одного инструмента с разными аргументами исполняются все,
+    # точный повтор — один раз, но ответ на каждый tool_call run всё равно ждёт: повтор получает ответ оригинала
+    planned = []
+    first_by_key: dict[tuple[str, str], str] = {}
+    repeats: list[tuple[str, str]] = []          # (id повтора, id оригинала)
+    generations_left = quota.generations_left
     for tc in tool_calls:
-        # print(tc.function.name)
-        if tc.function.name == "search_web" and "search_web" not in functions_start:
-            functions_start.append("search_web")
-            web_answer = await dispatch_tool_call(tc, image_client, user_id=user_id)
-            outputs.append({"tool_call_id": tc.id, "output": "Ответ от агента, который умеет"
-                                                             " находить информацию в интернете" + json.dumps({"text": web_answer})})
-            continue
-        if tc.function.name == "add_notification" and "add_notification" not in functions_start:
-            functions_start.append("add_notification")
-            notif_answer = await dispatch_tool_call(tc, image_client, user_id=user_id)
-            outputs.append({"tool_call_id": tc.id, "output": "Добавили информацию о напоминании: " + json.dumps({"text": notif_answer})})
-            continue
-        if images_counter >= max_photo_generations:
-            outputs.append({"tool_call_id": tc.id, "output": "Одно не было сгенерировано, так как был исчерпан лимит"})
-            continue
-        if tc.function.name == "generate_image" and "generate_image" not in functions_start:
-            functions_start.append("generate_image")
-        elif tc.function.name == "generate_image":
-            continue
-        if tc.function.name == "edit_image_only_with_peoples" and "edit_image_only_with_peoples" not in functions_start:
-            functions_start.append("edit_image_only_with_peoples")
-        elif tc.function.name == "edit_image_only_with_peoples":
-            continue
-        images = (await dispatch_tool_call(tc, image_client, user_id=user_id,
-                                           max_photo_generations=max_photo_generations))
-        if tc.function.name == "fitting_clothes" and isinstance(images, str):
-            outputs.append({"tool_call_id": tc.id, "output": json.dumps({"text": images})})
-            text_answer=images
-            continue
-        if tc.function.name == "edit_image_only_with_peoples" and isinstance(images, str):
-            # print(images)
-            outputs.append({"tool_call_id": tc.id, "output": json.dumps({"text": images})})
-            text_answer = images
+        fname = tc.function.name
+        key = _call_key(tc)
+        if key in first_by_key:
+            repeats.append((tc.id, first_by_key[key]))
             continue
+        first_by_key[key] = tc.id
+        if fname not in _FREE_TOOLS:
+            await require_tool_access(quota)
+            if generations_left <= 0:
+                outputs.append({"tool_call_id": tc.id, "output": "Одно не было сгенерировано, так как был исчерпан лимит"})
+                continue
+            generations_left -= 1
+        planned.append(tc)
 
-        if images is None:
-            outputs.append({"tool_call_id": tc.id, "output": "ignored"})
-            continue
-        images_counter += len(images if images is not None and isinstance(images, list) else 0)
-        final_images.extend(images)
-        # сохраняем изображения как файлы
-        file_ids = []
-        # if images[1] == "openai":
-        for idx, img in enumerate(images):
-            file = await client.files.create(file=(f"result_{idx}.png", io.BytesIO(img), "image/png"), purpose="vision")
-            file_ids.append(file.id)
-        outputs.append({
-            "tool_call_id": tc.id,
-            "output": "ID фотографий, которые были сгенерированы в конечном итоге" + json.dumps({"file_ids": file_ids})
-        })
-    # print(final_images)
-    await client.beta.threads.runs.submit_tool_outputs(thread_id=thread_id, run_id=run.id, tool_outputs=outputs)
-    # print("ура, картинка сделана")
-    await _await_run_done(client=client , thread_id=thread_id, run_id=run.id)
+    main_bot = get_current_bot()
+    user = await users_repository.get_user_by_user_id(user_id=user_id)
+    status_messages = await asyncio.gather(
+        *(send_tool_indicator(main_bot, user_id, fname)
+          for fname in dict.fromkeys(tc.function.name for tc in planned)),
+        return_exceptions=True,
+    )
+    try:
+        # 5) Независимые инструменты — параллельно, но не больше TOOL_CONCURRENCY_PER_USER на пользователя
+        results = await tool_executor.run(user_id, [
+            (tc.function.name,
+             lambda tc=tc: dispatch_tool_call(tc, image_client, user_id=user_id,
+                                              max_photo_generations=quota.generations_left, user=user))
+            for tc in planned
+        ])
+        for tc, result in zip(planned, results):
+            fname = tc.function.name
+            if isinstance(result, BaseException):
+                from settings import logger
+                logger.log("GPT_ERROR", "".join(traceback.format_exception(result)))
+                outputs.append({"tool_call_id": tc.id, "output": json.dumps({"status": "error"})})
+                continue
+            if fname == "search_web":
+                web_answer = result
+                outputs.append({"tool_call_id": tc.id, "output": "Ответ от агента, который умеет"
+                                                                 " находить информацию в интернете" + json.dumps({"text": web_answer})})
+                continue
+            if fname == "add_notification":
+                notif_answer = result
+                outputs.append({"tool_call_id": tc.id, "output": "Добавили информацию о напоминании: " + json.dumps({"text": notif_answer})})
+                continue
+            if isinstance(result, str):
+                # примерка и редактирование отвечают текстом, если сделать картинку не вышло
+                outputs.append({"tool_call_id": tc.id, "output": json.dumps({"text": result})})
+                text_answer = result
+                continue
+            if result is None:
+                outputs.append({"tool_call_id": tc.id, "output": "ignored"})
+                continue
+            if images_counter >= quota.generations_left:
+                outputs.append({"tool_call_id": tc.id, "output": "Одно не было сгенерировано, так как был исчерпан лимит"})
+                continue
+            images_counter += len(result)
+            final_images.extend(result)
+            # сохраняем изображения как файлы
+            file_ids = []
+            for idx, img in enumerate(result):
+                file_ids.append(await openai_file_cache.upload(client, img, filename=f"result_{idx}.png",
+                                                               mime="image/png", purpose="vision"))
+            outputs.append({
+                "tool_call_id": tc.id,
+                "output": "ID фотографий, которые были сгенерированы в конечном итоге" + json.dumps({"file_ids": file_ids})
+            })
+    finally:
+        for status_message in status_messages:
+            if isinstance(status_message, BaseException) or status_message is None:
+                continue
+            try:
+                await status_message.delete()
+            except Exception:
+                pass
+    answered = {o["tool_call_id"]: o["output"] for o in outputs}
+    outputs.extend({"tool_call_id": repeat_id, "output": answered.get(original_id, "ignored")}
+                   for repeat_id, original_id in repeats)
+    await _submit_tool_outputs_and_wait(client, thread_id=thread_id, run_id=run.id, tool_outputs=outputs)
     return {"final_images": final_images, "web_answer": web_answer, "notif_answer": notif_answer, "text_answer": text_answer}
-    # return images
+
+
+async def _submit_tool_outputs_and_wait(client, thread_id: str, run_id: str, tool_outputs: list[dict]) -> None:
+    """
+    Отдаёт результаты инструментов стримом и дочитывает события до конца run'а.
+    Если стрим оборвался — дожидаемся опросом с растущей паузой.
+    """
+    try:
+        async with client.beta.threads.runs.submit_tool_outputs_stream(
+            thread_id=thread_id, run_id=run_id, tool_outputs=tool_outputs, timeout=RUN_STREAM_READ_TIMEOUT_SEC,
+        ) as stream:
+            async for event in stream:
+                run_tracker.on_event(event)
+    except (APIConnectionError, APITimeoutError):
+        pass
+    if run_tracker.may_be_active(thread_id, run_id):
+        await _await_run_done(client=client, thread_id=thread_id, run_id=run_id)
 
 
 async def _await_run_done(client, thread_id: str, run_id: str) -> None:
-    TERMINAL = {"completed", "failed", "cancelled", "expired"}
-    while True:
+    # requires_action тоже конец ожидания: новый раунд инструментов здесь не обрабатывается,
+    # а run отменит finally в send_message
+    STOP = TERMINAL_STATUSES | {"requires_action"}
+    for delay in backoff_delays(initial=0.5, maximum=RUN_POLL_MAX_DELAY_SEC):
         run = await client.beta.threads.runs.retrieve(
             thread_id=thread_id, run_id=run_id
         )
-        if run.status in TERMINAL:
+        run_tracker.stats["polls"] += 1
+        run_tracker.observe(run)
+        if run.status in STOP:
             return
-        await asyncio.sleep(0.5)
+        await asyncio.sleep(delay)
 
@@ -2,28 +2,22 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import hashlib
 import io
 import json
 import os
 import traceback
-from collections import defaultdict
-from typing import Any, Awaitable, Callable, Optional, Sequence, Dict, List, Tuple
+from typing import Any, Optional, Sequence, List, Tuple
 
-import aiohttp
 from dotenv import find_dotenv, load_dotenv
 from openai import (
-    APIConnectionError,
-    APIStatusError,
-    APITimeoutError,
     AsyncOpenAI,
-    AuthenticationError,
-    PermissionDeniedError,
     RateLimitError,
     BadRequestError,
 )
 
 from settings import get_current_datetime_string, print_log, get_current_bot, gemini_images_client
-from data.keyboards import subscriptions_keyboard, more_generations_keyboard, delete_notification_keyboard
+from data.keyboards import delete_notification_keyboard
 from utils import web_search_agent
 from utils.create_notification import (
     schedule_notification,
@@ -38,16 +32,37 @@ from utils.create_notification import (
 from utils.google_banano_generate import ResponseBlockedError, PromptBlockedError, TextRefusalError, \
     NoImageInResponseError, InvalidPromptError, AuthError, TransientError, GeminiImageError, RateLimitError
 from utils.gpt_images import AsyncOpenAIImageClient
+from utils.assistant_backends import (
+    NoSubscription,
+    NoGenerations,
+    DialogHistory,
+    TurnQuota,
+    get_thread_lock,
+    load_quota,
+    require_tool_access,
+    consume_generations,
+    parse_tool_call,
+    send_tool_indicator,
+    tool_executor,
+    VIDEO_TOOLS,
+)
+from utils.document_extraction import document_extractor
+from utils.image_processing import image_processor
+from utils.llm_router import llm_router
+from utils.resilience import ProviderUnavailableError, deadline_scope
+from utils.semantic_retrieval import semantic_retrieval, RETRIEVAL_ENABLED, RETRIEVAL_MAX_DOC_CHARS
+from utils.tool_cache import SingleFlight
+from utils.media_fetcher import media_fetcher
+from utils.media_buffer import MediaBuffer, as_media
+from utils.audio_pipeline import audio_pipeline
 from utils.new_fitroom_api import FitroomClient
 from utils.parse_gpt_text import sanitize_with_links
+from utils.prompt_assembly import prompt_assembler
 from utils.runway_api import generate_image_bytes
 
 from db.models import Users
 from db.repository import (
     users_repository,
-    subscriptions_repository,
-    type_subscriptions_repository,
-    generations_packets_repository,
     notifications_repository, dialogs_messages_repository,
 )
 from db.models import DialogsMessages
@@ -55,91 +70,17 @@ from db.models import DialogsMessages
 # --- глобальные переменные и инициализация ---
 
 load_dotenv(find_dotenv())
-NEURO_GPT_TOKEN: str | None = os.getenv("NEURO_GPT_TOKEN")
 OPENAI_API_KEY: str | None = os.getenv("GPT_TOKEN")
 DEFAULT_IMAGE_MODEL = "gpt-image-1"
 DEFAULT_IMAGE_SIZE = "1024x1024"
+IMAGE_TOOL_DEADLINE_SEC = 150     # дольше пользователь ждать картинку не станет — лучше быстро сказать, что сервис лежит
 
-_thread_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
-
-class NoSubscription(Exception):
-    pass
-
-class NoGenerations(Exception):
-    pass
-
-async def get_thread_lock(user_key: str) -> asyncio.Lock:
-    return _thread_locks[user_key]
+# бесплатные инструменты: без проверки подписки и без списания генераций
+_FREE_TOOLS = ("search_web", "add_notification", *VIDEO_TOOLS)
 
 def _b64(b: bytes) -> str:
     return base64.b64encode(b).decode()
 
-async def _retry(
-    fn: Callable[..., Awaitable[Any]],
-    *args,
-    attempts: int = 6,
-    backoff: float = 1.5,
-    **kwargs,
-):
-    for attempt in range(1, attempts + 1):
-        try:
-            return await fn(*args, **kwargs)
-        except (APITimeoutError, APIConnectionError, APIStatusError, RateLimitError):
-            if attempt == attempts:
-                raise
-            await asyncio.sleep(backoff ** attempt)
-        except (AuthenticationError, PermissionDeniedError):
-            raise
-
-# --- Помощники по аудио ---
-
-async def tts_generate_audio_mp3(text: str) -> io.BytesIO:
-    url = "https://api.openai.com/v1/audio/speech"
-    headers = {
-        "Authorization": f"Bearer {NEURO_GPT_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": "gpt-4o-mini-tts",
-        "input": text,
-        "voice": "shimmer",
-        "instructions": "Speak dramatic",
-        "response_format": "mp3",
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=payload, timeout=30) as response:
-            if response.status == 200:
-                return io.BytesIO(await response.read())
-            raise RuntimeError(f"TTS error {response.status}: {await response.text()}")
-
-# --- Адаптация tools к Chat Completions ---
-
-def _tools_for_chat_completions(tools: List[dict]) -> List[dict]:
-    conv = []
-    for t in tools:
-        conv.append({
-            "type": "function",
-            "function": {
-                "name": t["name"],
-                "description": t.get("description") or "",
-                "parameters": t.get("parameters") or {"type": "object", "properties": {}},
-                "strict": t.get("strict", False),
-            }
-        })
-    return conv
-
-# --- Сохранение/загрузка истории ---
-
-class HistoryStore:
-    def __init__(self):
-        self.repo = dialogs_messages_repository
-
-    async def append(self, user_id: int, payload: dict):
-        await self.repo.add_message(user_id=user_id, message=payload)
-
-    async def load(self, user_id: int) -> List[DialogsMessages]:
-        return await self.repo.get_messages_by_user_id(user_id=user_id)
-
 # --- Маппинг истории в Chat Completions messages ---
 
 def _map_history_to_chat_messages(items: List[DialogsMessages]) -> List[dict]:
@@ -296,27 +237,13 @@ def _dedup_tool_calls(tool_calls: List[dict]) -> List[dict]:
 
 
 
-async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_generations: int | None = None) -> Any:
+async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_generations: int | None = None,
+                             user: Users | None = None) -> Any:
     # совместим как раньше: поддержка объекта/словаря
-    if hasattr(tool_call, "function"):
-        name = tool_call.function.name
-        args_raw = tool_call.function.arguments
-        call_id = getattr(tool_call, "id", None)
-    else:
-        name = tool_call.get("function", {}).get("name") or tool_call.get("name")
-        args_raw = tool_call.get("function", {}).get("arguments") or tool_call.get("arguments")
-        call_id = tool_call.get("id")
-
-    if isinstance(args_raw, dict):
-        args = args_raw
-    else:
-        try:
-            args = json.loads(args_raw)
-        except Exception:
-            first_obj = (args_raw or "").split('}', 1)[0] + '}'
-            args = json.loads(first_obj)
+    name, args, call_id = parse_tool_call(tool_call)
 
-    user = await users_repository.get_user_by_user_id(user_id=user_id)
+    if user is None:
+        user = await users_repository.get_user_by_user_id(user_id=user_id)
     photo_bytes = []
     # print(name)
     if name == "add_notification":
@@ -346,16 +273,10 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
         query = args.get("query") or ""
         return await web_search_agent.search_prompt(query)
 
-    if user.last_image_id is not None:
-        for photo_id in user.last_image_id.split(", "):
-            main_bot = get_current_bot()
-            photo_bytes_io = io.BytesIO()
-            try:
-                await main_bot.download(photo_id, destination=photo_bytes_io)
-                photo_bytes_io.seek(0)
-                photo_bytes.append(photo_bytes_io.read())
-            except:
-                pass
+    # Референсы нужны только генерации изображений — качаем их параллельно и только тогда
+    if user.last_image_id is not None and name == "generate_gemini_image" and args.get("with_photo_references", False):
+        photo_bytes = await media_fetcher.fetch_many_media(get_current_bot(), user.last_image_id.split(", "),
+                                                           skip_errors=True)
 
     # if name == "generate_image":
     #     try:
@@ -385,10 +306,15 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
             }
             print(args["prompt"])
             if args.get("with_photo_references", False):
-                kwargs["reference_images"] = [io.BytesIO(photo).read() for photo in photo_bytes]
-            result = await gemini_images_client.generate_gemini_image(**kwargs)
+                kwargs["reference_images"] = photo_bytes
+            with deadline_scope(IMAGE_TOOL_DEADLINE_SEC):
+                result = await gemini_images_client.generate_gemini_image(**kwargs)
             return [result]
 
+        except ProviderUnavailableError as e:
+            logger.log("GPT_ERROR", f"{user_id} | gemini недоступен: {e}")
+            return e.user_message
+
         except PromptBlockedError as e:
 #             error_text = """Мы не можем выполнить запрос из-за ограничений безопасности.
 # Попробуйте переформулировать: без упоминания конкретных публичных персон и в нереалистичном стиле (например, «cartoon/illustration»), либо заменить «рядом с X» на «на фоне постера/силуэта»."""
@@ -486,6 +412,10 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
             logger.info(f"Видео готово: {result}")
             return result
 
+        except ProviderUnavailableError as e:
+            logger.error(f"Sora недоступна: {e}")
+            return e.user_message
+
         except InsufficientCreditsError as e:
             logger.error(f"Недостаточно кредитов: {e}")
             return "К сожалению, на аккаунте закончились кредиты для генерации видео. Пожалуйста, свяжитесь с администратором для пополнения баланса."
@@ -550,6 +480,10 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
             logger.info(f"Видео готово: {result}")
             return result
 
+        except ProviderUnavailableError as e:
+            logger.error(f"Sora недоступна: {e}")
+            return e.user_message
+
         except InsufficientCreditsError as e:
             logger.error(f"Недостаточно кредитов: {e}")
             return "К сожалению, на аккаунте закончились кредиты для генерации видео. Пожалуйста, свяжитесь с администратором для пополнения баланса."
@@ -634,46 +568,40 @@ async def dispatch_tool_call(tool_call, image_client, user_id: int, max_photo_ge
 
 # --- Выполнение tool-calls в режиме Chat Completions ---
 
-async def _append_tool_message(
-    user_id: int,
-    tool_call_id: str,
-    name: str,
-    content_obj: dict | str,
-    outputs_messages: list[dict],
-):
-    """Единообразно:
-    1) добавляем role=tool в массив outputs_messages (для второго шага модели),
-    2) сохраняем 'type=tool' в БД для последующих запросов.
-    """
+def _tool_message(tool_call_id: str, name: str, content_obj: dict | str) -> dict:
+    """role=tool для второго шага модели; в БД он же уходит как 'type=tool'"""
     if isinstance(content_obj, dict):
         content_str = json.dumps(content_obj, ensure_ascii=False)
     else:
         content_str = str(content_obj)
-
-    tool_payload = {
+    return {
         "role": "tool",
         "tool_call_id": tool_call_id,
         "name": name,
         "content": content_str,
     }
-    outputs_messages.append(tool_payload)
 
-    tool_db_json = {
-        "type": "tool",
-        "tool_call_id": tool_call_id,
-        "name": name,
-        "content": content_str,
-    }
-    await dialogs_messages_repository.add_message(user_id=user_id, message=tool_db_json)
+
+async def _save_tool_messages(user_id: int, outputs_messages: list[dict]) -> None:
+    """Все ответы инструментов за ход — одной вставкой в БД"""
+    if not outputs_messages:
+        return
+    await dialogs_messages_repository.add_messages(
+        user_id=user_id,
+        messages=[
+            {"type": "tool", "tool_call_id": m["tool_call_id"], "name": m["name"], "content": m["content"]}
+            for m in outputs_messages
+        ],
+    )
 
 
 async def run_tools_and_followup_chat(
     client: AsyncOpenAI,
-    model: str,
     messages: List[dict],
     tool_calls: List[dict],
     user_id: int,
     max_photo_generations: int,
+    quota: TurnQuota | None = None,
 ) -> Tuple[List[bytes], Optional[str], Optional[str], List[dict], List[str]]:
     image_client = AsyncOpenAIImageClient()
     outputs_messages: List[dict] = []
@@ -687,196 +615,113 @@ async def run_tools_and_followup_chat(
     tool_calls = _dedup_tool_calls(tool_calls)
 
     main_bot = get_current_bot()
-    from settings import sub_text
     user = await users_repository.get_user_by_user_id(user_id=user_id)
-    user_sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user.user_id)
-    type_sub = await type_subscriptions_repository.get_type_subscription_by_id(
-        type_id=user_sub.type_subscription_id
-    ) if user_sub else None
-    sub_types = await type_subscriptions_repository.select_all_type_subscriptions()
-
-    delete_message = None
-    stop_event = None
-    task = None
+    quota = quota or await load_quota(user.user_id)
+
+    status_messages = []
     try:
-        # Каждый tool_call исполняем ровно один раз
+        # 1) Проверки подписки/лимитов — до запуска инструментов, в порядке вызовов.
+        # Генерации резервируем заранее: параллельные вызовы не должны выйти за остаток.
+        # Отказ в платном инструменте закрывает только его tool_call — бесплатные вызовы хода всё равно выполняются
+        planned: List[dict] = []
+        refusal: NoSubscription | NoGenerations | None = None
+        generations_left = max_photo_generations
         for tc in tool_calls:
             fname = tc["function"]["name"]
             tool_id = tc.get("id") or ""
-            # Проверки подписки/лимитов и индикаторы
-            if fname not in ("search_web", "add_notification" ,"generate_text_to_video", "generate_image_to_video"):
-                if user_sub is None or (type_sub is not None and type_sub.plan_name == "Free"):
-                    await main_bot.send_message(
-                        chat_id=user.user_id,
-                        text="🚨 Эта функция доступна только по подписке\n\n" + sub_text,
-                        reply_markup=subscriptions_keyboard(sub_types).as_markup(),
-                    )
-                    # ДОБАВЬ ЭТО: отдаем tool-ответ, чтобы закрыть tool_call
-                    await _append_tool_message(
-                        user_id=user.user_id,
-                        tool_call_id=tool_id,
-                        name=fname,
-                        content_obj={"error": "forbidden", "reason": "no_subscription"},
-                        outputs_messages=outputs_messages,
-                    )
-                    raise NoSubscription(f"User {user.user_id} dont has active subscription")
-
-                if user_sub.photo_generations <= 0:
-                    generations_packets = await generations_packets_repository.select_all_generations_packets()
-                    from settings import buy_generations_text
-                    if type_sub and type_sub.plan_name == "Free":
-                        await main_bot.send_message(
-                            chat_id=user.user_id,
-                            text="🚨 Эта функция доступна только по подписке\n\n" + sub_text,
-                            reply_markup=subscriptions_keyboard(sub_types).as_markup(),
-                        )
-                        # ДОБАВЬ ЭТО:
-                        await _append_tool_message(
-                            user_id=user.user_id,
-                            tool_call_id=tool_id,
-                            name=fname,
-                            content_obj={"error": "forbidden", "reason": "no_subscription"},
-                            outputs_messages=outputs_messages,
-                        )
-                        raise NoSubscription(f"User {user.user_id} dont has active subscription")
-
-                    await main_bot.send_message(
-                        chat_id=user_id,
-                        text=buy_generations_text,
-                        reply_markup=more_generations_keyboard(generations_packets).as_markup(),
-                    )
-                    # ДОБАВЬ ЭТО:
-                    await _append_tool_message(
-                        user_id=user.user_id,
-                        tool_call_id=tool_id,
-                        name=fname,
-                        content_obj={"error": "quota_exceeded", "reason": "no_generations_left"},
-                        outputs_messages=outputs_messages,
-                    )
-                    raise NoGenerations(f"User {user.user_id} dont has generations")
-
-                delete_message = await main_bot.send_message(
-                    chat_id=user.user_id,
-                    text="🎨Начал работу над изображением, немного магии…",
-                )
-            else:
-                if fname == "search_web":
-                    delete_message = await main_bot.send_message(
-                        text="🔍Начал поиск в интернете, анализирую страницы...",
-                        chat_id=user.user_id,
-                    )
-                elif fname == "add_notification":
-                    delete_message = await main_bot.send_message(
-                        text="🖌Начал настраивать напоминание...",
-                        chat_id=user.user_id,
-                    )
-                elif fname in ["generate_text_to_video", "generate_image_to_video"]:
-                    from settings import send_initial
-                    delete_message = await send_initial(main_bot, user_id)
-                    # stop_event = asyncio.Event()
-                    # task = asyncio.create_task(animate_spinner(main_bot, delete_message, stop_event))
-
-            # Исполняем инструмент
-            result = await dispatch_tool_call(
-                tc, image_client, user_id=user_id, max_photo_generations=max_photo_generations
-            )
+            if fname not in _FREE_TOOLS:
+                if refusal is None:
+                    try:
+                        # при отказе пользователь уже получил сообщение с кнопками покупки — второй раз не шлём
+                        await require_tool_access(quota)
+                    except (NoSubscription, NoGenerations) as e:
+                        refusal = e
+                if isinstance(refusal, NoSubscription):
+                    outputs_messages.append(_tool_message(tool_id, fname, {"error": "forbidden", "reason": "no_subscription"}))
+                    continue
+                if isinstance(refusal, NoGenerations):
+                    outputs_messages.append(_tool_message(tool_id, fname, {"error": "quota_exceeded", "reason": "no_generations_left"}))
+                    continue
+
+                if generations_left <= 0:
+                    # остаток уже зарезервирован предыдущими вызовами этого хода
+                    outputs_messages.append(_tool_message(tool_id, fname, {"error": "generation_limit"}))
+                    continue
+                generations_left -= 1
+            planned.append(tc)
+
+        if refusal is not None and not planned:
+            # ход состоял только из недоступных инструментов — хендлер молча завершит его
+            raise refusal
+
+        # 2) Индикаторы — по одному на вид инструмента, параллельно
+        status_messages = await asyncio.gather(
+            *(send_tool_indicator(main_bot, user.user_id, fname)
+              for fname in dict.fromkeys(tc["function"]["name"] for tc in planned)),
+            return_exceptions=True,
+        )
+
+        # 3) Независимые инструменты исполняем параллельно, но не больше TOOL_CONCURRENCY_PER_USER на пользователя
+        results = await tool_executor.run(user_id, [
+            (tc["function"]["name"],
+             lambda tc=tc: dispatch_tool_call(tc, image_client, user_id=user_id,
+                                              max_photo_generations=max_photo_generations, user=user))
+            for tc in planned
+        ])
+
+        # 4) Ответы инструментов МОДЕЛИ: role="tool" + тот же tool_call_id, в порядке вызовов
+        for tc, result in zip(planned, results):
+            fname = tc["function"]["name"]
+            tool_id = tc.get("id") or ""
+
+            if isinstance(result, BaseException):
+                from settings import logger
+                logger.log("GPT_ERROR", "".join(traceback.format_exception(result)))
+                outputs_messages.append(_tool_message(tool_id, fname, {"status": "error"}))
+                continue
 
-            # Возвращаем ответ инструмента МОДЕЛИ: role="tool" + тот же tool_call_id
             if fname == "search_web":
                 web_answer = result or ""
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj={"text": web_answer},
-                    outputs_messages=outputs_messages,
-                )
-                # --- КОНЕЦ ДОБАВЛЕНИЯ
+                outputs_messages.append(_tool_message(tool_id, fname, {"text": web_answer}))
                 continue
 
             if fname == "add_notification":
                 notif_answer = result or ""
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj={"text": notif_answer},
-                    outputs_messages=outputs_messages,
-                )
+                outputs_messages.append(_tool_message(tool_id, fname, {"text": notif_answer}))
                 continue
 
-            if fname in ["generate_text_to_video", "generate_image_to_video"] and isinstance(result, list):
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj={"text": f"Generated vido url: {result[0]}"},
-                    outputs_messages=outputs_messages,
-                )
+            if fname in VIDEO_TOOLS and isinstance(result, list):
+                outputs_messages.append(_tool_message(tool_id, fname, {"text": f"Generated vido url: {result[0]}"}))
                 video_urls.extend(result)
                 continue
 
-            if fname in ["generate_text_to_video", "generate_image_to_video"] and isinstance(result, str):
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj={"text": result},
-                    outputs_messages=outputs_messages,
-                )
+            if fname in VIDEO_TOOLS and isinstance(result, str):
+                outputs_messages.append(_tool_message(tool_id, fname, {"text": result}))
                 continue
 
             if isinstance(result, str):
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj=result,
-                    outputs_messages=outputs_messages,
-                )
+                outputs_messages.append(_tool_message(tool_id, fname, result))
                 continue
 
             if result is None:
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj={"status": "no_result"},
-                    outputs_messages=outputs_messages,
-                )
+                outputs_messages.append(_tool_message(tool_id, fname, {"status": "no_result"}))
                 continue
 
             if isinstance(result, list):
                 if images_counter >= max_photo_generations:
-                    await _append_tool_message(
-                        user_id=user_id,
-                        tool_call_id=tool_id,
-                        name=fname,
-                        content_obj={"error": "generation_limit"},
-                        outputs_messages=outputs_messages,
-                    )
+                    outputs_messages.append(_tool_message(tool_id, fname, {"error": "generation_limit"}))
                     continue
 
                 images_counter += len(result)
                 final_images.extend(result)
-
-                await _append_tool_message(
-                    user_id=user_id,
-                    tool_call_id=tool_id,
-                    name=fname,
-                    content_obj={"photo_names": ", ".join([f"image_{idx + 1}.png" for idx in range(len(final_images))])},
-                    outputs_messages=outputs_messages,
-                )
+                outputs_messages.append(_tool_message(
+                    tool_id, fname,
+                    {"photo_names": ", ".join([f"image_{idx + 1}.png" for idx in range(len(final_images))])},
+                ))
                 continue
 
             # safety-фоллбек
-            await _append_tool_message(
-                user_id=user_id,
-                tool_call_id=tool_id,
-                name=fname,
-                content_obj={"status": "ok"},
-                outputs_messages=outputs_messages,
-            )
+            outputs_messages.append(_tool_message(tool_id, fname, {"status": "ok"}))
     except NoSubscription:
         raise
     except NoGenerations:
@@ -885,15 +730,14 @@ async def run_tools_and_followup_chat(
         from settings import logger
         logger.log("GPT_ERROR", traceback.format_exc())
     finally:
-        if stop_event:
-            stop_event.set()
-        if task:
-            await task
-        if delete_message:
+        for status_message in status_messages:
+            if isinstance(status_message, BaseException) or status_message is None:
+                continue
             try:
-                await delete_message.delete()
+                await status_message.delete()
             except:
                 pass
+        await _save_tool_messages(user_id, outputs_messages)
 
     # Начало вставки
     def _filter_outputs_with_valid_tool_calls(messages: List[dict], outputs_messages: List[dict]) -> List[dict]:
@@ -988,9 +832,10 @@ def to_b64(data: bytes) -> str:
 async def build_user_content_for_chat(
     client: AsyncOpenAI,
     text: str,
-    image_bytes: Sequence[io.BytesIO] | None,
+    image_bytes: Sequence[MediaBuffer | io.BytesIO] | None,
     document_bytes: Sequence[tuple[io.BytesIO, str, str]] | None,
     audio_bytes: io.BytesIO | None,
+    user_id: int | None = None,
 ) -> List[dict]:
     photos: List[dict] = []
     content = []
@@ -1018,53 +863,92 @@ async def build_user_content_for_chat(
         return truncated
 
     if image_bytes:
-        for idx, img_io in enumerate(image_bytes):
-            try:
-                img_io.seek(0)
-                img_data = img_io.read()
-                base64_image = base64.b64encode(img_data).decode('utf-8')
-
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}"
-                    }
-                })
+        # MediaBuffer — без копий, base64 запоминается в буфере; ресайз и кодирование больших — в пуле процессов
+        data_urls = await asyncio.gather(
+            *(image_processor.to_data_url(as_media(img), "openai") for img in image_bytes),
+            return_exceptions=True,
+        )
+        for idx, url in enumerate(data_urls):
+            if isinstance(url, BaseException):
+                print(f"[ERROR] Failed to process image {idx}: {url}")
+                continue
 
-                image_names.append(f"image_{idx}.png")
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": url
+                }
+            })
 
-            except Exception as e:
-                print(f"[ERROR] Failed to process image {idx}: {e}")
-                continue
+            image_names.append(f"image_{idx}.png")
 
     text_final = f"Сегодня - {get_current_datetime_string()} по Москве.\n\n{text or 'Вот информация'}"
     if image_names:
         text_final += f"\n\nВот названия изображений: {', '.join(image_names)}"
 
     if document_bytes:
-        for doc_io, file_name, ext in document_bytes:
-            raw = doc_io.getvalue()
+        from settings import SUPPORTED_TEXT_FILE_TYPES, EXTRACTABLE_DOCUMENT_TYPES
+
+        # большие документы не обрезаем, а индексируем и берём из них только релевантные запросу фрагменты
+        use_retrieval = RETRIEVAL_ENABLED and user_id is not None
+        extract_chars = RETRIEVAL_MAX_DOC_CHARS if use_retrieval else MAX_TEXT_TOKENS_PER_FILE * 3
+
+        # PDF/DOCX/XLSX разбираются параллельно в пуле процессов;
+        # общий бюджет токенов применяется ниже в исходном порядке файлов
+        extracted = {}
+        extract_jobs = [
+            (idx, document_extractor.extract(doc_io.getbuffer(), ext_l, extract_chars,
+                                             file_unique_id=getattr(doc_io, "file_unique_id", None)))
+            for idx, (doc_io, _, ext) in enumerate(document_bytes)
+            if (ext_l := (ext or "").lower().lstrip(".")) in EXTRACTABLE_DOCUMENT_TYPES
+        ]
+        if extract_jobs:
+            results = await asyncio.gather(*(job for _, job in extract_jobs))
+            extracted = {idx: result for (idx, _), result in zip(extract_jobs, results)}
+
+        large_documents: list[tuple[str, str, str]] = []     # (doc_key, file_name, text)
+        for idx, (doc_io, file_name, ext) in enumerate(document_bytes):
             ext_l = (ext or "").lower().lstrip(".")
-            from settings import SUPPORTED_TEXT_FILE_TYPES
 
-            if ext_l in SUPPORTED_TEXT_FILE_TYPES:
+            if ext_l in SUPPORTED_TEXT_FILE_TYPES or idx in extracted:
                 if total_tokens_used >= TOTAL_TOKEN_BUDGET:
                     break
 
-                try:
-                    txt = raw.decode("utf-8", "replace")
-                except Exception:
-                    txt = raw.decode("latin-1", "replace")
-
                 remaining_budget = TOTAL_TOKEN_BUDGET - total_tokens_used
                 file_token_limit = min(MAX_TEXT_TOKENS_PER_FILE, remaining_budget)
 
+                if idx in extracted:
+                    document = extracted[idx]
+                    if document.error is not None:
+                        content.append({
+                            "type": "text",
+                            "text": f"Не удалось прочитать {file_name}: {document.error}"
+                        })
+                        continue
+                    txt = document.text
+                    document_truncated = document.truncated
+                else:
+                    raw = doc_io.getvalue()
+                    try:
+                        txt = raw.decode("utf-8", "replace")
+                    except Exception:
+                        txt = raw.decode("latin-1", "replace")
+                    document_truncated = False
+
                 original_tokens = estimate_tokens(txt)
+                if use_retrieval and (original_tokens > file_token_limit or document_truncated):
+                    doc_key = getattr(doc_io, "file_unique_id", None) \
+                        or hashlib.blake2b(doc_io.getbuffer(), digest_size=16).hexdigest()
+                    large_documents.append((doc_key, file_name, txt))
+                    continue
+
                 txt = truncate_to_tokens(txt, file_token_limit)
                 final_tokens = estimate_tokens(txt)
 
                 truncation_info = ""
-                if original_tokens > file_token_limit:
+                if document_truncated:
+                    truncation_info = f" [обрезан: прочитано {final_tokens} токенов, документ длиннее]"
+                elif original_tokens > file_token_limit:
                     truncation_info = f" [обрезан: {final_tokens} из {original_tokens} токенов]"
 
                 content.append({
@@ -1074,6 +958,40 @@ async def build_user_content_for_chat(
 
                 total_tokens_used += final_tokens
 
+        if large_documents:
+            try:
+                await asyncio.gather(*(semantic_retrieval.index_document(user_id, doc_key, file_name, txt)
+                                       for doc_key, file_name, txt in large_documents))
+                chunks = await semantic_retrieval.search(user_id, text or "Основное содержание документа",
+                                                         doc_keys={doc_key for doc_key, _, _ in large_documents})
+            except Exception:
+                from settings import logger
+                logger.log("GPT_ERROR", f"{user_id} | Ошибка локального поиска по документам\n\n{traceback.format_exc()}")
+                chunks = []
+                # без индекса — прежнее поведение: начало каждого документа
+                for _, file_name, txt in large_documents:
+                    budget = min(MAX_TEXT_TOKENS_PER_FILE, TOTAL_TOKEN_BUDGET - total_tokens_used)
+                    if budget <= 0:
+                        break
+                    txt = truncate_to_tokens(txt, budget)
+                    content.append({"type": "text", "text": f"Содержимое {file_name} [обрезан]:\n{txt}"})
+                    total_tokens_used += estimate_tokens(txt)
+
+            fragments = []
+            for chunk in chunks:
+                chunk_tokens = estimate_tokens(chunk.text)
+                if total_tokens_used + chunk_tokens > TOTAL_TOKEN_BUDGET:
+                    break
+                fragments.append(f"[{chunk.file_name}, фрагмент {chunk.position + 1}]\n{chunk.text}")
+                total_tokens_used += chunk_tokens
+            if fragments:
+                names = ", ".join(file_name for _, file_name, _ in large_documents)
+                content.append({
+                    "type": "text",
+                    "text": f"Документы {names} слишком большие, ниже — наиболее релевантные запросу фрагменты:\n\n"
+                            + "\n\n".join(fragments)
+                })
+
     content.append({"type": "text", "text": text_final})
     if photos:
         content.extend(photos)
@@ -1081,13 +999,47 @@ async def build_user_content_for_chat(
 
 
 
+CHAT_MODEL = "gpt-5-mini"
+
+# Одинаковые ходы в полёте (двойная отправка, повтор апдейта) выполняются один раз: дубль не ждёт
+# под блокировкой треда, чтобы потом повторить запрос к API и записать вход в историю второй раз
+completion_single_flight = SingleFlight()
+
+
+def _media_digest(item) -> str:
+    """Отпечаток вложения для ключа хода: file_unique_id Telegram, иначе хеш содержимого"""
+    file_unique_id = getattr(item, "file_unique_id", None)
+    if file_unique_id:
+        return f"tg:{file_unique_id}"
+    if isinstance(item, MediaBuffer):
+        return item.sha256()
+    return hashlib.blake2b(item.getvalue(), digest_size=20).hexdigest()
+
+
+def _turn_key(user_id: int, *, text: str | None, image_bytes, document_bytes, audio_bytes,
+              with_audio_transcription: bool) -> str:
+    """
+    Ключ хода — только то, что прислал пользователь, плюс модель и набор инструментов.
+    История и system-хвост со временем в ключ не входят: у дубля они отличаются секундами
+    """
+    payload = json.dumps([
+        user_id,
+        CHAT_MODEL,
+        prompt_assembler.tools_digest,
+        with_audio_transcription,
+        text or "",
+        [_media_digest(item) for item in image_bytes or ()],
+        [[_media_digest(doc), name, mime] for doc, name, mime in document_bytes or ()],
+        _media_digest(audio_bytes) if audio_bytes is not None else None,
+    ], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8", "surrogatepass"), digest_size=20).hexdigest()
+
+
 class GPTCompletions:  # noqa: N801
     def __init__(self):
-        self.client = AsyncOpenAI(api_key=NEURO_GPT_TOKEN, base_url="https://neuroapi.host/v1")
-        self.history = HistoryStore()
-
-    async def _reset_client(self):
-        self.client = AsyncOpenAI(api_key=NEURO_GPT_TOKEN, base_url="https://neuroapi.host/v1")
+        # роутер сам выбирает бэкенд, переключается при сбоях и пересоздаёт клиентов упавших бэкендов
+        self.client = llm_router
+        self.history = DialogHistory()
 
     async def send_message(
         self,
@@ -1096,7 +1048,35 @@ class GPTCompletions:  # noqa: N801
         *,
         with_audio_transcription: bool = False,
         text: str | None = None,
-        image_bytes: Sequence[io.BytesIO] | None = None,
+        image_bytes: Sequence[MediaBuffer | io.BytesIO] | None = None,
+        document_bytes: Sequence[tuple[io.BytesIO, str, str]] | None = None,
+        document_type: str | None = None,
+        audio_bytes: io.BytesIO | None = None,
+        user_data: Users | None = None,
+    ):
+        key = _turn_key(user_id, text=text, image_bytes=image_bytes, document_bytes=document_bytes,
+                        audio_bytes=audio_bytes, with_audio_transcription=with_audio_transcription)
+        result = await completion_single_flight.run(key, lambda: self._send_message(
+            user_id,
+            with_audio_transcription=with_audio_transcription,
+            text=text,
+            image_bytes=image_bytes,
+            document_bytes=document_bytes,
+            document_type=document_type,
+            audio_bytes=audio_bytes,
+            user_data=user_data,
+        ))
+        # у каждого вызывающего своя копия: хендлеры дописывают в ответ клавиатуры и т.п.
+        return dict(result)
+
+    async def _send_message(
+        self,
+        user_id: int,
+        thread_id: str | None = None,      # игнорируется, оставлено для совместимости
+        *,
+        with_audio_transcription: bool = False,
+        text: str | None = None,
+        image_bytes: Sequence[MediaBuffer | io.BytesIO] | None = None,
         document_bytes: Sequence[tuple[io.BytesIO, str, str]] | None = None,
         document_type: str | None = None,
         audio_bytes: io.BytesIO | None = None,
@@ -1112,7 +1092,6 @@ class GPTCompletions:  # noqa: N801
         }
         main_bot = get_current_bot()
         from settings import logger
-        from settings import get_weekday_russian
 
         user = await users_repository.get_user_by_user_id(user_id=user_id)
         about_user = user.context
@@ -1129,22 +1108,8 @@ class GPTCompletions:  # noqa: N801
                 messages = _map_history_to_chat_messages(stored)
                 messages = _sanitize_messages_for_chat_api(messages)
 
-                # 2) system-инструкции (как раньше в run.instructions)
-                system_text = (
-                    "ВАЖНАЯ ИНФОРМАЦИЯ О ВРЕМЕНИ:\n"
-                    f"Текущие дата и время в Москве: {get_current_datetime_string()}\n"
-                    f"Сегодня {get_weekday_russian()}\n"
-                    "ВСЕ уведомления и напоминания должны устанавливаться в московском времени!\n"
-                    "Примеры относительных дат:\n"
-                    "- 'завтра' = следующий день после сегодняшнего\n"
-                    "- 'послезавтра' = через два дня\n"
-                    "- 'на следующей неделе в понедельник' = ближайший понедельник после текущей недели\n"
-                    "- 'через 30 минут' = добавить 30 минут к текущему времени\n\n"
-                )
-                if about_user:
-                    system_text += f"Информация о пользователе:\n{about_user}\n\n"
-                from settings import system_prompt
-                messages = [{"role": "system", "content": system_prompt + "\n\n" + system_text}] + messages
+                # 2) system-инструкции: статичный префикс собран заранее, время и about_user — в конце
+                messages = prompt_assembler.build_messages(messages, about_user)
 
                 # 3) вход пользователя
                 if not any([text, image_bytes, document_bytes, audio_bytes]):
@@ -1157,6 +1122,7 @@ class GPTCompletions:  # noqa: N801
                     image_bytes=image_bytes,
                     document_bytes=document_bytes,
                     audio_bytes=audio_bytes,
+                    user_id=user_id,
                 )
                 messages.append({"role": "user", "content": content})
 
@@ -1173,16 +1139,14 @@ class GPTCompletions:  # noqa: N801
                 }
 
 
-                from settings import tools
-                tools_payload = _tools_for_chat_completions(tools or [])
                 comp = await chat_create_with_auto_repair(
                     self.client,
                     # model=user.model_type,
-                    model="gpt-5-mini",
+                    model=CHAT_MODEL,
                     messages=messages,
-                    tools=tools_payload,
+                    tools=prompt_assembler.tools_payload,
                     # temperature=0.7,
-                    parallel_tool_calls=False,
+                    parallel_tool_calls=True,
                 )
                 await self.history.append(user_id=user_id, payload=human_json)
                 msg = comp.choices[0].message
@@ -1200,16 +1164,16 @@ class GPTCompletions:  # noqa: N801
                     }
                     await self.history.append(user_id=user_id, payload=ai_turn_json)
                     # проверки подписок/лимитов внутри run_tools_and_followup_chat
-                    user_sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user.user_id)
-                    max_photo_generations = user_sub.photo_generations if user_sub else 0
+                    quota = await load_quota(user.user_id)
+                    max_photo_generations = quota.generations_left
                     try:
                         final_images, web_answer, notif_answer, assistant_msgs, video_urls = await run_tools_and_followup_chat(
                             client=self.client,
-                            model=user.model_type,
                             messages=messages + [{"role": "assistant", "content": msg.content or None, "tool_calls": [tc.model_dump() for tc in tool_calls]}],
                             tool_calls=[tc.model_dump() for tc in tool_calls],
                             user_id=user.user_id,
                             max_photo_generations=max_photo_generations,
+                            quota=quota,
                         )
                     except NoSubscription:
                         raise
@@ -1266,8 +1230,7 @@ class GPTCompletions:  # noqa: N801
 
                     if final_images:
                         # Списание генераций
-                        if user_sub:
-                            await subscriptions_repository.use_generation(subscription_id=user_sub.id, count=len(final_images))
+                        await consume_generations(quota, len(final_images))
                         # Текст из второго ответа
                         # assistant_text = assistant_msgs[0].get("content") or "Сгенерировал изображение"
                         # final_text = sanitize_with_links(assistant_text)
@@ -1302,7 +1265,8 @@ class GPTCompletions:  # noqa: N801
                 # 7) обычный ответ ассистента без тулзов
                 message_text = msg.content or ""
                 if with_audio_transcription:
-                    audio_data = await tts_generate_audio_mp3(message_text)
+                    # озвучка запросится только при загрузке в Telegram и уйдёт туда потоком
+                    audio_data = audio_pipeline.speech_file(message_text)
                     final_text = sanitize_with_links(message_text)
                     ai_json = {
                         "type": "ai",
@@ -1335,7 +1299,6 @@ class GPTCompletions:  # noqa: N801
             except NoGenerations:
                 raise
             except Exception:
-                await self._reset_client()
                 logger.log("GPT_ERROR", f"{user_id} | Ошибка в ответе gpt: {traceback.format_exc()}")
                 final_content["text"] = ("В связи с большим наплывом пользователей"
                                          " наши сервера испытывают экстремальные нагрузки."
@@ -1347,18 +1310,10 @@ class GPTCompletions:  # noqa: N801
     @staticmethod
     async def transcribe_audio(audio_bytes: io.BytesIO, language: str = "ru") -> str:
         """Возвращает текстовую расшифровку аудио через Whisper."""
-        url = "https://api.openai.com/v1/audio/transcriptions"
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-        audio_bytes.name = "audio.mp3"
-        data = {"file": audio_bytes, "model": "whisper-1", "language": language}
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=data, timeout=60) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result.get("text", "")
-                raise RuntimeError(f"Transcription error {response.status}: {await response.text()}")
+        return await audio_pipeline.transcribe(audio_bytes, language)
+
+    async def clear_history(self, user_id: int) -> None:
+        await self.history.clear(user_id=user_id)
 
 
 from openai import BadRequestError
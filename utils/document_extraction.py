@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator
+
+# document_extraction.py — извлечение текста из PDF/DOCX/XLSX в пуле процессов
+#
+# Парсеры импортируются только внутри воркеров: основной процесс бота PyPDF2/docx/openpyxl не грузит.
+
+DOC_EXTRACT_WORKERS = int(os.getenv("DOC_EXTRACT_WORKERS", str(min(2, os.cpu_count() or 1))))
+DOC_EXTRACT_CPU_SEC = float(os.getenv("DOC_EXTRACT_CPU_SEC", "10"))        # CPU на один файл
+DOC_EXTRACT_TIMEOUT_SEC = float(os.getenv("DOC_EXTRACT_TIMEOUT_SEC", "30"))  # стеночное время на один файл
+DOC_TEXT_CACHE_MAX_CHARS = int(os.getenv("DOC_TEXT_CACHE_MB", "32")) * 1024 * 1024
+
+
+@dataclass(slots=True)
+class ExtractedDocument:
+    text: str
+    complete: bool                # документ прочитан целиком
+    parts_read: int               # страниц / абзацев+таблиц / строк листов
+    error: str | None = None
+
+    @property
+    def truncated(self) -> bool:
+        return not self.complete
+
+
+# ---------- функции, выполняемые в процессах пула ----------
+
+def _iter_pdf(data: bytes) -> Iterator[str]:
+    from PyPDF2 import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    if reader.is_encrypted:
+        # многие PDF «зашифрованы» пустым паролем только ради запрета печати
+        reader.decrypt("")
+    for number, page in enumerate(reader.pages, start=1):
+        yield f"--- Страница {number} ---\n{page.extract_text() or ''}"
+
+
+def _iter_docx(data: bytes) -> Iterator[str]:
+    from docx import Document
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+    document = Document(io.BytesIO(data))
+    # абзацы и таблицы в порядке следования в документе
+    for child in document.element.body.iterchildren():
+        tag = child.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            text = Paragraph(child, document).text
+            if text.strip():
+                yield text
+        elif tag == "tbl":
+            rows = [" | ".join(cell.text.strip() for cell in row.cells) for row in Table(child, document).rows]
+            yield "\n".join(rows)
+
+
+def _iter_xlsx(data: bytes) -> Iterator[str]:
+    from openpyxl import load_workbook
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield f"--- Лист {sheet.title} ---"
+            for row in sheet.iter_rows(values_only=True):
+                if any(value is not None for value in row):
+                    yield "\t".join("" if value is None else str(value) for value in row)
+    finally:
+        workbook.close()
+
+
+_EXTRACTORS = {
+    "pdf": _iter_pdf,
+    "docx": _iter_docx,
+    "xlsx": _iter_xlsx,
+    "xlsm": _iter_xlsx,
+}
+
+
+def extract_document(data: bytes, ext: str, max_chars: int, cpu_budget: float = DOC_EXTRACT_CPU_SEC) -> ExtractedDocument:
+    """
+    Читает документ по частям, пока не наберётся max_chars символов или не кончится CPU-бюджет.
+    Оставшиеся страницы/листы не разбираются вовсе.
+    """
+    started = time.process_time()
+    chunks: list[str] = []
+    size = 0
+    parts = 0
+    try:
+        for chunk in _EXTRACTORS[ext](data):
+            parts += 1
+            chunks.append(chunk)
+            size += len(chunk) + 1
+            if size >= max_chars or time.process_time() - started > cpu_budget:
+                return ExtractedDocument(text="\n".join(chunks)[:max_chars], complete=False, parts_read=parts)
+    except Exception as e:
+        if not chunks:
+            return ExtractedDocument(text="", complete=False, parts_read=0, error=f"{type(e).__name__}: {e}")
+        # битый хвост документа — отдаём то, что успели прочитать
+        return ExtractedDocument(text="\n".join(chunks), complete=False, parts_read=parts)
+    return ExtractedDocument(text="\n".join(chunks), complete=True, parts_read=parts)
+
+
+# ---------- асинхронный фасад ----------
+
+def _pool_context():
+    # воркеру нужен только парсер, а не fork-копия бота с его потоками и соединениями
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class DocumentExtractor:
+    """
+    Извлечение текста из документов вне event loop.
+    Результат кешируется по file_unique_id (или по хешу содержимого, если id неизвестен),
+    поэтому повторно присланный документ не разбирается заново.
+    """
+
+    def __init__(self, workers: int = DOC_EXTRACT_WORKERS, timeout: float = DOC_EXTRACT_TIMEOUT_SEC,
+                 cache_max_chars: int = DOC_TEXT_CACHE_MAX_CHARS):
+        self.workers = workers
+        self.timeout = timeout
+        self.cache_max_chars = cache_max_chars
+        self._pool: ProcessPoolExecutor | None = None
+        self._cache: OrderedDict[tuple[str, str], tuple[ExtractedDocument, int]] = OrderedDict()
+        self._cache_chars = 0
+        self.stats = {"hits": 0, "misses": 0, "timeouts": 0, "errors": 0}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+        return self._pool
+
+    def _recycle_pool(self) -> None:
+        """Зависший воркер в пуле не отменить — отдаём пул на доработку и дальше работаем с новым"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    @staticmethod
+    def supports(ext: str) -> bool:
+        return ext in _EXTRACTORS
+
+    def _cache_get(self, key: tuple[str, str], max_chars: int) -> ExtractedDocument | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        cached, requested_chars = entry
+        # неполный результат годится, только если его читали с лимитом не меньше нынешнего
+        if not cached.complete and requested_chars < max_chars:
+            return None
+        self._cache.move_to_end(key)
+        if len(cached.text) <= max_chars:
+            return cached
+        return ExtractedDocument(text=cached.text[:max_chars], complete=False, parts_read=cached.parts_read)
+
+    def _cache_put(self, key: tuple[str, str], result: ExtractedDocument, requested_chars: int) -> None:
+        previous = self._cache.pop(key, None)
+        if previous is not None:
+            self._cache_chars -= len(previous[0].text)
+        self._cache[key] = (result, requested_chars)
+        self._cache_chars += len(result.text)
+        while self._cache_chars > self.cache_max_chars and len(self._cache) > 1:
+            _, (evicted, _) = self._cache.popitem(last=False)
+            self._cache_chars -= len(evicted.text)
+
+    async def extract(self, data: bytes | memoryview, ext: str, max_chars: int,
+                      file_unique_id: str | None = None) -> ExtractedDocument:
+        ext = ext.lower().lstrip(".")
+        key = (file_unique_id or hashlib.blake2b(data, digest_size=16).hexdigest(), ext)
+        cached = self._cache_get(key, max_chars)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached
+        self.stats["misses"] += 1
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self._get_pool(), extract_document, bytes(data), ext, max_chars),
+                timeout=self.timeout,
+            )
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self._recycle_pool()
+            return ExtractedDocument(text="", complete=False, parts_read=0,
+                                     error=f"не уложились в {self.timeout:.0f} с")
+        except Exception as e:
+            # BrokenProcessPool и т.п. — пересоздаём пул, файл считаем нечитаемым, но не кешируем
+            print(traceback.format_exc())
+            self.stats["errors"] += 1
+            self._recycle_pool()
+            return ExtractedDocument(text="", complete=False, parts_read=0, error=f"{type(e).__name__}: {e}")
+        if result.error is not None:
+            self.stats["errors"] += 1
+        self._cache_put(key, result, max_chars)
+        return result
+
+    def shutdown(self) -> None:
+        self._recycle_pool()
+
+
+document_extractor = DocumentExtractor()
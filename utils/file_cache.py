@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import os
+import time
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+
+# file_cache.py — кеш скачанных из Telegram файлов и их метаданных (File.file_path)
+
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("TG_FILE_CACHE_MEMORY_MB", "128")) * 1024 * 1024
+DISK_CACHE_DIR = os.getenv("TG_FILE_CACHE_DIR")                  # не задан — дисковый уровень выключен
+DISK_CACHE_MAX_BYTES = int(os.getenv("TG_FILE_CACHE_DISK_MB", "1024")) * 1024 * 1024
+MAX_ITEM_BYTES = 20 * 1024 * 1024                                 # Bot API больше 20 МБ всё равно не отдаёт
+FILE_META_TTL_SEC = 50 * 60                                       # ссылка на файл живёт не меньше часа
+MAX_FILE_META_ITEMS = 50_000
+
+
+@dataclass(slots=True)
+class CachedFile:
+    """То, что нужно от aiogram.types.File для повторного скачивания и ссылок"""
+    file_id: str
+    file_unique_id: str | None
+    file_path: str | None
+    file_size: int | None
+    fetched_at: float
+
+
+class _LRUBytes:
+    """LRU по суммарному размеру: вытесняем самые давно использованные, пока не влезем в лимит"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items: OrderedDict[str, int] = OrderedDict()
+
+    def touch(self, key: str) -> None:
+        self._items.move_to_end(key)
+
+    def add(self, key: str, size: int) -> list[str]:
+        """Добавляет запись и возвращает ключи, которые нужно выбросить"""
+        if key in self._items:
+            self.total_bytes -= self._items.pop(key)
+        self._items[key] = size
+        self.total_bytes += size
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self._items) > 1:
+            old_key, old_size = self._items.popitem(last=False)
+            self.total_bytes -= old_size
+            evicted.append(old_key)
+        return evicted
+
+    def remove(self, key: str) -> None:
+        size = self._items.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+
+class TelegramFileCache:
+    """
+    Двухуровневый кеш содержимого файлов Telegram.
+    Ключ — file_unique_id (одинаков для всех file_id одного файла и для всех ботов),
+    file_id сводятся к нему через таблицу алиасов, как только он становится известен.
+    Память — OrderedDict с лимитом по байтам, диск — файлы в DISK_CACHE_DIR.
+    Отдельно кешируются метаданные File, чтобы не дёргать getFile на каждую ссылку/загрузку.
+    """
+
+    def __init__(self, memory_max_bytes: int = MEMORY_CACHE_MAX_BYTES, disk_dir: str | None = DISK_CACHE_DIR,
+                 disk_max_bytes: int = DISK_CACHE_MAX_BYTES):
+        self._memory: dict[str, bytes] = {}
+        self._memory_lru = _LRUBytes(memory_max_bytes)
+        self.disk_dir = disk_dir
+        self._disk_lru = _LRUBytes(disk_max_bytes)
+        self._aliases: dict[str, str] = {}
+        self._meta: OrderedDict[tuple[int, str], CachedFile] = OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "meta_hits": 0, "meta_misses": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    # ---------- ключи ----------
+    def remember_alias(self, file_id: str, file_unique_id: str | None) -> None:
+        if file_unique_id and file_id != file_unique_id:
+            self._aliases[file_id] = file_unique_id
+            if len(self._aliases) > MAX_FILE_META_ITEMS:
+                self._aliases.pop(next(iter(self._aliases)))
+
+    def _resolve(self, key: str) -> str:
+        return self._aliases.get(key, key)
+
+    # ---------- содержимое ----------
+    async def get(self, key: str) -> bytes | None:
+        key = self._resolve(key)
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory_lru.touch(key)
+            self.stats["memory_hits"] += 1
+            return data
+        if self.disk_dir and key in self._disk_lru:
+            try:
+                data = await asyncio.to_thread(self._read_disk, key)
+            except OSError:
+                self._disk_lru.remove(key)
+                data = None
+            if data is not None:
+                self._disk_lru.touch(key)
+                self._put_memory(key, data)
+                self.stats["disk_hits"] += 1
+                return data
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, data: bytes) -> None:
+        if not data or len(data) > MAX_ITEM_BYTES:
+            return
+        key = self._resolve(key)
+        self._put_memory(key, data)
+        if self.disk_dir and key not in self._disk_lru:
+            try:
+                await asyncio.to_thread(self._write_disk, key, data)
+            except OSError:
+                print(traceback.format_exc())
+                return
+            for evicted in self._disk_lru.add(key, len(data)):
+                self._remove_disk(evicted)
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        self._memory[key] = data
+        for evicted in self._memory_lru.add(key, len(data)):
+            self._memory.pop(evicted, None)
+
+    # ---------- дисковый уровень ----------
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _remove_disk(self, key: str) -> None:
+        path = self._disk_path(key)
+        for p in (path, path + ".key"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def _read_disk(self, key: str) -> bytes:
+        # файл целиком уходит в память и в bytes-кеш: один read() — одна копия, mmap тут ничего не экономит
+        with open(self._disk_path(key), "rb") as f:
+            return f.read()
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        path = self._disk_path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        # имя файла — хеш, поэтому сам ключ храним рядом для восстановления индекса после рестарта
+        with open(path + ".key", "w", encoding="utf-8") as f:
+            f.write(key)
+
+    def _load_disk_index(self) -> None:
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith((".key", ".tmp")):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                with open(path + ".key", encoding="utf-8") as f:
+                    key = f.read()
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            for evicted in self._disk_lru.add(key, size):
+                self._remove_disk(evicted)
+
+    # ---------- метаданные File ----------
+    async def get_file(self, bot, file_id: str) -> CachedFile:
+        """Кешированный bot.get_file: file_path, размер и file_unique_id без лишних запросов к Bot API"""
+        meta_key = (getattr(bot, "id", 0), file_id)
+        cached = self._meta.get(meta_key)
+        if cached is not None and time.monotonic() - cached.fetched_at < FILE_META_TTL_SEC:
+            self._meta.move_to_end(meta_key)
+            self.stats["meta_hits"] += 1
+            return cached
+        self.stats["meta_misses"] += 1
+        file = await bot.get_file(file_id)
+        cached = CachedFile(file_id=file_id, file_unique_id=getattr(file, "file_unique_id", None),
+                            file_path=file.file_path, file_size=getattr(file, "file_size", None),
+                            fetched_at=time.monotonic())
+        self._meta[meta_key] = cached
+        self._meta.move_to_end(meta_key)
+        while len(self._meta) > MAX_FILE_META_ITEMS:
+            self._meta.popitem(last=False)
+        self.remember_alias(file_id, cached.file_unique_id)
+        return cached
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "memory_bytes": self._memory_lru.total_bytes,
+            "disk_bytes": self._disk_lru.total_bytes,
+            "aliases": len(self._aliases),
+            "file_meta": len(self._meta),
+        }
+
+
+file_cache = TelegramFileCache()
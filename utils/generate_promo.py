@@ -1,29 +1,103 @@
 import secrets
 import string
+from typing import Iterable
 
-from db.repository import referral_system_repository
+from db.repository import referral_system_repository, type_subscriptions_repository
 
 # Общий алфавит: заглавные латинские буквы + цифры
 ALPHABET = string.ascii_uppercase + string.digits
 
+MAX_GENERATION_ROUNDS = 10        # сколько раз перегенерируем коллизии, прежде чем сдаться
 
-async def generate_single_promo_code(code_length: int = 10) -> str:
+# Параметры тарифа promo_{code}, который создаётся вместе с каждым промокодом
+PROMO_PLAN_OPTIONS = dict(with_files=True, web_search=True, with_voice=True, price=0, from_promo=True)
+
+# байт -> символ алфавита; байты >= 252 выбрасываются, чтобы 256 % 36 не давал перекоса распределения
+_UNBIASED_LIMIT = 256 - 256 % len(ALPHABET)
+_BYTE_TO_CHAR = bytes(ord(ALPHABET[i % len(ALPHABET)]) for i in range(256))
+_REJECTED_BYTES = bytes(range(_UNBIASED_LIMIT, 256))
+
+
+def generate_promo_codes(count: int, code_length: int = 10) -> set[str]:
+    """
+    Генерирует count разных случайных промокодов за один проход:
+    один вызов secrets.token_bytes на пачку вместо secrets.choice на каждый символ.
+    Уникальность гарантируется только внутри пачки — с базой её проверяет INSERT ... ON CONFLICT.
     """
-    Генерирует один новый промокод длиной code_length, гарантированно не совпадающий
-    с любым кодом в existing_codes. Новый код сразу добавляется в existing_codes.
+    codes: set[str] = set()
+    while len(codes) < count:
+        need = count - len(codes)
+        raw = secrets.token_bytes(need * code_length * 2)
+        chars = raw.translate(_BYTE_TO_CHAR, _REJECTED_BYTES).decode("ascii")
+        for start in range(0, len(chars) - code_length + 1, code_length):
+            codes.add(chars[start:start + code_length])
+            if len(codes) == count:
+                break
+    return codes
 
-    :param existing_codes: множество уже существующих промокодов
-    :param code_length: длина генерируемого кода
-    :return: уникальный промокод (строка)
+
+async def generate_single_promo_code(code_length: int = 10) -> str:
+    """
+    Генерирует один промокод длиной code_length, которого ещё нет в базе.
+    Проверяется только сам кандидат, а не вся таблица промокодов.
     """
-    existing_codes = await referral_system_repository.select_all_promo_codes()
-    # print("\n\n\n\n\n")
-    # print(existing_codes)
-    # print("\n\n\n\n\n")
     while True:
-        # Генерируем случайный код
-        code = ''.join(secrets.choice(ALPHABET) for _ in range(code_length))
-        # Проверяем, что он не содержится в set
-        if code not in existing_codes:
-            # Добавляем в множество, чтобы в дальнейшем код не повторился
-            return code
\ No newline at end of file
+        code = generate_promo_codes(1, code_length).pop()
+        if not await referral_system_repository.select_existing_promo_codes([code]):
+            return code
+
+
+async def _add_promo_plans(promo_codes: Iterable[str], max_generations: int) -> None:
+    await type_subscriptions_repository.add_type_subscriptions_bulk(
+        [f"promo_{code}" for code in promo_codes],
+        max_generations=max_generations,
+        **PROMO_PLAN_OPTIONS,
+    )
+
+
+async def create_promo_codes(count: int,
+                             days_sub: int,
+                             max_activations: int | None,
+                             max_generations: int,
+                             code_length: int = 10) -> list[str]:
+    """
+    Выпускает count новых промокодов вместе с их тарифами promo_{code}.
+    Коды вставляются пачками через ON CONFLICT DO NOTHING, перегенерируются только коллизии.
+
+    :return: список выпущенных промокодов
+    """
+    created: list[str] = []
+    for _ in range(MAX_GENERATION_ROUNDS):
+        need = count - len(created)
+        if need <= 0:
+            break
+        candidates = generate_promo_codes(need, code_length).difference(created)
+        created.extend(await referral_system_repository.add_promos_bulk(list(candidates),
+                                                                        days_sub=days_sub,
+                                                                        max_activations=max_activations,
+                                                                        max_generations=max_generations))
+    else:
+        if len(created) < count:
+            raise RuntimeError(f"Не удалось сгенерировать {count} уникальных промокодов длины {code_length}, "
+                               f"получено {len(created)}")
+    await _add_promo_plans(created, max_generations)
+    return created
+
+
+async def import_promo_codes(promo_codes: Iterable,
+                             days_sub: int,
+                             max_activations: int | None,
+                             max_generations: int) -> list[str]:
+    """
+    Загружает готовые промокоды (например, из excel партнёра).
+    Уже существующие коды пропускаются, тарифы создаются только для новых.
+
+    :return: список добавленных промокодов
+    """
+    codes = list(dict.fromkeys(str(code) for code in promo_codes))
+    created = await referral_system_repository.add_promos_bulk(codes,
+                                                               days_sub=days_sub,
+                                                               max_activations=max_activations,
+                                                               max_generations=max_generations)
+    await _add_promo_plans(created, max_generations)
+    return created
@@ -1,13 +1,16 @@
 from __future__ import annotations
 import os
 import asyncio
-from io import BytesIO
-from typing import Optional, Sequence, Union, List, Tuple
-from PIL import Image
+from typing import Optional, Sequence, Union, List
 from dotenv import load_dotenv, find_dotenv
 from google import genai
+import httpx
 from google.genai import types, errors
 
+from utils.image_processing import image_processor, ImageProcessingError, ImageInput
+from utils.media_buffer import MediaBuffer
+from utils.resilience import Outcome, ProviderUnavailableError, get_guard, CircuitBreaker
+
 
 class GeminiImageError(Exception):
     pass
@@ -66,19 +69,28 @@ class TextRefusalError(GeminiImageError):
 
 
 
+gemini_guard = get_guard("gemini", breaker=CircuitBreaker("gemini", reset_timeout=30.0))
+
+
+def _classify_gemini_error(error: BaseException) -> Outcome:
+    if isinstance(error, errors.APIError):
+        code = getattr(error, "code", None)
+        if code == 429:
+            return Outcome.RATE_LIMITED
+        if code in (500, 502, 503, 504):
+            return Outcome.RETRY
+        return Outcome.FATAL
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+        return Outcome.RETRY
+    return Outcome.FATAL
+
+
 class GeminiImageService:
     """
     Класс-обёртка: один экземпляр -> один реиспользуемый genai.Client.
     Вся остальная логика оставлена неизменной.
     """
 
-    _MIME_BY_FORMAT = {
-        "PNG": "image/png",
-        "JPEG": "image/jpeg",
-        "JPG": "image/jpeg",
-        "WEBP": "image/webp",
-    }
-
     def __init__(self, api_key: Optional[str] = None, *, timeout: float = 60.0):
         load_dotenv(find_dotenv())
         key = api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
@@ -93,31 +105,23 @@ class GeminiImageService:
     # --- Вспомогательные методы (идентичная логика, перенесены внутрь класса) ---
 
     @staticmethod
-    def _detect_or_convert_to_png(img_bytes: bytes) -> Tuple[str, bytes]:
-        try:
-            with Image.open(BytesIO(img_bytes)) as im:
-                fmt = (im.format or "PNG").upper()
-                if fmt in GeminiImageService._MIME_BY_FORMAT:
-                    return GeminiImageService._MIME_BY_FORMAT[fmt], img_bytes
-                out = BytesIO()
-                im.save(out, format="PNG")
-                return "image/png", out.getvalue()
-        except Exception as e:
-            raise GeminiImageError(f"Невозможно прочитать входное изображение: {e}") from e
-
-    @staticmethod
-    def _normalize_ref_images(reference_images: Optional[Union[bytes, Sequence[bytes]]]) -> List[bytes]:
+    def _normalize_ref_images(reference_images: Optional[Union[ImageInput, Sequence[ImageInput]]]) -> List[ImageInput]:
+        # MediaBuffer из media_fetcher идёт дальше как есть — без копии в bytes
         if reference_images is None:
             return []
-        if isinstance(reference_images, (bytes, bytearray)):
-            return [bytes(reference_images)]
-        return [bytes(b) for b in reference_images]
+        if isinstance(reference_images, (bytes, bytearray, memoryview, MediaBuffer)):
+            return [reference_images]
+        return list(reference_images)
 
-    @classmethod
-    def _build_contents(cls, prompt: str, ref_imgs: List[bytes]) -> List[Union[str, types.Part]]:
+    @staticmethod
+    async def _build_contents(prompt: str, ref_imgs: List[ImageInput]) -> List[Union[str, types.Part]]:
+        # декодирование/ресайз референсов — в пуле процессов, event loop не блокируется
+        try:
+            normalized = await image_processor.normalize_many(ref_imgs, "gemini")
+        except ImageProcessingError as e:
+            raise GeminiImageError(str(e)) from e
         parts: List[Union[str, types.Part]] = [prompt]
-        for b in ref_imgs:
-            mime, raw = cls._detect_or_convert_to_png(b)
+        for mime, raw in normalized:
             parts.append(types.Part.from_bytes(data=raw, mime_type=mime))
         return parts
 
@@ -172,7 +176,7 @@ class GeminiImageService:
     async def generate_gemini_image(
         self,
         prompt: str,
-        reference_images: Optional[Union[bytes, Sequence[bytes]]] = None,
+        reference_images: Optional[Union[ImageInput, Sequence[ImageInput]]] = None,
         *,
         api_key: Optional[str] = None,  # сохранён для совместимости, но НЕ используется (клиент уже создан)
         model: str = "gemini-2.5-flash-image-preview",
@@ -183,46 +187,27 @@ class GeminiImageService:
             raise InvalidPromptError("Параметр 'prompt' обязателен и не должен быть пустым.")
 
         refs = self._normalize_ref_images(reference_images)
-        contents = self._build_contents(prompt, refs)
-
-        attempt = 0
-        while True:
-            try:
-                response = await self._client.aio.models.generate_content(
-                    model=model,
-                    contents=contents,
-                )
-                return self._extract_first_image_bytes(response)
-
-            except PromptBlockedError as e:
-                raise
-
-            except ResponseBlockedError as e:
-                raise
-            except TextRefusalError as e:
-                raise  # или тут же маппинг на «смягчённый» ретрай — см. ниже
-
-            except errors.APIError as e:
-                code = getattr(e, "code", None)
-                msg = getattr(e, "message", str(e))
-                if code in (401, 403):
-                    raise AuthError(f"Ошибка авторизации ({code}): {msg}") from e
-                if code == 429:
-                    if attempt < max_retries:
-                        attempt += 1
-                        await asyncio.sleep(min(2 ** attempt, 8))
-                        continue
-                    raise RateLimitError(f"Превышен лимит запросов (429): {msg}") from e
-                if code in (500, 502, 503, 504):
-                    if attempt < max_retries:
-                        attempt += 1
-                        await asyncio.sleep(min(2 ** attempt, 8))
-                        continue
-                    raise TransientError(f"Временная ошибка сервера ({code}): {msg}") from e
-                raise GeminiImageError(f"APIError {code}: {msg}") from e
-
-            except (SafetyBlockedError, NoImageInResponseError):
-                raise
-
-            except Exception as e:
-                raise GeminiImageError(f"Низкоуровневая ошибка: {e}") from e
+        contents = await self._build_contents(prompt, refs)
+
+        try:
+            # повторы, автомат защиты и дедлайн — в общем ProviderGuard
+            response = await gemini_guard.call(
+                lambda: self._client.aio.models.generate_content(model=model, contents=contents),
+                classify=_classify_gemini_error,
+                max_attempts=max_retries + 1,
+            )
+        except ProviderUnavailableError:
+            raise
+        except errors.APIError as e:
+            code = getattr(e, "code", None)
+            msg = getattr(e, "message", str(e))
+            if code in (401, 403):
+                raise AuthError(f"Ошибка авторизации ({code}): {msg}") from e
+            if code == 429:
+                raise RateLimitError(f"Превышен лимит запросов (429): {msg}") from e
+            if code in (500, 502, 503, 504):
+                raise TransientError(f"Временная ошибка сервера ({code}): {msg}") from e
+            raise GeminiImageError(f"APIError {code}: {msg}") from e
+        except Exception as e:
+            raise GeminiImageError(f"Низкоуровневая ошибка: {e}") from e
+        return self._extract_first_image_bytes(response)
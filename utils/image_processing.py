@@ -0,0 +1,238 @@
+import asyncio
+import base64
+import io
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Sequence, Union
+
+from PIL import Image, ImageOps
+
+from utils.media_buffer import MediaBuffer
+
+# image_processing.py — декодирование/ресайз/кодирование картинок вне event loop
+#
+# Модуль намеренно лёгкий (только Pillow): его функции выполняются в дочерних процессах пула.
+
+ImageInput = Union[bytes, bytearray, memoryview, MediaBuffer]
+
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Максимальная сторона, до которой ужимаем картинку перед отправкой провайдеру.
+# OpenAI сам приводит vision-картинки к 2048px, Gemini тайлит по 768px, Runway принимает data URI до ~5 МБ —
+# всё, что больше, только увеличивает трафик и время загрузки.
+PROVIDER_MAX_SIDE = {
+    "openai": 2048,
+    "gemini": 2048,
+    "runway": 2048,
+}
+
+_MIME_BY_FORMAT = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "JPG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+# Runway: соотношение сторон строго внутри (0.5; 2.0)
+RUNWAY_MIN_AR, RUNWAY_MAX_AR = 0.5, 2.0
+
+
+class ImageProcessingError(Exception):
+    """Картинку не удалось прочитать или перекодировать"""
+    pass
+
+
+class _MemoryViewReader(io.RawIOBase):
+    """Файловый интерфейс поверх memoryview без копирования всего буфера (для Image.open)"""
+
+    def __init__(self, data: ImageInput):
+        self._view = (data.view if isinstance(data, MediaBuffer) else memoryview(data)).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def probe_image(data: ImageInput) -> tuple[str | None, int, int]:
+    """Читает только заголовок: (формат, ширина, высота). Дёшево, можно звать прямо в event loop."""
+    try:
+        with Image.open(_MemoryViewReader(data)) as im:
+            return (im.format or "").upper() or None, im.width, im.height
+    except Exception as e:
+        raise ImageProcessingError(f"Невозможно прочитать входное изображение: {e}") from e
+
+
+# ---------- функции, выполняемые в процессах пула ----------
+
+def _downscale(im: Image.Image, max_side: int) -> Image.Image:
+    if max(im.size) <= max_side:
+        return im
+    scale = max_side / max(im.size)
+    return im.resize((max(1, int(im.width * scale)), max(1, int(im.height * scale))), Image.LANCZOS)
+
+
+def normalize_image(data: bytes, max_side: int) -> tuple[str, bytes]:
+    """
+    Приводит картинку к формату, который понимают провайдеры (PNG/JPEG/WEBP), и к max_side.
+    Подходящие картинки возвращаются как есть, без перекодирования.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            fmt = (im.format or "PNG").upper()
+            if fmt in _MIME_BY_FORMAT and max(im.size) <= max_side:
+                return _MIME_BY_FORMAT[fmt], data
+            im = ImageOps.exif_transpose(im)
+            im = _downscale(im, max_side)
+            out = io.BytesIO()
+            if fmt in ("JPEG", "JPG"):
+                im.convert("RGB").save(out, format="JPEG", quality=92)
+                return "image/jpeg", out.getvalue()
+            im.save(out, format="PNG")
+            return "image/png", out.getvalue()
+    except Exception as e:
+        raise ImageProcessingError(f"Невозможно прочитать входное изображение: {e}") from e
+
+
+def normalize_image_to_data_url(data: bytes, max_side: int) -> str:
+    """normalize_image + base64 — кодирование мегабайтных строк тоже не место для event loop"""
+    mime, raw = normalize_image(data, max_side)
+    return f"data:{mime};base64,{base64.b64encode(raw).decode()}"
+
+
+def encode_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+def prepare_runway_ref(data: bytes, max_side: int = PROVIDER_MAX_SIDE["runway"]) -> bytes:
+    """Ресайз до max_side, паддинг в допустимый для Runway диапазон соотношения сторон, JPEG q95"""
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    img = _downscale(img, max_side)
+    w, h = img.size
+    ar = w / h
+
+    # паддинг до MIN_AR (строго > MIN_AR)
+    if ar <= RUNWAY_MIN_AR:
+        new_w = math.floor(h * RUNWAY_MIN_AR) + 1
+        total_pad = new_w - w
+        pad_left = total_pad // 2
+        img = ImageOps.expand(img, (pad_left, 0, total_pad - pad_left, 0), fill=(0, 0, 0))
+    # паддинг до MAX_AR (строго < MAX_AR)
+    elif ar >= RUNWAY_MAX_AR:
+        new_h = math.floor(w / RUNWAY_MAX_AR) + 1
+        total_pad = new_h - h
+        pad_top = total_pad // 2
+        img = ImageOps.expand(img, (0, pad_top, 0, total_pad - pad_top), fill=(0, 0, 0))
+
+    w2, h2 = img.size
+    assert RUNWAY_MIN_AR < w2 / h2 < RUNWAY_MAX_AR, f"AR всё ещё вне диапазона: {w2 / h2:.3f}"
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
+
+def prepare_runway_ref_data_uri(data: bytes, max_side: int = PROVIDER_MAX_SIDE["runway"]) -> str:
+    return f"data:image/jpeg;base64,{base64.b64encode(prepare_runway_ref(data, max_side)).decode()}"
+
+
+# ---------- асинхронный фасад ----------
+
+def _as_bytes(data: ImageInput) -> bytes:
+    """bytes для пула и SDK: MediaBuffer и bytes отдаются без копии"""
+    if isinstance(data, MediaBuffer):
+        return data.tobytes()
+    return data if isinstance(data, bytes) else bytes(data)
+
+
+def _pool_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class ImageProcessor:
+    """
+    Общий сервис обработки изображений: тяжёлый Pillow-код уходит в ProcessPoolExecutor,
+    в event loop остаётся только чтение заголовка, чтобы не гонять в пул то, что трогать не нужно.
+    """
+
+    def __init__(self, workers: int = IMAGE_PROCESS_WORKERS):
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # не fork: копия процесса бота со всеми его потоками и сокетами воркеру не нужна
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+        return self._pool
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._get_pool(), fn, *args)
+
+    @staticmethod
+    def _fits(data: ImageInput, max_side: int) -> str | None:
+        """MIME, если картинку можно отдать провайдеру как есть, иначе None"""
+        fmt, w, h = probe_image(data)
+        if fmt in _MIME_BY_FORMAT and max(w, h) <= max_side:
+            return _MIME_BY_FORMAT[fmt]
+        return None
+
+    async def normalize(self, data: ImageInput, provider: str) -> tuple[str, bytes]:
+        max_side = PROVIDER_MAX_SIDE[provider]
+        mime = self._fits(data, max_side)
+        if mime is not None:
+            return mime, _as_bytes(data)
+        return await self._run(normalize_image, _as_bytes(data), max_side)
+
+    async def normalize_many(self, images: Sequence[ImageInput], provider: str) -> list[tuple[str, bytes]]:
+        return list(await asyncio.gather(*(self.normalize(b, provider) for b in images)))
+
+    async def to_data_url(self, data: ImageInput, provider: str) -> str:
+        max_side = PROVIDER_MAX_SIDE[provider]
+        mime = self._fits(data, max_side)
+        if isinstance(data, MediaBuffer) and mime is not None:
+            # data URL буфера считается один раз: повторная сборка запроса (фолбэк, ретрай) его не пересчитывает
+            if not data.has_data_url and len(data) >= 256 * 1024:
+                data.remember_data_url(await self._run(encode_data_url, data.tobytes(), mime))
+            return data.data_url(mime)
+        if mime is not None and len(data) < 256 * 1024:
+            # маленькую картинку быстрее закодировать на месте, чем сериализовать в пул
+            return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+        return await self._run(normalize_image_to_data_url, _as_bytes(data), max_side)
+
+    async def to_data_urls(self, images: Sequence[ImageInput], provider: str) -> list[str]:
+        return list(await asyncio.gather(*(self.to_data_url(b, provider) for b in images)))
+
+    async def runway_ref_data_uris(self, images: Sequence[ImageInput]) -> list[str]:
+        return list(await asyncio.gather(*(self._run(prepare_runway_ref_data_uri, _as_bytes(b)) for b in images)))
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+image_processor = ImageProcessor()
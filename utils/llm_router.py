@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+
+from dotenv import find_dotenv, load_dotenv
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+)
+
+from utils.resilience import BreakerState, CircuitBreaker
+
+# llm_router.py — маршрутизация chat.completions между несколькими OpenAI-совместимыми бэкендами
+#
+# Бэкенды задаются в LLM_BACKENDS (JSON-список), например:
+#   [{"name": "neuroapi", "base_url": "https://neuroapi.host/v1", "api_key_env": "NEURO_GPT_TOKEN"},
+#    {"name": "openai", "base_url": "https://api.openai.com/v1", "api_key_env": "GPT_TOKEN",
+#     "models": {"gpt-5-mini": "gpt-5-mini-2025-08-07"}}]
+# Без LLM_BACKENDS работаем, как раньше, через один neuroapi.
+
+load_dotenv(find_dotenv())
+
+LLM_REQUEST_TIMEOUT_SEC = float(os.getenv("LLM_REQUEST_TIMEOUT_SEC", "120"))
+LLM_HEDGE_AFTER_SEC = float(os.getenv("LLM_HEDGE_AFTER_SEC", "25"))   # пока статистики мало
+LLM_HEDGE_P95_FACTOR = 1.5        # дубль запроса на другой бэкенд, если ответа нет дольше 1.5 × p95
+LLM_HEDGE_MIN_SEC = 2.0
+LATENCY_WINDOW = 200              # сколько последних ответов учитываем в p50/p95
+MIN_SAMPLES = 20                  # меньше — перцентили не считаем надёжными
+ERROR_PENALTY = 4.0               # 25% ошибок ≈ вдвое более медленный бэкенд
+
+_RETRYABLE_STATUSES = {408, 409, 429}
+
+
+class LLMUnavailableError(Exception):
+    """Ни один бэкенд не смог ответить"""
+    pass
+
+
+@dataclass(slots=True)
+class LLMBackendConfig:
+    name: str
+    base_url: str
+    api_key: str | None
+    models: dict[str, str] = field(default_factory=dict)   # имя модели у нас → имя у провайдера
+
+
+def load_backend_configs() -> list[LLMBackendConfig]:
+    raw = os.getenv("LLM_BACKENDS")
+    if not raw:
+        return [LLMBackendConfig(name="neuroapi", base_url="https://neuroapi.host/v1",
+                                 api_key=os.getenv("NEURO_GPT_TOKEN"))]
+    return [
+        LLMBackendConfig(
+            name=item["name"],
+            base_url=item["base_url"],
+            api_key=item.get("api_key") or os.getenv(item.get("api_key_env", "")),
+            models=item.get("models", {}),
+        )
+        for item in json.loads(raw)
+    ]
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Ошибки, при которых имеет смысл идти в другой бэкенд (сеть, таймауты, 5xx, 429)"""
+    if isinstance(error, (APIConnectionError, APITimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500 or error.status_code in _RETRYABLE_STATUSES
+    return False
+
+
+def _consume_result(task: asyncio.Task) -> None:
+    # отменённый проигравший хедж мог успеть упасть — не даём asyncio ругаться на непрочитанное исключение
+    if not task.cancelled():
+        task.exception()
+
+
+class LLMBackend:
+    def __init__(self, config: LLMBackendConfig, max_retries: int = 0):
+        self.config = config
+        self.name = config.name
+        self.max_retries = max_retries
+        self._client: AsyncOpenAI | None = None
+        self._client_requests: dict[AsyncOpenAI, int] = {}     # незавершённые запросы на каждом клиенте
+        self.breaker = CircuitBreaker(f"llm:{config.name}")
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes: deque[bool] = deque(maxlen=LATENCY_WINDOW)
+        self.in_flight = 0
+        self.stats = {"requests": 0, "errors": 0, "hedges": 0, "hedge_wins": 0}
+
+    def _make_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(api_key=self.config.api_key, base_url=self.config.base_url,
+                           timeout=LLM_REQUEST_TIMEOUT_SEC, max_retries=self.max_retries)
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        # клиент создаём при первом запросе: импорт модуля не должен зависеть от наличия ключей
+        if self._client is None:
+            self._client = self._make_client()
+        return self._client
+
+    def reset_client(self) -> None:
+        """
+        Новые запросы пойдут через новый клиент: старый мог застрять с битыми соединениями в пуле.
+        Старый закрываем, только когда допишутся начатые на нём запросы, — иначе их соединения оборвутся.
+        """
+        old, self._client = self._client, None
+        if old is not None and not self._client_requests.get(old):
+            asyncio.get_running_loop().create_task(old.close())
+
+    def _release_client(self, client: AsyncOpenAI) -> None:
+        left = self._client_requests[client] - 1
+        if left:
+            self._client_requests[client] = left
+            return
+        del self._client_requests[client]
+        if client is not self._client:
+            # последний запрос списанного клиента
+            asyncio.get_running_loop().create_task(client.close())
+
+    def percentile(self, q: float) -> float | None:
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self) -> float:
+        """Чем меньше, тем лучше; бэкенд без статистики получает 0, чтобы его попробовали"""
+        p95 = self.percentile(0.95)
+        if p95 is None:
+            return 0.0
+        return p95 * (1 + ERROR_PENALTY * self.error_rate) * (1 + 0.1 * self.in_flight)
+
+    def hedge_after(self) -> float:
+        p95 = self.percentile(0.95)
+        if p95 is None:
+            return LLM_HEDGE_AFTER_SEC
+        return max(LLM_HEDGE_MIN_SEC, p95 * LLM_HEDGE_P95_FACTOR)
+
+    def start(self, kwargs: dict) -> asyncio.Task | None:
+        """
+        Запускает запрос, если автомат пропускает (в half-open это занимает слот пробного запроса).
+        Отменённый запрос — проигравший хедж или отменённый вызывающий — возвращает слот, даже если
+        задачу отменили до первого шага и create так и не начал выполняться.
+        """
+        if not self.breaker.allow():
+            return None
+        task = asyncio.create_task(self.create(kwargs))
+        task.add_done_callback(self._release_if_cancelled)
+        return task
+
+    def _release_if_cancelled(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            self.breaker.release()
+
+    async def create(self, kwargs: dict):
+        model = kwargs.get("model")
+        if model in self.config.models:
+            kwargs = {**kwargs, "model": self.config.models[model]}
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        client = self.client
+        self._client_requests[client] = self._client_requests.get(client, 0) + 1
+        started = time.perf_counter()
+        try:
+            result = await client.chat.completions.create(**kwargs)
+        except asyncio.CancelledError:
+            # проиграл хеджу — не ошибка, но его задержка не меньше прошедшего времени, иначе p95 врёт в лучшую сторону
+            self.latencies.append(time.perf_counter() - started)
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # 400 и т.п. — бэкенд жив, проблема в запросе; в half-open это не повод замыкать цепь
+                self.breaker.record_request_error()
+                raise
+            self.stats["errors"] += 1
+            self.outcomes.append(False)
+            if self.breaker.record_failure():
+                self.reset_client()
+            raise
+        finally:
+            self.in_flight -= 1
+            self._release_client(client)
+        self.latencies.append(time.perf_counter() - started)
+        self.outcomes.append(True)
+        self.breaker.record_success()
+        return result
+
+    def snapshot(self) -> dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "p50": round(p50, 2) if p50 is not None else None,
+            "p95": round(p95, 2) if p95 is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "breaker": self.breaker.state.value,
+        }
+
+
+class LLMRouter:
+    """
+    Выбирает для каждого запроса самый здоровый бэкенд (по p95 с поправкой на ошибки и нагрузку),
+    при сетевой/5xx-ошибке переключается на следующий, а если ответа нет дольше обычного —
+    дублирует запрос на другой бэкенд и берёт тот ответ, что придёт первым.
+    Снаружи выглядит как AsyncOpenAI: router.chat.completions.create(...).
+    """
+
+    def __init__(self, configs: list[LLMBackendConfig] | None = None, max_hedges: int = 1):
+        configs = configs if configs is not None else load_backend_configs()
+        if not configs:
+            raise ValueError("Не задано ни одного LLM-бэкенда")
+        # единственному бэкенду идти больше некуда — пусть SDK сам повторит запрос
+        retries = 2 if len(configs) == 1 else 0
+        self.backends = [LLMBackend(config, max_retries=retries) for config in configs]
+        self.max_hedges = max_hedges
+        self.stats = {"requests": 0, "failovers": 0, "hedged": 0, "unavailable": 0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+
+    def ranked(self) -> list[LLMBackend]:
+        available = [b for b in self.backends if b.breaker.state is not BreakerState.OPEN]
+        return sorted(available, key=LLMBackend.score)
+
+    async def create_chat_completion(self, **kwargs):
+        self.stats["requests"] += 1
+        candidates = iter(self.ranked())
+        pending: dict[asyncio.Task, LLMBackend] = {}
+        hedges = 0
+        last_error: BaseException | None = None
+
+        def launch() -> LLMBackend | None:
+            for backend in candidates:
+                task = backend.start(kwargs)
+                if task is not None:
+                    pending[task] = backend
+                    return backend
+            return None
+
+        primary = launch()
+        try:
+            while pending:
+                can_hedge = hedges < self.max_hedges and len(pending) == 1
+                # после failover ждём по статистике того бэкенда, что отвечает сейчас, а не первого
+                active = next(iter(pending.values()))
+                done, _ = await asyncio.wait(pending, timeout=active.hedge_after() if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge = launch()
+                    hedges += 1
+                    if hedge is not None:
+                        hedge.stats["hedges"] += 1
+                        self.stats["hedged"] += 1
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        if hedges and backend is not primary:
+                            backend.stats["hedge_wins"] += 1
+                        return task.result()
+                    last_error = task.exception()
+                    if not is_retryable(last_error):
+                        raise last_error
+                if not pending:
+                    fallback = launch()
+                    if fallback is not None:
+                        primary = fallback
+                        self.stats["failovers"] += 1
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_consume_result)
+
+        self.stats["unavailable"] += 1
+        if last_error is not None:
+            raise last_error
+        raise LLMUnavailableError("Все LLM-бэкенды недоступны (разомкнуты автоматы защиты)")
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "backends": {b.name: b.snapshot() for b in self.backends}}
+
+
+llm_router = LLMRouter()
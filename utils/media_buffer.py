@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import io
+from typing import Any, Union
+
+# media_buffer.py — байты медиа, которые проходят весь конвейер без копий
+#
+# Фото из Telegram идёт по цепочке хендлер → бэкенд → build_user_content_for_chat / dispatch_tool_call →
+# провайдер → process_ai_response. MediaBuffer держит исходный bytes/bytearray и отдаёт memoryview,
+# а производные (MIME по сигнатуре, base64 в виде data URL, sha256) считает один раз и запоминает.
+# bytes из него берутся только там, где API не принимает ничего другого, и для bytes-источника
+# это тот же объект.
+
+BufferSource = Union[bytes, bytearray, memoryview]
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"OggS", "audio/ogg"),
+    (b"ID3", "audio/mpeg"),
+    (b"%PDF", "application/pdf"),
+)
+
+
+def sniff_mime(data: BufferSource) -> str | None:
+    """MIME по первым байтам; None — формат не узнали"""
+    head = bytes(memoryview(data)[:12])
+    for signature, mime in _SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class MediaBuffer:
+    """Неизменяемое содержимое файла: memoryview без копий + лениво посчитанные MIME, data URL и sha256"""
+
+    __slots__ = ("_data", "file_unique_id", "_mime", "_data_url", "_sha256")
+
+    def __init__(self, data: BufferSource, *, file_unique_id: str | None = None, mime: str | None = None):
+        self._data = data
+        self.file_unique_id = file_unique_id
+        self._mime = mime
+        self._data_url: str | None = None
+        self._sha256: str | None = None
+
+    @property
+    def view(self) -> memoryview:
+        return memoryview(self._data).toreadonly()
+
+    def __len__(self) -> int:
+        return self._data.nbytes if isinstance(self._data, memoryview) else len(self._data)
+
+    def tobytes(self) -> bytes:
+        """bytes для API, которые принимают только их; для bytes-источника копии нет"""
+        if isinstance(self._data, bytes):
+            return self._data
+        return bytes(self._data)
+
+    @property
+    def mime(self) -> str | None:
+        if self._mime is None:
+            self._mime = sniff_mime(self._data)
+        return self._mime
+
+    @property
+    def has_data_url(self) -> bool:
+        return self._data_url is not None
+
+    def data_url(self, mime: str | None = None) -> str:
+        """
+        data:<mime>;base64,... — считается один раз. Запоминается целиком, а не отдельно base64:
+        иначе в памяти жили бы две строки по 4/3 размера файла.
+        """
+        mime = mime or self.mime or "application/octet-stream"
+        if self._data_url is None or not self._data_url.startswith(f"data:{mime};"):
+            self._data_url = f"data:{mime};base64,{base64.b64encode(self._data).decode('ascii')}"
+        return self._data_url
+
+    def remember_data_url(self, value: str) -> None:
+        """data URL, посчитанный на стороне (в пуле процессов), — чтобы второй раз его не считать"""
+        self._data_url = value
+
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self._data).hexdigest()
+        return self._sha256
+
+    # интерфейс io.BytesIO, которым пользуется код, написанный под буферы
+    def getbuffer(self) -> memoryview:
+        return self.view
+
+    def getvalue(self) -> bytes:
+        return self.tobytes()
+
+
+def as_media(data: Any) -> MediaBuffer:
+    """MediaBuffer из MediaBuffer, BytesIO (в том числе FileBuffer) или bytes-like"""
+    if isinstance(data, MediaBuffer):
+        return data
+    if isinstance(data, io.BytesIO):
+        # getvalue() отдаёт внутренний bytes без копии, а getbuffer() разделяемого буфера копирует
+        return MediaBuffer(data.getvalue(), file_unique_id=getattr(data, "file_unique_id", None))
+    return MediaBuffer(data)
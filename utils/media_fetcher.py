@@ -0,0 +1,149 @@
+import asyncio
+import io
+import traceback
+from typing import Any, Iterable
+
+from utils.file_cache import TelegramFileCache, file_cache
+from utils.media_buffer import MediaBuffer
+from utils.tool_cache import SingleFlight
+
+# media_fetcher.py — параллельное скачивание файлов из Telegram
+
+DOWNLOAD_CONCURRENCY = 8          # одновременно качаем не больше стольких файлов на процесс
+DOWNLOAD_TIMEOUT = 60
+
+
+class _PresizedBuffer(io.BytesIO):
+    """
+    Приёмник для bot.download: BytesIO, память под который выделяется один раз по file_size,
+    без многократных реаллокаций по мере записи чанков.
+    getvalue() отдаёт внутренний bytes без копии (буфер не расшарен, а лишний хвост обрезается
+    на месте), так что скачанные байты уходят в кеш и MediaBuffer тем же объектом.
+    """
+
+    def __init__(self, size_hint: int | None):
+        super().__init__()
+        self._end = 0
+        if size_hint:
+            # запись последнего байта выделяет буфер ровно под файл одним куском
+            self.seek(size_hint - 1)
+            self.write(b"\0")
+            self.seek(0)
+            self._end = 0
+
+    def write(self, chunk) -> int:
+        # file_size от Telegram не гарантирован — больше подсказки BytesIO дорастёт сам
+        written = super().write(chunk)
+        self._end = max(self._end, self.tell())
+        return written
+
+    def getvalue(self) -> bytes:
+        # aiogram после скачивания делает seek(0) — конец данных помним сами
+        self.truncate(self._end)
+        return super().getvalue()
+
+
+class FileBuffer(io.BytesIO):
+    """BytesIO, помнящий file_unique_id исходного файла — по нему кешируются производные данные (текст документа и т.п.)"""
+
+    def __init__(self, data: bytes = b"", file_unique_id: str | None = None):
+        super().__init__(data)
+        self.file_unique_id = file_unique_id
+
+
+def _file_keys(file: Any) -> tuple[str, str, int | None]:
+    """(file_id, ключ дедупликации, file_size) для строки-id или PhotoSize/Document/Voice"""
+    if isinstance(file, str):
+        return file, file, None
+    file_id = file.file_id
+    return file_id, getattr(file, "file_unique_id", None) or file_id, getattr(file, "file_size", None)
+
+
+class MediaFetcher:
+    """
+    Скачивает файлы Telegram параллельно под общим семафором.
+    Одинаковые file_id/file_unique_id, которые уже качаются, не скачиваются второй раз —
+    все ждущие получают результат одной загрузки (SingleFlight: если скачивавший отменён,
+    загрузку продолжает один из ждущих). Скачанное кладётся в TelegramFileCache,
+    поэтому повторная работа с тем же фото обходится без сети.
+    """
+
+    def __init__(self, concurrency: int = DOWNLOAD_CONCURRENCY, timeout: float = DOWNLOAD_TIMEOUT,
+                 cache: TelegramFileCache | None = None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache = cache if cache is not None else file_cache
+        self._semaphore: asyncio.Semaphore | None = None
+        self._single_flight = SingleFlight()
+        self.downloads = 0
+
+    @property
+    def coalesced(self) -> int:
+        return self._single_flight.coalesced
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def fetch(self, bot, file: Any) -> bytes:
+        """Скачивает один файл (str file_id или объект с file_id) и возвращает его байты"""
+        file_id, key, file_size = _file_keys(file)
+        self.cache.remember_alias(file_id, key)
+        cached = await self.cache.get(file_id)
+        if cached is not None:
+            return cached
+
+        return await self._single_flight.run(key, lambda: self._download(bot, file_id, file_size))
+
+    async def fetch_buffer(self, bot, file: Any) -> FileBuffer:
+        """fetch, завёрнутый в FileBuffer — для кода, который работает с BytesIO"""
+        data = await self.fetch(bot, file)
+        return FileBuffer(data, getattr(file, "file_unique_id", None))
+
+    async def fetch_media(self, bot, file: Any) -> MediaBuffer:
+        """fetch, завёрнутый в MediaBuffer, — байты из кеша дальше по конвейеру не копируются"""
+        data = await self.fetch(bot, file)
+        return MediaBuffer(data, file_unique_id=getattr(file, "file_unique_id", None))
+
+    async def fetch_many_media(self, bot, files: Iterable[Any], *, skip_errors: bool = False) -> list[MediaBuffer]:
+        """fetch_many с результатами в MediaBuffer (при skip_errors неудачные пропускаются)"""
+        return await self._gather([self.fetch_media(bot, f) for f in files], skip_errors)
+
+    async def fetch_many(self, bot, files: Iterable[Any], *, skip_errors: bool = False) -> list[bytes]:
+        """
+        Скачивает все файлы параллельно, сохраняя исходный порядок.
+        При skip_errors=True неудачные загрузки выбрасываются из результата, иначе пробрасывается первая ошибка.
+        """
+        return await self._gather([self.fetch(bot, f) for f in files], skip_errors)
+
+    @staticmethod
+    async def _gather(jobs: list, skip_errors: bool) -> list:
+        results = await asyncio.gather(*jobs, return_exceptions=skip_errors)
+        if not skip_errors:
+            return list(results)
+        out = []
+        for result in results:
+            if isinstance(result, BaseException):
+                print("".join(traceback.format_exception(type(result), result, result.__traceback__)))
+                continue
+            out.append(result)
+        return out
+
+    async def _download(self, bot, file_id: str, file_size: int | None) -> bytes:
+        async with self._get_semaphore():
+            meta = await self.cache.get_file(bot, file_id)
+            # по строковому file_id уникальный id известен только после getFile — проверяем кеш ещё раз
+            if meta.file_unique_id and meta.file_unique_id != file_id:
+                cached = await self.cache.get(meta.file_unique_id)
+                if cached is not None:
+                    return cached
+            buffer = _PresizedBuffer(file_size or meta.file_size)
+            await bot.download_file(meta.file_path, destination=buffer, timeout=self.timeout)
+            self.downloads += 1
+            data = buffer.getvalue()
+            await self.cache.put(file_id, data)
+            return data
+
+
+media_fetcher = MediaFetcher()
@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputFile
+
+from db.repository import telegram_media_repository
+from utils.media_buffer import MediaBuffer
+
+# media_registry.py — реестр отправленных медиа: ключ содержимого → file_id в Telegram
+#
+# Любые байты (картинка, документ, озвучка, видео по URL, статичная картинка инструкции) загружаются
+# в Telegram одним ботом не больше одного раза: после первой отправки запоминаем file_id
+# (в памяти и в таблице telegram_media) и дальше шлём по нему. Параллельные отправки одного ещё
+# не загруженного файла (рассылка) ждут первую загрузку и уходят по её file_id.
+
+STATIC_MEDIA_DIR = os.getenv("STATIC_MEDIA_DIR", "static")      # <ключ>.jpg/.png — для бота без готового file_id
+MAX_MEMORY_ITEMS = 100_000
+_FILE_KINDS = ("photo", "document", "video", "animation", "audio", "voice")
+
+
+def content_key(data: bytes | MediaBuffer) -> str:
+    if isinstance(data, MediaBuffer):
+        return "sha256:" + data.sha256()
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def url_key(url: str) -> str:
+    return "url:" + url
+
+
+def static_key(name: str) -> str:
+    return "static:" + name
+
+
+def sent_file(message: Any, kind: str) -> tuple[str, str | None] | None:
+    """(file_id, file_unique_id) файла из отправленного сообщения; Telegram может сменить тип (document → video)"""
+    for attr in (kind, *_FILE_KINDS):
+        obj = getattr(message, attr, None)
+        if not obj:
+            continue
+        if isinstance(obj, list):           # photo — список размеров, нужен самый большой
+            obj = obj[-1]
+        return obj.file_id, getattr(obj, "file_unique_id", None)
+    return None
+
+
+def _is_stale_file_id(error: TelegramBadRequest) -> bool:
+    text = str(error).lower()
+    return "file" in text and ("identifier" in text or "reference" in text or "not found" in text)
+
+
+class MediaRegistry:
+    """file_id по (бот, ключ медиа): LRU в памяти + таблица telegram_media + file_id статичных картинок из settings"""
+
+    def __init__(self, static_dir: str = STATIC_MEDIA_DIR, max_memory_items: int = MAX_MEMORY_ITEMS):
+        self.static_dir = static_dir
+        self.max_memory_items = max_memory_items
+        self._memory: OrderedDict[tuple[int, str], str] = OrderedDict()
+        self._static_seeds: dict[str, str] = {}
+        self._stale_seeds: set[tuple[int, str]] = set()     # боты, которым file_id из settings не подошёл
+        self._uploads: dict[tuple[int, str], asyncio.Future] = {}
+        self.stats = {"file_id_sends": 0, "uploads": 0, "coalesced": 0, "stale": 0}
+
+    def register_static(self, seeds: dict[str, str]) -> None:
+        """file_id статичных картинок, загруженных заранее (ими пользуется основной бот)"""
+        self._static_seeds.update({static_key(name): file_id for name, file_id in seeds.items()})
+
+    async def lookup(self, bot_id: int, key: str) -> str | None:
+        file_id = self._memory.get((bot_id, key))
+        if file_id is not None:
+            self._memory.move_to_end((bot_id, key))
+            return file_id
+        row = await telegram_media_repository.get_media(bot_id=bot_id, media_key=key)
+        if row is not None:
+            self._remember(bot_id, key, row.file_id)
+            return row.file_id
+        if (bot_id, key) in self._stale_seeds:
+            return None
+        return self._static_seeds.get(key)
+
+    async def send(self, bot, key: str | None, kind: str,
+                   send: Callable[[InputFile | str], Awaitable[Any]],
+                   make_input: Callable[[], InputFile | None]) -> Any:
+        """
+        Отправляет медиа: по file_id, если этот бот его уже загружал, иначе загружает make_input()
+        и запоминает file_id. send получает то, что нужно передать в photo=/document=/voice=…
+        key=None — медиа не переиспользуется (просто загрузка).
+        """
+        if key is None:
+            return await send(make_input())
+        slot = (bot.id, key)
+        file_id = await self.lookup(bot.id, key)
+        if file_id is None:
+            upload = self._uploads.get(slot)
+            if upload is None:
+                return await self._upload(bot, slot, kind, send, make_input)
+            # этот же файл уже загружается (рассылка) — ждём его file_id
+            self.stats["coalesced"] += 1
+            file_id = await asyncio.shield(upload)
+            if file_id is None:
+                return await self._upload(bot, slot, kind, send, make_input)
+        try:
+            result = await send(file_id)
+        except TelegramBadRequest as e:
+            if not _is_stale_file_id(e):
+                raise
+            # file_id протух или чужой (например, статичный file_id основного бота у тестового)
+            self.stats["stale"] += 1
+            await self.forget(bot.id, key)
+            return await self._upload(bot, slot, kind, send, make_input)
+        self.stats["file_id_sends"] += 1
+        return result
+
+    async def send_static(self, bot, name: str, kind: str,
+                          send: Callable[[InputFile | str], Awaitable[Any]]) -> Any:
+        """Статичная картинка: по известному file_id, иначе из STATIC_MEDIA_DIR/<name>.jpg|.png"""
+        return await self.send(bot, static_key(name), kind, send, lambda: self._static_file(name))
+
+    async def _upload(self, bot, slot: tuple[int, str], kind: str,
+                      send: Callable[[InputFile | str], Awaitable[Any]],
+                      make_input: Callable[[], InputFile | None]) -> Any:
+        input_file = make_input()
+        if input_file is None:
+            raise LookupError(f"Нет ни file_id, ни файла для {slot[1]}")
+        future = asyncio.get_running_loop().create_future()
+        self._uploads[slot] = future
+        file_id = None
+        try:
+            result = await send(input_file)
+            self.stats["uploads"] += 1
+            sent = sent_file(result, kind)
+            if sent is not None:
+                file_id, file_unique_id = sent
+                self._remember(*slot, file_id)
+                try:
+                    await telegram_media_repository.upsert_media(bot_id=slot[0], media_key=slot[1], kind=kind,
+                                                                 file_id=file_id, file_unique_id=file_unique_id)
+                except Exception as e:
+                    # сообщение уже ушло — без записи в базе file_id просто проживёт до рестарта
+                    from settings import logger
+                    logger.log("ERROR_HANDLER", f"telegram_media: не удалось сохранить {slot[1]}: {e!r}")
+            return result
+        finally:
+            # ждущие получат None при неудаче и загрузят сами
+            if not future.done():
+                future.set_result(file_id)
+            self._uploads.pop(slot, None)
+
+    async def forget(self, bot_id: int, key: str) -> None:
+        self._memory.pop((bot_id, key), None)
+        if key in self._static_seeds:
+            self._stale_seeds.add((bot_id, key))
+        await telegram_media_repository.delete_media(bot_id=bot_id, media_key=key)
+
+    def _remember(self, bot_id: int, key: str, file_id: str) -> None:
+        self._memory[(bot_id, key)] = file_id
+        self._memory.move_to_end((bot_id, key))
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _static_file(self, name: str) -> InputFile | None:
+        for ext in ("jpg", "png"):
+            path = os.path.join(self.static_dir, f"{name}.{ext}")
+            if os.path.exists(path):
+                return FSInputFile(path)
+        return None
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "memory_items": len(self._memory), "uploading": len(self._uploads)}
+
+
+media_registry = MediaRegistry()
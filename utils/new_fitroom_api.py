@@ -2,12 +2,13 @@ from os import getenv
 
 import aiohttp
 import asyncio
-import time
 from typing import Optional, Dict, Any
 
 from aiogram import Bot
 from dotenv import load_dotenv, find_dotenv
 
+from utils.resilience import CircuitBreaker, Outcome, get_guard, time_left
+
 
 class FitroomAPIError(Exception):
     """Base exception for Fitroom API errors."""
@@ -22,6 +23,27 @@ class TryonTaskFailed(FitroomAPIError):
     pass
 
 
+class FitroomHTTPError(FitroomAPIError):
+    """Non-200 HTTP response."""
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"HTTP {status}: {text}")
+        self.status = status
+
+
+def _classify_fitroom_error(error: BaseException) -> Outcome:
+    if isinstance(error, FitroomHTTPError):
+        if error.status == 429:
+            return Outcome.RATE_LIMITED
+        return Outcome.RETRY if error.status >= 500 else Outcome.FATAL
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+        return Outcome.RETRY
+    return Outcome.FATAL
+
+
+fitroom_guard = get_guard("fitroom", breaker=CircuitBreaker("fitroom", reset_timeout=30.0), rate_limit_delay=1.0)
+
+
 load_dotenv(find_dotenv("../.env"))
 fit_room_token = getenv("FITROOM_TOKEN")
 
@@ -33,9 +55,8 @@ class FitroomClient:
         self.api_key = fit_room_token
         self.session = session or aiohttp.ClientSession()
 
-    async def _request(self, method: str, path: str, *, data=None, timeout=60) -> Dict[str, Any]:
-        url = f"{self.BASE_URL}{path}"
-        headers = {
+    def _headers(self) -> Dict[str, str]:
+        return {
             "X-API-KEY": self.api_key,
             "Origin": "https://platform.fitroom.app",  # Обязательный заголовок
             "Referer": "https://platform.fitroom.app/",  # Требуется для Cloudflare
@@ -43,44 +64,33 @@ class FitroomClient:
             "Sec-Fetch-Mode": "cors",
             "Sec-Fetch-Site": "same-origin",
         }
-        backoff = 1.0
-        max_retries = 5
-        retry_count = 0
 
-        while retry_count < max_retries:
+    async def _request(self, method: str, path: str, *, data=None, timeout=60) -> Dict[str, Any]:
+        url = f"{self.BASE_URL}{path}"
+        headers = self._headers()
+        return await fitroom_guard.call(
+            lambda: self._request_once(method, url, headers=headers, data=data, timeout=timeout),
+            classify=_classify_fitroom_error,
+            max_attempts=5,
+        )
+
+    async def _request_once(self, method: str, url: str, *, headers: dict, data, timeout) -> Dict[str, Any]:
+        async with self.session.request(method, url, headers=headers, data=data, timeout=timeout) as resp:
+            text = await resp.text()
+
+            if resp.status == 402:
+                raise CreditsFitroomAPIError(
+                    "Ошибка 402: недостаточно кредитов. "
+                    "Пожалуйста, пополните баланс в личном кабинете."
+                )
+
+            if resp.status != 200:
+                raise FitroomHTTPError(resp.status, text)
+
             try:
-                async with self.session.request(method, url, headers=headers, data=data, timeout=timeout) as resp:
-                    text = await resp.text()
-
-                    if resp.status == 402:
-                        raise CreditsFitroomAPIError(
-                            "Ошибка 402: недостаточно кредитов. "
-                            "Пожалуйста, пополните баланс в личном кабинете."
-                        )
-
-                    if resp.status == 429:
-                        print(f"Rate limit hit, waiting {backoff} seconds...")
-                        await asyncio.sleep(backoff)
-                        backoff = min(backoff * 2, 30.0)
-                        retry_count += 1
-                        continue
-
-                    if resp.status != 200:
-                        raise FitroomAPIError(f"HTTP {resp.status}: {text}")
-
-                    try:
-                        return await resp.json()
-                    except Exception as e:
-                        raise FitroomAPIError(f"Failed to parse JSON response: {text}")
-
-            except asyncio.TimeoutError:
-                retry_count += 1
-                if retry_count >= max_retries:
-                    raise FitroomAPIError("Request timed out after multiple retries")
-                await asyncio.sleep(backoff)
-                backoff = min(backoff * 2, 30.0)
-
-        raise FitroomAPIError("Max retries exceeded")
+                return await resp.json()
+            except Exception as e:
+                raise FitroomAPIError(f"Failed to parse JSON response: {text}")
 
     async def check_model_image(self, image_bytes: bytes) -> Dict[str, Any]:
         """
@@ -133,16 +143,18 @@ class FitroomClient:
 
         form.add_field("cloth_type", cloth_type)
 
-        print(f"Creating task with cloth_type: {cloth_type}")
+        from settings import logger
         resp = await self._request("POST", "/api/tryon/v2/tasks", data=form)
-        print(f"Task created successfully: {resp}")
+        logger.info(f"Fitroom: задача {resp['task_id']} создана, cloth_type={cloth_type}")
         return resp["task_id"]
 
-    async def get_task_status(self, task_id: str) -> Dict[str, Any]:
+    async def get_task_status(self, task_id: str, timeout: float = 60) -> Dict[str, Any]:
         """
         Retrieves the status of a try-on task.
+        Один запрос без fitroom_guard: опрос не создаёт работу у провайдера, его ограничивает дедлайн try_on.
         """
-        return await self._request("GET", f"/api/tryon/v2/tasks/{task_id}")
+        return await self._request_once("GET", f"{self.BASE_URL}/api/tryon/v2/tasks/{task_id}",
+                                        headers=self._headers(), data=None, timeout=timeout)
 
     async def download_result(self, download_url: str) -> bytes:
         """
@@ -169,17 +181,18 @@ class FitroomClient:
         End-to-end try-on: optionally validates images, creates task, polls status,
         and returns final image bytes.
         """
+        from settings import logger
         if validate:
             # Проверяем модель
             model_check = await self.check_model_image(model_bytes)
-            print(f"Model check result: {model_check}")
+            logger.debug(f"Fitroom: проверка модели: {model_check}")
 
             if not model_check.get("is_good", False):
                 raise FitroomAPIError(f"Model image invalid: {model_check}")
 
             # Проверяем одежду
             clothes_check = await self.check_clothes_image(cloth_bytes)
-            print(f"Clothes check result: {clothes_check}")
+            logger.debug(f"Fitroom: проверка одежды: {clothes_check}")
 
             if not clothes_check.get("is_clothes", False):
                 raise FitroomAPIError(f"Clothes image invalid: {clothes_check}")
@@ -187,32 +200,31 @@ class FitroomClient:
             # ВАЖНО: используем тип одежды, определенный API, если не указан явно
             if cloth_type is None:
                 cloth_type = clothes_check["clothes_type"]
-                print(f"Auto-detected cloth_type: {cloth_type}")
+                logger.info(f"Fitroom: тип одежды определён автоматически: {cloth_type}")
             else:
                 # Если тип указан принудительно, проверяем совместимость
                 detected_type = clothes_check["clothes_type"]
                 if cloth_type != detected_type:
-                    print(
-                        f"❌ КРИТИЧЕСКАЯ ОШИБКА: Указанный cloth_type='{cloth_type}' не совпадает с определенным API='{detected_type}'")
-                    print(f"   Это может привести к зависанию задачи в статусе CREATED!")
-                    print(f"   Рекомендуется использовать cloth_type='{detected_type}'")
-
-                    # Автоматически исправляем
-                    print(f"   Автоматически исправляю на '{detected_type}'")
+                    # с неверным cloth_type задача может зависнуть в статусе CREATED — исправляем автоматически
+                    logger.warning(f"Fitroom: cloth_type='{cloth_type}' не совпадает с определённым API "
+                                   f"'{detected_type}', использую '{detected_type}'")
                     cloth_type = detected_type
 
             # Проверяем совместимость с моделью
             good_clothes_types = model_check.get("good_clothes_types", [])
             if cloth_type not in good_clothes_types:
-                print(f"Warning: cloth_type '{cloth_type}' not in good_clothes_types {good_clothes_types}")
+                logger.warning(f"Fitroom: cloth_type '{cloth_type}' не входит в good_clothes_types {good_clothes_types}")
 
         # Создаем задачу
         task_id = await self.create_tryon_task(model_bytes, cloth_bytes, cloth_type, lower_cloth_bytes)
-        # print(f"Task created with ID: {task_id}")
 
         # Ожидаем выполнения с более частым логированием
-        start = time.time()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        remaining = time_left()
+        deadline = start + (timeout if remaining is None else min(timeout, remaining))
         poll_count = 0
+        stuck_reported = False
 
         # Отправляем начальное сообщение и сохраняем его для редактирования
         edit_message = await send_bot.send_message(
@@ -221,13 +233,22 @@ class FitroomClient:
         )
 
         while True:
-            # Получаем статус задачи и прогресс
-            status = await self.get_task_status(task_id)
+            # Получаем статус задачи и прогресс; временный сбой опроса — просто следующий опрос
+            try:
+                status = await asyncio.wait_for(self.get_task_status(task_id),
+                                                timeout=max(0.0, deadline - loop.time()))
+            except Exception as e:
+                if _classify_fitroom_error(e) is Outcome.FATAL:
+                    raise
+                if loop.time() > deadline:
+                    raise FitroomAPIError(f"Try-on task timed out after {loop.time() - start:.1f} seconds") from e
+                await asyncio.sleep(min(poll_interval, max(0.0, deadline - loop.time())))
+                continue
             poll_count += 1
             current_status = status.get("status", "UNKNOWN")
             progress = status.get("progress", 0)
 
-            print(f"Poll #{poll_count}: Status={current_status}, Progress={progress}%")
+            logger.debug(f"Fitroom: опрос #{poll_count} задачи {task_id}: status={current_status}, progress={progress}%")
 
             # Формируем текст с прогресс-баром
             bar_length = 10
@@ -248,7 +269,7 @@ class FitroomClient:
                 )
             except Exception as e:
                 # Логируем ошибки редактирования, но продолжаем попытки
-                print(f"Ошибка редактирования сообщения: {e}")
+                logger.debug(f"Fitroom: ошибка редактирования сообщения: {e}")
 
             if current_status == "COMPLETED":
                 await send_bot.delete_message(chat_id=chat_id,
@@ -256,7 +277,7 @@ class FitroomClient:
                 download_url = status.get("download_signed_url")
                 if not download_url:
                     raise FitroomAPIError("No download URL in completed task")
-                print(f"Task completed! Downloading from: {download_url[:50]}...")
+                logger.info(f"Fitroom: задача {task_id} готова за {loop.time() - start:.1f}с")
                 return await self.download_result(download_url)
 
             if current_status == "FAILED":
@@ -265,21 +286,18 @@ class FitroomClient:
                 error_msg = status.get("error", "Unknown error")
                 raise TryonTaskFailed(f"Task {task_id} failed: {error_msg}")
             # Проверяем таймаут
-            elapsed = time.time() - start
-            if elapsed > timeout:
+            elapsed = loop.time() - start
+            if loop.time() > deadline:
                 raise FitroomAPIError(
                     f"Try-on task timed out after {elapsed:.1f} seconds. Last status: {current_status}")
 
-            # Особая логика для CREATED статуса
-            if current_status == "CREATED" and poll_count > 10:
-                print(f"Warning: Task stuck in CREATED status for {poll_count} polls ({elapsed:.1f}s)")
-
-                # После 30 секунд в CREATED статусе - это аномалия
-                if elapsed > 30:
-                    print("Task appears to be stuck. This might indicate a service issue.")
-                    # Можно попробовать создать новую задачу или обратиться в поддержку
+            # После 30 секунд в CREATED задача, скорее всего, зависла на стороне сервиса — сообщаем один раз
+            if current_status == "CREATED" and poll_count > 10 and elapsed > 30 and not stuck_reported:
+                stuck_reported = True
+                logger.warning(f"Fitroom: задача {task_id} висит в статусе CREATED {elapsed:.1f}с "
+                               f"({poll_count} опросов)")
 
-            await asyncio.sleep(poll_interval)
+            await asyncio.sleep(min(poll_interval, max(0.0, deadline - loop.time())))
 
     async def close(self):
         """Closes underlying HTTP session."""
@@ -0,0 +1,118 @@
+import datetime
+import hashlib
+import io
+import os
+import time
+from collections import OrderedDict
+
+from openai import AsyncOpenAI, NotFoundError
+
+from db.repository import openai_files_repository
+from utils.media_buffer import MediaBuffer
+from utils.tool_cache import SingleFlight
+
+# openai_file_cache.py — дедупликация загрузок в OpenAI Files API по хешу содержимого
+#
+# Ключ — (sha256 содержимого, purpose), значение — file_id. Горячие записи держим в памяти,
+# все — в таблице openai_files. Запись старше VERIFY_AFTER_SEC перед использованием проверяем
+# через retrieve_with_retry (файл могли удалить), файл с истекающим expires_at загружаем заново.
+
+VERIFY_AFTER_SEC = int(os.getenv("OPENAI_FILE_CACHE_VERIFY_HOURS", "24")) * 3600
+EXPIRY_MARGIN_SEC = 10 * 60          # файл, который вот-вот истечёт, модель может уже не прочитать
+MAX_MEMORY_ITEMS = 10_000
+
+
+class _Entry:
+    __slots__ = ("file_id", "verified_at", "expires_at")
+
+    def __init__(self, file_id: str, verified_at: float, expires_at: float | None):
+        self.file_id = file_id
+        self.verified_at = verified_at
+        self.expires_at = expires_at
+
+
+class OpenAIFileCache:
+    """Загружает файл в Files API, только если такого содержимого с таким purpose там ещё нет"""
+
+    def __init__(self, verify_after: float = VERIFY_AFTER_SEC, max_memory_items: int = MAX_MEMORY_ITEMS):
+        self.verify_after = verify_after
+        self.max_memory_items = max_memory_items
+        self._memory: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._single_flight = SingleFlight()
+        self.stats = {"hits": 0, "uploads": 0, "verified": 0, "expired": 0, "bytes_saved": 0}
+
+    async def upload(self, client: AsyncOpenAI, data: bytes | io.BytesIO | MediaBuffer, *, filename: str,
+                     purpose: str, mime: str | None = None) -> str:
+        """:return: file_id уже загруженной копии или только что загруженного файла"""
+        if isinstance(data, MediaBuffer):
+            digest, size = data.sha256(), len(data)
+            data = data.tobytes()
+        elif isinstance(data, io.BytesIO):
+            with data.getbuffer() as view:
+                digest, size = hashlib.sha256(view).hexdigest(), view.nbytes
+        else:
+            digest, size = hashlib.sha256(data).hexdigest(), len(data)
+        key = (digest, purpose)
+        # одинаковые файлы, присланные одновременно (альбом, пересылка), грузим один раз
+        return await self._single_flight.run(key, lambda: self._resolve(client, key, data, size, filename, mime))
+
+    async def _resolve(self, client: AsyncOpenAI, key: tuple[str, str], data: bytes | io.BytesIO, size: int,
+                       filename: str, mime: str | None) -> str:
+        entry = self._memory.get(key)
+        if entry is None:
+            row = await openai_files_repository.get_file(*key)
+            if row is not None:
+                entry = _Entry(row.file_id, row.verified_at.timestamp(),
+                               row.expires_at.timestamp() if row.expires_at else None)
+        if entry is not None and await self._still_valid(client, entry):
+            self._remember(key, entry)
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += size
+            return entry.file_id
+        if entry is not None:
+            self._memory.pop(key, None)
+            await openai_files_repository.delete_file(file_id=entry.file_id)
+
+        if isinstance(data, io.BytesIO):
+            data.seek(0)
+        file = await client.files.create(file=(filename, data, mime) if mime else (filename, data), purpose=key[1])
+        self.stats["uploads"] += 1
+        expires_at = getattr(file, "expires_at", None)
+        await openai_files_repository.upsert_file(
+            content_hash=key[0], purpose=key[1], file_id=file.id,
+            expires_at=datetime.datetime.fromtimestamp(expires_at) if expires_at else None,
+        )
+        self._remember(key, _Entry(file.id, time.time(), expires_at))
+        return file.id
+
+    async def _still_valid(self, client: AsyncOpenAI, entry: _Entry) -> bool:
+        now = time.time()
+        if entry.expires_at is not None and entry.expires_at - now < EXPIRY_MARGIN_SEC:
+            self.stats["expired"] += 1
+            return False
+        if now - entry.verified_at < self.verify_after:
+            return True
+        from utils.combined_gpt_tools import retrieve_with_retry
+        try:
+            file = await retrieve_with_retry(client, file_id=entry.file_id)
+        except (NotFoundError, RuntimeError):
+            # файл удалён (или API так и не ответил) — надёжнее загрузить заново
+            self.stats["expired"] += 1
+            return False
+        self.stats["verified"] += 1
+        entry.verified_at = now
+        entry.expires_at = getattr(file, "expires_at", None) or entry.expires_at
+        await openai_files_repository.mark_verified(file_id=entry.file_id)
+        return True
+
+    def _remember(self, key: tuple[str, str], entry: _Entry) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, **self._single_flight.snapshot(), "memory_items": len(self._memory)}
+
+
+openai_file_cache = OpenAIFileCache()
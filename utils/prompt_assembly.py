@@ -0,0 +1,101 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+# prompt_assembly.py — сборка system-промпта и tools для Chat Completions
+#
+# Всё статичное (system_prompt, правила про время, tools) собирается один раз.
+# Изменчивое (время в Москве, день недели, about_user) идёт коротким system-сообщением
+# в самом конце, перед вопросом пользователя: так tools + system + история совпадают
+# байт-в-байт между запросами одного пользователя и попадают в кеш промпта у провайдера.
+#
+# Тело запроса с tools сериализует сам SDK: готовый JSON туда не передать, не обходя llm_router
+# (хеджирование, переключение бэкендов) и проверку параметров. Это не узкое место — json.dumps
+# всех tools (~25 КБ) занимает порядка 40 мкс; заранее считается только их отпечаток для ключа схлопывания.
+
+MSK = ZoneInfo("Europe/Moscow")
+_WEEKDAYS = ("понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье")
+
+TIME_RULES = (
+    "ВАЖНАЯ ИНФОРМАЦИЯ О ВРЕМЕНИ:\n"
+    "Текущие дата и время в Москве и день недели указаны в последнем системном сообщении перед вопросом пользователя.\n"
+    "ВСЕ уведомления и напоминания должны устанавливаться в московском времени!\n"
+    "Примеры относительных дат:\n"
+    "- 'завтра' = следующий день после сегодняшнего\n"
+    "- 'послезавтра' = через два дня\n"
+    "- 'на следующей неделе в понедельник' = ближайший понедельник после текущей недели\n"
+    "- 'через 30 минут' = добавить 30 минут к текущему времени"
+)
+
+
+def _tools_for_chat_completions(tools: list[dict]) -> list[dict]:
+    conv = []
+    for t in tools:
+        conv.append({
+            "type": "function",
+            "function": {
+                "name": t["name"],
+                "description": t.get("description") or "",
+                "parameters": t.get("parameters") or {"type": "object", "properties": {}},
+                "strict": t.get("strict", False),
+            }
+        })
+    return conv
+
+
+class PromptAssembler:
+    """
+    Один раз компилирует статический префикс запроса и tools (плюс их отпечаток для ключа схлопывания),
+    на каждый запрос добавляет только маленький изменчивый суффикс.
+    Без аргументов берёт system_prompt и tools из settings при первом обращении
+    (settings импортирует этот модуль раньше, чем объявляет их).
+    """
+
+    def __init__(self, system_prompt: str | None = None, tools: list[dict] | None = None):
+        self._source = (system_prompt, tools)
+        self._compiled: tuple[str, list[dict], str] | None = None
+
+    def _compile(self) -> tuple[str, list[dict], str]:
+        if self._compiled is None:
+            system_prompt, tools = self._source
+            if system_prompt is None or tools is None:
+                import settings
+                system_prompt = settings.system_prompt if system_prompt is None else system_prompt
+                tools = settings.tools if tools is None else tools
+            payload = _tools_for_chat_completions(tools or [])
+            digest = hashlib.blake2b(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode(),
+                                     digest_size=20).hexdigest()
+            self._compiled = (system_prompt + "\n\n" + TIME_RULES, payload, digest)
+        return self._compiled
+
+    @property
+    def static_system(self) -> str:
+        return self._compile()[0]
+
+    @property
+    def tools_payload(self) -> list[dict]:
+        """Один и тот же объект на все запросы — не изменять"""
+        return self._compile()[1]
+
+    @property
+    def tools_digest(self) -> str:
+        return self._compile()[2]
+
+    @staticmethod
+    def volatile_context(about_user: str | None, now: datetime | None = None) -> str:
+        now = now or datetime.now(timezone.utc).astimezone(MSK)
+        text = (f"Текущие дата и время в Москве: {now:%Y-%m-%d %H:%M:%S}\n"
+                f"Сегодня {_WEEKDAYS[now.weekday()]}")
+        if about_user:
+            text += f"\n\nИнформация о пользователе:\n{about_user}"
+        return text
+
+    def build_messages(self, history: list[dict], about_user: str | None) -> list[dict]:
+        """system (статичный) + история + system (время и контекст пользователя); вход пользователя добавляет вызывающий"""
+        return ([{"role": "system", "content": self.static_system}]
+                + history
+                + [{"role": "system", "content": self.volatile_context(about_user)}])
+
+
+prompt_assembler = PromptAssembler()
@@ -0,0 +1,307 @@
+import asyncio
+import contextlib
+import contextvars
+import random
+import time
+from collections import deque
+from enum import Enum
+from typing import Any, Awaitable, Callable, Iterator
+
+# resilience.py — общие примитивы отказоустойчивости для внешних провайдеров:
+# автоматы защиты, бюджеты повторов, дедлайны и единая обёртка вызова провайдера
+
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"          # запросы идут как обычно
+    OPEN = "open"              # провайдер считается лежащим, запросы не пускаем
+    HALF_OPEN = "half_open"    # пробуем пару запросов, чтобы понять, ожил ли
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты провайдера.
+    Размыкается после failure_threshold ошибок подряд или если в окне из последних window исходов
+    доля ошибок не меньше failure_rate. Через reset_timeout пропускает half_open_calls пробных запросов:
+    успех замыкает цепь, ошибка снова размыкает с удвоенным таймаутом (но не больше max_reset_timeout).
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, window: int = 20, failure_rate: float = 0.5,
+                 min_calls: int = 10, reset_timeout: float = 15.0, max_reset_timeout: float = 300.0,
+                 half_open_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.half_open_calls = half_open_calls
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._state = BreakerState.CLOSED
+        self._opened_at = 0.0
+        self._reset_timeout = reset_timeout
+        self._probes = 0
+        self.stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> BreakerState:
+        if self._state is BreakerState.OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self._state = BreakerState.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    @property
+    def retry_after(self) -> float:
+        """Сколько секунд ещё будет разомкнут (0 — можно пробовать)"""
+        if self.state is not BreakerState.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self._reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в half-open занимает слот пробного запроса"""
+        state = self.state
+        if state is BreakerState.CLOSED:
+            return True
+        if state is BreakerState.HALF_OPEN and self._probes < self.half_open_calls:
+            self._probes += 1
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def release(self) -> None:
+        """Пробный запрос отменили, не дождавшись исхода — возвращаем слот"""
+        if self._state is BreakerState.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record_success(self) -> None:
+        self._consecutive_failures = 0
+        if self._state is not BreakerState.CLOSED:
+            self._state = BreakerState.CLOSED
+            self._reset_timeout = self.base_reset_timeout
+            self._outcomes.clear()
+        self._outcomes.append(True)
+
+    def record_request_error(self) -> None:
+        """
+        Провайдер ответил, но отказал в самом запросе (модерация, валидация, 400).
+        Это не сбой, но и не доказательство, что он ожил: в half-open слот пробного запроса
+        возвращается без замыкания цепи, а разомкнутую другим вызовом цепь не трогаем
+        """
+        if self._state is BreakerState.CLOSED:
+            self.record_success()
+        else:
+            self.release()
+
+    def record_failure(self) -> bool:
+        """:return: True, если именно эта ошибка разомкнула цепь"""
+        self._consecutive_failures += 1
+        self._outcomes.append(False)
+        if self._state is BreakerState.HALF_OPEN:
+            self._open(self._reset_timeout * 2)
+            return True
+        if self._state is BreakerState.OPEN:
+            return False
+        failures = self._outcomes.count(False)
+        if (self._consecutive_failures >= self.failure_threshold
+                or (len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate)):
+            self._open(self.base_reset_timeout)
+            return True
+        return False
+
+    def _open(self, reset_timeout: float) -> None:
+        self._state = BreakerState.OPEN
+        self._opened_at = time.monotonic()
+        self._reset_timeout = min(reset_timeout, self.max_reset_timeout)
+        self.stats["opened"] += 1
+
+    def snapshot(self) -> dict:
+        return {"state": self.state.value, "consecutive_failures": self._consecutive_failures,
+                "retry_after": round(self.retry_after, 1), **self.stats}
+
+
+class RetryBudget:
+    """
+    Бюджет повторов в духе token bucket: каждый первый запрос кладёт ratio токена,
+    каждый повтор забирает целый. В норме повторы ограничены ~ratio от потока запросов,
+    а во время аварии бюджет быстро кончается и запросы падают сразу, а не после всех попыток.
+    min_tokens — запас, чтобы при редких запросах повторы всё же были.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 5.0, max_tokens: float = 50.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+# ---------- дедлайны ----------
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("resilience_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline_scope(seconds: float | None) -> Iterator[None]:
+    """
+    Задаёт дедлайн для всех вызовов провайдеров внутри блока (и в созданных в нём задачах).
+    Вложенный дедлайн не может быть позже внешнего.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left() -> float | None:
+    """Сколько секунд осталось до дедлайна (None — дедлайна нет)"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# ---------- обёртка вызова провайдера ----------
+
+class Outcome(str, Enum):
+    FATAL = "fatal"                # ошибка запроса (модерация, валидация, кредиты) — не повторяем, провайдер жив
+    RETRY = "retry"                # сеть, таймаут, 5xx — повторяем, считаем сбоем провайдера
+    RATE_LIMITED = "rate_limited"  # 429 — повторяем с более длинной паузой, тоже сбой
+
+
+PROVIDER_TITLES = {
+    "gemini": "генерации изображений",
+    "runway": "генерации изображений",
+    "sora": "генерации видео",
+    "fitroom": "примерки одежды",
+}
+
+
+class ProviderUnavailableError(Exception):
+    """Провайдер разомкнут автоматом защиты, кончился бюджет повторов или истёк дедлайн"""
+
+    def __init__(self, provider: str, reason: str, retry_after: float = 0.0):
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"{provider}: {reason}")
+
+    @property
+    def user_message(self) -> str:
+        title = PROVIDER_TITLES.get(self.provider, "генерации")
+        minutes = max(1, round(self.retry_after / 60))
+        return (f"⚠️ Сервис {title} сейчас перегружен. Попробуйте через {minutes} мин.,"
+                " а пока можете воспользоваться другим функционалом. Я умею немало 🤗")
+
+
+class ProviderGuard:
+    """
+    Единая политика вызова внешнего провайдера: автомат защиты, общий бюджет повторов,
+    экспоненциальная пауза с полным джиттером и уважение дедлайна вызывающего хендлера.
+    Пока автомат разомкнут, вызовы сразу падают с ProviderUnavailableError.
+    """
+
+    def __init__(self, name: str, *, base_delay: float = 1.0, max_delay: float = 30.0,
+                 rate_limit_delay: float = 5.0, breaker: CircuitBreaker | None = None,
+                 budget: RetryBudget | None = None):
+        self.name = name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limit_delay = rate_limit_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.budget = budget or RetryBudget()
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "retries": 0, "fast_failed": 0,
+                      "budget_exhausted": 0, "deadline_exceeded": 0}
+
+    def _delay(self, attempt: int, outcome: Outcome) -> float:
+        base = self.rate_limit_delay if outcome is Outcome.RATE_LIMITED else self.base_delay
+        return random.uniform(0, min(self.max_delay, base * 2 ** (attempt - 1)))
+
+    def _unavailable(self, reason: str, stat: str, retry_after: float = 0.0) -> ProviderUnavailableError:
+        self.stats[stat] += 1
+        return ProviderUnavailableError(self.name, reason, retry_after)
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], classify: Callable[[BaseException], Outcome],
+                   max_attempts: int = 3) -> Any:
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise self._unavailable("circuit_open", "fast_failed", self.breaker.retry_after)
+            remaining = time_left()
+            if remaining is not None and remaining <= 0:
+                self.breaker.release()
+                raise self._unavailable("deadline", "deadline_exceeded")
+            attempt += 1
+            if attempt == 1:
+                # быстро отбитые автоматом вызовы бюджет не пополняют
+                self.budget.deposit()
+            try:
+                if remaining is None:
+                    result = await fn()
+                else:
+                    result = await asyncio.wait_for(fn(), timeout=remaining)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except asyncio.TimeoutError as e:
+                if time_left() is not None and time_left() <= 0:
+                    # не успели к дедлайну хендлера — медленный провайдер тоже сбой
+                    self.stats["failures"] += 1
+                    self.breaker.record_failure()
+                    raise self._unavailable("deadline", "deadline_exceeded") from e
+                outcome = classify(e)
+                error = e
+            except Exception as e:
+                outcome = classify(e)
+                error = e
+            else:
+                self.stats["successes"] += 1
+                self.breaker.record_success()
+                return result
+
+            if outcome is Outcome.FATAL:
+                self.breaker.record_request_error()
+                raise error
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            if attempt >= max_attempts:
+                raise error
+            if self.breaker.state is BreakerState.OPEN:
+                raise self._unavailable("circuit_open", "fast_failed", self.breaker.retry_after) from error
+            if not self.budget.try_spend():
+                raise self._unavailable("retry_budget", "budget_exhausted", self.breaker.base_reset_timeout) from error
+            delay = self._delay(attempt, outcome)
+            remaining = time_left()
+            if remaining is not None and remaining <= delay:
+                raise self._unavailable("deadline", "deadline_exceeded") from error
+            self.stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "retry_tokens": round(self.budget.tokens, 1), "breaker": self.breaker.snapshot()}
+
+
+_guards: dict[str, ProviderGuard] = {}
+
+
+def get_guard(name: str, **kwargs) -> ProviderGuard:
+    """Один ProviderGuard на провайдера на весь процесс"""
+    guard = _guards.get(name)
+    if guard is None:
+        guard = _guards[name] = ProviderGuard(name, **kwargs)
+    return guard
+
+
+def guards_snapshot() -> dict:
+    return {name: guard.snapshot() for name, guard in _guards.items()}
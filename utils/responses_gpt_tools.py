@@ -9,10 +9,8 @@ import json
 import mimetypes
 import os
 import traceback
-from collections import defaultdict
 from typing import Any, Optional, Sequence, Dict, List, Tuple
 
-import aiohttp
 from dotenv import find_dotenv, load_dotenv
 from openai import (
     APIConnectionError,
@@ -24,16 +22,15 @@ from openai import (
     RateLimitError,
     BadRequestError,
     InternalServerError,
+    NotFoundError,
 )
 
-from data.keyboards import subscriptions_keyboard, more_generations_keyboard, delete_notification_keyboard
+from data.keyboards import delete_notification_keyboard
 from db.models import Users
 from db.repository import (
     users_repository,
-    subscriptions_repository,
-    type_subscriptions_repository,
-    generations_packets_repository,
     notifications_repository,
+    vector_store_files_repository,
 )
 from settings import get_current_datetime_string, print_log, get_current_bot
 from utils.create_notification import (
@@ -47,17 +44,30 @@ from utils.create_notification import (
     NotificationTextTooLongError,
 )
 from utils.gpt_images import AsyncOpenAIImageClient
+from utils.media_fetcher import media_fetcher
+from utils.media_buffer import MediaBuffer, as_media
+from utils.audio_pipeline import audio_pipeline, SpeechInputFile
 from utils.new_fitroom_api import FitroomClient
 from utils.parse_gpt_text import sanitize_with_links
 from utils.runway_api import generate_image_bytes
+from utils.telegram_sender import get_sender
+from utils.resilience import ProviderUnavailableError
+from utils.openai_file_cache import openai_file_cache
+from utils.vector_store_manifest import vector_store_manifest
+from utils.assistant_backends import (
+    NoSubscription,
+    NoGenerations,
+    get_thread_lock,
+    parse_tool_call,
+    tool_executor,
+    load_quota,
+    require_tool_access,
+    consume_generations,
+    TurnQuota,
+)
 
 # ----------------------------- shared ---------------------------------
 
-_thread_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
-
-class NoSubscription(Exception): ...
-class NoGenerations(Exception): ...
-
 def _b64(b: bytes) -> str:
     return base64.b64encode(b).decode()
 
@@ -72,13 +82,11 @@ async def retrieve_with_retry(client: AsyncOpenAI, file_id: str, max_attempts: i
             await asyncio.sleep(base_delay * (2 ** (attempt - 1)))
     raise RuntimeError(f"Не удалось получить файл {file_id} после {max_attempts} попыток")
 
-async def get_thread_lock(dialog_key: str) -> asyncio.Lock:
-    return _thread_locks[dialog_key]
-
 load_dotenv(find_dotenv())
 OPENAI_API_KEY: str | None = os.getenv("GPT_TOKEN") or os.getenv("OPENAI_API_KEY")
 DEFAULT_IMAGE_MODEL = "gpt-image-1"
 DEFAULT_IMAGE_SIZE = "1024x1024"
+VECTOR_STORE_SCOPE = "responses"    # один Vector Store на пользователя (строка манифеста vector_store_files)
 
 UNSUPPORTED_FOR_GPT_IMAGE = {"response_format", "style"}
 
@@ -104,7 +112,7 @@ class GPTResponses:  # API через /v1/responses
             *,
             with_audio_transcription: bool = False,
             text: str | None = None,
-            image_bytes: Sequence[io.BytesIO] | None = None,
+            image_bytes: Sequence[MediaBuffer | io.BytesIO] | None = None,
             document_bytes: Sequence[Tuple[io.BytesIO, str, str]] | None = None,
             # (buf, filename, mime_ext) — mime_ext игнорим
             document_type: str | None = None,
@@ -150,25 +158,10 @@ class GPTResponses:  # API через /v1/responses
                     audio_bytes=audio_bytes,
                 )
 
-                # 2) Если есть документы — создаём временный Vector Store и грузим файлы прямо в него
+                # 2) Если есть документы — кладём их в Vector Store пользователя (по манифесту: без повторных загрузок)
                 vector_store_id = None
                 if document_bytes:
-                    vs = await self.client.vector_stores.create(
-                        name=f"vs-user-{user_id}",
-                        expires_after={"anchor": "last_active_at", "days": 1},  # авто-очистка
-                    )
-                    vector_store_id = vs.id
-
-                    files_payload: list[tuple[str, io.BytesIO]] = []
-                    for (doc_io, file_name, _mime_ext) in document_bytes:
-                        doc_io.seek(0)
-                        files_payload.append((file_name, doc_io))
-
-                    # официальный путь: батч-аплоад + подождать индексацию
-                    await self.client.vector_stores.file_batches.upload_and_poll(
-                        vector_store_id=vector_store_id,
-                        files=files_payload,
-                    )
+                    vector_store_id = await self._sync_vector_store(user_id, document_bytes)
 
                 # 3) Формируем tools. Если есть VS — подключаем file_search с vector_store_ids прямо в элементе инструмента
                 tools: list[dict] = [{"type": "web_search"}]
@@ -235,10 +228,11 @@ class GPTResponses:  # API через /v1/responses
                 # 7) Цикл инструментов — важно сохранить те же tools (чтобы file_search оставался доступен)
                 delete_message = None
                 self._followup_tools = tools
+                quota = await load_quota(user.user_id)
                 resp, tool_side_effects = await self._tool_call_loop(
                     first_response=resp,
                     user=user,
-                    max_photo_generations=await self._get_remaining_generations(user),
+                    quota=quota,
                 )
 
                 # 8) Сохраняем last_response_id (уже новый, т.к. могли порвать контекст выше)
@@ -276,7 +270,7 @@ class GPTResponses:  # API через /v1/responses
                         await delete_message.delete()
                     imgs = tool_side_effects["final_images"]
                     if imgs:
-                        await self._consume_generations(user, count=len(imgs))
+                        await consume_generations(quota, count=len(imgs))
                         final_text = self._extract_text(resp) or "Сгенерировал изображение"
                         final_content["text"] = sanitize_with_links(final_text)
                         final_content["image_files"] = imgs
@@ -375,24 +369,24 @@ class GPTResponses:  # API через /v1/responses
         Грузим файл в Files API корректно для блоков input_file.
         Сначала пробуем с purpose='user_data' (рекомендовано в срочных доках),
         если SDK/аккаунт ругнётся — фоллбек на 'assistants'.
-        Возвращает file_id.
+        Возвращает file_id. Повторно присланный тот же файл заново не загружается.
         """
-        file_obj.seek(0)
         try:
-            up = await self.client.files.create(file=(filename, file_obj, mime), purpose="user_data")
-            return up.id
+            return await openai_file_cache.upload(self.client, file_obj, filename=filename, mime=mime,
+                                                  purpose="user_data")
         except BadRequestError:
             # фоллбек на старый purpose
-            up = await self.client.files.create(file=(filename, file_obj, mime), purpose="assistants")
-            return up.id
+            return await openai_file_cache.upload(self.client, file_obj, filename=filename, mime=mime,
+                                                  purpose="assistants")
 
     async def _tool_call_loop(
         self,
         *,
         first_response,
         user: Users,
-        max_photo_generations: int | None,
+        quota: TurnQuota,
     ):
+        from settings import logger
         main_bot = get_current_bot()
 
         delete_message = None
@@ -418,68 +412,38 @@ class GPTResponses:  # API через /v1/responses
             for tc in tool_calls:
                 fname = getattr(tc, "name", None) or tc.get("name")
                 if fname in ("generate_image", "edit_image_only_with_peoples", "fitting_clothes"):
-                    # проверки подписок/лимитов
-                    sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user.user_id)
-                    sub_types = await type_subscriptions_repository.select_all_type_subscriptions()
-                    type_sub = await type_subscriptions_repository.get_type_subscription_by_id(type_id=sub.type_subscription_id) if sub else None
-                    if sub is None or (type_sub and type_sub.plan_name == "Free"):
-                        from settings import sub_text
-                        await main_bot.send_message(
-                            chat_id=user.user_id,
-                            text="🚨К сожалению, данная функция доступна только по подписке\n\n" + sub_text,
-                            reply_markup=subscriptions_keyboard(sub_types).as_markup(),
-                        )
-                        raise NoSubscription("No active subscription")
+                    # проверки подписок/лимитов; примерка генерации не списывает
+                    await require_tool_access(quota, metered=fname != "fitting_clothes")
                     if fname != "fitting_clothes":
-                        if sub.photo_generations <= 0:
-                            generations_packets = await generations_packets_repository.select_all_generations_packets()
-                            from settings import buy_generations_text
-                            await main_bot.send_message(
-                                chat_id=user.user_id,
-                                text=buy_generations_text,
-                                reply_markup=more_generations_keyboard(generations_packets).as_markup(),
-                            )
-                            raise NoGenerations("No generations left")
-                        delete_message = await main_bot.send_message(chat_id=user.user_id, text="🎨Начал работу над изображением, немного магии…")
+                        delete_message = await get_sender(main_bot).send_message(user.user_id, "🎨Начал работу над изображением, немного магии…")
                 elif fname == "add_notification":
-                    delete_message = await main_bot.send_message(chat_id=user.user_id, text="🖌Начал настраивать напоминание, это не займет много времени...")
+                    delete_message = await get_sender(main_bot).send_message(user.user_id, "🖌Начал настраивать напоминание, это не займет много времени...")
                 elif fname == "search_web":
                     # в Responses API встроенный web_search, ваш кастом удалён; этот кейс может не прийти
-                    delete_message = await main_bot.send_message(chat_id=user.user_id, text="🔍Начал поиск в интернете, анализирую страницы...")
-
-            # Выполняем вызовы
+                    delete_message = await get_sender(main_bot).send_message(user.user_id, "🔍Начал поиск в интернете, анализирую страницы...")
+
+            # Выполняем вызовы: независимые инструменты — параллельно (с лимитом на пользователя)
+            # встроенные web_search/file_search обрабатываются платформой — их пропускаем
+            calls = [self._split_tool_call(tc) for tc in tool_calls]
+            calls = [(name, call_id, args) for name, call_id, args in calls if name in custom_names]
+            results = await tool_executor.run(user.user_id, [
+                (name, lambda name=name, args=args: self._run_tool(user, name, args, quota.generations_left))
+                for name, _, args in calls
+            ])
             tool_results: List[dict] = []
-            images_counter = 0
-            for tc in tool_calls:
-                name, call_id, args = self._split_tool_call(tc)
-                result_payload = None
-                if name not in custom_names:
-                    # можно просто пропустить или залогировать
-                    # встроенные web_search/file_search обрабатываются платформой
-                    continue
-                if name == "add_notification":
-                    result_payload = {"text": await self._handle_add_notification(user.user_id, args)}
-                    notif_answer = result_payload["text"]
-                elif name in ("generate_image", "edit_image_only_with_peoples"):
-                    imgs = await self._handle_image_tools(user_id=user.user_id, name=name, args=args, max_photo_generations=max_photo_generations)
-                    if isinstance(imgs, list) and imgs:
-                        final_images.extend(imgs)
-                        images_counter += len(imgs)
-                    result_payload = {"file_ids": await self._upload_images_as_files(imgs)}
-                elif name == "fitting_clothes":
-                    msg = await self._handle_fitting_clothes(user_id=user.user_id, args=args)
-                    if isinstance(msg, str):
-                        result_payload = {"text": msg}
-                    else:
-                        final_images.extend(msg)
-                        result_payload = {"file_ids": await self._upload_images_as_files(msg)}
-                elif name == "search_web":
-                    # оставлено для совместимости; фактически web_search встроен в модель
-                    result_payload = {"text": "Поиск выполнен встроенным инструментом web_search"}
-                    web_answer = "Поиск выполнен встроенным инструментом web_search"
+            for (name, call_id, _), result in zip(calls, results):
+                if isinstance(result, (NoSubscription, NoGenerations)):
+                    raise result
+                if isinstance(result, BaseException):
+                    logger.log("GPT_ERROR", f"{user.user_id} | Ошибка инструмента {name}: {result!r}")
+                    result_payload = {"status": "error", "text": str(result)}
                 else:
-                    # неизвестный tool — игнор
-                    result_payload = {"text": "ignored"}
+                    result_payload, images = result
+                    final_images.extend(images)
+                    if name == "add_notification":
+                        notif_answer = result_payload["text"]
+                    elif name == "search_web":
+                        web_answer = result_payload["text"]
 
                 tool_results.append({
                     "type": "function_call_output",
@@ -505,6 +469,26 @@ class GPTResponses:  # API через /v1/responses
             "notif_answer": notif_answer,
         }
 
+    async def _run_tool(self, user: Users, name: str, args: dict,
+                        max_photo_generations: int | None) -> Tuple[dict, List[bytes]]:
+        """:return: (результат для модели, картинки для пользователя)"""
+        if name == "add_notification":
+            return {"text": await self._handle_add_notification(user.user_id, args)}, []
+        if name in ("generate_image", "edit_image_only_with_peoples"):
+            imgs = await self._handle_image_tools(user_id=user.user_id, name=name, args=args, max_photo_generations=max_photo_generations)
+            imgs = imgs if isinstance(imgs, list) else []
+            return {"file_ids": await self._upload_images_as_files(imgs)}, imgs
+        if name == "fitting_clothes":
+            msg = await self._handle_fitting_clothes(user_id=user.user_id, args=args)
+            if isinstance(msg, str):
+                return {"text": msg}, []
+            return {"file_ids": await self._upload_images_as_files(msg)}, msg
+        if name == "search_web":
+            # оставлено для совместимости; фактически web_search встроен в модель
+            return {"text": "Поиск выполнен встроенным инструментом web_search"}, []
+        # неизвестный tool — игнор
+        return {"text": "ignored"}, []
+
     def _custom_function_names(self) -> set[str]:
         from settings import tools as settings_tools
         return {t["name"] for t in settings_tools}
@@ -534,18 +518,8 @@ class GPTResponses:  # API через /v1/responses
         return calls
 
     def _split_tool_call(self, tc: dict) -> Tuple[str, str, dict]:
-        name = tc.get("name") or ""
-        call_id = tc.get("call_id") or ""
-        raw = tc.get("arguments")
-        if isinstance(raw, dict):
-            args = raw
-        else:
-            try:
-                args = json.loads(raw or "{}")
-            except json.JSONDecodeError:
-                first_obj = (raw or "").split('}', 1)[0] + '}'
-                args = json.loads(first_obj)
-        return name, call_id, args
+        name, args, call_id = parse_tool_call(tc)
+        return name or "", call_id or "", args
 
     def _extract_text(self, resp) -> Optional[str]:
         # Responses API: итоговый текст лежит в output как message-блок(и)
@@ -595,7 +569,7 @@ class GPTResponses:  # API через /v1/responses
             self,
             *,
             base_text: str,
-            image_bytes: Sequence[io.BytesIO] | None,
+            image_bytes: Sequence[MediaBuffer | io.BytesIO] | None,
             document_bytes: Sequence[Tuple[io.BytesIO, str, str]] | None,
             audio_bytes: io.BytesIO | None,
     ) -> Tuple[List[dict], List[str], List[str]]:
@@ -609,14 +583,12 @@ class GPTResponses:  # API через /v1/responses
         file_ids: List[str] = []
         image_file_ids: List[str] = []
 
-        # 1) картинки — без изменений
+        # 1) картинки — data URL из буфера без копий, base64 считается один раз на буфер
         if image_bytes:
-            for img_io in image_bytes:
-                img_io.seek(0)
-                b64 = base64.b64encode(img_io.read()).decode("utf-8")
+            for img in map(as_media, image_bytes):
                 content.append({
                     "type": "input_image",
-                    "image_url": f"data:image/png;base64,{b64}",
+                    "image_url": img.data_url(img.mime or "image/png"),
                 })
 
         # 2) текст
@@ -627,12 +599,8 @@ class GPTResponses:  # API через /v1/responses
         if document_bytes:
             for (doc_io, file_name, _mime_ext) in document_bytes:
                 # MIME можно не указывать — SDK сам проставит; если хочешь — можно угадать из имени
-                doc_io.seek(0)
-                up = await self.client.files.create(
-                    file=(file_name, doc_io),
-                    purpose="assistants",
-                )
-                file_ids.append(up.id)
+                file_ids.append(await openai_file_cache.upload(self.client, doc_io, filename=file_name,
+                                                               purpose="assistants"))
 
         # лимит контента
         if len(content) > 12:
@@ -642,37 +610,31 @@ class GPTResponses:  # API через /v1/responses
 
     # --------------------- vector store / file_search ---------------------
 
-    async def _sync_vector_store(self, file_ids: List[str]) -> str:
+    async def _sync_vector_store(self, user_id: int, document_bytes: Sequence[Tuple[io.BytesIO, str, str]]) -> str:
         """
-        Кладём file_ids в Vector Store и ждём, пока батч проиндексируется.
-        Возвращаем vector_store_id.
+        Приводит Vector Store пользователя к набору присланных документов и ждёт индексации.
+        Те же документы повторно не загружаются и не индексируются; хранилище живёт сутки
+        с последнего использования, истёкшее создаётся заново. Возвращаем vector_store_id.
         """
-        # создаём/переиспользуем общий VS
-        if not self.vector_store_id:
-            vs = await self.client.vector_stores.create(name="vs-responses")
-            self.vector_store_id = vs.id
-
-        if not file_ids:
-            return self.vector_store_id
-
-        # создаём батч из уже загруженных в Files API файлов
-        batch = await self.client.vector_stores.file_batches.create(
-            vector_store_id=self.vector_store_id,
-            file_ids=file_ids,
+        documents = await vector_store_manifest.upload_documents(
+            self.client, user_id=user_id, scope=VECTOR_STORE_SCOPE, document_bytes=document_bytes,
         )
+        rows = await vector_store_files_repository.get_files(user_id=user_id, scope=VECTOR_STORE_SCOPE)
+        if rows:
+            try:
+                await vector_store_manifest.sync(self.client, user_id=user_id, scope=VECTOR_STORE_SCOPE,
+                                                 vector_store_id=rows[0].vector_store_id, documents=documents)
+                return rows[0].vector_store_id
+            except NotFoundError:
+                pass  # хранилище истекло — манифест уже очищен, создаём новое
 
-        # ждём завершения индексации батча
-        # статус: "in_progress" -> "completed" | "failed" | "cancelled"
-        while True:
-            b = await self.client.vector_stores.file_batches.retrieve(
-                vector_store_id=self.vector_store_id,
-                batch_id=batch.id,
-            )
-            if getattr(b, "status", None) in ("completed", "failed", "cancelled"):
-                break
-            await asyncio.sleep(0.5)
-
-        return self.vector_store_id
+        vs = await self.client.vector_stores.create(
+            name=f"vs-user-{user_id}",
+            expires_after={"anchor": "last_active_at", "days": 1},  # авто-очистка
+        )
+        await vector_store_manifest.sync(self.client, user_id=user_id, scope=VECTOR_STORE_SCOPE,
+                                         vector_store_id=vs.id, documents=documents)
+        return vs.id
 
     # --------------------- tool handlers ---------------------
 
@@ -705,15 +667,7 @@ class GPTResponses:  # API через /v1/responses
         user = await users_repository.get_user_by_user_id(user_id=user_id)
         photo_bytes = []
         if user.last_image_id:
-            for pid in user.last_image_id.split(", "):
-                main_bot = get_current_bot()
-                buf = io.BytesIO()
-                try:
-                    await main_bot.download(pid, destination=buf)
-                    buf.seek(0)
-                    photo_bytes.append(buf.read())
-                except:
-                    pass
+            photo_bytes = await media_fetcher.fetch_many(get_current_bot(), user.last_image_id.split(", "), skip_errors=True)
 
         if name == "generate_image":
             try:
@@ -741,6 +695,8 @@ class GPTResponses:  # API через /v1/responses
                     return []
                 return [await generate_image_bytes(prompt=args.get("prompt"), ratio=args.get("ratio"),
                                                    images=photo_bytes if len(photo_bytes) <= 3 else photo_bytes[:3])]
+            except ProviderUnavailableError as e:
+                return e.user_message
             except:
                 from settings import logger
                 logger.log("GPT_ERROR", f"{user_id} | Ошибка edit_image_only_with_peoples: {traceback.format_exc()}")
@@ -757,15 +713,7 @@ class GPTResponses:  # API через /v1/responses
         user = await users_repository.get_user_by_user_id(user_id=user_id)
         photos = []
         if user.last_image_id:
-            for pid in user.last_image_id.split(", "):
-                main_bot = get_current_bot()
-                buf = io.BytesIO()
-                try:
-                    await main_bot.download(pid, destination=buf)
-                    buf.seek(0)
-                    photos.append(buf.read())
-                except:
-                    pass
+            photos = await media_fetcher.fetch_many(get_current_bot(), user.last_image_id.split(", "), skip_errors=True)
 
         if len(photos) != 2:
             return "Дорогой друг, пришли фото человека и фото одежды для примерки одним сообщением! Ровно две фотографии!"
@@ -783,6 +731,8 @@ class GPTResponses:  # API через /v1/responses
                 validate=False,
             )
             return [result_bytes]
+        except ProviderUnavailableError as e:
+            return e.user_message
         except Exception:
             return []
         finally:
@@ -794,44 +744,25 @@ class GPTResponses:  # API через /v1/responses
     async def _upload_images_as_files(self, images: List[bytes]) -> List[str]:
         file_ids: List[str] = []
         for idx, img in enumerate(images or []):
-            f = await self.client.files.create(file=(f"result_{idx}.png", io.BytesIO(img), "image/png"), purpose="vision")
-            file_ids.append(f.id)
+            file_ids.append(await openai_file_cache.upload(self.client, img, filename=f"result_{idx}.png",
+                                                           mime="image/png", purpose="vision"))
         return file_ids
 
-    async def _get_remaining_generations(self, user: Users) -> Optional[int]:
-        sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user.user_id)
-        return (sub.photo_generations if sub else None)
-
-    async def _consume_generations(self, user: Users, count: int):
-        sub = await subscriptions_repository.get_active_subscription_by_user_id(user_id=user.user_id)
-        if sub:
-            await subscriptions_repository.use_generation(subscription_id=sub.id, count=count)
+    async def clear_history(self, user_id: int) -> None:
+        """Контекст живёт у OpenAI цепочкой previous_response_id — просто начинаем новую"""
+        await users_repository.update_last_response_id_by_user_id(user_id=user_id, last_response_id=None)
 
     # --------------------- TTS / ASR ---------------------
 
     @staticmethod
-    async def generate_audio_by_text(text: str) -> io.BytesIO:
-        url = "https://api.openai.com/v1/audio/speech"
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-        payload = {"model": "gpt-4o-mini-tts", "input": text, "voice": "shimmer", "instructions": "Speak dramatic", "response_format": "mp3"}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload, timeout=30) as r:
-                if r.status == 200:
-                    return io.BytesIO(await r.read())
-                raise RuntimeError(f"TTS error {r.status}: {await r.text()}")
+    async def generate_audio_by_text(text: str) -> SpeechInputFile:
+        """TTS-озвучка ответа: файл, который при отправке в Telegram потоком читается из /audio/speech"""
+        return audio_pipeline.speech_file(text)
 
     @staticmethod
     async def transcribe_audio(audio_bytes: io.BytesIO, language: str = "ru") -> str:
-        url = "https://api.openai.com/v1/audio/transcriptions"
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-        audio_bytes.name = "audio.mp3"
-        data = {"file": audio_bytes, "model": "whisper-1", "language": language}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=data, timeout=60) as r:
-                if r.status == 200:
-                    j = await r.json()
-                    return j.get("text", "")
-                raise RuntimeError(f"Transcription error {r.status}: {await r.text()}")
+        """Возвращает текстовую расшифровку аудио через Whisper."""
+        return await audio_pipeline.transcribe(audio_bytes, language)
 
     # --------------------- maintenance ---------------------
 
@@ -0,0 +1,122 @@
+import asyncio
+from collections import OrderedDict
+from typing import Any, Iterator
+
+# run_tracker.py — локальное состояние run'ов Assistants API по thread'ам
+#
+# GPT сам создаёт все run'ы своих thread'ов и получает их статусы из стрима событий,
+# поэтому «есть ли в thread активный run» известно без runs.list перед каждым сообщением.
+# Сервер спрашиваем, только если thread ещё не видели в этом процессе
+# или API ответил «already has an active run» (локальное состояние разошлось).
+
+ACTIVE_STATUSES = frozenset({"queued", "in_progress", "requires_action", "cancelling"})
+TERMINAL_STATUSES = frozenset({"completed", "failed", "cancelled", "expired", "incomplete"})
+MAX_KNOWN_THREADS = 50_000
+
+
+def backoff_delays(initial: float = 0.25, maximum: float = 4.0, factor: float = 2.0) -> Iterator[float]:
+    """Паузы для оставшихся опросов: initial, initial*factor, ... но не больше maximum"""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(maximum, delay * factor)
+
+
+class RunTracker:
+    """
+    Статусы run'ов по thread'ам: активные run'ы и событие «thread свободен» на каждый thread.
+    Known-thread — thread, состояние которого достоверно (создавали в нём run'ы или один раз сверились с API).
+    """
+
+    def __init__(self, max_known_threads: int = MAX_KNOWN_THREADS):
+        self.max_known_threads = max_known_threads
+        self._known: OrderedDict[str, None] = OrderedDict()
+        self._active: dict[str, dict[str, str]] = {}
+        self._idle: dict[str, asyncio.Event] = {}
+        self.stats = {"events": 0, "observed": 0, "local_hits": 0, "list_calls": 0, "polls": 0,
+                      "skipped_cancels": 0}
+
+    def _remember(self, thread_id: str) -> None:
+        self._known[thread_id] = None
+        self._known.move_to_end(thread_id)
+        while len(self._known) > self.max_known_threads:
+            old, _ = self._known.popitem(last=False)
+            if old not in self._active:
+                self._idle.pop(old, None)
+
+    def _idle_event(self, thread_id: str) -> asyncio.Event:
+        event = self._idle.get(thread_id)
+        if event is None:
+            event = self._idle[thread_id] = asyncio.Event()
+            if not self._active.get(thread_id):
+                event.set()
+        return event
+
+    def observe(self, run: Any) -> None:
+        """Учитывает свежий объект Run (из create/retrieve/cancel/стрима)"""
+        thread_id = getattr(run, "thread_id", None)
+        run_id = getattr(run, "id", None)
+        status = getattr(run, "status", None)
+        if not thread_id or not run_id or not status:
+            return
+        self.stats["observed"] += 1
+        self._remember(thread_id)
+        runs = self._active.setdefault(thread_id, {})
+        if status in ACTIVE_STATUSES:
+            runs[run_id] = status
+            self._idle_event(thread_id).clear()
+        else:
+            runs.pop(run_id, None)
+        if not runs:
+            del self._active[thread_id]
+            self._idle_event(thread_id).set()
+
+    def on_event(self, event: Any) -> Any | None:
+        """Событие стрима: статусы run'а учитываем, остальное игнорируем. Возвращает Run, если событие про него"""
+        data = getattr(event, "data", None)
+        if getattr(data, "object", None) != "thread.run":
+            return None
+        self.stats["events"] += 1
+        self.observe(data)
+        return data
+
+    def seed(self, thread_id: str, runs: list[Any]) -> None:
+        """Сверка с runs.list: заменяет локальное состояние thread'а серверным"""
+        self.stats["list_calls"] += 1
+        self._active.pop(thread_id, None)
+        self._remember(thread_id)
+        self._idle_event(thread_id).set()
+        for run in runs:
+            if getattr(run, "status", None) in ACTIVE_STATUSES:
+                self.observe(run)
+
+    def forget(self, thread_id: str) -> None:
+        """Состояние thread'а больше не достоверно — при следующем ожидании сверимся с API"""
+        self._known.pop(thread_id, None)
+
+    def is_known(self, thread_id: str) -> bool:
+        return thread_id in self._known
+
+    def is_idle(self, thread_id: str) -> bool:
+        return not self._active.get(thread_id)
+
+    def active_run_ids(self, thread_id: str) -> list[str]:
+        return list(self._active.get(thread_id, ()))
+
+    def may_be_active(self, thread_id: str, run_id: str) -> bool:
+        """False, только если точно известно, что run уже завершён"""
+        return not self.is_known(thread_id) or run_id in self._active.get(thread_id, ())
+
+    async def wait_idle(self, thread_id: str, timeout: float) -> bool:
+        """Ждёт, пока в thread не останется активных run'ов; True — дождались"""
+        try:
+            await asyncio.wait_for(self._idle_event(thread_id).wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "known_threads": len(self._known), "busy_threads": len(self._active)}
+
+
+run_tracker = RunTracker()
@@ -224,15 +224,12 @@ from __future__ import annotations
 import asyncio
 import base64
 import logging
-import math
 import os
 import random
 import traceback
-from io import BytesIO
 from typing import Optional, Sequence
 
 import aiohttp
-from PIL import Image, ImageOps
 from runwayml import (
     AsyncRunwayML,
     APIStatusError,        # 4xx/5xx HTTP
@@ -241,14 +238,30 @@ from runwayml import (
     DefaultAsyncHttpxClient,
 )
 
+from utils.image_processing import image_processor, prepare_runway_ref
+from utils.resilience import CircuitBreaker, Outcome, get_guard, time_left
+
 # ----------------------- Конфигурация клиента и логирование -----------------------
 RUNWAY_KEY = os.getenv("RUNWAY_KEY")
 client = AsyncRunwayML(
     api_key=RUNWAY_KEY,
     http_client=DefaultAsyncHttpxClient(),  # официальный async backend (httpx)
     timeout=60.0,       # SDK поддерживает timeouts
-    max_retries=2,      # и базовые ретраи на уровне клиента
+    max_retries=0,      # ретраи делает runway_guard, с общим бюджетом и автоматом защиты
 )
+runway_guard = get_guard("runway", breaker=CircuitBreaker("runway", reset_timeout=30.0), rate_limit_delay=4.0)
+
+
+def _classify_runway_error(error: BaseException) -> Outcome:
+    """Ретраим только 429/сетевые/5xx, как рекомендует Runway"""
+    if isinstance(error, RateLimitError):
+        return Outcome.RATE_LIMITED
+    if isinstance(error, (APIConnectionError, asyncio.TimeoutError)):
+        return Outcome.RETRY
+    if isinstance(error, APIStatusError) and error.status_code >= 500:
+        return Outcome.RETRY
+    # 4xx — обычно ошибка входных данных/модерация и ретрай не поможет
+    return Outcome.FATAL
 
 # ----------------------- Утилиты для изображений -----------------------
 MIN_AR, MAX_AR, MAX_SIDE = 0.5, 2.0, 8000  # рекомендации по AR/пикселям
@@ -292,44 +305,8 @@ MIN_AR, MAX_AR = 0.5, 2.0          # требования Runway
 MAX_SIDE       = 8000              # px – лимит Runway
 
 def prepare_ref(raw: bytes) -> bytes:
-    img = Image.open(BytesIO(raw)).convert("RGB")
-    w, h = img.size
-    ar   = w / h
-
-    # ограничение максимального разрешения
-    if max(w, h) > MAX_SIDE:
-        scale = MAX_SIDE / max(w, h)
-        img   = img.resize((int(w*scale), int(h*scale)), Image.LANCZOS)
-        w, h  = img.size
-        ar    = w / h
-
-    # паддинг до MIN_AR (строго > MIN_AR)
-    if ar <= MIN_AR:
-        # new_width > h * MIN_AR
-        new_w = math.floor(h * MIN_AR) + 1
-        total_pad = new_w - w
-        pad_left  = total_pad // 2
-        pad_right = total_pad - pad_left
-        img = ImageOps.expand(img, (pad_left, 0, pad_right, 0), fill=(0,0,0))
-
-    # паддинг до MAX_AR (строго < MAX_AR)
-    elif ar >= MAX_AR:
-        # new_height > w / MAX_AR
-        new_h = math.floor(w / MAX_AR) + 1
-        total_pad = new_h - h
-        pad_top    = total_pad // 2
-        pad_bottom = total_pad - pad_top
-        img = ImageOps.expand(img, (0, pad_top, 0, pad_bottom), fill=(0,0,0))
-
-    # проверяем, что соотношение теперь в допустимом «открытом» промежутке
-    w2, h2 = img.size
-    ar2    = w2 / h2
-    assert MIN_AR < ar2 < MAX_AR, f"AR всё ещё вне диапазона: {ar2:.3f}"
-
-    # сохраняем в JPEG ≤95 качества
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=95)
-    return buf.getvalue()
+    """Синхронный вариант для скриптов; в боте референсы готовит image_processor в пуле процессов"""
+    return prepare_runway_ref(raw, MAX_SIDE)
 
 # ----------------------- Исключение с понятной причиной FAIL -----------------------
 class RunwayTaskFailed(RuntimeError):
@@ -401,112 +378,95 @@ async def generate_image_bytes(
 
     refs = None
     if images:
-        refs = [{"uri": _to_data_uri(prepare_ref(b)), "tag": f"ref{i}"} for i, b in enumerate(images)]
+        uris = await image_processor.runway_ref_data_uris(images)
+        refs = [{"uri": uri, "tag": f"ref{i}"} for i, uri in enumerate(uris)]
 
     TERMINAL_OK = {"SUCCEEDED"}
     TERMINAL_FAIL = {"FAILED", "CANCELED", "REJECTED"}
 
-    attempt = 0
-    while True:
-        attempt += 1
-        try:
-            # 1) Создать задачу
-            task = await client.text_to_image.create(
+    # 1) Создать задачу; повторы, автомат защиты и дедлайн хендлера — в общем ProviderGuard
+    try:
+        task = await runway_guard.call(
+            lambda: client.text_to_image.create(
                 model="gen4_image",
                 ratio=ratio,
                 prompt_text=prompt,
                 reference_images=refs,
                 content_moderation={"publicFigureThreshold": "auto"},
-            )
-            task_id = task.id
-            logger.info("Runway task created: %s", task_id)
+            ),
+            classify=_classify_runway_error,
+            max_attempts=max_retries + 1,
+        )
+    except APIStatusError:
+        logger.log("GPT_ERROR", traceback.format_exc())
+        raise
+    task_id = task.id
+    logger.info("Runway task created: %s", task_id)
+
+    # 2) Ждать завершения (ручной поллинг, т.к. в Python SDK нет wait_for_task_output)
+    loop = asyncio.get_running_loop()
+    remaining = time_left()
+    deadline = loop.time() + (timeout if remaining is None else min(timeout, remaining))
+    interval = poll_interval
+    last_code: Optional[str] = None
+    last_msg: Optional[str] = None
 
-            # 2) Ждать завершения (ручной поллинг, т.к. в Python SDK нет wait_for_task_output)
-            loop = asyncio.get_running_loop()
-            deadline = loop.time() + timeout
-            interval = poll_interval
-            last_code: Optional[str] = None
-            last_msg: Optional[str] = None
-
-            while True:
-                cur = await client.tasks.retrieve(task_id)
-                status = (cur.status or "").upper()
-                code, msg = _extract_failure(cur)
-                if code or msg:
-                    last_code, last_msg = code, msg
-
-                if status in TERMINAL_OK:
-                    break
-                if status in TERMINAL_FAIL:
-                    raise RunwayTaskFailed(status=status, code=last_code, message=last_msg)
-
-                if loop.time() > deadline:
-                    raise TimeoutError(f"Generation exceeded time limit ({int(timeout)}s)")
-
-                # возможны подсказки по троттлингу внутри metadata
-                retry_after = None
-                meta = getattr(cur, "metadata", None) or {}
-                if isinstance(meta, dict):
-                    for key in ("retry_after", "retryAfter", "retryAfterSec",
-                                "retry_after_sec", "throttle_seconds", "cooldown"):
-                        if key in meta:
-                            retry_after = meta[key]
-                            break
-
-                if status in {"THROTTLED", "RATE_LIMITED"}:
-                    cool = float(retry_after) if retry_after else 18.0
-                    cool += random.uniform(0.0, 2.0)
-                    await asyncio.sleep(min(cool, max(0.0, deadline - loop.time())))
-                    interval = max(poll_interval, min(interval, 2.0))
-                else:
-                    await asyncio.sleep(min(interval, max(0.0, deadline - loop.time())))
-                    interval = min(max_poll_interval, interval * 1.5) + random.uniform(0.0, 0.25)
-
-            # 3) Получить результат и скачать сразу (URL эфемерный)
-            if not cur.output or not isinstance(cur.output, (list, tuple)) or not cur.output[0]:
-                raise RuntimeError("Empty output from Runway (no URL)")
-
-            url = cur.output[0]
-            timeout_dl = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout_dl) as s:
-                async with s.get(url) as r:
-                    r.raise_for_status()
-                    data = await r.read()
-            return data
-
-        # ----------------------- Ретраим только то, что имеет смысл -----------------------
-        except RateLimitError as e:
-            if attempt <= max_retries:
-                # экспоненциальный бэкофф с джиттером
-                sleep_s = min(60.0, (2 ** attempt) + random.uniform(0, 0.5 * (2 ** attempt)))
-                logger.warning("429/Throttle at create: sleep %.1fs (attempt %d/%d)", sleep_s, attempt, max_retries + 1)
-                await asyncio.sleep(sleep_s)
-                continue
-            raise
-
-        except APIConnectionError as e:
-            if attempt <= max_retries:
-                sleep_s = 1.0 + 0.75 * attempt + random.random()
-                logger.warning("APIConnectionError: %s. Retry in %.2fs", e, sleep_s)
-                await asyncio.sleep(sleep_s)
-                continue
-            raise
-
-        except APIStatusError as e:
-            logger.log("GPT_ERROR",
-                       traceback.format_exc() + '\n\n\n\n' + f'APIStatusError %s:'
-                                                                          f' %s{getattr(e, "status_code", "?")}, {getattr(e, "response", None)}')
-            # 5xx — можно ретраить; 4xx — обычно ошибка входных данных/модерация и ретрай не поможет
-            if getattr(e, "status_code", 0) >= 500 and attempt <= max_retries:
-                sleep_s = 1.25 * attempt + random.random()
-                await asyncio.sleep(sleep_s)
-                continue
-            raise
-
-        except RunwayTaskFailed as e:
-            human = format_failure_human(e.status, e.code, e.message)
+    while True:
+        # опрос — не новый вызов провайдера: автомат и бюджет повторов runway_guard его не видят,
+        # ограничивает только дедлайн. Сетевой сбой на опросе — просто следующий опрос
+        try:
+            cur = await asyncio.wait_for(client.tasks.retrieve(task_id),
+                                         timeout=max(0.0, deadline - loop.time()))
+        except Exception as e:
+            if _classify_runway_error(e) is Outcome.FATAL:
+                raise
+            if loop.time() > deadline:
+                raise TimeoutError(f"Generation exceeded time limit ({int(timeout)}s)") from e
+            logger.warning("Runway poll failed for %s: %r", task_id, e)
+            await asyncio.sleep(min(interval, max(0.0, deadline - loop.time())))
+            interval = min(max_poll_interval, interval * 1.5) + random.uniform(0.0, 0.25)
+            continue
+        status = (cur.status or "").upper()
+        code, msg = _extract_failure(cur)
+        if code or msg:
+            last_code, last_msg = code, msg
+
+        if status in TERMINAL_OK:
+            break
+        if status in TERMINAL_FAIL:
+            human = format_failure_human(status, last_code, last_msg)
             logger.error("RunwayTaskFailed: %s", human)
+            raise RunwayTaskFailed(status, last_code, human)
+
+        if loop.time() > deadline:
+            raise TimeoutError(f"Generation exceeded time limit ({int(timeout)}s)")
+
+        # возможны подсказки по троттлингу внутри metadata
+        retry_after = None
+        meta = getattr(cur, "metadata", None) or {}
+        if isinstance(meta, dict):
+            for key in ("retry_after", "retryAfter", "retryAfterSec",
+                        "retry_after_sec", "throttle_seconds", "cooldown"):
+                if key in meta:
+                    retry_after = meta[key]
+                    break
 
-            # 1) если хотите возвращать читабельную причину наверх — пробрасываем
-            #    то же исключение, но с расширенным сообщением:
-            raise RunwayTaskFailed(e.status, e.code, human)
+        if status in {"THROTTLED", "RATE_LIMITED"}:
+            cool = float(retry_after) if retry_after else 18.0
+            cool += random.uniform(0.0, 2.0)
+            await asyncio.sleep(min(cool, max(0.0, deadline - loop.time())))
+            interval = max(poll_interval, min(interval, 2.0))
+        else:
+            await asyncio.sleep(min(interval, max(0.0, deadline - loop.time())))
+            interval = min(max_poll_interval, interval * 1.5) + random.uniform(0.0, 0.25)
+
+    # 3) Получить результат и скачать сразу (URL эфемерный)
+    if not cur.output or not isinstance(cur.output, (list, tuple)) or not cur.output[0]:
+        raise RuntimeError("Empty output from Runway (no URL)")
+
+    url = cur.output[0]
+    timeout_dl = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(timeout=timeout_dl) as s:
+        async with s.get(url) as r:
+            r.raise_for_status()
+            return await r.read()
@@ -9,9 +9,14 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from db.repository import users_repository, notifications_repository, subscriptions_repository, \
     type_subscriptions_repository
 from utils.payment_for_services import create_recurring_payment
+from utils.telegram_sender import get_sender, SendPriority
 
 scheduler: AsyncIOScheduler | None = None
 
+# сколько отметок «напоминание отправлено» пишем в БД одновременно: пул соединений по умолчанию — 5 (+10 overflow),
+# а рассылка не должна выбирать его целиком у хендлеров
+NOTIF_DB_CONCURRENCY = 4
+
 import asyncio
 import traceback
 # from datetime import datetime
@@ -83,16 +88,67 @@ async def send_notif(bot: Bot):
     moscow_now_naive = moscow_now.replace(tzinfo=None)
     
     notifications = await notifications_repository.select_all_active_notifications()
-    for notif in notifications:
+    sender = get_sender(bot)
+    db_semaphore = asyncio.Semaphore(NOTIF_DB_CONCURRENCY)
+
+    async def send_one(notif):
         try:
-            # Предполагаем, что notif.when_send хранится как московское время (naive datetime)
-            # Проверяем, наступило ли время для отправки уведомления
-            if moscow_now_naive >= notif.when_send:
-                await bot.send_message(chat_id=notif.user_id, text="<b>🚨Напоминание:</b>\n\n" + notif.text_notification)
+            await sender.send_message(chat_id=notif.user_id,
+                                      text="<b>🚨Напоминание:</b>\n\n" + notif.text_notification,
+                                      priority=SendPriority.REMINDER)
+            async with db_semaphore:
                 await notifications_repository.update_active_by_notification_id(notification_id=notif.id)
         except Exception:
             print(traceback.format_exc())
-            continue
+
+    # Предполагаем, что notif.when_send хранится как московское время (naive datetime)
+    # Проверяем, наступило ли время для отправки уведомления; темп отправки задаёт очередь, обращения к БД — семафор
+    await asyncio.gather(*(send_one(notif) for notif in notifications if moscow_now_naive >= notif.when_send))
+
+
+async def log_runtime_stats():
+    """Периодическая сводка по кешам и схлопыванию запросов — видно, сколько вызовов и времени сэкономили"""
+    from settings import logger
+    from utils.web_search_agent import web_search_cache
+    from utils.file_cache import file_cache
+    from utils.completions_gpt_tools import completion_single_flight
+    from utils.llm_router import llm_router
+    from utils.resilience import guards_snapshot
+    from utils.run_tracker import run_tracker
+    from utils.vector_store_manifest import vector_store_manifest
+    from utils.openai_file_cache import openai_file_cache
+    from utils.assistant_backends import assistant_router, tool_executor
+    from utils.audio_pipeline import audio_pipeline
+    from utils.transcription_cache import transcription_cache
+    from utils.tts_cache import tts_cache
+    from utils.media_registry import media_registry
+    from utils.video_relay import video_relay
+    logger.log("STATS", f"search_web cache: {web_search_cache.snapshot()}")
+    logger.log("STATS", f"chat completions: {completion_single_flight.snapshot()}")
+    logger.log("STATS", f"llm router: {llm_router.snapshot()}")
+    logger.log("STATS", f"providers: {guards_snapshot()}")
+    logger.log("STATS", f"assistant runs: {run_tracker.snapshot()}")
+    logger.log("STATS", f"vector stores: {vector_store_manifest.snapshot()}")
+    logger.log("STATS", f"openai files: {openai_file_cache.snapshot()}")
+    logger.log("STATS", f"assistant backends: {assistant_router.snapshot()}")
+    logger.log("STATS", f"tools: {tool_executor.snapshot()}")
+    logger.log("STATS", f"audio: {audio_pipeline.snapshot()}")
+    logger.log("STATS", f"transcriptions: {transcription_cache.snapshot()}")
+    logger.log("STATS", f"tts: {tts_cache.snapshot()}")
+    logger.log("STATS", f"telegram media: {media_registry.snapshot()}")
+    logger.log("STATS", f"video relay: {video_relay.snapshot()}")
+    logger.log("STATS", f"telegram file cache: {file_cache.snapshot()}")
+
+
+async def safe_prune_caches():
+    """Чистит давно не использованные записи кешей в базе"""
+    from settings import logger
+    from utils.transcription_cache import transcription_cache
+    try:
+        removed = await transcription_cache.prune()
+        logger.log("STATS", f"voice_transcriptions: удалено {removed}")
+    except:
+        logger.log("SCHEDULER_ERROR", f"safe_prune_caches error: {traceback.format_exc()}")
 
 
 async def safe_extend_users_sub(main_bot: Bot):
@@ -105,6 +161,7 @@ async def safe_extend_users_sub(main_bot: Bot):
 #
 async def extend_users_sub(main_bot: Bot):
     from settings import logger
+    sender = get_sender(main_bot)
     users_subs = await subscriptions_repository.select_all_active_subscriptions()
     now_datetime = datetime.datetime.now()
     extended_subs = 0
@@ -115,7 +172,7 @@ async def extend_users_sub(main_bot: Bot):
                 try:
                     if sub.method_id is None:
                         await subscriptions_repository.deactivate_subscription(subscription_id=sub.id)
-                        await main_bot.send_message(chat_id=sub.user_id,
+                        await sender.send_message(chat_id=sub.user_id, priority=SendPriority.REMINDER,
                                                     text="Дорогой друг, не получилось автоматически продлить твою подписку."
                                                      " Если ты видишь, что при этом у тебя"
                                                      " списались деньги - обязательно пиши нашу поддержку по команде /support")
@@ -134,18 +191,18 @@ async def extend_users_sub(main_bot: Bot):
                                                                             method_id=sub.method_id,
                                                                             photo_generations=max_generations)
 
-                        await main_bot.send_message(chat_id=sub.user_id,
+                        await sender.send_message(chat_id=sub.user_id, priority=SendPriority.REMINDER,
                                                     text="🚀Дорогой друг, твоя подписка автоматически продлена на один месяц")
                         extended_subs += 1
                     else:
                         logger.log("EXTEND_SUB_ERROR", f"payment_data - {payment.json()}")
-                        await main_bot.send_message(chat_id=sub.user_id,
+                        await sender.send_message(chat_id=sub.user_id, priority=SendPriority.REMINDER,
                                                     text="Дорогой друг, не получилось автоматически продлить твою подписку."
                                                          " Если ты видишь, что при этом у тебя"
                                                          " списались деньги - обязательно пиши нашу поддержку по команде /support")
                 except:
                     logger.log("EXTEND_SUB_ERROR", traceback.format_exc())
-                    await main_bot.send_message(chat_id=sub.user_id,
+                    await sender.send_message(chat_id=sub.user_id, priority=SendPriority.REMINDER,
                                                 text="Дорогой друг, не получилось автоматически продлить твою подписку."
                                                      " Если ты видишь, что при этом у тебя"
                                                      " списались деньги - обязательно пиши нашу поддержку по команде /support")
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import faiss
+import numpy as np
+
+# semantic_retrieval.py — локальный поиск по загруженным документам: чанки + эмбеддинги + FAISS на пользователя
+#
+# Модель эмбеддингов живёт только в процессах пула, основной процесс держит индексы и метаданные чанков.
+
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+RETRIEVAL_MODEL = os.getenv("RETRIEVAL_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "retrieval_index")
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "1"))      # каждый воркер держит свою копию модели
+RETRIEVAL_MAX_LOADED_USERS = int(os.getenv("RETRIEVAL_MAX_LOADED_USERS", "64"))
+RETRIEVAL_MAX_CHUNKS_PER_USER = 20_000
+RETRIEVAL_MAX_DOC_CHARS = 2_000_000    # больше из одного документа не извлекаем и не индексируем
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+TOP_K = 8
+
+_SPLIT_RE = re.compile(r"\n\s*\n|\n|(?<=[.!?])\s+")
+
+
+@dataclass(slots=True)
+class RetrievedChunk:
+    doc_key: str
+    file_name: str
+    position: int                 # номер чанка внутри документа
+    text: str
+    score: float
+
+
+# ---------- функции, выполняемые в процессах пула ----------
+
+_model = None
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(RETRIEVAL_MODEL, device="cpu")
+    return _model
+
+
+def split_into_chunks(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """Режет текст на куски ~chunk_chars, стараясь резать по абзацам/строкам/предложениям, с перекрытием"""
+    chunks: list[str] = []
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(start + chunk_chars, length)
+        if end < length:
+            # ищем естественную границу во второй половине окна
+            window = text[start + chunk_chars // 2:end]
+            boundaries = [m.end() for m in _SPLIT_RE.finditer(window)]
+            if boundaries:
+                end = start + chunk_chars // 2 + boundaries[-1]
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= length:
+            break
+        # перекрытие начинаем с границы слова, а не с середины
+        next_start = end - overlap
+        space = text.find(" ", next_start, end)
+        start = max(space + 1 if space != -1 else next_start, start + 1)
+    return chunks
+
+
+def _embed(texts: list[str]) -> np.ndarray:
+    vectors = _get_model().encode(texts, batch_size=32, normalize_embeddings=True, show_progress_bar=False)
+    return np.asarray(vectors, dtype="float32")
+
+
+def chunk_and_embed(text: str) -> tuple[list[str], np.ndarray]:
+    chunks = split_into_chunks(text)
+    return chunks, _embed(chunks) if chunks else np.zeros((0, 0), dtype="float32")
+
+
+def embed_query(text: str) -> np.ndarray:
+    return _embed([text])
+
+
+# ---------- индекс пользователя ----------
+
+class _UserIndex:
+    """FAISS IndexFlatIP + метаданные чанков; id вектора в индексе совпадает с номером строки в .jsonl"""
+
+    def __init__(self, index, chunks: list[dict], writable: bool):
+        self.index = index
+        self.chunks = chunks
+        self.writable = writable
+        self.doc_keys = {chunk["doc"] for chunk in chunks}
+
+
+def _pool_context():
+    # fork после того, как faiss поднял потоки OpenMP в основном процессе, может повесить воркер
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class SemanticRetrieval:
+    """
+    Локальный RAG: документ режется на чанки, эмбеддится CPU-моделью в пуле процессов
+    и кладётся в персональный FAISS-индекс пользователя на диске.
+    В промпт попадают только top-k релевантных запросу чанков.
+    В памяти держим ограниченное число индексов (LRU), остальные читаются с диска через mmap.
+    """
+
+    def __init__(self, index_dir: str = RETRIEVAL_INDEX_DIR, workers: int = RETRIEVAL_WORKERS,
+                 max_loaded: int = RETRIEVAL_MAX_LOADED_USERS):
+        self.index_dir = index_dir
+        self.workers = workers
+        self.max_loaded = max_loaded
+        self._pool: ProcessPoolExecutor | None = None
+        self._loaded: OrderedDict[int, _UserIndex] = OrderedDict()
+        self._locks: dict[int, asyncio.Lock] = {}
+        os.makedirs(index_dir, exist_ok=True)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+        return self._pool
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._get_pool(), fn, *args)
+
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    # ---------- диск ----------
+    def _paths(self, user_id: int) -> tuple[str, str]:
+        base = os.path.join(self.index_dir, str(user_id))
+        return base + ".faiss", base + ".jsonl"
+
+    def _read(self, user_id: int, writable: bool) -> _UserIndex | None:
+        index_path, chunks_path = self._paths(user_id)
+        if not os.path.exists(index_path):
+            return None
+        # для поиска достаточно mmap, для добавления векторов индекс нужен целиком в памяти
+        flags = 0 if writable else faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        index = faiss.read_index(index_path, flags)
+        with open(chunks_path, encoding="utf-8") as f:
+            chunks = [json.loads(line) for line in f]
+        return _UserIndex(index, chunks, writable)
+
+    def _write(self, user_id: int, user_index: _UserIndex, new_chunks: list[dict]) -> None:
+        index_path, chunks_path = self._paths(user_id)
+        faiss.write_index(user_index.index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        with open(chunks_path, "a", encoding="utf-8") as f:
+            for chunk in new_chunks:
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+
+    def _drop_files(self, user_id: int) -> None:
+        for path in self._paths(user_id):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def _get(self, user_id: int, writable: bool) -> _UserIndex | None:
+        user_index = self._loaded.get(user_id)
+        if user_index is None or (writable and not user_index.writable):
+            user_index = await asyncio.to_thread(self._read, user_id, writable)
+            if user_index is None:
+                return None
+            self._loaded[user_id] = user_index
+        self._loaded.move_to_end(user_id)
+        while len(self._loaded) > self.max_loaded:
+            self._loaded.popitem(last=False)
+        return user_index
+
+    # ---------- API ----------
+    async def index_document(self, user_id: int, doc_key: str, file_name: str, text: str) -> bool:
+        """
+        Добавляет документ в индекс пользователя (если его там ещё нет).
+        :return: True, если документ уже был проиндексирован раньше
+        """
+        async with self._lock(user_id):
+            user_index = await self._get(user_id, writable=True)
+            if user_index is not None and doc_key in user_index.doc_keys:
+                return True
+
+            chunks, vectors = await self._run(chunk_and_embed, text)
+            if not chunks:
+                return False
+
+            if user_index is not None and len(user_index.chunks) + len(chunks) > RETRIEVAL_MAX_CHUNKS_PER_USER:
+                # индекс разросся — начинаем заново, старые документы всё равно давно не нужны
+                await asyncio.to_thread(self._drop_files, user_id)
+                self._loaded.pop(user_id, None)
+                user_index = None
+            if user_index is None:
+                index = faiss.IndexFlatIP(vectors.shape[1])
+                user_index = _UserIndex(index, [], writable=True)
+                self._loaded[user_id] = user_index
+
+            new_chunks = [{"doc": doc_key, "file": file_name, "pos": pos, "text": chunk}
+                          for pos, chunk in enumerate(chunks)]
+            user_index.index.add(vectors)
+            user_index.chunks.extend(new_chunks)
+            user_index.doc_keys.add(doc_key)
+            await asyncio.to_thread(self._write, user_id, user_index, new_chunks)
+            return False
+
+    async def search(self, user_id: int, query: str, doc_keys: set[str] | None = None,
+                     k: int = TOP_K) -> list[RetrievedChunk]:
+        """top-k чанков пользователя по запросу; doc_keys ограничивает поиск конкретными документами"""
+        user_index = await self._get(user_id, writable=False)
+        if user_index is None or not user_index.chunks:
+            return []
+        query_vector = await self._run(embed_query, query)
+
+        params = None
+        if doc_keys is not None:
+            ids = np.array([i for i, chunk in enumerate(user_index.chunks) if chunk["doc"] in doc_keys], dtype="int64")
+            if not len(ids):
+                return []
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(ids))
+        scores, ids = await asyncio.to_thread(user_index.index.search, query_vector, k, params=params)
+
+        result = []
+        for score, chunk_id in zip(scores[0], ids[0]):
+            if chunk_id < 0:
+                continue
+            chunk = user_index.chunks[chunk_id]
+            result.append(RetrievedChunk(doc_key=chunk["doc"], file_name=chunk["file"], position=chunk["pos"],
+                                         text=chunk["text"], score=float(score)))
+        return result
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Нормированный эмбеддинг одной строки (для кешей с поиском по близости)"""
+        return (await self._run(embed_query, text))[0]
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+semantic_retrieval = SemanticRetrieval()
@@ -13,6 +13,7 @@ import aiohttp
 from dotenv import load_dotenv, find_dotenv
 
 from settings import logger
+from utils.resilience import CircuitBreaker, Outcome, get_guard, time_left
 
 
 load_dotenv(find_dotenv())
@@ -39,6 +40,23 @@ class ContentPolicyError(KieSora2Error):
     pass
 
 
+sora_guard = get_guard("sora", breaker=CircuitBreaker("sora", reset_timeout=60.0), rate_limit_delay=5.0)
+
+
+def _classify_sora_error(error: BaseException) -> Outcome:
+    if isinstance(error, RateLimitError):
+        return Outcome.RATE_LIMITED
+    if isinstance(error, (InsufficientCreditsError, ContentPolicyError)):
+        return Outcome.FATAL
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError)):
+        return Outcome.RETRY
+    if isinstance(error, KieSora2Error):
+        # 455 — техобслуживание, 5xx — сбой на их стороне; 401/404/422 повторять бессмысленно
+        status = getattr(error, "status", None)
+        return Outcome.RETRY if status is None or status >= 455 else Outcome.FATAL
+    return Outcome.FATAL
+
+
 class KieSora2Client:
     """Асинхронный клиент для работы с Sora 2 API"""
 
@@ -106,9 +124,26 @@ class KieSora2Client:
 
         # Проверка на content policy ошибки
         if "public_error" in error_msg or "policy" in error_msg.lower():
-            raise ContentPolicyError(f"Нарушение content policy: {error_msg}")
+            error = ContentPolicyError(f"Нарушение content policy: {error_msg}")
+        else:
+            error = error_mapping.get(status, KieSora2Error(f"HTTP {status}: {error_msg}"))
+        error.status = status
+        raise error
 
-        raise error_mapping.get(status, KieSora2Error(f"HTTP {status}: {error_msg}"))
+    async def _request_once(self, method: str, url: str, **kwargs) -> dict:
+        # Проверяем сессию перед каждым запросом
+        await self._ensure_session()
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                data = await response.json()
+                if response.status == 200:
+                    return data
+                self._handle_error(response.status, data)
+        except aiohttp.ClientError as e:
+            # При ошибке соединения - пересоздаем сессию
+            logger.warning(f"Ошибка соединения: {e}, пересоздание сессии")
+            await self.close()
+            raise
 
     async def _request_with_retry(
             self,
@@ -116,56 +151,14 @@ class KieSora2Client:
             url: str,
             **kwargs
     ) -> dict:
-        """Выполнение запроса с retry логикой"""
-        for attempt in range(self.max_retries):
-            try:
-                # Проверяем сессию перед каждым запросом
-                await self._ensure_session()
-
-                async with self.session.request(method, url, **kwargs) as response:
-                    data = await response.json()
-
-                    # Успешный запрос
-                    if response.status == 200:
-                        return data
-
-                    # Rate limit - exponential backoff
-                    if response.status == 429:
-                        wait_time = 2 ** attempt * 5
-                        logger.warning(f"Rate limit, ожидание {wait_time}с (попытка {attempt + 1}/{self.max_retries})")
-                        await asyncio.sleep(wait_time)
-                        continue
-
-                    # Остальные ошибки
-                    self._handle_error(response.status, data)
-
-            except asyncio.TimeoutError:
-                if attempt == self.max_retries - 1:
-                    raise KieSora2Error("Превышен таймаут запроса")
-                logger.warning(f"Таймаут, повтор попытки {attempt + 1}/{self.max_retries}")
-                await asyncio.sleep(5)
-
-            except aiohttp.ClientError as e:
-                if attempt == self.max_retries - 1:
-                    raise KieSora2Error(f"Ошибка соединения: {e}")
-
-                # При ошибке соединения - пересоздаем сессию
-                logger.warning(
-                    f"Ошибка соединения: {e}, пересоздание сессии (попытка {attempt + 1}/{self.max_retries})")
-                await self.close()
-                await asyncio.sleep(2 ** attempt)
-                continue
-
-            except (InsufficientCreditsError, ContentPolicyError):
-                raise  # Не ретраим эти ошибки
-
-            except KieSora2Error:
-                if attempt == self.max_retries - 1:
-                    raise
-                logger.warning(f"Повтор попытки {attempt + 1}/{self.max_retries}")
-                await asyncio.sleep(2 ** attempt)
-
-        raise KieSora2Error("Превышено максимальное количество попыток")
+        """Выполнение запроса через общий ProviderGuard: повторы из бюджета, автомат защиты, дедлайн"""
+        try:
+            return await sora_guard.call(lambda: self._request_once(method, url, **kwargs),
+                                         classify=_classify_sora_error, max_attempts=self.max_retries)
+        except asyncio.TimeoutError:
+            raise KieSora2Error("Превышен таймаут запроса")
+        except aiohttp.ClientError as e:
+            raise KieSora2Error(f"Ошибка соединения: {e}")
 
     async def _create_task(self, endpoint: str, payload: dict) -> str:
         """Создание задачи генерации"""
@@ -184,18 +177,31 @@ class KieSora2Client:
     async def _poll_task_status(self, task_id: str) -> str | list[str]:
         """Polling статуса задачи до завершения"""
         url = f"{self.BASE_URL}/jobs/recordInfo"
-        start_time = asyncio.get_event_loop().time()
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        remaining = time_left()
+        deadline = start_time + (self.max_poll_time if remaining is None else min(self.max_poll_time, remaining))
 
         IN_PROGRESS = {"waiting", "wait", "queue", "queueing", "processing", "generating", "pending"}
         DONE_OK = {"success"}
         DONE_FAIL = {"fail", "failed", "error", "timeout", "canceled"}
 
         while True:
-            elapsed = asyncio.get_event_loop().time() - start_time
-            if elapsed > self.max_poll_time:
+            elapsed = loop.time() - start_time
+            if loop.time() > deadline:
                 raise KieSora2Error(f"Таймаут ожидания генерации ({self.max_poll_time}с)")
 
-            data = await self._request_with_retry("GET", url, params={"taskId": task_id})
+            # опрос — не новый вызов провайдера: sora_guard охраняет только создание задачи,
+            # опрос ограничивает дедлайн. Временный сбой опроса — просто следующий опрос
+            try:
+                data = await asyncio.wait_for(self._request_once("GET", url, params={"taskId": task_id}),
+                                              timeout=max(0.0, deadline - loop.time()))
+            except Exception as e:
+                if _classify_sora_error(e) is Outcome.FATAL:
+                    raise
+                logger.warning(f"Сбой опроса задачи {task_id}: {e!r}")
+                await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - loop.time())))
+                continue
             if data.get("code") != 200:
                 raise KieSora2Error(f"Ошибка проверки статуса: {data.get('msg')}")
 
@@ -205,7 +211,7 @@ class KieSora2Client:
 
             if state in IN_PROGRESS:
                 logger.info(f"Генерация в процессе... ({int(elapsed)}с) state={raw_state}")
-                await asyncio.sleep(self.poll_interval)
+                await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - loop.time())))
                 continue
 
             if state in DONE_OK:
@@ -232,7 +238,7 @@ class KieSora2Client:
 
             # неизвестное состояние — трактуем как промежуточное, но предупредим
             logger.warning(f"Неизвестный статус от API: {raw_state} — считаю как IN_PROGRESS")
-            await asyncio.sleep(self.poll_interval)
+            await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - loop.time())))
 
     async def text_to_video(
             self,
@@ -0,0 +1,362 @@
+import asyncio
+import itertools
+import time
+from collections import defaultdict
+from enum import IntEnum
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError
+
+# telegram_sender.py — единая очередь исходящих сообщений Telegram
+
+GLOBAL_RATE_PER_SEC = 30          # общий лимит Telegram на бота
+BACKGROUND_RATE_PER_SEC = 25      # фоновые рассылки не выбирают весь лимит — запас под ответы
+CHAT_RATE_PER_SEC = 1             # лимит на один чат
+CHAT_BURST = 3                    # короткий всплеск в один чат (разбитый на части ответ)
+WORKERS_COUNT = 16
+MAX_SEND_ATTEMPTS = 4
+IDLE_CHAT_BUCKET_TTL = 300        # через сколько секунд простоя чистим бакет чата
+
+
+class SendPriority(IntEnum):
+    """Полосы приоритета: чем меньше число, тем раньше уйдёт сообщение"""
+    INTERACTIVE = 0
+    REMINDER = 1
+    BROADCAST = 2
+
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def block_for(self, seconds: float) -> None:
+        """Блокирует выдачу токенов (например, после RetryAfter от Telegram)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def try_acquire(self) -> float:
+        """
+        Берёт токен без ожидания: 0 — токен взят, иначе сколько секунд ждать следующего.
+        Для бакетов чатов — воркер не спит на одном чате, пока остальные ждут в очереди.
+        """
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _SendJob:
+    __slots__ = ("chat_id", "call", "priority", "future", "enqueued_at", "attempts", "seq", "not_before")
+
+    def __init__(self, chat_id: int | str, call: Callable[[], Awaitable[Any]], priority: SendPriority,
+                 future: asyncio.Future, seq: int):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.seq = seq                # при возврате в очередь задание сохраняет место среди сообщений чата
+        self.not_before = 0.0
+
+
+class TelegramSender:
+    """
+    Центральный диспетчер исходящих запросов одного бота.
+    Все отправки встают в приоритетную очередь, воркеры разбирают её,
+    соблюдая глобальный лимит и лимит на чат, и сами переживают RetryAfter.
+    Если чат упёрся в лимит или получил RetryAfter, задание откладывается с отметкой not_before
+    и возвращается в очередь по таймеру — воркер за это время разбирает другие чаты.
+    Пока в чате есть отложенное задание, более поздние сообщения этого чата ждут рядом с ним,
+    а не обгоняют его: части одного ответа приходят в исходном порядке.
+    """
+
+    def __init__(self, bot: Bot, workers_count: int = WORKERS_COUNT):
+        self.bot = bot
+        self.workers_count = workers_count
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._global_bucket = TokenBucket(GLOBAL_RATE_PER_SEC)
+        self._background_bucket = TokenBucket(BACKGROUND_RATE_PER_SEC)
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._chat_last_used: dict[int | str, float] = {}
+        self._deferred: dict[_SendJob, asyncio.TimerHandle] = {}
+        self._chat_blockers: dict[int | str, set[_SendJob]] = {}      # отложенные и ещё не отправленные задания чата
+        self._held: dict[int | str, list[_SendJob]] = {}              # более поздние задания, ждущие их
+        self.metrics: dict[str, Any] = {
+            "sent": defaultdict(int),
+            "failed": defaultdict(int),
+            "retry_after": 0,
+            "deferred": 0,
+            "held_back": 0,
+            "queue_wait_total": defaultdict(float),
+            "queue_wait_max": defaultdict(float),
+        }
+
+    # ---------- жизненный цикл ----------
+    def _ensure_started(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < self.workers_count:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def close(self) -> None:
+        """Дожидается отправки очереди (и отложенных заданий) и останавливает воркеры"""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._drain(), timeout=10)
+            except asyncio.TimeoutError:
+                pass
+        for job, handle in list(self._deferred.items()):
+            handle.cancel()
+            if not job.future.done():
+                job.future.cancel()
+        self._deferred.clear()
+        for jobs in self._held.values():
+            for job in jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._held.clear()
+        self._chat_blockers.clear()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _drain(self) -> None:
+        while True:
+            await self._queue.join()
+            if not self._deferred and not self._held:
+                return
+            await asyncio.sleep(0.1)
+
+    # ---------- публичный API ----------
+    async def send(self, chat_id: int | str, method: Callable[..., Awaitable[Any]], /, *args,
+                   priority: SendPriority = SendPriority.INTERACTIVE, **kwargs) -> Any:
+        """
+        Ставит вызов метода бота (или Message.answer/reply) в очередь и возвращает его результат.
+        Ошибки Telegram (кроме RetryAfter) пробрасываются вызывающему коду.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        job = _SendJob(chat_id, lambda: method(*args, **kwargs), priority, future, next(self._seq))
+        await self._queue.put((int(priority), job.seq, job))
+        return await future
+
+    async def send_message(self, chat_id: int | str, text: str, *,
+                           priority: SendPriority = SendPriority.INTERACTIVE, **kwargs):
+        return await self.send(chat_id, self.bot.send_message, chat_id=chat_id, text=text,
+                               priority=priority, **kwargs)
+
+    async def send_photo(self, chat_id: int | str, photo, *,
+                         priority: SendPriority = SendPriority.INTERACTIVE, **kwargs):
+        return await self.send(chat_id, self.bot.send_photo, chat_id=chat_id, photo=photo,
+                               priority=priority, **kwargs)
+
+    async def send_document(self, chat_id: int | str, document, *,
+                            priority: SendPriority = SendPriority.INTERACTIVE, **kwargs):
+        return await self.send(chat_id, self.bot.send_document, chat_id=chat_id, document=document,
+                               priority=priority, **kwargs)
+
+    def stats(self) -> dict:
+        """Снимок метрик для логов и админки"""
+        sent = dict(self.metrics["sent"])
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "deferred_now": len(self._deferred),
+            "held_now": sum(len(jobs) for jobs in self._held.values()),
+            "sent": sent,
+            "failed": dict(self.metrics["failed"]),
+            "retry_after": self.metrics["retry_after"],
+            "deferred": self.metrics["deferred"],
+            "held_back": self.metrics["held_back"],
+            "avg_queue_wait": {
+                lane: round(self.metrics["queue_wait_total"][lane] / count, 3)
+                for lane, count in sent.items() if count
+            },
+            "max_queue_wait": {lane: round(v, 3) for lane, v in self.metrics["queue_wait_max"].items()},
+        }
+
+    # ---------- внутренняя кухня ----------
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        now = time.monotonic()
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10_000:
+                self._drop_idle_chat_buckets(now)
+            bucket = self._chat_buckets[chat_id] = TokenBucket(CHAT_RATE_PER_SEC, CHAT_BURST)
+        self._chat_last_used[chat_id] = now
+        return bucket
+
+    def _drop_idle_chat_buckets(self, now: float) -> None:
+        for chat_id, last_used in list(self._chat_last_used.items()):
+            if now - last_used > IDLE_CHAT_BUCKET_TTL:
+                self._chat_buckets.pop(chat_id, None)
+                self._chat_last_used.pop(chat_id, None)
+
+    def _defer(self, job: _SendJob, delay: float) -> None:
+        """Откладывает задание на delay секунд, не занимая воркер; до отправки оно держит очередь своего чата"""
+        loop = asyncio.get_running_loop()
+        job.not_before = time.monotonic() + delay
+        self.metrics["deferred"] += 1
+        self._chat_blockers.setdefault(job.chat_id, set()).add(job)
+        self._deferred[job] = loop.call_later(delay, self._requeue, job)
+
+    def _requeue(self, job: _SendJob) -> None:
+        self._deferred.pop(job, None)
+        if job.future.done():
+            # вызывающий код перестал ждать — отправлять уже некому
+            self._settle(job)
+            return
+        self._queue.put_nowait((int(job.priority), job.seq, job))
+
+    def _hold_if_behind(self, job: _SendJob) -> bool:
+        """Ставит задание в ожидание, если в его чате есть более раннее отложенное"""
+        blockers = self._chat_blockers.get(job.chat_id)
+        if not blockers or min(b.seq for b in blockers) >= job.seq:
+            return False
+        self.metrics["held_back"] += 1
+        self._held.setdefault(job.chat_id, []).append(job)
+        return True
+
+    def _settle(self, job: _SendJob) -> None:
+        """Задание завершено (отправлено, упало или отменено): отпускаем ждавшие его сообщения чата"""
+        blockers = self._chat_blockers.get(job.chat_id)
+        if blockers is None:
+            return
+        blockers.discard(job)
+        first_blocked = min((b.seq for b in blockers), default=None)
+        if first_blocked is None:
+            del self._chat_blockers[job.chat_id]
+        held = self._held.pop(job.chat_id, [])
+        still_held = []
+        for waiting in held:
+            if first_blocked is not None and waiting.seq > first_blocked:
+                still_held.append(waiting)
+            else:
+                self._queue.put_nowait((int(waiting.priority), waiting.seq, waiting))
+        if still_held:
+            self._held[job.chat_id] = still_held
+
+    async def _worker(self) -> None:
+        from settings import logger
+        while True:
+            _, _, job = await self._queue.get()
+            finished = True
+            try:
+                finished = await self._execute(job)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception:
+                logger.exception("Ошибка в воркере TelegramSender")
+            finally:
+                if finished:
+                    self._settle(job)
+                self._queue.task_done()
+
+    async def _execute(self, job: _SendJob) -> bool:
+        """:return: False, если задание отложено или ждёт более раннее сообщение своего чата"""
+        if job.future.cancelled():
+            # вызывающий код отменил ожидание, пока задание стояло в очереди
+            return True
+        if self._hold_if_behind(job):
+            return False
+        lane = job.priority.name.lower()
+        chat_bucket = self._chat_bucket(job.chat_id)
+        wait_chat = chat_bucket.try_acquire()
+        if wait_chat > 0:
+            self._defer(job, wait_chat)
+            return False
+        job.attempts += 1
+        if job.priority != SendPriority.INTERACTIVE:
+            await self._background_bucket.acquire()
+        await self._global_bucket.acquire()
+        if job.attempts == 1:
+            wait = time.monotonic() - job.enqueued_at
+            self.metrics["queue_wait_total"][lane] += wait
+            self.metrics["queue_wait_max"][lane] = max(self.metrics["queue_wait_max"][lane], wait)
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            self.metrics["retry_after"] += 1
+            # Telegram сам говорит, сколько ждать: тормозим и этот чат, и весь бот
+            chat_bucket.block_for(e.retry_after)
+            self._global_bucket.block_for(min(e.retry_after, 5))
+            if job.attempts < MAX_SEND_ATTEMPTS:
+                self._defer(job, e.retry_after)
+                return False
+            self._fail(job, lane, e)
+            return True
+        except TelegramNetworkError as e:
+            if job.attempts < MAX_SEND_ATTEMPTS:
+                self._defer(job, job.attempts)
+                return False
+            self._fail(job, lane, e)
+            return True
+        except Exception as e:
+            self._fail(job, lane, e)
+            return True
+        self.metrics["sent"][lane] += 1
+        if not job.future.done():
+            job.future.set_result(result)
+        return True
+
+    def _fail(self, job: _SendJob, lane: str, error: Exception) -> None:
+        self.metrics["failed"][lane] += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+
+_senders: dict[int, TelegramSender] = {}
+
+
+def get_sender(bot: Bot) -> TelegramSender:
+    """Возвращает диспетчер для конкретного бота (лимиты Telegram считаются на токен)"""
+    sender = _senders.get(id(bot))
+    if sender is None:
+        sender = _senders[id(bot)] = TelegramSender(bot)
+    return sender
+
+
+async def close_senders() -> None:
+    from settings import logger
+    for sender in list(_senders.values()):
+        try:
+            logger.info(f"TelegramSender stats: {sender.stats()}")
+            await sender.close()
+        except Exception:
+            logger.exception("Ошибка при остановке TelegramSender")
+    _senders.clear()
@@ -0,0 +1,215 @@
+import asyncio
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+import numpy as np
+
+# tool_cache.py — кеш результатов детерминированных инструментов (веб-поиск и т.п.) и single-flight
+
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """«Какая погода в Москве?!» и «какая  погода в москве» — один и тот же ключ"""
+    query = unicodedata.normalize("NFKC", query).lower().replace("ё", "е")
+    query = _PUNCT_RE.sub(" ", query)
+    return _SPACES_RE.sub(" ", query).strip()
+
+
+class LeaderCancelled(Exception):
+    """Ведущий вызов SingleFlight отменён до результата — ждущие повторяют работу сами"""
+
+
+class SingleFlight:
+    """
+    Схлопывает одинаковые одновременные вызовы: первый выполняет работу,
+    остальные с тем же ключом ждут его результат (или его исключение).
+    Отмена первого (пользователь ушёл, хендлер отменён) ждущих не отменяет:
+    один из них становится новым ведущим и выполняет работу, остальные ждут уже его.
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.takeovers = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    def snapshot(self) -> dict:
+        """leaders — реальные вызовы, coalesced — сэкономленные, takeovers — перехваты после отмены ведущего"""
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "takeovers": self.takeovers,
+                "in_flight": len(self._in_flight)}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            while future is not None:
+                try:
+                    return await asyncio.shield(future)
+                except LeaderCancelled:
+                    # ведущий уже снят с _in_flight: первый проснувшийся займёт его место
+                    future = self._in_flight.get(key)
+            self.takeovers += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.leaders += 1
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            future.set_exception(LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # исключение уже доставлено ждущим; гасим предупреждение «never retrieved»
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._in_flight.pop(key, None)
+
+
+class _Entry:
+    __slots__ = ("value", "created_at", "latency", "vector")
+
+    def __init__(self, value: Any, latency: float, vector: np.ndarray | None):
+        self.value = value
+        self.created_at = time.monotonic()
+        self.latency = latency
+        self.vector = vector
+
+
+class ToolResultCache:
+    """
+    Кеш ответов инструмента по нормализованному запросу: точное совпадение,
+    а при заданном embedder — ещё и совпадение по косинусной близости эмбеддингов.
+    Ограничен по TTL и количеству записей; одинаковые запросы в полёте схлопываются.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int,
+                 embedder: Callable[[str], Awaitable[np.ndarray]] | None = None,
+                 similarity_threshold: float = 0.95):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._matrix: tuple[list[str], np.ndarray] | None = None
+        self._single_flight = SingleFlight()
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "coalesced": 0, "misses": 0, "errors": 0}
+        self.saved_seconds = 0.0
+
+    # ---------- хранилище ----------
+    def _get_fresh(self, key: str) -> _Entry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: str) -> None:
+        if self._entries.pop(key, None) is not None:
+            self._matrix = None
+
+    def _store(self, key: str, value: Any, latency: float, vector: np.ndarray | None) -> None:
+        self._entries[key] = _Entry(value, latency, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def _find_similar(self, vector: np.ndarray) -> tuple[str, _Entry] | None:
+        if self._matrix is None:
+            keys = [key for key, entry in self._entries.items() if entry.vector is not None]
+            if not keys:
+                return None
+            self._matrix = (keys, np.stack([self._entries[key].vector for key in keys]))
+        keys, matrix = self._matrix
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        entry = self._get_fresh(keys[best])
+        return (keys[best], entry) if entry is not None else None
+
+    async def _embed(self, key: str) -> np.ndarray | None:
+        if self.embedder is None:
+            return None
+        try:
+            return np.asarray(await self.embedder(key), dtype="float32").reshape(-1)
+        except Exception:
+            # эмбеддинги — только оптимизация, без них работаем по точному совпадению
+            return None
+
+    # ---------- API ----------
+    async def get_or_compute(self, query: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        key = normalize_query(query)
+        entry = self._get_fresh(key)
+        if entry is not None:
+            self.stats["exact_hits"] += 1
+            self.saved_seconds += entry.latency
+            return entry.value
+
+        if self._single_flight.in_flight(key):
+            return await self._join(key)
+
+        vector = await self._embed(key)
+        if self._single_flight.in_flight(key):
+            # пока считали эмбеддинг, такой же запрос уже ушёл в инструмент
+            return await self._join(key)
+        if vector is not None:
+            similar = self._find_similar(vector)
+            if similar is not None:
+                self.stats["similar_hits"] += 1
+                self.saved_seconds += similar[1].latency
+                return similar[1].value
+
+        async def _compute_and_store():
+            started = time.perf_counter()
+            value = await compute()
+            if value:
+                self._store(key, value, time.perf_counter() - started, vector)
+            return value
+
+        self.stats["misses"] += 1
+        try:
+            return await self._single_flight.run(key, _compute_and_store)
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+
+    async def _join(self, key: str) -> Any:
+        self.stats["coalesced"] += 1
+        value = await self._single_flight.run(key, None)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.saved_seconds += entry.latency
+        return value
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats["exact_hits"] + self.stats["similar_hits"] + self.stats["coalesced"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "hit_rate": round(self.hit_rate, 3),
+            "saved_seconds": round(self.saved_seconds, 1),
+        }
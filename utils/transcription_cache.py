@@ -0,0 +1,93 @@
+import datetime
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from db.repository import voice_transcriptions_repository
+from utils.tool_cache import SingleFlight
+
+# transcription_cache.py — расшифровки голосовых по file_unique_id Telegram
+#
+# Пересланное или повторно отправленное голосовое приходит с тем же file_unique_id —
+# его текст берём из памяти или из таблицы voice_transcriptions, не обращаясь к Whisper.
+# Одновременные расшифровки одного и того же файла схлопываются в один запрос.
+
+MEMORY_MAX_CHARS = int(os.getenv("TRANSCRIPTION_CACHE_MEMORY_CHARS", "5000000"))
+MAX_TEXT_CHARS = 50_000              # больше — это не голосовое, а лекция; в кеш не кладём
+RETENTION_DAYS = int(os.getenv("TRANSCRIPTION_CACHE_DAYS", "30"))
+
+
+class TranscriptionCache:
+    """Текст голосового по (file_unique_id, язык): LRU в памяти с лимитом по символам + таблица в Postgres"""
+
+    def __init__(self, memory_max_chars: int = MEMORY_MAX_CHARS, retention_days: int = RETENTION_DAYS):
+        self.memory_max_chars = memory_max_chars
+        self.retention_days = retention_days
+        self._memory: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._memory_chars = 0
+        self._single_flight = SingleFlight()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "seconds_saved": 0, "pruned": 0}
+
+    async def get_or_transcribe(self, file_unique_id: str | None, language: str,
+                                transcribe: Callable[[], Awaitable[str]], *, duration: int | None = None) -> str:
+        """Готовая расшифровка или результат transcribe(), который тут же запоминается"""
+        if not file_unique_id:
+            return await transcribe()
+        key = (file_unique_id, language)
+        text = self._memory.get(key)
+        if text is not None:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            self.stats["seconds_saved"] += duration or 0
+            return text
+        return await self._single_flight.run(key, lambda: self._resolve(key, transcribe, duration))
+
+    async def _resolve(self, key: tuple[str, str], transcribe: Callable[[], Awaitable[str]],
+                       duration: int | None) -> str:
+        from settings import logger
+        try:
+            row = await voice_transcriptions_repository.get_transcription(*key)
+        except Exception as e:
+            # без базы просто распознаём заново — кеш не должен ломать голосовые
+            logger.log("GPT_ERROR", f"voice_transcriptions недоступна: {e!r}")
+            row = None
+        if row is not None:
+            self.stats["db_hits"] += 1
+            self.stats["seconds_saved"] += duration or 0
+            self._remember(key, row.text)
+            return row.text
+
+        self.stats["misses"] += 1
+        text = await transcribe()
+        # пустой текст — скорее сбой распознавания, чем тишина; пусть следующая попытка распознает заново
+        if text and text.strip() and len(text) <= MAX_TEXT_CHARS:
+            self._remember(key, text)
+            try:
+                await voice_transcriptions_repository.save_transcription(*key, text=text, duration=duration)
+            except Exception as e:
+                logger.log("GPT_ERROR", f"Не удалось сохранить расшифровку {key[0]}: {e!r}")
+        return text
+
+    def _remember(self, key: tuple[str, str], text: str) -> None:
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_chars -= len(old)
+        self._memory[key] = text
+        self._memory_chars += len(text)
+        while self._memory_chars > self.memory_max_chars and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_chars -= len(evicted)
+
+    async def prune(self) -> int:
+        """Удаляет из таблицы расшифровки, которые не пригодились дольше retention_days"""
+        removed = await voice_transcriptions_repository.delete_unused_before(
+            datetime.datetime.now() - datetime.timedelta(days=self.retention_days))
+        self.stats["pruned"] += removed
+        return removed
+
+    def snapshot(self) -> dict:
+        return {**self.stats, **self._single_flight.snapshot(), "memory_items": len(self._memory),
+                "memory_chars": self._memory_chars}
+
+
+transcription_cache = TranscriptionCache()
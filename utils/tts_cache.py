@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+
+from utils.file_cache import TelegramFileCache
+
+# tts_cache.py — кеш озвучки по содержимому: хеш (модель, голос, инструкция, формат, текст)
+#
+# Короткие частые ответы и шаблонные тексты ошибок озвучиваются один раз: байты лежат в памяти
+# и на диске (TTS_CACHE_DIR). file_id уже отправленной фразы хранит media_registry (ключ "tts:<speech_key>") —
+# по нему голосовое уходит без синтеза и без загрузки.
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR")                     # не задан — дисковый уровень выключен
+MEMORY_MAX_BYTES = int(os.getenv("TTS_CACHE_MEMORY_MB", "32")) * 1024 * 1024
+DISK_MAX_BYTES = int(os.getenv("TTS_CACHE_DISK_MB", "512")) * 1024 * 1024
+MAX_CACHED_TEXT_CHARS = 500          # длинные ответы уникальны — кешировать их нет смысла
+
+
+def speech_key(text: str, *, model: str, voice: str, instructions: str, response_format: str) -> str:
+    payload = json.dumps([model, voice, instructions, response_format, text.strip()], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """Байты озвучки по ключу speech_key — в памяти и на диске"""
+
+    def __init__(self, disk_dir: str | None = TTS_CACHE_DIR, memory_max_bytes: int = MEMORY_MAX_BYTES,
+                 disk_max_bytes: int = DISK_MAX_BYTES):
+        self._audio = TelegramFileCache(memory_max_bytes=memory_max_bytes, disk_dir=disk_dir,
+                                        disk_max_bytes=disk_max_bytes)
+        self.stats = {"audio_hits": 0, "stored": 0}
+
+    @staticmethod
+    def cacheable(text: str) -> bool:
+        return len(text) <= MAX_CACHED_TEXT_CHARS
+
+    async def get_audio(self, key: str) -> bytes | None:
+        data = await self._audio.get(key)
+        if data is not None:
+            self.stats["audio_hits"] += 1
+        return data
+
+    async def put_audio(self, key: str, data: bytes) -> None:
+        await self._audio.put(key, data)
+        self.stats["stored"] += 1
+
+    def snapshot(self) -> dict:
+        audio = self._audio.snapshot()
+        return {**self.stats, "memory_bytes": audio["memory_bytes"], "disk_bytes": audio["disk_bytes"]}
+
+
+tts_cache = TTSCache()
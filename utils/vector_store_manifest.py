@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import io
+from dataclasses import dataclass
+from typing import Sequence
+
+from openai import AsyncOpenAI, NotFoundError
+
+from db.repository import vector_store_files_repository
+from utils.openai_file_cache import openai_file_cache
+from utils.run_tracker import backoff_delays
+
+# vector_store_manifest.py — локальный манифест vector store'ов (таблица vector_store_files)
+#
+# Для каждого хранилища помним, какие file_id в нём лежат и хеш их содержимого.
+# Повторно присланный тот же документ не загружается в Files API и не индексируется заново,
+# а разница между нужным и текущим набором файлов уходит в API одним file_batches.
+
+BATCH_WAIT_MAX_DELAY_SEC = 4.0
+
+
+@dataclass(slots=True)
+class DocumentFile:
+    """Документ пользователя, уже лежащий в Files API"""
+    content_hash: str
+    file_id: str
+    file_name: str
+    reused: bool = False
+
+
+def content_hash(buf: io.BytesIO) -> str:
+    with buf.getbuffer() as view:
+        return hashlib.sha256(view).hexdigest()
+
+
+class VectorStoreManifest:
+    """Загрузка документов с дедупликацией по хешу и инкрементальная синхронизация vector store"""
+
+    def __init__(self):
+        self.stats = {"uploads": 0, "reused_uploads": 0, "added": 0, "removed": 0, "unchanged_syncs": 0,
+                      "batches": 0, "list_calls": 0}
+
+    async def upload_documents(self, client: AsyncOpenAI, *, user_id: int, scope: str,
+                               document_bytes: Sequence[tuple[io.BytesIO, str, str]]) -> list[DocumentFile]:
+        """Загружает в Files API только те документы, которых ещё нет в хранилище этого scope"""
+        known = {row.content_hash: row.file_id
+                 for row in await vector_store_files_repository.get_files(user_id=user_id, scope=scope)
+                 if row.content_hash}
+
+        async def one(doc_io: io.BytesIO, file_name: str, mime_ext: str) -> DocumentFile:
+            digest = content_hash(doc_io)
+            if digest in known:
+                self.stats["reused_uploads"] += 1
+                return DocumentFile(digest, known[digest], file_name, reused=True)
+            # в другом хранилище такой файл мог уже быть — тогда Files API его не получит повторно
+            file_id = await openai_file_cache.upload(client, doc_io, filename=file_name, purpose="assistants",
+                                                     mime=f"application/{mime_ext}" if mime_ext else None)
+            self.stats["uploads"] += 1
+            return DocumentFile(digest, file_id, file_name)
+
+        return list(await asyncio.gather(*(one(*doc) for doc in document_bytes)))
+
+    async def sync(self, client: AsyncOpenAI, *, user_id: int, scope: str, vector_store_id: str,
+                   documents: Sequence[DocumentFile]) -> None:
+        """
+        Приводит хранилище к набору documents: лишние файлы убираем, недостающие добавляем
+        одним file_batches и ждём индексации с растущей паузой. Если всё уже на месте — ни одного запроса в API.
+        NotFoundError (хранилище истекло) пробрасывается вызывающему, манифест хранилища при этом чистится.
+        """
+        rows = [row for row in await vector_store_files_repository.get_files(user_id=user_id, scope=scope)
+                if row.vector_store_id == vector_store_id]
+        if rows:
+            current = {row.file_id for row in rows}
+        else:
+            # хранилище создано до манифеста или пустое — один раз узнаём его содержимое у API
+            self.stats["list_calls"] += 1
+            current = {f.id async for f in client.vector_stores.files.list(vector_store_id=vector_store_id)}
+        desired = {doc.file_id: doc for doc in documents}
+        removed = current - desired.keys()
+        added = [doc for file_id, doc in desired.items() if file_id not in current]
+        if not removed and not added:
+            self.stats["unchanged_syncs"] += 1
+            return
+
+        try:
+            # удалять пачкой API не умеет — снимаем параллельно
+            await asyncio.gather(*(self._detach(client, vector_store_id, file_id) for file_id in removed))
+            indexed = await self._add_batch(client, vector_store_id, [doc.file_id for doc in added])
+        except NotFoundError:
+            await vector_store_files_repository.delete_store(vector_store_id=vector_store_id)
+            raise
+        self.stats["removed"] += len(removed)
+        if indexed:
+            self.stats["added"] += len(added)
+        # непроиндексированные файлы в манифест не пишем — в следующий раз добавим их снова
+        await vector_store_files_repository.apply_diff(
+            user_id=user_id, scope=scope, vector_store_id=vector_store_id, removed_file_ids=list(removed),
+            added=[{"file_id": doc.file_id, "content_hash": doc.content_hash, "file_name": doc.file_name}
+                   for doc in added] if indexed else [],
+        )
+
+    @staticmethod
+    async def _detach(client: AsyncOpenAI, vector_store_id: str, file_id: str) -> None:
+        try:
+            await client.vector_stores.files.delete(vector_store_id=vector_store_id, file_id=file_id)
+        except NotFoundError:
+            # файл уже убран из хранилища — манифест просто догоняет API
+            pass
+
+    async def _add_batch(self, client: AsyncOpenAI, vector_store_id: str, file_ids: list[str]) -> bool:
+        """:return: True, если батч проиндексирован"""
+        if not file_ids:
+            return True
+        from settings import logger
+        self.stats["batches"] += 1
+        batch = await client.vector_stores.file_batches.create(vector_store_id=vector_store_id, file_ids=file_ids)
+        # статус: "in_progress" -> "completed" | "failed" | "cancelled"
+        for delay in backoff_delays(initial=0.5, maximum=BATCH_WAIT_MAX_DELAY_SEC):
+            if batch.status != "in_progress":
+                break
+            await asyncio.sleep(delay)
+            batch = await client.vector_stores.file_batches.retrieve(vector_store_id=vector_store_id,
+                                                                     batch_id=batch.id)
+        if batch.status != "completed":
+            logger.log("GPT_ERROR", f"Vector store batch {batch.id} finished with status={batch.status}, "
+                                    f"file_counts={batch.file_counts}")
+            return False
+        return True
+
+    def snapshot(self) -> dict:
+        return dict(self.stats)
+
+
+vector_store_manifest = VectorStoreManifest()
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+from typing import Any, AsyncGenerator, Awaitable, Callable, TypeVar
+
+import aiohttp
+from aiogram.types import InputFile
+
+# video_relay.py — потоковая пересылка готовых видео от провайдера (Sora) в Telegram
+#
+# Видео не собирается в памяти: чанки фиксированного размера идут из ответа провайдера прямо
+# в тело multipart-загрузки Telegram. Буфер чтения aiohttp ограничен RELAY_CHUNK_SIZE, так что
+# на одну пересылку приходится порядка пары чанков. Одновременных пересылок не больше
+# RELAY_CONCURRENCY — десяток готовых видео разом не раздувает RSS.
+
+RELAY_CHUNK_SIZE = 256 * 1024
+RELAY_CONCURRENCY = int(os.getenv("VIDEO_RELAY_CONCURRENCY", "4"))
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024          # лимит Bot API на загрузку файла ботом
+CONNECT_TIMEOUT = 15
+READ_TIMEOUT = 60                             # между чанками, а не на всё видео
+VIDEO_UPLOAD_TIMEOUT = 600                    # request_timeout загрузки в Telegram
+PROGRESS_EDIT_SEC = 3.0
+
+T = TypeVar("T")
+
+
+class VideoTooLarge(Exception):
+    """Видео больше, чем бот может загрузить в Telegram, — отдаём ссылку"""
+
+    def __init__(self, url: str, size: int):
+        super().__init__(f"{url}: {size} bytes")
+        self.url = url
+        self.size = size
+
+
+class RelayInputFile(InputFile):
+    """Видео по URL провайдера, которое читается чанками прямо в загрузку Telegram"""
+
+    def __init__(self, url: str, relay: "VideoRelay", *, filename: str | None = None,
+                 on_progress: Callable[[int, int | None], None] | None = None):
+        super().__init__(filename=filename, chunk_size=RELAY_CHUNK_SIZE)
+        self.url = url
+        self.size: int | None = None
+        self._relay = relay
+        self._on_progress = on_progress
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        # при повторе отправки (сетевой сбой) aiogram снова вызывает read — видео перечитывается с начала
+        sent = 0
+        async for chunk in self._relay.stream(self.url):
+            sent += len(chunk)
+            if self._on_progress is not None:
+                self._on_progress(sent, self.size)
+            yield chunk
+
+
+class UploadProgress:
+    """
+    Сообщение «загружаю видео… N%»: появляется с первым чанком (если размер известен),
+    правится не чаще PROGRESS_EDIT_SEC и удаляется в конце. Отправка по file_id его не создаёт.
+    """
+
+    def __init__(self, bot, chat_id: int, text: str = "📤 Загружаю видео"):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self._message = None
+        self._edited_at = 0.0
+        self._task: asyncio.Task | None = None
+
+    def __call__(self, sent: int, total: int | None) -> None:
+        # вызывается из потока загрузки — не ждём Telegram, а правим в фоне, и не больше одной правки сразу
+        if not total or (self._task is not None and not self._task.done()):
+            return
+        now = time.monotonic()
+        if self._message is not None and now - self._edited_at < PROGRESS_EDIT_SEC:
+            return
+        self._edited_at = now
+        self._task = asyncio.create_task(self._show(f"{self.text}… {min(100, sent * 100 // total)}%"))
+
+    async def _show(self, text: str) -> None:
+        try:
+            if self._message is None:
+                self._message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+            else:
+                await self._message.edit_text(text)
+        except Exception:
+            pass
+
+    async def finish(self) -> None:
+        if self._task is not None and not self._task.done():
+            await asyncio.wait([self._task], timeout=PROGRESS_EDIT_SEC)
+        if self._message is not None:
+            try:
+                await self._message.delete()
+            except Exception:
+                pass
+
+
+class VideoRelay:
+    """Пересылка видео по URL в Telegram: ограничение параллельности, размер заранее, статистика"""
+
+    def __init__(self, concurrency: int = RELAY_CONCURRENCY):
+        self.concurrency = concurrency
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self.active = 0
+        self.stats = {"relayed": 0, "failed": 0, "too_large": 0, "bytes": 0, "max_active": 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            # read_bufsize ограничивает, сколько aiohttp держит непрочитанным на одну пересылку
+            self._session = aiohttp.ClientSession(
+                read_bufsize=RELAY_CHUNK_SIZE,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+            )
+        return self._session
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def input_file(self, url: str, *, filename: str | None = None,
+                   on_progress: Callable[[int, int | None], None] | None = None) -> RelayInputFile:
+        return RelayInputFile(url, self, filename=filename, on_progress=on_progress)
+
+    async def send(self, document: Any, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет call (отправку в Telegram) под лимитом одновременных пересылок.
+        Для RelayInputFile сначала узнаёт размер: больше MAX_UPLOAD_BYTES — VideoTooLarge.
+        file_id и прочее отправляется сразу, без лимита.
+        """
+        if not isinstance(document, RelayInputFile):
+            return await call()
+        async with self._get_semaphore():
+            document.size = await self._content_length(document.url)
+            if document.size and document.size > MAX_UPLOAD_BYTES:
+                self.stats["too_large"] += 1
+                raise VideoTooLarge(document.url, document.size)
+            self.active += 1
+            self.stats["max_active"] = max(self.stats["max_active"], self.active)
+            try:
+                result = await call()
+            except BaseException:
+                self.stats["failed"] += 1
+                raise
+            finally:
+                self.active -= 1
+            self.stats["relayed"] += 1
+            return result
+
+    async def stream(self, url: str) -> AsyncGenerator[bytes, None]:
+        async with self._get_session().get(url, raise_for_status=True) as response:
+            async for chunk in response.content.iter_chunked(RELAY_CHUNK_SIZE):
+                self.stats["bytes"] += len(chunk)
+                yield chunk
+
+    async def _content_length(self, url: str) -> int | None:
+        try:
+            async with self._get_session().head(url, allow_redirects=True) as response:
+                return response.content_length if response.status == 200 else None
+        except aiohttp.ClientError:
+            # HEAD не поддержан — размер узнаем только по факту загрузки
+            return None
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "active": self.active}
+
+
+video_relay = VideoRelay()
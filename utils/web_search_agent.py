@@ -4,6 +4,7 @@ from agents import set_default_openai_key, Agent, WebSearchTool, Runner
 from dotenv import find_dotenv, load_dotenv
 
 from utils.parse_gpt_text import sanitize_with_links
+from utils.tool_cache import ToolResultCache
 
 # 1. Настройка API-ключа
 load_dotenv(find_dotenv())
@@ -20,6 +21,29 @@ agent = Agent(
 
 )
 
-async def search_prompt(prompt: str) -> str:
+# 3. Кеш ответов: популярные запросы за последние минуты не гоняют агента повторно
+WEB_SEARCH_CACHE_TTL_SEC = int(os.getenv("WEB_SEARCH_CACHE_TTL_SEC", "600"))
+WEB_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("WEB_SEARCH_CACHE_MAX_ENTRIES", "2000"))
+# порог косинусной близости для «того же вопроса другими словами»; 0 — только точное совпадение
+WEB_SEARCH_CACHE_SIMILARITY = float(os.getenv("WEB_SEARCH_CACHE_SIMILARITY", "0"))
+
+
+def _build_cache() -> ToolResultCache:
+    embedder = None
+    if WEB_SEARCH_CACHE_SIMILARITY > 0:
+        from utils.semantic_retrieval import semantic_retrieval
+        embedder = semantic_retrieval.embed
+    return ToolResultCache("search_web", ttl=WEB_SEARCH_CACHE_TTL_SEC, max_entries=WEB_SEARCH_CACHE_MAX_ENTRIES,
+                           embedder=embedder, similarity_threshold=WEB_SEARCH_CACHE_SIMILARITY or 1.0)
+
+
+web_search_cache = _build_cache()
+
+
+async def _run_agent(prompt: str) -> str:
     result = await Runner.run(agent, prompt)
-    return result.final_output
\ No newline at end of file
+    return result.final_output
+
+
+async def search_prompt(prompt: str) -> str:
+    return await web_search_cache.get_or_compute(prompt, lambda: _run_agent(prompt))
\ No newline at end of file